@@ -10,6 +10,7 @@
 LOCAL_IP = MUST_BE_CONFIGURED
 STATIC_DIR = "/usr/share/clearwater/ellis/web-content"
 LOGS_DIR = "/var/log/ellis"
+EMAIL_SPOOL_DIR = "/var/spool/ellis"
 PID_FILE = "/var/run/ellis/ellis.pid"
 SIP_DIGEST_REALM = MUST_BE_CONFIGURED
 HOMESTEAD_URL = MUST_BE_CONFIGURED
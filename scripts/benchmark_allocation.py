@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# @file benchmark_allocation.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Benchmarks random number allocation against pools of different sizes,
+comparing numbers.allocate_number (which scans the rand_key index) with the
+ORDER BY RAND() query it replaced.
+
+The pools are created in a scratch database, which is dropped afterwards, so
+this never touches the real pool.  The scratch database must not already
+exist, and can't be the Ellis database.  Its tables are copied from the Ellis
+ones, so apply_db_updates.sql must have been run first.
+"""
+
+import re
+import sys
+import time
+import uuid
+
+from optparse import OptionParser
+
+from metaswitch.ellis import settings
+from metaswitch.ellis.data import numbers, connection
+
+BATCH_SIZE = 10000
+
+def allocate_number_order_by_rand(db_sess, user_id, pstn=False):
+    """The allocation query used before numbers had a rand_key"""
+    db_sess.execute(
+        """
+        SET @number_id := NULL;
+        UPDATE numbers
+        SET number_id = @number_id := number_id,
+            owner_id = :user_id,
+            gab_listed = 1
+        WHERE owner_id IS NULL
+        AND pstn = :pstn
+        ORDER BY RAND()
+        LIMIT 1;
+        """,
+        {
+            "user_id": user_id,
+            "pstn": 1 if pstn else 0
+        })
+    cursor = db_sess.execute("SELECT @number_id;")
+    number_id = cursor.fetchone()[0]
+    # As allocate_number does, so that the two are compared like for like
+    numbers._bump_gab_version(db_sess)
+    return number_id
+
+def fill_pool(db_sess, size):
+    db_sess.execute("TRUNCATE TABLE numbers;")
+    for start in xrange(0, size, BATCH_SIZE):
+        rows = ["('%s', 'sip:%d@benchmark.invalid', FALSE, FLOOR(RAND() * %d))" %
+                (uuid.uuid4(), 6500000000 + n, numbers.RAND_KEY_MAX + 1)
+                for n in xrange(start, min(start + BATCH_SIZE, size))]
+        db_sess.execute("INSERT INTO numbers (number_id, number, pstn, rand_key) VALUES " +
+                        ",".join(rows))
+    db_sess.commit()
+
+def time_allocations(db_sess, allocate, count):
+    """Returns the mean time in ms to allocate a number.  Each allocation is
+    rolled back, so the pool stays the same size."""
+    total = 0.0
+    for _ in xrange(count):
+        user_id = str(uuid.uuid4())
+        start = time.time()
+        allocate(db_sess, user_id)
+        total += time.time() - start
+        db_sess.rollback()
+    return total * 1000 / count
+
+def standalone(database, sizes, count):
+    # The scratch database is truncated and then dropped, so make very sure
+    # it's one this script created.
+    if not re.match(r"^\w+$", database):
+        sys.exit("Invalid database name %s" % database)
+    if database == settings.SQL_DB:
+        sys.exit("Refusing to use the Ellis database %s as the scratch database" % database)
+    connection.init_connection()
+    existing = connection.engine.execute(
+        "SELECT SCHEMA_NAME FROM information_schema.SCHEMATA WHERE SCHEMA_NAME = %s;",
+        database).fetchall()
+    if existing:
+        sys.exit("Database %s already exists - choose another scratch database" % database)
+
+    connection.engine.execute("CREATE DATABASE %s;" % database)
+    try:
+        # allocate_number bumps the global address book version, so the
+        # scratch database needs that too.
+        for table in ("numbers", "gab_version"):
+            connection.engine.execute("CREATE TABLE %s.%s LIKE %s.%s;" %
+                                      (database, table, settings.SQL_DB, table))
+        connection.engine.execute("INSERT INTO %s.gab_version SELECT * FROM %s.gab_version WHERE id = 0;" %
+                                  (database, settings.SQL_DB))
+
+        settings.SQL_DB = database
+        connection.init_connection()
+        db_sess = connection.Session()
+        try:
+            table_format = "{:>12}{:>24}{:>24}"
+            print table_format.format("Pool size", "ORDER BY RAND() (ms)", "rand_key (ms)")
+            for size in sizes:
+                fill_pool(db_sess, size)
+                print table_format.format(size,
+                                          "%.2f" % time_allocations(db_sess, allocate_number_order_by_rand, count),
+                                          "%.2f" % time_allocations(db_sess, numbers.allocate_number, count))
+        finally:
+            db_sess.close()
+    finally:
+        connection.engine.execute("DROP DATABASE %s;" % database)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-d",
+                      "--database",
+                      dest="database",
+                      default="ellis_benchmark",
+                      help="Scratch database to create the pools in (default: ellis_benchmark)")
+    parser.add_option("-s",
+                      "--sizes",
+                      dest="sizes",
+                      default="1000,10000,100000,1000000",
+                      help="Comma-separated list of pool sizes to benchmark")
+    parser.add_option("-c",
+                      "--count",
+                      dest="count",
+                      type="int",
+                      default=20,
+                      help="Number of allocations to time for each pool size")
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.print_help()
+    else:
+        standalone(options.database,
+                   [int(size) for size in options.sizes.split(",")],
+                   options.count)
@@ -8,9 +8,12 @@
 # Metaswitch Networks in a separate written agreement.
 
 
+import httplib
+
 from tornado.web import RequestHandler
 
 from metaswitch.ellis.api import users, static, session, numbers, _base
+from metaswitch.ellis.remote import upstream
 from metaswitch.ellis import settings
 
 PATH_PREFIX = "^/"
@@ -21,7 +24,16 @@ PUBLIC_ID = r'[^/]+'
 
 class PingHandler(RequestHandler):
     def get(self):
-        self.finish("OK") # pragma: no cover
+        # While requests to a backend are being turned away, so would most
+        # requests to us be.
+        unavailable = upstream.unavailable_backends()
+        if unavailable:
+            self.set_status(httplib.SERVICE_UNAVAILABLE)
+            self.set_header("Retry-After",
+                            str(max(b.breaker.retry_after() for b in unavailable)))
+            self.finish("Unavailable: %s" % ", ".join(b.name for b in unavailable))
+        else:
+            self.finish("OK")
 
 URLS = [
     # User-focussed APIs.  Typically secured with username/password.
@@ -30,6 +42,10 @@ URLS = [
     # /accounts/ (POST)
     (PATH_PREFIX + r'accounts/?$', users.AccountsHandler),
 
+    # Bulk account deletion (admin only).
+    # /accounts/deprovision (POST)
+    (PATH_PREFIX + r'accounts/deprovision/?$', users.AccountsDeprovisionHandler),
+
     # Account edit.
     # /accounts/<account_id> (DELETE)
     (PATH_PREFIX + r'accounts/([^/]*)/?$', users.AccountHandler),
@@ -10,20 +10,24 @@
 
 import logging
 import json
+import time
 import traceback
 import httplib
 import cgi
+from functools import partial
 
 import msgpack
 import tornado.web
 import tornado.httpclient
+from tornado import stack_context
 from tornado.web import HTTPError, RequestHandler
 
 from metaswitch.common import utils
-from metaswitch.ellis import settings
+from metaswitch.ellis import settings, background
 from metaswitch.ellis.api import validation
-from metaswitch.ellis.data import users, numbers, connection
+from metaswitch.ellis.data import users, numbers, dbpool
 from metaswitch.ellis.data import NotFound
+from metaswitch.ellis.remote import upstream
 import sys
 
 _log = logging.getLogger("ellis.api")
@@ -43,19 +47,7 @@ def _guess_mime_type(body):
         _log.warning("Guessed MIME type of uploaded data as URL-encoded. Client should specify.")
         return "application/x-www-form-urlencoded"
 
-class DbSessionMixin(object):
-    def db_session(self):
-        if not hasattr(self, "_db_session"):
-            self._db_session = connection.Session()
-        return self._db_session
-
-    def on_finish(self): # pragma: no cover
-        super(DbSessionMixin, self).on_finish()
-        if hasattr(self, "_db_session"):
-            self._db_session.close()
-        # @@@KSW for some reason, this isn't called if the handler throws!
-
-class BaseHandler(tornado.web.RequestHandler, DbSessionMixin):
+class BaseHandler(tornado.web.RequestHandler):
     """
     Base class for our web handlers, should handle shared concerns like
     authenticating requests and post-processing data.
@@ -126,11 +118,28 @@ class BaseHandler(tornado.web.RequestHandler, DbSessionMixin):
                 ret[k] = args[k]
         return ret
 
+    def _execute(self, transforms, *args, **kwargs):
+        """
+        Overridden so that requests to the backends made while handling the
+        request, including from callbacks, are retried only until the
+        request's deadline.
+        """
+        deadline = time.time() + settings.UPSTREAM_RETRY_DEADLINE_SECS
+        with stack_context.StackContext(partial(upstream.deadline, deadline)):
+            super(BaseHandler, self)._execute(transforms, *args, **kwargs)
+
     def _handle_request_exception(self, e):
         """
         Overridden to pass on the exception object to send_error.  Otherwise,
         should track superclass version.
         """
+        if isinstance(e, background.PoolFull):
+            # A background job started part way through the request found
+            # its pool overloaded - turn the request away, as we would have
+            # if the pool had been full when the request arrived.
+            e = HTTPErrorEx(httplib.SERVICE_UNAVAILABLE,
+                            "Too many background jobs",
+                            headers={"Retry-After": "1"})
         if isinstance(e, HTTPError):
             if e.log_message: # pragma: no cover
                 format = "%d %s: " + e.log_message
@@ -216,6 +225,33 @@ class BaseHandler(tornado.web.RequestHandler, DbSessionMixin):
                 raise e
         return ret
 
+    def run_password_job(self, job, *args):
+        """
+        Runs one of the users.*_async password jobs, after which the request
+        is finished asynchronously, as if the handler were @asynchronous.
+        Turns the request away with a 503 if the password pool is overloaded.
+        """
+        self._run_background_job(users.password_pool_full(), "password", job, args)
+
+    def run_db_job(self, job, *args):
+        """
+        Runs one of the users.*_async or numbers.*_async database jobs, after
+        which the request is finished asynchronously, as if the handler were
+        @asynchronous.  Turns the request away with a 503 if the database
+        pool is overloaded.
+        """
+        self._run_background_job(dbpool.pool_full(), "database", job, args)
+
+    def _run_background_job(self, pool_full, what, job, args):
+        if pool_full:
+            _log.warning("Too many %s requests queued", what)
+            raise HTTPErrorEx(httplib.SERVICE_UNAVAILABLE,
+                              "Too many %s requests" % what,
+                              headers={"Retry-After": "1"})
+        self._auto_finish = False
+        with stack_context.ExceptionStackContext(self._stack_context_handle_exception):
+            job(*args)
+
     def do_login(self, user, set_cookie=False):
         """
         Handle a successful login: if requested or we're about to
@@ -255,8 +291,20 @@ class BaseHandler(tornado.web.RequestHandler, DbSessionMixin):
 
     def forward_error(self, response): # pragma: no cover
         """
-        Forwards on an error from a remote backend
+        Forwards on an error from a remote backend.  If the request wasn't
+        sent because the backend is unavailable, that's a 503, with a
+        Retry-After.
         """
+        error = response
+        if isinstance(response, tornado.httpclient.HTTPResponse):
+            error = response.error
+        if isinstance(error, upstream.BackendUnavailable):
+            self.send_error(httplib.SERVICE_UNAVAILABLE,
+                            reason="Upstream backend unavailable",
+                            detail={"Upstream": error.backend},
+                            headers={"Retry-After": str(error.retry_after)})
+            return
+
         code = 0
         url = None
         if isinstance(response, tornado.httpclient.HTTPError):
@@ -280,10 +328,11 @@ class BaseHandler(tornado.web.RequestHandler, DbSessionMixin):
 
         If the client has requested an error redirect rather than a status
         code then the error is formatted into URL parameters and sent on the
-        redirect instead.
+        redirect instead.  Otherwise, any headers given are added to the
+        response.
         """
         redirect_url = self.get_argument("onfailure", None)
-        headers = {}
+        headers = kwargs.pop("headers", {})
         if "exception" in kwargs: # pragma: no cover
             e = kwargs["exception"]
             if reason == "unknown" and isinstance(e, HTTPError):
@@ -324,44 +373,64 @@ class BaseHandler(tornado.web.RequestHandler, DbSessionMixin):
         if self.settings.get("debug") and "exc_info" in kwargs:
             data["exception"] = traceback.format_exception(*kwargs["exc_info"])
         if 'headers' in kwargs:
-            for k,v in kwargs['headers']: # pragma: no cover
+            for k,v in kwargs['headers'].iteritems(): # pragma: no cover
                 self.set_header(k,v)
         self.finish(data)
 
-class UsernameCookieMixin(RequestHandler, DbSessionMixin):
-    @property
-    def logged_in_username(self):
-        if not hasattr(self, "_username"):
-            username = self.get_secure_cookie("username")
-            if username != None:
-                try:
-                    users.lookup_user_id(self.db_session(), username)
-                except NotFound:
-                    username = None
-            self._username = username
-        return self._username
+class UsernameCookieMixin(RequestHandler):
+    def get_logged_in_username_async(self, callback, errback):
+        """
+        Passes callback the username from the request's login cookie, or None
+        if there's no cookie or the user no longer exists.  The user is
+        looked up on a database thread.  Raises background.PoolFull if the
+        pool is overloaded.
+        """
+        username = self.get_secure_cookie("username")
+        if username is None:
+            callback(None)
+            return
+
+        def on_lookup_failed(e):
+            if isinstance(e, NotFound):
+                callback(None)
+            else:
+                errback(e)
+
+        users.lookup_user_id_async(username,
+                                   lambda _: callback(username),
+                                   on_lookup_failed)
 
 class LoggedInHandler(BaseHandler, UsernameCookieMixin):
-    def check_number_ownership(self, sip_uri, user_id):
-        try:
-            owner_id = numbers.get_sip_uri_owner_id(self.db_session(), sip_uri)
-        except NotFound:
-            raise HTTPError(404, "Number not found")
-        else:
-            if owner_id != user_id:
-                raise HTTPError(404, "User doesn't own that number")
+    def get_and_check_user_id_async(self, username, callback):
+        """
+        Checks that the request is from the given user (or has the API key)
+        and looks the user up on a database thread, passing the user ID to
+        callback.  The request is then finished asynchronously, as for
+        run_db_job.
+        """
+        self._check_username(username)
+        self.run_db_job(users.lookup_user_id_async,
+                        username,
+                        callback,
+                        _on_lookup_user_id_failed)
 
-    def get_and_check_user_id(self, username): # pragma: no cover
-        if username != self.logged_in_username and \
+    def get_and_check_number_owner_async(self, username, sip_uri, callback):
+        """
+        As get_and_check_user_id_async, but also checks that the user owns
+        sip_uri before passing the user ID to callback.
+        """
+        def on_got_user_id(user_id):
+            numbers.get_sip_uri_owner_id_async(sip_uri,
+                                               partial(_check_number_owner, user_id, callback),
+                                               _on_lookup_number_owner_failed)
+        self.get_and_check_user_id_async(username, on_got_user_id)
+
+    def _check_username(self, username):
+        # Only the cookie is checked here - the lookup that follows checks
+        # that the user still exists.
+        if username != self.get_secure_cookie("username") and \
            self.request.headers.get("NGV-API-Key", None) != settings.API_KEY:
             raise HTTPError(403, "Username doesn't match logged in username.")
-        try:
-            return users.lookup_user_id(self.db_session(), username)
-        except NotFound:
-            raise HTTPError(404, "User not found.")
-
-    def is_request_authenticated(self):
-        return self.logged_in_username is not None
 
     def is_admin_request(self): # pragma: no cover
         if self.request.headers.get("NGV-API-Key", None) != settings.API_KEY:
@@ -375,6 +444,26 @@ class HTTPErrorEx(HTTPError):
         self.headers = headers
         self.args = args
 
+def reraise(e):
+    """Errback for background jobs that fails the request with the job's
+    exception, as if the job had been run by the handler itself."""
+    raise e
+
+def _on_lookup_user_id_failed(e):
+    if isinstance(e, NotFound):
+        raise HTTPError(404, "User not found.")
+    raise e
+
+def _check_number_owner(user_id, callback, owner_id):
+    if owner_id != user_id:
+        raise HTTPError(404, "User doesn't own that number")
+    callback(user_id)
+
+def _on_lookup_number_owner_failed(e):
+    if isinstance(e, NotFound):
+        raise HTTPError(404, "Number not found")
+    raise e
+
 class UnknownApiHandler(BaseHandler):
     """
     Handler that sends a 404 JSON/msgpack/etc response to all requests.
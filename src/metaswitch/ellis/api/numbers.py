@@ -8,27 +8,29 @@
 # Metaswitch Networks in a separate written agreement.
 
 
+import base64
+import bisect
+import collections
+import hashlib
 import logging
 import httplib
 import json
-import uuid
 
 from tornado.web import HTTPError, asynchronous
 from functools import partial
 
+from metaswitch.ellis import settings, ifc_cache
 from metaswitch.ellis.api import _base
 from metaswitch.ellis.api.utils import HTTPCallbackGroup
-from metaswitch.ellis.data import numbers, NotFound
+from metaswitch.ellis.data import numbers, allocator, dbpool, NotFound
 from metaswitch.ellis.remote import homestead
 from metaswitch.ellis.remote import xdm
 from metaswitch.common import utils
 from metaswitch.common.phonenumber_utils import format_phone_number
-from metaswitch.common import ifcs, simservs
+from metaswitch.common import simservs
 
 _log = logging.getLogger("ellis.api")
 
-NUM_RETRIES = 2
-
 class NumbersHandler(_base.LoggedInHandler):
     def __init__(self, application, request, **kwargs):
         super(NumbersHandler, self).__init__(application, request, **kwargs)
@@ -40,8 +42,16 @@ class NumbersHandler(_base.LoggedInHandler):
     @asynchronous
     def get(self, username):
         """Retrieve list of phone numbers."""
-        user_id = self.get_and_check_user_id(username)
-        self._numbers = numbers.get_numbers(self.db_session(), user_id)
+        self.get_and_check_user_id_async(username, self._get_numbers)
+
+    def _get_numbers(self, user_id):
+        self.run_db_job(numbers.get_numbers_async,
+                        user_id,
+                        self._on_get_numbers,
+                        _base.reraise)
+
+    def _on_get_numbers(self, user_numbers):
+        self._numbers = user_numbers
         if len(self._numbers) == 0:
             self.finish({"numbers": []})
             return
@@ -54,123 +64,121 @@ class NumbersHandler(_base.LoggedInHandler):
             number["number"] = utils.sip_uri_to_phone_number(number["number"])
             number["formatted_number"] = format_phone_number(number["number"])
 
-            _request_group = HTTPCallbackGroup(partial(self._on_get_success, number["sip_uri"]),
-                                               partial(self._on_get_failure, number["sip_uri"]))
-            # We only store the public identities in Ellis, and must query
-            # Homestead for the associated private identities
-            homestead.get_associated_privates(number["sip_uri"],
-                                              _request_group.callback())
+        # We only store the public identities in Ellis, and must query
+        # Homestead for the associated private identities
+        homestead.get_associated_privates_batch([n["sip_uri"] for n in self._numbers],
+                                                self._on_get_privates)
+
+    def _on_get_privates(self, private_ids, errors):
+        if errors:
+            self._on_get_failure(errors)
+            return
 
-    def _on_get_success(self, public_id, responses):
         _log.debug("Successfully fetched associated private identities")
-        for response in responses:
+        for number in self._numbers:
             try:
-                # Body is of format {"public_id": "<public_id>",
-                #                    "private_ids": ["<private_id_1>", "<private_id_2>"...]}
-                parsed_body = json.loads(response.body)
                 # We only support one private id per public id, so only pull out first in list
-                private_id = parsed_body["private_ids"][0]
-                for number in [n for n in self._numbers if n["sip_uri"] == public_id]:
-                    number["private_id"] = private_id
-
-            except (TypeError, KeyError): # pragma: no cover
-                _log.error("Could not parse response: %s", response.body)
+                number["private_id"] = private_ids[number["sip_uri"]][0]
+            except IndexError:
+                _log.error("No private identities associated with %s", number["sip_uri"])
                 self.send_error(httplib.BAD_GATEWAY,
                                 reason="Upstream request failed: could not parse private identity list")
                 return
 
-        for number in self._numbers:
-            if "private_id" not in number:
-                _log.debug("Not all numbers have private IDs associated, not sending response to the browser yet...")
-                return
-
         self.finish({"numbers": self._numbers})
 
-    def _on_get_failure(self, sip_uri, response): # pragma: no cover
-        _log.warn("Failed to fetch private identities from homestead for %s", sip_uri)
-        if hasattr(response, 'code') and response.code == 404:
-            # The number has no records in Homestead, so forget about it locally
-            _log.warn("Returning %s to the pool", sip_uri)
-            db_sess = self.db_session()
-            numbers.remove_owner(db_sess, sip_uri)
-            db_sess.commit()
-            # Also try and remove it from Homer, but do nothing if we fail
-            xdm.delete_simservs(sip_uri, lambda responses: None)
-            
-        self.forward_error(response)
+    def _on_get_failure(self, errors):
+        for sip_uri, error in errors.iteritems():
+            _log.warn("Failed to fetch private identities from homestead for %s", sip_uri)
+            if error.code == 404:
+                # The number has no records in Homestead, so forget about it locally
+                _log.warn("Returning %s to the pool", sip_uri)
+                numbers.remove_owners_async([sip_uri],
+                                            lambda _: None,
+                                            partial(_on_return_to_pool_failed, [sip_uri]))
+                # Also try and remove it from Homer, but do nothing if we fail
+                xdm.delete_simservs(sip_uri, lambda responses: None)
+
+        self.forward_error(errors.values()[0])
 
     @asynchronous
     def post(self, username):
-        """Allocate a phone number."""
+        """Allocate a phone number, or if count is given, that many."""
         _log.debug("Number allocation API call (PSTN = %s)", self.get_argument('pstn', 'false'))
-        user_id = self.get_and_check_user_id(username)
-        db_sess = self.db_session()
+        self.get_and_check_user_id_async(username, self._allocate)
+
+    def _allocate(self, user_id):
         pstn = self.get_argument('pstn', 'false').lower() == 'true'
         private_id = self.get_argument('private_id', None)
-        try:
-            number_id = numbers.allocate_number(db_sess, user_id, pstn)
-            sip_uri = numbers.get_number(db_sess, number_id, user_id)
-            self.sip_uri = sip_uri
-            _log.debug("SIP URI %s", sip_uri)
-            # FIXME We shouldn't commit until we know XDM/HS have succeeded but
-            # if we hold the transaction open we can deadlock
-            # * Request 1 comes in and allocates a number, kicks off requests
-            #   to XDM/Homestead, has transaction open, returns thread to Tornado
-            # * Request 2 comes in, allocates same number, can't lock it for
-            #   update because Request 1 is holding it.  Blocks.
-            # * Request 1 gets response but the thread is tied up
-            # * Request 2 SQL transaction times out.
-            # * Request 1 probably completes..
-            db_sess.commit()
-        except NotFound: # pragma: no cover
-            # FIXME email operator to tell them we're out of numbers!
-            db_sess.rollback()
-            _log.warning("No available numbers")
-            raise HTTPError(httplib.SERVICE_UNAVAILABLE,
-                            "No available numbers")
+        count = self.get_argument('count', None)
+        if count is not None:
+            self._post_batch(user_id, count, pstn, private_id)
+            return
+        # The allocation is committed as soon as it's made, on the database
+        # thread.
+        # FIXME We shouldn't commit until we know XDM/HS have succeeded but
+        # if we hold the transaction open we can deadlock
+        # * Request 1 comes in and allocates a number, kicks off requests
+        #   to XDM/Homestead, has transaction open, returns thread to Tornado
+        # * Request 2 comes in, allocates same number, can't lock it for
+        #   update because Request 1 is holding it.  Blocks.
+        # * Request 1 gets response but the thread is tied up
+        # * Request 2 SQL transaction times out.
+        # * Request 1 probably completes..
+        self.run_db_job(allocator.allocate_numbers_async,
+                        user_id,
+                        1,
+                        pstn,
+                        partial(self._on_allocated, pstn, private_id),
+                        partial(_on_allocate_failed, "No available numbers"))
+
+    def _on_allocated(self, pstn, private_id, allocated):
+        [(number_id, sip_uri)] = allocated
+        self.sip_uri = sip_uri
+        _log.debug("SIP URI %s", sip_uri)
 
         # Work out the response we'll send if the upstream requests
         # are successful.
-        number = utils.sip_uri_to_phone_number(sip_uri)
-        pretty_number = format_phone_number(number)
-        self.__response = {"sip_uri": sip_uri,
-                           "sip_username": number,
-                           "number": number,
-                           "pstn": pstn,
-                           "formatted_number": pretty_number,
-                           "number_id": number_id.hex}
+        self.__response = _number_response(number_id, sip_uri, pstn)
 
-        # Generate a random password and store it in Homestead.
         _log.debug("Populating other servers...")
         self._request_group = HTTPCallbackGroup(self._on_post_success,
                                                 self._on_post_failure)
+        self.__response.update(_provision_number(sip_uri, private_id, self._request_group))
 
-        public_callback = self._request_group.callback()
-
-        if private_id == None:
-            # No private id was provided, so we need to create a new
-            # digest in Homestead
-            private_id = utils.sip_public_id_to_private(sip_uri)
-            sip_password = utils.generate_sip_password()
-            _log.debug("About to create private ID at Homestead")
-            homestead.create_private_id(private_id,
-                                        utils.sip_uri_to_domain(sip_uri),
-                                        sip_password,
-                                        self._request_group.callback())
-            _log.debug("Created private ID at Homestead")
-            self.__response["sip_password"] = sip_password
-
-        # Associate the new public identity with the private identity in Homestead
-        # and store the iFCs in homestead.
-        homestead.create_public_id(private_id,
-                                   sip_uri,
-                                   ifcs.generate_ifcs(utils.sip_uri_to_domain(sip_uri)),
-                                   public_callback)
-
-        self.__response["private_id"] = private_id
-
-        # Concurrently, store the default simservs in XDM.
-        xdm.put_simservs(sip_uri, simservs.default_simservs(), self._request_group.callback())
+    def _post_batch(self, user_id, count, pstn, private_id):
+        """Allocate count numbers, in a single transaction, and create them
+        all in Homestead and Homer."""
+        try:
+            count = int(count)
+        except ValueError:
+            count = 0
+        if not 0 < count <= settings.NUMBER_BATCH_MAX_SIZE:
+            raise HTTPError(httplib.BAD_REQUEST,
+                            "count must be between 1 and %d" % settings.NUMBER_BATCH_MAX_SIZE)
+        atomic = self.get_argument('atomic', 'false').lower() == 'true'
+        _log.debug("Batch allocation of %d numbers (atomic = %s)", count, atomic)
+        # As for a single number, we can't hold the transaction open while
+        # we create the numbers upstream.
+        self.run_db_job(allocator.allocate_numbers_async,
+                        user_id,
+                        count,
+                        pstn,
+                        partial(self._on_batch_allocated, pstn, private_id, atomic),
+                        partial(_on_allocate_failed, "Not enough available numbers"))
+
+    def _on_batch_allocated(self, pstn, private_id, atomic, allocated):
+        batch = _NumberBatch(allocated,
+                             pstn,
+                             private_id,
+                             atomic,
+                             self._on_batch_done)
+        batch.start()
+
+    def _on_batch_done(self, results):
+        if not all(r["status"] == "created" for r in results):
+            self.set_status(httplib.BAD_GATEWAY)
+        self.finish({"numbers": results})
 
     def _on_post_success(self, responses):
         _log.debug("Successfully updated all the backends")
@@ -185,7 +193,7 @@ class NumbersHandler(_base.LoggedInHandler):
         # Set force_delete=True - this means that we remove the
         # partially-created line from Ellis even if Homestead is still
         # down and our DELETE requests aren't successful.
-        remove_public_id(self.db_session(), self.sip_uri,
+        remove_public_id(self.sip_uri,
                          self._on_backout_success, self._on_backout_failure, force_delete=True)
 
     def _on_backout_success(self, responses): # pragma: no cover
@@ -196,14 +204,180 @@ class NumbersHandler(_base.LoggedInHandler):
         _log.warn("Failed to back out changes after failure")
         self.forward_error(self.__failure_response)
 
-def remove_public_id(db_sess, sip_uri, on_success, on_failure, force_delete):
+def _provision_number(sip_uri, private_id, request_group):
+    """
+    Creates a newly allocated number in Homestead and Homer, reporting each
+    request's response to request_group.  If private_id is None, a new
+    private ID is created for the number, with a random password.  Returns
+    the private ID and any new password, to add to the response.
+    """
+    response = {}
+    public_callback = request_group.callback()
+
+    if private_id == None:
+        # No private id was provided, so we need to create a new
+        # digest in Homestead
+        private_id = utils.sip_public_id_to_private(sip_uri)
+        sip_password = utils.generate_sip_password()
+        _log.debug("About to create private ID at Homestead")
+        homestead.create_private_id(private_id,
+                                    utils.sip_uri_to_domain(sip_uri),
+                                    sip_password,
+                                    request_group.callback())
+        _log.debug("Created private ID at Homestead")
+        response["sip_password"] = sip_password
+
+    # Associate the new public identity with the private identity in Homestead
+    # and store the iFCs in homestead.
+    homestead.create_public_id(private_id,
+                               sip_uri,
+                               ifc_cache.default_ifcs(utils.sip_uri_to_domain(sip_uri)),
+                               public_callback)
+
+    response["private_id"] = private_id
+
+    # Concurrently, store the default simservs in XDM.
+    xdm.put_simservs(sip_uri, simservs.default_simservs(), request_group.callback())
+    return response
+
+def _on_allocate_failed(reason, e):
+    """Errback for allocator.allocate_numbers_async."""
+    if isinstance(e, NotFound):
+        # FIXME email operator to tell them we're out of numbers!
+        _log.warning(reason)
+        raise HTTPError(httplib.SERVICE_UNAVAILABLE, reason)
+    raise e
+
+def _on_return_to_pool_failed(sip_uris, e):
+    # Only called where the request has already moved on, so there's
+    # nothing to do but log it - the numbers are left with their owner.
+    _log.error("Failed to return %s to the pool: %s", ", ".join(sip_uris), e)
+
+def _number_response(number_id, sip_uri, pstn):
+    """Returns the details of a newly allocated number, for a response."""
+    number = utils.sip_uri_to_phone_number(sip_uri)
+    return {"sip_uri": sip_uri,
+            "sip_username": number,
+            "number": number,
+            "pstn": pstn,
+            "formatted_number": format_phone_number(number),
+            "number_id": number_id.hex}
+
+class _NumberBatch(object):
+    """
+    Creates a batch of newly allocated numbers in Homestead and Homer, with
+    up to NUMBER_BATCH_MAX_IN_FLIGHT at once, then calls callback with the
+    result for each, in order.
+
+    Each number that can't be created is backed out with remove_public_id
+    (and returned to the pool).  If atomic is set, so is every other number
+    in the batch, once they've all finished: no more are started after the
+    first failure, and those not yet started are returned to the pool.
+    """
+
+    def __init__(self, numbers, pstn, private_id, atomic, callback):
+        self._pstn = pstn
+        self._private_id = private_id
+        self._atomic = atomic
+        self._callback = callback
+        self._results = [_number_response(number_id, sip_uri, pstn)
+                         for number_id, sip_uri in numbers]
+        self._pending = collections.deque(self._results)
+        self._in_flight = 0
+        self._failed = False
+
+    def start(self):
+        self._start_some(self._provision_next)
+
+    def _start_some(self, start_one):
+        for _ in range(min(settings.NUMBER_BATCH_MAX_IN_FLIGHT, len(self._pending))):
+            # Requests may complete synchronously, and start the rest
+            if self._pending:
+                start_one()
+
+    def _provision_next(self):
+        result = self._pending.popleft()
+        self._in_flight += 1
+        request_group = HTTPCallbackGroup(partial(self._on_provisioned, result),
+                                          partial(self._on_provision_failed, result))
+        result.update(_provision_number(result["sip_uri"], self._private_id, request_group))
+
+    def _on_provisioned(self, result, responses):
+        result["status"] = "created"
+        self._in_flight -= 1
+        self._on_done()
+
+    def _on_provision_failed(self, result, response):
+        _log.warn("Failed to create %s in all the backends", result["sip_uri"])
+        self._failed = True
+        result["status"] = "failed"
+        result["error"] = {"Upstream error": str(getattr(response, "code", None))}
+        result.pop("sip_password", None)
+        if self._atomic:
+            # Don't create any more - the batch is being backed out anyway.
+            # Those not yet started were never created upstream, so just
+            # need returning to the pool.
+            sip_uris = []
+            while self._pending:
+                pending = self._pending.popleft()
+                sip_uris.append(pending["sip_uri"])
+                pending["status"] = "backed out"
+            if sip_uris:
+                numbers.remove_owners_async(sip_uris,
+                                            lambda _: None,
+                                            partial(_on_return_to_pool_failed, sip_uris))
+        # As for a single number, remove the partially-created number from
+        # Ellis even if the DELETE requests fail.
+        remove_public_id(result["sip_uri"],
+                         partial(self._on_backed_out, result),
+                         partial(self._on_backed_out, result),
+                         force_delete=True)
+
+    def _on_backed_out(self, result, responses):
+        self._in_flight -= 1
+        self._on_done()
+
+    def _on_done(self):
+        if self._pending:
+            self._provision_next()
+        elif self._in_flight == 0:
+            if self._atomic and self._failed:
+                self._back_out_batch()
+            else:
+                self._callback(self._results)
+
+    def _back_out_batch(self):
+        self._failed = False
+        self._atomic = False
+        self._pending = collections.deque(r for r in self._results if r["status"] == "created")
+        if not self._pending:
+            self._callback(self._results)
+        else:
+            self._start_some(self._back_out_next)
+
+    def _back_out_next(self):
+        result = self._pending.popleft()
+        self._in_flight += 1
+        result["status"] = "backed out"
+        result.pop("sip_password", None)
+
+        def on_backed_out(responses):
+            self._in_flight -= 1
+            if self._pending:
+                self._back_out_next()
+            elif self._in_flight == 0:
+                self._callback(self._results)
+        remove_public_id(result["sip_uri"], on_backed_out, on_backed_out, force_delete=True)
+
+def remove_public_id(sip_uri, on_success, on_failure, force_delete):
     """
        Looks up the private id related to the sip_uri, and then the public ids
        related the retrieved private id. If there are multiple public ids, then
        only the sip_uri is is removed from Homestead, and the association to its
        private id is destroyed. If this is the only public id associated with the
        private id, then both the private and public ids are removed from Homestead
-       along with their associations
+       along with their associations.  The number is returned to the pool on a
+       database thread.
     """
     def _on_get_privates_success(responses):
         _log.debug("Got related private ids")
@@ -230,16 +404,14 @@ def remove_public_id(db_sess, sip_uri, on_success, on_failure, force_delete):
             # Only delete the digest if there is only a single private identity
             # associated with our sip_uri (i.e. this is the last public id)
             delete_digest = (len(public_ids) == 1)
-            _delete_number(db_sess, sip_uri, private_id, delete_digest, on_success, on_failure, force_delete)
+            _delete_number(sip_uri, private_id, delete_digest, on_success, on_failure, force_delete)
 
     def _on_get_privates_failure(response):
         if (response.code == 404) or force_delete:
             # The number has no records in Homestead
             _log.debug("Failed to retrieve private IDs for a public ID")
             _log.debug("Returning %s to the pool" % sip_uri)
-            numbers.remove_owner(db_sess, sip_uri)
-            db_sess.commit()
-            on_success({})
+            _return_to_pool(sip_uri, partial(on_success, {}))
         else: # pragma: no cover
             _log.warn("Non-404 response - not returning number to pool")
             on_failure(response)
@@ -247,7 +419,7 @@ def remove_public_id(db_sess, sip_uri, on_success, on_failure, force_delete):
     request_group = HTTPCallbackGroup(_on_get_privates_success, _on_get_privates_failure)
     homestead.get_associated_privates(sip_uri, request_group.callback())
 
-def _delete_number(db_sess, sip_uri, private_id, delete_digest, on_success, on_failure, force_delete):
+def _delete_number(sip_uri, private_id, delete_digest, on_success, on_failure, force_delete):
     """
        Deletes all information associated with a private/public identity
        pair, optionally deleting the digest associated with the private identity
@@ -255,26 +427,30 @@ def _delete_number(db_sess, sip_uri, private_id, delete_digest, on_success, on_f
 
     def on_upstream_deletion(*args):
         _log.info("Deletion from Homestead and Homer was OK - returning number to pool")
-        numbers.remove_owner(db_sess, sip_uri)
-        db_sess.commit()
-        on_success(args)
-
-    # Concurrently, delete data from Homestead and Homer
-    request_group = HTTPCallbackGroup(on_upstream_deletion, on_failure)
+        _return_to_pool(sip_uri, partial(on_success, args))
+
+    def delete_upstream(request_group):
+        # Concurrently, delete data from Homestead and Homer
+        if delete_digest:
+            # Deleting the private ID will delete its associated IRS (and
+            # therefore any subsidiary public IDs and their service profiles)
+            homestead.delete_private_id(private_id, request_group.callback())
+        else:
+            homestead.delete_public_id(sip_uri, request_group.callback())
+        xdm.delete_simservs(sip_uri, request_group.callback())
 
     if force_delete: # pragma: no cover
-        request_group = HTTPCallbackGroup(on_success, on_failure)
         _log.info("Returning number to pool before attempting deletion from Homestead and Homer")
-        numbers.remove_owner(db_sess, sip_uri)
-        db_sess.commit()
-
-    if delete_digest:
-        # Deleting the private ID will delete its associated IRS (and
-        # therefore any subsidiary public IDs and their service profiles)
-        homestead.delete_private_id(private_id, request_group.callback())
+        _return_to_pool(sip_uri,
+                        lambda: delete_upstream(HTTPCallbackGroup(on_success, on_failure)))
     else:
-        homestead.delete_public_id(sip_uri, request_group.callback())
-    xdm.delete_simservs(sip_uri, request_group.callback())
+        delete_upstream(HTTPCallbackGroup(on_upstream_deletion, on_failure))
+
+def _return_to_pool(sip_uri, callback):
+    """Returns sip_uri to the pool on a database thread, then calls
+    callback.  If that fails, so does the request, as it would had the
+    handler made the query itself."""
+    numbers.remove_owners_async([sip_uri], lambda _: callback(), _base.reraise)
 
 class NumberHandler(_base.LoggedInHandler):
     def __init__(self, application, request, **kwargs):
@@ -287,13 +463,14 @@ class NumberHandler(_base.LoggedInHandler):
     def delete(self, username, sip_uri):
         """Deletes a given SIP URI."""
         _log.info("Request to delete %s by %s", sip_uri, username)
-        user_id = self.get_and_check_user_id(username)
-        self.check_number_ownership(sip_uri, user_id)
+        self.get_and_check_number_owner_async(username, sip_uri, partial(self._delete, sip_uri))
+
+    def _delete(self, sip_uri, user_id):
         # Set force_delete=False - if we can't remove the number from
         # Homestead/Homer, we'll keep the number assigned to the user
         # (who can delete it in future) rather than removing it and
         # leaving orphaned data in Homestead.
-        remove_public_id(self.db_session(), sip_uri, self._on_delete_success, self._on_delete_failure, force_delete=False)
+        remove_public_id(sip_uri, self._on_delete_success, self._on_delete_failure, force_delete=False)
 
     def _on_delete_success(self, responses):
         _log.debug("All requests successful.")
@@ -308,19 +485,20 @@ class NumberHandler(_base.LoggedInHandler):
         """Allocate a phone number."""
         _log.debug("Specific number allocation API call (%s)", sip_uri)
         self.is_admin_request()
-        user_id = self.get_and_check_user_id(username)
-        db_sess = self.db_session()
+        self.get_and_check_user_id_async(username, partial(self._allocate_sip_uri, sip_uri))
+
+    def _allocate_sip_uri(self, sip_uri, user_id): # pragma: no cover
+        self.run_db_job(numbers.allocate_sip_uri_async,
+                        user_id,
+                        sip_uri,
+                        partial(self._on_sip_uri_allocated, sip_uri),
+                        _base.reraise)
+
+    def _on_sip_uri_allocated(self, sip_uri, number_id): # pragma: no cover
         pstn = self.get_argument('pstn', 'false').lower() == 'true'
         private_id = self.get_argument('private_id', None)
         new_private_id = self.get_argument('new_private_id', 'false').lower() == 'true'
-        try:
-            number_id = uuid.UUID(numbers.get_sip_uri_number_id(db_sess, sip_uri))
-        except NotFound:
-            # This SIP URI is not currently in the pool, so add it
-            number_id = numbers.add_number_to_pool(db_sess, sip_uri, False, True)
-        numbers.allocate_specific_number(db_sess, user_id, number_id)
         self.sip_uri = sip_uri
-        db_sess.commit()
 
         # Work out the response we'll send if the upstream requests
         # are successful.
@@ -362,7 +540,7 @@ class NumberHandler(_base.LoggedInHandler):
         # and store the iFCs in homestead.
         homestead.create_public_id(private_id,
                                    sip_uri,
-                                   ifcs.generate_ifcs(utils.sip_uri_to_domain(sip_uri)),
+                                   ifc_cache.default_ifcs(utils.sip_uri_to_domain(sip_uri)),
                                    public_callback)
 
         self.__response["private_id"] = private_id
@@ -382,7 +560,7 @@ class NumberHandler(_base.LoggedInHandler):
         # Set force_delete=True - this means that we remove the
         # partially-created line from Ellis even if Homestead is still
         # down and our DELETE requests aren't successful.
-        remove_public_id(self.db_session(), self.sip_uri,
+        remove_public_id(self.sip_uri,
                          self._on_backout_success, self._on_backout_failure, force_delete=True)
 
 
@@ -390,8 +568,9 @@ class SipPasswordHandler(_base.LoggedInHandler):
     @asynchronous
     def post(self, username, sip_uri):
         """Resets the password for the given SIP URI."""
-        user_id = self.get_and_check_user_id(username)
-        self.check_number_ownership(sip_uri, user_id)
+        self.get_and_check_number_owner_async(username, sip_uri, partial(self._reset_password, sip_uri))
+
+    def _reset_password(self, sip_uri, user_id):
         self.sip_digest_realm = utils.sip_uri_to_domain(sip_uri)
         self.sip_password = utils.generate_sip_password()
 
@@ -448,9 +627,9 @@ class RemoteProxyHandler(_base.LoggedInHandler):
     @asynchronous
     def get(self, username, sip_uri):
         """Fetches document from remote"""
-        user_id = self.get_and_check_user_id(username)
-        self.check_number_ownership(sip_uri, user_id)
+        self.get_and_check_number_owner_async(username, sip_uri, partial(self._get, sip_uri))
 
+    def _get(self, sip_uri, user_id):
         self._request_group = HTTPCallbackGroup(self._on_get_success,
                                                 self._on_get_failure)
         self.remote_get(sip_uri, self._request_group.callback())
@@ -466,8 +645,9 @@ class RemoteProxyHandler(_base.LoggedInHandler):
     @asynchronous
     def put(self, username, sip_uri):
         """Updates document on remote"""
-        user_id = self.get_and_check_user_id(username)
-        self.check_number_ownership(sip_uri, user_id)
+        self.get_and_check_number_owner_async(username, sip_uri, partial(self._put, sip_uri))
+
+    def _put(self, sip_uri, user_id):
         response_body = self.request.body
         self._request_group = HTTPCallbackGroup(self._on_put_success,
                                                 self._on_put_failure)
@@ -500,28 +680,131 @@ class IFCsHandler(RemoteProxyHandler):
 class NumberGabListedHandler(_base.LoggedInHandler):
     def get(self, username, sip_uri): # pragma: no cover
         """Retrieves GAB listed setting for a given phone number"""
-        user_id = self.get_and_check_user_id(username)
-        db_sess = self.db_session()
-        try:
-            gab_listed = numbers.is_gab_listed(db_sess, user_id, sip_uri)
-        except NotFound:
-            _log.warning("Could not retrieve gab listing")
-            raise HTTPError(httplib.NOT_FOUND)
+        self.get_and_check_user_id_async(username, partial(self._get_gab_listed, sip_uri))
 
-        self.finish({"gab_listed": gab_listed})
+    def _get_gab_listed(self, sip_uri, user_id): # pragma: no cover
+        self.run_db_job(numbers.is_gab_listed_async,
+                        user_id,
+                        sip_uri,
+                        lambda gab_listed: self.finish({"gab_listed": gab_listed}),
+                        _on_get_gab_listed_failed)
 
     def put(self, username, sip_phone, isListed): # pragma: no cover
         """Updates GAB listed setting for a given phone number"""
-        user_id = self.get_and_check_user_id(username)
-        db_sess = self.db_session()
-        number_id = numbers.get_sip_uri_number_id(db_sess, sip_phone)
-        numbers.update_gab_list(db_sess, user_id, number_id, isListed)
-        db_sess.commit()
-        self.finish({})
+        self.get_and_check_user_id_async(username, partial(self._put_gab_listed, sip_phone, isListed))
+
+    def _put_gab_listed(self, sip_phone, isListed, user_id): # pragma: no cover
+        self.run_db_job(numbers.update_gab_list_async,
+                        user_id,
+                        sip_phone,
+                        isListed,
+                        lambda _: self.finish({}),
+                        _base.reraise)
+
+def _on_get_gab_listed_failed(e): # pragma: no cover
+    if isinstance(e, NotFound):
+        _log.warning("Could not retrieve gab listing")
+        raise HTTPError(httplib.NOT_FOUND)
+    raise e
+
+class GabSnapshot(object):
+    """
+    An in-memory copy of the global address book, at a given GAB version.
+
+    Contacts are sorted by (lower-cased full name, user ID), and a page
+    cursor is the sort key of the last contact on the previous page, so
+    paging through the GAB neither skips nor repeats contacts that stay
+    listed, even if the GAB changes part way through.
+    """
+
+    def __init__(self, version, listed_contacts):
+        self.version = version
+        entries = sorted(((contact["full_name"].lower(), user_id), contact)
+                         for user_id, contact in listed_contacts)
+        self.keys = [key for key, _ in entries]
+        self.contacts = [contact for _, contact in entries]
+
+    def page(self, cursor, limit):
+        """Returns up to limit contacts following cursor (or from the start
+        if cursor is None), and the cursor for the next page (or None if
+        there are no more)."""
+        start = bisect.bisect_right(self.keys, cursor) if cursor else 0
+        end = start + limit
+        next_cursor = self.keys[end - 1] if end < len(self.keys) else None
+        return self.contacts[start:end], next_cursor
+
+_gab_snapshot = None
+
+def get_gab_snapshot(db_sess):
+    """Returns a snapshot of the current GAB, only reading the GAB from the
+    database if it has changed since the last snapshot."""
+    global _gab_snapshot
+    # Read the version first, so a change made while we read the GAB leaves
+    # our snapshot looking out of date, rather than the other way round.
+    version = numbers.get_gab_version(db_sess)
+    if _gab_snapshot is None or _gab_snapshot.version != version:
+        _log.debug("Loading GAB version %d", version)
+        _gab_snapshot = GabSnapshot(version, numbers.get_listed_contacts(db_sess))
+    return _gab_snapshot
+
+def get_gab_snapshot_async(callback, errback):
+    """As get_gab_snapshot, on a database thread.  Snapshots are never
+    changed once made, so they can be shared between threads, and at worst
+    two threads both load the same new version."""
+    dbpool.run(get_gab_snapshot, (), callback, errback)
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+def _decode_cursor(cursor):
+    try:
+        full_name, user_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return (full_name, str(user_id))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise HTTPError(httplib.BAD_REQUEST, "Invalid cursor")
 
 class GabListedNumbersHandler(_base.LoggedInHandler):
-    def get(self): # pragma: no cover
-        """List of numbers that are available for users to contact"""
-        db_sess = self.db_session()
-        contact_list = numbers.get_listed_numbers(db_sess)
-        self.finish({"contacts": contact_list})
+    def get(self):
+        """
+        List of numbers that are available for users to contact.
+
+        By default the whole GAB is returned.  If limit is specified, only
+        that many contacts are returned, along with a cursor to pass to
+        fetch the next page, if there is one.  The ETag changes whenever the
+        GAB does, so clients can poll with If-None-Match.
+        """
+        cursor = self.get_argument("cursor", None)
+        limit = self.get_argument("limit", None)
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise HTTPError(httplib.BAD_REQUEST, "Invalid limit")
+            if limit <= 0:
+                raise HTTPError(httplib.BAD_REQUEST, "Invalid limit")
+            limit = min(limit, settings.GAB_MAX_PAGE_SIZE)
+        key = _decode_cursor(cursor) if cursor else None
+
+        self.run_db_job(get_gab_snapshot_async,
+                        partial(self._on_got_gab_snapshot, cursor, key, limit),
+                        _base.reraise)
+
+    def _on_got_gab_snapshot(self, cursor, key, limit, snapshot):
+        # The GAB version identifies the whole GAB, so include the page
+        # requested in the ETag.
+        etag = '"%s"' % hashlib.sha1("%d/%s/%s" % (snapshot.version, cursor, limit)).hexdigest()
+        self.set_header("Etag", etag)
+        if etag in self.request.headers.get("If-None-Match", ""):
+            self.set_status(httplib.NOT_MODIFIED)
+            self.finish()
+            return
+
+        if cursor is None and limit is None:
+            self.finish({"contacts": snapshot.contacts})
+            return
+
+        contacts, next_key = snapshot.page(key, limit or len(snapshot.contacts))
+        response = {"contacts": contacts}
+        if next_key is not None:
+            response["cursor"] = _encode_cursor(next_key)
+        self.finish(response)
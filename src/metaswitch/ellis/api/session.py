@@ -15,6 +15,9 @@ RequestHandler for creating a session.
 import logging
 import httplib
 
+from functools import partial
+
+from metaswitch.ellis import background
 from metaswitch.ellis.api import _base
 from metaswitch.ellis.api.validation import REQUIRED, STRING
 from metaswitch.ellis.data import users
@@ -28,14 +31,54 @@ class SessionHandler(_base.BaseHandler):
     def post(self):
         username = self.request_data["email"]
         password = self.request_data["password"]
-        user = users.get_user_by_email_and_password(self.db_session(), username, password)
-        if user:
-            _log.debug("User %s provided correct password (%s) (%s)", username, user["email"], str(user))
-            self.do_login(user, True)
-        else:
-            _log.debug("User %s provided incorrect password", username)
-            self.send_error(httplib.FORBIDDEN, reason="Incorrect username or password")
+        self.run_db_job(users.get_user_by_email_async,
+                        username,
+                        partial(self._on_got_user, password),
+                        _base.reraise)
     post.validation = {
         "email": (REQUIRED, STRING, r'.+'),
         "password": (REQUIRED, STRING, r'.+'),
     }
+
+    def _on_got_user(self, password, user):
+        if user:
+            self.run_password_job(users.check_password_async,
+                                  password,
+                                  user["hashed_password"],
+                                  partial(self._on_password_checked, user, password),
+                                  _base.reraise)
+        else:
+            self._on_password_checked(None, password, False)
+
+    def _on_password_checked(self, user, password, correct):
+        username = self.request_data["email"]
+        if not correct:
+            _log.debug("User %s provided incorrect password", username)
+            self.send_error(httplib.FORBIDDEN, reason="Incorrect username or password")
+            return
+
+        _log.debug("User %s provided correct password (%s) (%s)", username, user["email"], str(user))
+        if users.needs_rehash(user["hashed_password"]):
+            # The work factor has changed since the password was hashed, and
+            # this is our only chance to rehash it.
+            _log.info("Rehashing password for %s", user["email"])
+            try:
+                users.hash_password_async(password,
+                                          partial(self._on_password_rehashed, user),
+                                          partial(self._on_rehash_failed, user))
+                return
+            except background.PoolFull:
+                # Don't hold up the login - we'll try again next time.
+                pass
+        self.do_login(user, True)
+
+    def _on_password_rehashed(self, user, hashed_password):
+        self.run_db_job(users.set_password_async,
+                        user["user_id"],
+                        hashed_password,
+                        lambda _: self.do_login(user, True),
+                        _base.reraise)
+
+    def _on_rehash_failed(self, user, e): # pragma: no cover
+        _log.warning("Failed to rehash password for %s: %s", user["email"], e)
+        self.do_login(user, True)
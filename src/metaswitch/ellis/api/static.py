@@ -10,7 +10,10 @@
 
 import re
 import logging
-from tornado.web import StaticFileHandler
+import httplib
+from functools import partial
+from tornado.web import StaticFileHandler, asynchronous
+from metaswitch.ellis import background
 from metaswitch.ellis.api._base import UsernameCookieMixin
 
 _log = logging.getLogger("ellis.api")
@@ -45,11 +48,31 @@ class AuthenticatedStaticFileHandler(StaticFileHandler, UsernameCookieMixin):
         self.login_url = login_url
         self.allowed_regexes = allowed_regexes
 
+    @asynchronous
     def get(self, path, **kwargs):
-        if self.path_is_restricted(path) and not self.request_is_authenticated():
-            self.redirect_to_login_page()
+        if not self.path_is_restricted(path):
+            self._serve(path, kwargs)
             return
+        # The user is looked up on a database thread.
+        try:
+            self.get_logged_in_username_async(partial(self._on_checked_login, path, kwargs),
+                                              self._on_check_login_failed)
+        except background.PoolFull:
+            self.send_error(httplib.SERVICE_UNAVAILABLE)
+
+    def _on_checked_login(self, path, kwargs, username):
+        if username is None:
+            self.redirect_to_login_page()
+        else:
+            self._serve(path, kwargs)
+
+    def _on_check_login_failed(self, e):
+        raise e
+
+    def _serve(self, path, kwargs):
         super(AuthenticatedStaticFileHandler, self).get(path, **kwargs)
+        if not self._finished:
+            self.finish()
 
     def path_is_restricted(self, path):
         _log.debug("Checking if %s is allowed", path)
@@ -67,9 +90,6 @@ class AuthenticatedStaticFileHandler(StaticFileHandler, UsernameCookieMixin):
         # FIXME A bit messy
         pass
 
-    def request_is_authenticated(self):
-        return self.logged_in_username is not None
-
     def redirect_to_login_page(self):
         _log.debug("Redirecting to %s", self.login_url)
         self.redirect(self.login_url, False)
@@ -13,9 +13,14 @@ RequestHandlers for dealing with user signup and management.
 
 import logging
 import httplib
+import collections
+from functools import partial
 
+from tornado import stack_context
+from tornado.ioloop import IOLoop
 from tornado.web import HTTPError, asynchronous
 
+from metaswitch.common import utils
 from metaswitch.common.throttler import Throttler
 
 from metaswitch.ellis.api import _base
@@ -25,7 +30,8 @@ from metaswitch.ellis.api.validation import REQUIRED, OPTIONAL, STRING, validate
 from metaswitch.ellis.data import users, numbers
 from metaswitch.ellis.data import AlreadyExists, NotFound
 from metaswitch.ellis.mail import mail
-from metaswitch.ellis import settings
+from metaswitch.ellis.remote import homestead
+from metaswitch.ellis import settings, background
 
 _log = logging.getLogger("ellis.api")
 
@@ -48,19 +54,21 @@ class AccountsHandler(_base.BaseHandler):
         if signup_code != settings.SIGNUP_CODE:
             _log.warning("Request had wrong/missing signup code %s", signup_code)
             raise HTTPError(httplib.FORBIDDEN, "Missing signup code")
+        self.run_password_job(users.hash_password_async,
+                              self.request_data["password"],
+                              self._on_password_hashed,
+                              _base.reraise)
+
+    def _on_password_hashed(self, hashed_password):
         data = self.request_data
-        db_sess = self.db_session()
-        try:
-            user = users.create_user(db_sess,
-                                     data["password"],
-                                     data["full_name"], data["email"],
-                                     int(data["expires"]) if "expires" in data else None)
-        except AlreadyExists:
-            db_sess.rollback()
-            raise HTTPError(httplib.CONFLICT, "Email already exists")
-        else:
-            db_sess.commit()
-            self.do_login(user)
+        self.run_db_job(users.create_user_async,
+                        data["password"],
+                        data["full_name"],
+                        data["email"],
+                        int(data["expires"]) if "expires" in data else None,
+                        hashed_password,
+                        self.do_login,
+                        _on_create_user_failed)
 
     post.validation = {
             "password": (REQUIRED, STRING, _PASSWORD_REGEXP),
@@ -69,6 +77,11 @@ class AccountsHandler(_base.BaseHandler):
             "expires": (OPTIONAL, STRING, r'[0-9]+'),
         }
 
+def _on_create_user_failed(e):
+    if isinstance(e, AlreadyExists):
+        raise HTTPError(httplib.CONFLICT, "Email already exists")
+    raise e
+
 class AccountPasswordHandler(_base.BaseHandler):
     def authenticate_request(self): # pragma: no cover
         # Do not require the API key for these calls.
@@ -88,22 +101,26 @@ class AccountPasswordHandler(_base.BaseHandler):
         _log.info("Recover password for %s", address)
         if not _email_throttler.is_allowed():
             _log.warn("Throttling to avoid being blacklisted")
-            raise HTTPErrorEx(httplib.SERVICE_UNAVAILABLE, "Request throttled", headers={"Retry-After", str(_email_throttler.interval_sec)})
-        db_sess = self.db_session()
-        try:
-            token = users.get_token(db_sess, address)
-        except ValueError:
-            # To avoid revealing who subscribes to our service to
-            # third parties, this must behave identically to the case
-            # where the email is recognised.
-            db_sess.rollback()
-            _log.info("Silently ignoring unrecognised email")
-        else:
-            db_sess.commit()
-            user = users.get_details(db_sess, address)
-            urlbase = self.request.protocol + "://" + self.request.host + \
-                settings.EMAIL_RECOVERY_PATH
-            mail.send_recovery_message(urlbase, user["email"], user["full_name"], token)
+            raise HTTPErrorEx(httplib.SERVICE_UNAVAILABLE, "Request throttled", headers={"Retry-After": str(_email_throttler.interval_sec)})
+        self.run_db_job(users.get_token_async,
+                        address,
+                        self._on_got_token,
+                        self._on_get_token_failed)
+
+    def _on_got_token(self, token_and_user):
+        token, user = token_and_user
+        urlbase = self.request.protocol + "://" + self.request.host + \
+            settings.EMAIL_RECOVERY_PATH
+        mail.send_recovery_message(urlbase, user["email"], user["full_name"], token)
+        self.send_success(httplib.OK)
+
+    def _on_get_token_failed(self, e):
+        if not isinstance(e, ValueError):
+            raise e
+        # To avoid revealing who subscribes to our service to third parties,
+        # this must behave identically to the case where the email is
+        # recognised.
+        _log.info("Silently ignoring unrecognised email")
         self.send_success(httplib.OK)
 
     def _set_recovered_password(self, address, token):
@@ -111,56 +128,265 @@ class AccountPasswordHandler(_base.BaseHandler):
         _log.info("Set recovery password for %s (token %s)", address, token)
         if not _recover_throttler.is_allowed():
             _log.warn("Throttling to avoid brute-force attacks")
-            raise HTTPErrorEx(httplib.SERVICE_UNAVAILABLE, "Request throttled", headers={"Retry-After", str(_recover_throttler.interval_sec)})
+            raise HTTPErrorEx(httplib.SERVICE_UNAVAILABLE, "Request throttled", headers={"Retry-After": str(_recover_throttler.interval_sec)})
         password = self.request_text_or_field("password")
         ok, msg = validate({"password": password}, {"password": (REQUIRED, STRING, _PASSWORD_REGEXP)})
         if not ok: # pragma: no cover
             raise HTTPError(httplib.BAD_REQUEST, "Password not acceptable")
-        db_sess = self.db_session()
-        try:
-            users.set_recovered_password(db_sess, address, token, password)
-            db_sess.commit()
-        except (ValueError, NotFound):
-            # Wrong token or unknown email address - for security reasons, these
-            # must behave identically.
-            db_sess.rollback()
-            raise HTTPError(httplib.UNPROCESSABLE_ENTITY, "Invalid token or email address")
-        self.send_success(httplib.OK)
+        # Check the token before the expensive business of hashing the
+        # password.
+        self.run_db_job(users.check_recovery_token_async,
+                        address,
+                        token,
+                        lambda _: self._hash_recovered_password(address, token, password),
+                        _on_recovery_token_failed)
+
+    def _hash_recovered_password(self, address, token, password):
+        self.run_password_job(users.hash_password_async,
+                              password,
+                              partial(self._on_recovered_password_hashed, address, token),
+                              _base.reraise)
+
+    def _on_recovered_password_hashed(self, address, token, hashed_password):
+        # The token is checked again, in case it has been used or has expired
+        # while we were hashing.
+        self.run_db_job(users.set_recovered_password_async,
+                        address,
+                        token,
+                        hashed_password,
+                        lambda _: self.send_success(httplib.OK),
+                        _on_recovery_token_failed)
+
+def _on_recovery_token_failed(e):
+    if isinstance(e, (ValueError, NotFound)):
+        # Wrong token or unknown email address - for security reasons, these
+        # must behave identically.
+        raise HTTPError(httplib.UNPROCESSABLE_ENTITY, "Invalid token or email address")
+    raise e
 
 class AccountHandler(_base.LoggedInHandler):
     def __init__(self, application, request, **kwargs):
         super(AccountHandler, self).__init__(application, request, **kwargs)
-        self._request_group = None
         self._user_id = None
-        self._numbers = None
-        self._sip_uri = None
 
     @asynchronous
     def delete(self, email):
         _log.info("Request to delete account")
-        self._user_id = self.get_and_check_user_id(email)
-        self._numbers = numbers.get_numbers(self.db_session(), self._user_id)
-        self._do_delete_work()
-
-    def _do_delete_work(self):
-        # If there are still numbers to delete, do so.  If not, delete the user and return.
-        if len(self._numbers) > 0:
-            api_numbers.remove_public_id(self.db_session(), self._numbers.pop()["number"],
-                                         self._on_delete_post_success, self._on_delete_post_failure, True)
-        else:
-            _log.debug("Deleting user %s", self._user_id)
-            db_sess = self.db_session()
-            users.delete_user(db_sess, self._user_id)
-            db_sess.commit()
-            self.send_success(httplib.NO_CONTENT)
-
-    def _on_delete_post_success(self, responses):
-        _log.debug("Successfully updated all the backends for %s", self._sip_uri)
-        # We've updated all the backends, so delete the next number
-        self._do_delete_work()
-
-    def _on_delete_post_failure(self, response):
-        _log.warn("Failed to update all the backends for %s", self._sip_uri)
-        # Bin out.  We will end up leaving some backends with data, but the number
-        # will still be owned by this user, so they can try deleting again.
+        self.get_and_check_user_id_async(email, self._delete_account)
+
+    def _delete_account(self, user_id):
+        self._user_id = user_id
+        delete_account(self._user_id,
+                       self._on_delete_success,
+                       self._on_delete_failure)
+
+    def _on_delete_success(self):
+        self.send_success(httplib.NO_CONTENT)
+
+    def _on_delete_failure(self, response):
+        # Bin out.  We will end up leaving some backends with data, but the
+        # numbers that are left will still be owned by this user, so they can
+        # try deleting again.
         self.forward_error(response)
+
+class AccountsDeprovisionHandler(_base.LoggedInHandler):
+    """
+    Deletes many accounts in one request, as for AccountHandler.delete.  This
+    is an admin-only operation.
+    """
+
+    def __init__(self, application, request, **kwargs):
+        super(AccountsDeprovisionHandler, self).__init__(application, request, **kwargs)
+        self._pending = None
+        self._results = None
+        self._in_flight = 0
+        self._start_next = None
+
+    @asynchronous
+    def post(self):
+        self.is_admin_request()
+        emails = self.request_data.get("emails")
+        if (not isinstance(emails, list) or
+            not all(isinstance(e, basestring) for e in emails)):
+            raise HTTPError(httplib.BAD_REQUEST, "emails should be a list of strings")
+        if len(emails) > settings.DEPROVISION_MAX_ACCOUNTS:
+            raise HTTPError(httplib.BAD_REQUEST,
+                            "At most %d accounts may be deleted at once" % settings.DEPROVISION_MAX_ACCOUNTS)
+        _log.info("Request to delete %d accounts", len(emails))
+
+        # Each account is only deleted once, however many times it's listed
+        self._pending = collections.deque()
+        self._results = collections.OrderedDict()
+        for email in emails:
+            if email not in self._results:
+                self._results[email] = None
+                self._pending.append(email)
+
+        if not self._pending:
+            self._finish_deprovision()
+            return
+        # Start each deletion in the request's own stack context, rather than
+        # in that of the account whose deletion finished before it.
+        self._start_next = stack_context.wrap(self._delete_next)
+        for _ in range(min(settings.DEPROVISION_MAX_ACCOUNTS_IN_FLIGHT, len(self._pending))):
+            # Deletions may complete synchronously, and start the rest
+            if self._pending:
+                self._delete_next()
+
+    def _delete_next(self):
+        if not self._pending:
+            # Another deletion finishing got there first
+            return
+        email = self._pending.popleft()
+        self._in_flight += 1
+        # Delete each account in its own stack context, so that an error is
+        # recorded against that account, rather than failing the whole
+        # request while other deletions are still in flight.
+        with stack_context.ExceptionStackContext(partial(self._on_account_error, email)):
+            users.lookup_user_id_async(email,
+                                       partial(self._on_got_user_id, email),
+                                       partial(self._on_lookup_failed, email))
+
+    def _on_got_user_id(self, email, user_id):
+        delete_account(user_id,
+                       partial(self._on_account_done, email, {"status": httplib.NO_CONTENT}),
+                       partial(self._on_account_failed, email))
+
+    def _on_lookup_failed(self, email, e):
+        if not isinstance(e, NotFound):
+            raise e
+        self._on_account_done(email, {"status": httplib.NOT_FOUND,
+                                      "reason": "User not found"})
+
+    def _on_account_failed(self, email, response):
+        _log.warn("Failed to delete account %s", email)
+        self._on_account_done(email, {"status": httplib.BAD_GATEWAY,
+                                      "reason": "Upstream request failed",
+                                      "detail": {"Upstream error": str(getattr(response, "code", None))}})
+
+    def _on_account_error(self, email, typ, value, tb):
+        if self._results[email] is not None:
+            _log.error("Error after deleting account %s", email, exc_info=(typ, value, tb))
+            return True
+        _log.error("Failed to delete account %s", email, exc_info=(typ, value, tb))
+        if isinstance(value, background.PoolFull):
+            result = {"status": httplib.SERVICE_UNAVAILABLE,
+                      "reason": "Too many background jobs"}
+        else:
+            result = {"status": httplib.INTERNAL_SERVER_ERROR,
+                      "reason": "Internal error"}
+        self._on_account_done(email, result)
+        return True
+
+    def _on_account_done(self, email, result):
+        if self._results[email] is not None:
+            _log.warning("Ignoring a second result for account %s", email)
+            return
+        self._in_flight -= 1
+        result["email"] = email
+        self._results[email] = result
+        if self._pending:
+            # Start the next from the IOLoop, as deletions can complete
+            # synchronously (e.g. for unknown accounts), and a long list of
+            # them mustn't recurse.
+            IOLoop.instance().add_callback(self._start_next)
+        elif self._in_flight == 0:
+            self._finish_deprovision()
+
+    def _finish_deprovision(self):
+        self.finish({"accounts": self._results.values()})
+
+def delete_account(user_id, on_success, on_failure):
+    """
+    Deletes an account.  Each of its numbers is removed from Homestead and
+    Homer, as by numbers.remove_public_id, with up to
+    ACCOUNT_DELETE_MAX_IN_FLIGHT at once, and then the account itself is
+    deleted and on_success called.  If any number can't be removed, no more
+    are started, and on_failure is called with the response of the first
+    that failed once the rest have finished.  The account's database queries
+    are made on the database threads.
+    """
+    _AccountDeleter(user_id, on_success, on_failure).start()
+
+class _AccountDeleter(object):
+    def __init__(self, user_id, on_success, on_failure):
+        self._user_id = user_id
+        self._on_success = on_success
+        self._on_failure = on_failure
+        self._sip_uris = None
+        # The numbers to remove, in batches that must be removed in turn, and
+        # those left in the current batch
+        self._batches = None
+        self._batch = collections.deque()
+        self._in_flight = 0
+        self._failure = None
+
+    def start(self):
+        numbers.get_numbers_async(self._user_id, self._on_got_numbers, _base.reraise)
+
+    def _on_got_numbers(self, user_numbers):
+        self._sip_uris = [n["number"] for n in user_numbers]
+        if not self._sip_uris:
+            self._delete_user()
+            return
+        # remove_public_id won't remove the public ID that a private ID was
+        # created for while other public IDs share that private ID, so those
+        # others must be removed first.  The lookups are cached, so this
+        # doesn't cost remove_public_id any more requests.
+        homestead.get_associated_privates_batch(self._sip_uris, self._on_got_privates)
+
+    def _on_got_privates(self, private_ids, errors):
+        shared = []
+        original = []
+        for sip_uri in self._sip_uris:
+            privates = private_ids.get(sip_uri)
+            if privates and privates[0] != utils.sip_public_id_to_private(sip_uri):
+                shared.append(sip_uri)
+            else:
+                # This includes numbers that couldn't be looked up, which
+                # remove_public_id deals with
+                original.append(sip_uri)
+        self._batches = [b for b in (shared, original) if b]
+        self._start_batch()
+
+    def _start_batch(self):
+        self._batch = collections.deque(self._batches.pop(0))
+        for _ in range(min(settings.ACCOUNT_DELETE_MAX_IN_FLIGHT, len(self._batch))):
+            # Removals may complete synchronously, and start the rest
+            if self._batch and self._failure is None:
+                self._remove_next()
+
+    def _remove_next(self):
+        sip_uri = self._batch.popleft()
+        self._in_flight += 1
+        api_numbers.remove_public_id(sip_uri,
+                                     partial(self._on_removed, sip_uri),
+                                     partial(self._on_remove_failed, sip_uri),
+                                     True)
+
+    def _on_removed(self, sip_uri, responses):
+        _log.debug("Successfully updated all the backends for %s", sip_uri)
+        self._on_done()
+
+    def _on_remove_failed(self, sip_uri, response):
+        _log.warn("Failed to update all the backends for %s", sip_uri)
+        if self._failure is None:
+            self._failure = response
+        self._on_done()
+
+    def _on_done(self):
+        self._in_flight -= 1
+        if self._failure is not None:
+            if self._in_flight == 0:
+                self._on_failure(self._failure)
+        elif self._batch:
+            self._remove_next()
+        elif self._in_flight == 0:
+            if self._batches:
+                self._start_batch()
+            else:
+                self._delete_user()
+
+    def _delete_user(self):
+        _log.debug("Deleting user %s", self._user_id)
+        users.delete_user_async(self._user_id, lambda _: self._on_success(), _base.reraise)
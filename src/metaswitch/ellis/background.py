@@ -8,8 +8,16 @@
 # Metaswitch Networks in a separate written agreement.
 
 
+import logging
+import os
 import threading
+import Queue
 import tornado
+from functools import partial
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+_log = logging.getLogger("ellis")
 
 background_io_loop = None
 
@@ -21,3 +29,70 @@ def start_background_worker_io_loop():
     t = threading.Thread(name="bg_ioloop_thread", target=background_io_loop.start)
     t.daemon = True
     t.start()
+
+
+class PoolFull(Exception):
+    """Raised when a WorkerPool already has as many jobs queued as it
+    allows."""
+    pass
+
+class WorkerPool(object):
+    """
+    Runs blocking functions on a pool of threads, so that they don't hold up
+    the IOLoop, and passes their results back to the IOLoop.
+
+    At most max_queued jobs may be waiting for a thread - beyond that, run
+    raises PoolFull, so that callers can turn work away rather than build up
+    a backlog they will never get through.
+    """
+
+    def __init__(self, name, num_threads, max_queued):
+        self._name = name
+        self._num_threads = num_threads
+        self._max_queued = max_queued
+        self._queue = None
+        self._pid = None
+
+    def run(self, fn, args, callback, errback):
+        """
+        Calls fn(*args) on a worker thread.  callback is then called on the
+        IOLoop with the result, or errback with the exception if it raised.
+        """
+        self._start()
+        # Capture the caller's stack context, so that exceptions raised from
+        # the callbacks are handled as if raised by the caller.
+        job = (fn, args, stack_context.wrap(callback), stack_context.wrap(errback))
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            _log.warning("Too many %s jobs queued", self._name)
+            raise PoolFull()
+
+    def full(self):
+        return (self._pid == os.getpid() and
+                self._max_queued > 0 and
+                self._queue.qsize() >= self._max_queued)
+
+    def _start(self):
+        # Threads don't survive forking, so start them in the process that
+        # uses them.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queue = Queue.Queue(self._max_queued)
+        for i in range(self._num_threads):
+            t = threading.Thread(name="%s_thread_%d" % (self._name, i),
+                                 target=self._worker)
+            t.daemon = True
+            t.start()
+
+    def _worker(self):
+        while True:
+            fn, args, callback, errback = self._queue.get()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                _log.exception("%s job failed", self._name)
+                IOLoop.instance().add_callback(partial(errback, e))
+            else:
+                IOLoop.instance().add_callback(partial(callback, result))
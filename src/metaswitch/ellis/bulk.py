@@ -0,0 +1,278 @@
+# @file bulk.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Helpers for the command-line tools that work through many numbers or
+subscribers at once.
+"""
+
+import collections
+import logging
+import os
+import re
+import sys
+import time
+import tornado.ioloop
+from functools import partial
+from tornado import stack_context
+
+_log = logging.getLogger("ellis.bulk")
+
+def parse_dn_ranges(dn_ranges):
+    """
+    A generator that parses DN ranges of the form <start-dn>..<end-dn>,... or
+    <single-dn>,... and yields each individual DN.
+    """
+    for dn_range in dn_ranges.split(","):
+        # Split on .. into start and end DNs.  If there's no .., set them identically.
+        dn_range = dn_range.split("..")
+        start_dn = dn_range[0]
+        end_dn = dn_range[1] if len(dn_range) > 1 else dn_range[0]
+
+        if len(start_dn) != len(end_dn):
+            _log.error("Directory number range %s..%s has different start and end number lengths", start_dn, end_dn)
+            continue
+
+        # Find any non-numeric prefix (e.g. +) and check that both numbers have it.
+        dn_prefix = re.search("^[^0-9]*", start_dn).group(0)
+        if not end_dn.startswith(dn_prefix):
+            _log.error("Directory number range %s..%s has different start and end number prefixes", start_dn, end_dn)
+            continue
+
+        # Strip the prefix, iterate through the resulting numbers and yield them
+        suffix_len = len(start_dn) - len(dn_prefix)
+        start_num = int(start_dn[len(dn_prefix):])
+        end_num = int(end_dn[len(dn_prefix):])
+        for num in xrange(start_num, end_num + 1):
+            yield "%s%0*d" % (dn_prefix, suffix_len, num)
+
+class BulkRunner(object):
+    """
+    Runs job(item, callback) for each of a sequence of items, keeping up to
+    window jobs in flight at once, so that bulk operations are limited by how
+    fast homestead-prov can serve them rather than by the round trip time.
+    Each job passes True or False to callback to say whether it succeeded.
+    A job that raises an exception, whether straight away or from one of its
+    callbacks later on, fails; and only the first result each job passes back
+    counts.
+
+    Progress is reported every second.  If checkpoint_file is given, it
+    records the last item (or item_id(item), if items aren't strings) such
+    that it and every item before it have been done, and items up to that
+    one are skipped when resuming from it.  If items is callable, it is
+    instead called with the checkpoint (or None) to get the items after it,
+    so that a source that can seek, such as a database query, needn't be
+    read from the start.  If reading the items fails, the run stops as if an
+    item had failed.  A failed item stops the run, and isn't covered by the
+    checkpoint, so it is retried on resuming - unless keep_going is set, in
+    which case failed items are just reported and passed over.
+
+    If key is given, items for which it returns the same (non-None) key,
+    such as subscribers sharing an IMPI, are run in turn rather than at once.
+
+    If rate is given, at most rate items are started each second.  If total
+    is given (as a number, or like items as a function of the checkpoint),
+    the progress reports include an estimate of the time remaining.
+    """
+
+    def __init__(self, items, job, window, checkpoint_file=None, keep_going=False, verb="Processed", key=None, item_id=None,
+                 rate=None, total=None):
+        self._items = items
+        self._job = job
+        self._rate = rate
+        self._total = total
+        self._next_start = 0
+        self._timer_pending = False
+        self._key = key
+        self._item_id = item_id or (lambda item: item)
+        # Jobs waiting for the one in flight with the same key to finish, by
+        # key
+        self._waiting = {}
+        self._window = window
+        self._checkpoint_file = checkpoint_file
+        self._keep_going = keep_going
+        self._verb = verb
+        self.succeeded = 0
+        self.failed = 0
+        self._in_flight = 0
+        # [item, done] for each item started, in order, up to the first that
+        # isn't done
+        self._started = collections.deque()
+        self._checkpoint = None
+        self._exhausted = False
+        self._stopping = False
+        self._finished = False
+        self._last_report = (time.time(), 0)
+        self._start_time = time.time()
+        self._io_loop = tornado.ioloop.IOLoop.instance()
+
+    def run(self):
+        """Runs all the jobs, returning True if they all succeeded."""
+        self._skip_to_checkpoint()
+        if callable(self._total):
+            self._total = self._total(self._checkpoint)
+        self._start_time = time.time()
+        reporter = tornado.ioloop.PeriodicCallback(self._report, 1000, io_loop=self._io_loop)
+        reporter.start()
+        self._io_loop.add_callback(self._fill)
+        self._io_loop.start()
+        reporter.stop()
+        self._report()
+
+        if self.failed == 0 and self._exhausted:
+            if self._checkpoint_file and os.path.exists(self._checkpoint_file):
+                os.remove(self._checkpoint_file)
+            return True
+        self._write_checkpoint()
+        return False
+
+    def _skip_to_checkpoint(self):
+        checkpoint = None
+        if self._checkpoint_file and os.path.exists(self._checkpoint_file):
+            with open(self._checkpoint_file) as f:
+                checkpoint = f.read().strip()
+            print("Resuming after {}".format(checkpoint))
+
+        if callable(self._items):
+            self._items = iter(self._items(checkpoint))
+            self._checkpoint = checkpoint
+            return
+        self._items = iter(self._items)
+        if checkpoint is None:
+            return
+        for item in self._items:
+            if self._item_id(item) == checkpoint:
+                self._checkpoint = checkpoint
+                return
+        # The checkpoint doesn't match these items, so there's nothing left
+        _log.error("Checkpoint %s not found in the items to process", checkpoint)
+        self._exhausted = True
+
+    def _on_rate_timer(self):
+        self._timer_pending = False
+        self._fill()
+
+    def _fill(self):
+        while (self._in_flight < self._window and
+               not self._exhausted and
+               not self._stopping):
+            if self._rate:
+                now = time.time()
+                if self._next_start > now:
+                    if not self._timer_pending:
+                        self._timer_pending = True
+                        self._io_loop.add_timeout(self._next_start, self._on_rate_timer)
+                    break
+                self._next_start = max(self._next_start, now - 1) + 1.0 / self._rate
+            try:
+                item = next(self._items)
+            except StopIteration:
+                self._exhausted = True
+                break
+            except Exception as e:
+                _log.error("Failed to read the items to process - %s", e)
+                self._exhausted = True
+                self.failed += 1
+                break
+            entry = [item, False]
+            self._started.append(entry)
+            self._in_flight += 1
+            key = self._key(item) if self._key else None
+            if key is None:
+                self._start(entry, key)
+            elif key in self._waiting:
+                self._waiting[key].append(entry)
+            else:
+                self._waiting[key] = collections.deque()
+                self._start(entry, key)
+
+        if (self._in_flight == 0 and
+            (self._exhausted or self._stopping) and
+            not self._finished):
+            # Only stop the IOLoop once, as a stop left over from this run
+            # would end the next one as soon as it started.
+            self._finished = True
+            self._io_loop.stop()
+
+    def _start(self, entry, key):
+        state = {"done": False}
+
+        def on_done(success):
+            if state["done"]:
+                _log.warning("Ignoring a second result for %s", entry[0])
+                return
+            state["done"] = True
+            self._on_done(entry, key, success)
+
+        def on_exception(typ, value, tb):
+            _log.error("Failed to process %s - %s", entry[0], value, exc_info=(typ, value, tb))
+            if not state["done"]:
+                on_done(False)
+            return True
+
+        # Run the job in its own stack context, so that an exception from any
+        # of its callbacks fails the item rather than leaving it in flight for
+        # ever.
+        with stack_context.ExceptionStackContext(on_exception):
+            self._job(entry[0], on_done)
+
+    def _on_done(self, entry, key, success):
+        # Schedule further work outside the finished job's stack context, so
+        # that contexts don't pile up from one job to the next.
+        with stack_context.NullContext():
+            self._after_done(entry, key, success)
+
+    def _after_done(self, entry, key, success):
+        if key is not None:
+            if self._waiting[key]:
+                self._io_loop.add_callback(partial(self._start, self._waiting[key].popleft(), key))
+            else:
+                del self._waiting[key]
+        self._in_flight -= 1
+        if success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+            if not self._keep_going:
+                self._stopping = True
+        entry[1] = success or self._keep_going
+        while self._started and self._started[0][1]:
+            self._checkpoint = self._item_id(self._started.popleft()[0])
+        # Start the next job from the IOLoop, rather than from within this
+        # one's callback chain.
+        self._io_loop.add_callback(self._fill)
+
+    def _report(self):
+        now = time.time()
+        done = self.succeeded + self.failed
+        last_time, last_done = self._last_report
+        rate = (done - last_done) / (now - last_time) if now > last_time else 0
+        self._last_report = (now, done)
+        eta = ""
+        if self._total and done and now > self._start_time:
+            remaining = max(self._total - done, 0) * (now - self._start_time) / done
+            eta = ", ETA {}m{:02d}s".format(int(remaining) / 60, int(remaining) % 60)
+            done = "{}/{}".format(done, self._total)
+        print("{} {} ({} failed, {} in flight) - {:.0f}/s{}".format(self._verb,
+                                                                    done,
+                                                                    self.failed,
+                                                                    self._in_flight,
+                                                                    rate,
+                                                                    eta))
+        sys.stdout.flush()
+        self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        if not self._checkpoint_file or self._checkpoint is None:
+            return
+        # Write and rename, so the checkpoint is never left half written.
+        tmp_file = self._checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(self._checkpoint + "\n")
+        os.rename(tmp_file, self._checkpoint_file)
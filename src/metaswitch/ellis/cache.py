@@ -0,0 +1,61 @@
+# @file cache.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import time
+from collections import OrderedDict
+
+class TTLCache(object):
+    """
+    A cache of at most max_size entries, each of which expires ttl seconds
+    after it was added.  When the cache is full, the least recently used
+    entry is evicted.  A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size, ttl):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped whenever entries are invalidated, so that callers who looked
+        # something up before the invalidation can tell not to cache it.
+        self.generation = 0
+
+    def get(self, key):
+        """Returns the value cached for key, or None if there isn't one"""
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= time.time():
+            self.misses += 1
+            return None
+        # Move the entry to the most recently used end
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if self._max_size <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self._ttl, value)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries)}
@@ -0,0 +1,147 @@
+# @file allocator.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Allocates numbers from batches leased from the pool by this process.
+
+Allocating straight from the pool locks rows in the numbers index, so bursts
+of allocations from several processes contend with each other.  Instead, if
+NUMBER_LEASE_BATCH_SIZE is set, each process leases a batch of free numbers
+at once and hands them out one at a time, so each allocation is a primary key
+update of a number no other process will touch.  Leases are short-lived, so
+the numbers leased by a process that dies soon return to the pool.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from metaswitch.ellis import settings
+from metaswitch.ellis.data import connection, dbpool, numbers
+from metaswitch.ellis.data._base import NotFound
+
+_log = logging.getLogger("ellis.data")
+
+# Stop handing out leased numbers this long before their lease expires, so we
+# never race with another process picking up the expired lease.
+LEASE_MARGIN_SECS = 5
+
+class NumberAllocator(object):
+    def __init__(self, batch_size, lease_secs):
+        self.lease_id = uuid.uuid4().hex
+        self._batch_size = batch_size
+        self._lease_secs = lease_secs
+        # Leased number IDs, and when the lease on them runs out, by PSTN flag
+        self._number_ids = {True: [], False: []}
+        self._expiry = {True: 0, False: 0}
+        # Allocations are made on the database threads, so only one at a
+        # time may take a leased number or lease more.
+        self._lock = threading.Lock()
+
+    def allocate_number(self, db_sess, user_id, pstn=False):
+        """Allocates a leased number to user_id, leasing some more if we've
+        run out.  Raises NotFound if there are no free numbers left."""
+        leased = False
+        while True:
+            with self._lock:
+                if (not self._number_ids[pstn] or
+                    time.time() >= self._expiry[pstn]):
+                    if leased:
+                        # We've lost all of the batch we just leased
+                        break
+                    self._lease_numbers(pstn)
+                    leased = True
+
+                if not self._number_ids[pstn]:
+                    break
+
+                number_id = self._number_ids[pstn].pop()
+            if numbers.allocate_leased_number(db_sess, user_id, number_id, self.lease_id):
+                return uuid.UUID(number_id)
+            _log.warning("Lease on number %s has been lost", number_id)
+
+        _log.warning("No free numbers to lease")
+        raise NotFound()
+
+    def release_leases(self):
+        """Returns the numbers we haven't allocated yet to the pool"""
+        self._number_ids = {True: [], False: []}
+        self._expiry = {True: 0, False: 0}
+        db_sess = connection.Session()
+        try:
+            numbers.release_leases(db_sess, self.lease_id)
+            db_sess.commit()
+        finally:
+            db_sess.close()
+
+    def _lease_numbers(self, pstn):
+        # The lease is committed in its own session, so that other processes
+        # see it immediately, whatever happens to the caller's transaction.
+        expiry = time.time() + self._lease_secs - LEASE_MARGIN_SECS
+        db_sess = connection.Session()
+        try:
+            number_ids = numbers.lease_numbers(db_sess,
+                                               self.lease_id,
+                                               pstn,
+                                               self._batch_size,
+                                               self._lease_secs)
+            db_sess.commit()
+        finally:
+            db_sess.close()
+        self._number_ids[pstn] = number_ids
+        self._expiry[pstn] = expiry
+
+_allocator = None
+_allocator_pid = None
+
+def get_allocator():
+    """Returns this process's allocator.  Each process must have its own
+    lease, so a new allocator is created after forking."""
+    global _allocator, _allocator_pid
+    if _allocator_pid != os.getpid():
+        _allocator = NumberAllocator(settings.NUMBER_LEASE_BATCH_SIZE,
+                                     settings.NUMBER_LEASE_SECS)
+        _allocator_pid = os.getpid()
+    return _allocator
+
+def allocate_number(db_sess, user_id, pstn=False):
+    """Allocates a random free number to user_id, from this process's leased
+    numbers if NUMBER_LEASE_BATCH_SIZE is set."""
+    if settings.NUMBER_LEASE_BATCH_SIZE:
+        return get_allocator().allocate_number(db_sess, user_id, pstn)
+    else:
+        return numbers.allocate_number(db_sess, user_id, pstn)
+
+def allocate_numbers(db_sess, user_id, count, pstn=False):
+    """Allocates count random free numbers to user_id, as allocate_number,
+    in the caller's transaction.  Raises NotFound if there aren't that many
+    free numbers left, in which case the caller should roll back."""
+    return [allocate_number(db_sess, user_id, pstn) for _ in xrange(count)]
+
+def allocate_numbers_async(user_id, count, pstn, callback, errback):
+    """Allocates count numbers to user_id, as allocate_numbers, in one
+    transaction on a database thread.  Passes callback a list of the
+    allocated numbers' (number ID, SIP URI), or NotFound to errback if there
+    weren't enough free numbers.  Raises background.PoolFull if the pool is
+    overloaded."""
+    dbpool.run(_allocate_numbers, (user_id, count, pstn), callback, errback)
+
+def _allocate_numbers(db_sess, user_id, count, pstn):
+    number_ids = allocate_numbers(db_sess, user_id, count, pstn)
+    return [(number_id, numbers.get_number(db_sess, number_id, user_id))
+            for number_id in number_ids]
+
+def release_leases():
+    """Returns any numbers leased by this process to the pool.  Called on
+    shutdown."""
+    if _allocator and _allocator_pid == os.getpid():
+        _log.info("Releasing leased numbers")
+        _allocator.release_leases()
@@ -68,6 +68,51 @@ BEGIN
     ALTER TABLE numbers ADD COLUMN specified boolean NOT NULL DEFAULT False;
   END IF;
 
+  -- --------------------------------------------------------------------------
+  -- Add the random allocation key to the numbers table, so that numbers can
+  -- be allocated randomly without sorting the whole pool.
+  -- --------------------------------------------------------------------------
+  IF NOT EXISTS (SELECT * FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='numbers' AND COLUMN_NAME='rand_key') THEN
+    ALTER TABLE numbers ADD COLUMN rand_key int unsigned NOT NULL DEFAULT 0;
+    UPDATE numbers SET rand_key = FLOOR(RAND() * 4294967296);
+    ALTER TABLE numbers ADD INDEX allocation (pstn, owner_id, rand_key);
+  END IF;
+
+  -- --------------------------------------------------------------------------
+  -- Add the lease fields to the numbers table, so that Ellis processes can
+  -- reserve batches of free numbers to allocate from.
+  -- --------------------------------------------------------------------------
+  IF NOT EXISTS (SELECT * FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='numbers' AND COLUMN_NAME='lease_id') THEN
+    ALTER TABLE numbers
+          ADD COLUMN lease_id varchar(32) NULL,
+          ADD COLUMN lease_expires datetime NULL,
+          ADD INDEX (lease_id);
+  END IF;
+
+  -- --------------------------------------------------------------------------
+  -- Add the global address book version, bumped whenever the GAB changes, so
+  -- that Ellis can tell whether its copy of the GAB is still current.
+  -- --------------------------------------------------------------------------
+  IF NOT EXISTS (SELECT * FROM information_schema.TABLES WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='gab_version') THEN
+    CREATE TABLE gab_version (
+      id tinyint NOT NULL PRIMARY KEY,
+      version bigint unsigned NOT NULL
+    ) ENGINE=InnoDB;
+    INSERT INTO gab_version (id, version) VALUES (0, 1);
+  END IF;
+
+  -- --------------------------------------------------------------------------
+  -- Add change tracking to the numbers table, so that sync_databases can
+  -- re-check only the lines that have changed (or haven't been checked for a
+  -- while).  Existing numbers count as changed, but not yet verified.
+  -- --------------------------------------------------------------------------
+  IF NOT EXISTS (SELECT * FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='numbers' AND COLUMN_NAME='last_verified') THEN
+    ALTER TABLE numbers
+          ADD COLUMN last_modified timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          ADD COLUMN last_verified timestamp NULL DEFAULT NULL,
+          ADD INDEX (last_verified);
+  END IF;
+
 END $$
 DELIMITER ;
 
@@ -0,0 +1,53 @@
+# @file dbpool.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Runs database queries on a pool of threads, so that a slow query holds up
+only the request that made it, rather than every request on the IOLoop.
+
+Each job runs in a session of its own, taken from the connection.engine
+pool, so DB_THREADS should leave some of that pool for the sessions still
+used on the IOLoop.
+"""
+
+import logging
+
+from metaswitch.ellis import settings, background
+from metaswitch.ellis.data import connection
+
+_log = logging.getLogger("ellis.data")
+
+_db_pool = background.WorkerPool("db",
+                                 settings.DB_THREADS,
+                                 settings.DB_MAX_QUEUED)
+
+def pool_full():
+    """returns True if run would raise background.PoolFull."""
+    return _db_pool.full()
+
+def run(fn, args, callback, errback):
+    """
+    Calls fn(db_sess, *args) on a database thread, passing the result to
+    callback on the IOLoop, or the exception to errback if it raised.  The
+    session is committed if fn returns, and rolled back if it raises.
+    Raises background.PoolFull if the pool is overloaded.
+    """
+    _db_pool.run(_in_session, (fn, args), callback, errback)
+
+def _in_session(fn, args):
+    db_sess = connection.Session()
+    try:
+        result = fn(db_sess, *args)
+        db_sess.commit()
+        return result
+    except:
+        db_sess.rollback()
+        raise
+    finally:
+        db_sess.close()
@@ -9,12 +9,38 @@
 
 
 import logging
+import random
 import uuid
 
 from metaswitch.ellis.data._base import NotFound
+from metaswitch.ellis.data import dbpool
 
 _log = logging.getLogger("ellis.data")
 
+# Every number in the pool has a random allocation key, indexed along with its
+# PSTN flag and owner.  Keys are uniformly distributed over 0..RAND_KEY_MAX,
+# and are re-randomized whenever a number is returned to the pool.
+RAND_KEY_MAX = 2**32 - 1
+_NEW_RAND_KEY = "FLOOR(RAND() * %d)" % (RAND_KEY_MAX + 1)
+
+# Set whenever a number's owner changes, so that sync_databases knows to
+# re-check it against Homestead and Homer.  Clearing last_verified (rather
+# than comparing it with last_modified) keeps the lines to re-check a range of
+# the last_verified index.
+_MODIFIED = "last_modified = NOW(), last_verified = NULL"
+
+def get_gab_version(db_sess):
+    """Returns the current version of the global address book"""
+    cursor = db_sess.execute("SELECT version FROM gab_version WHERE id = 0")
+    return cursor.fetchone()[0]
+
+def _bump_gab_version(db_sess):
+    # Called whenever a change might alter the global address book.  The
+    # version row is locked until the caller's transaction commits, so do
+    # this after the change itself to hold the lock for as little time as
+    # possible.
+    db_sess.execute("UPDATE gab_version SET version = version + 1 WHERE id = 0")
+
 def get_numbers(db_sess, user_id):
     cursor = db_sess.execute("""
                              SELECT number_id, number, pstn, gab_listed FROM numbers
@@ -27,6 +53,11 @@ def get_numbers(db_sess, user_id):
              "pstn": row[2],
              "gab_listed": row[3]} for row in cursor.fetchall()]
 
+def get_numbers_async(user_id, callback, errback):
+    """Looks up the given user's numbers on a database thread, passing them
+    to callback.  Raises background.PoolFull if the pool is overloaded."""
+    dbpool.run(get_numbers, (user_id,), callback, errback)
+
 def get_sip_uri_owner_id(db_sess, sip_uri):
     cursor = db_sess.execute("""
                              SELECT owner_id FROM numbers
@@ -43,6 +74,12 @@ def get_sip_uri_owner_id(db_sess, sip_uri):
         _log.info("Not found: %s", sip_uri)
         raise NotFound()
 
+def get_sip_uri_owner_id_async(sip_uri, callback, errback):
+    """Looks up the owner of the given number on a database thread, passing
+    it to callback, or NotFound to errback if the number isn't owned.
+    Raises background.PoolFull if the pool is overloaded."""
+    dbpool.run(get_sip_uri_owner_id, (sip_uri,), callback, errback)
+
 def get_sip_uri_number_id(db_sess, sip_uri):
     cursor = db_sess.execute("""
                              SELECT number_id FROM numbers
@@ -72,18 +109,31 @@ def remove_owner(db_sess, sip_uri):
                     """, {"number_id": number_id})
     db_sess.execute("""
                     UPDATE numbers
-                    SET owner_id = NULL
+                    SET owner_id = NULL,
+                        rand_key = %s,
+                        %s
                     WHERE number_id = :number_id
-                    """, {"number_id": number_id})
+                    """ % (_NEW_RAND_KEY, _MODIFIED), {"number_id": number_id})
+    _bump_gab_version(db_sess)
+
+def remove_owners_async(sip_uris, callback, errback):
+    """Returns the given numbers to the pool, as remove_owner, in one
+    transaction on a database thread, then calls callback.  Raises
+    background.PoolFull if the pool is overloaded."""
+    dbpool.run(_remove_owners, (sip_uris,), callback, errback)
+
+def _remove_owners(db_sess, sip_uris):
+    for sip_uri in sip_uris:
+        remove_owner(db_sess, sip_uri)
 
 def add_number_to_pool(db_sess, number, pstn=False, specified=False):
     _log.debug("Adding %s to the pool", number)
     number_id = uuid.uuid4()
 
     db_sess.execute("""
-                   INSERT INTO numbers (number_id, number, pstn, specified)
-                   VALUES (:number_id, :number, :pstn, :specified);
-                   """,
+                   INSERT INTO numbers (number_id, number, pstn, specified, rand_key)
+                   VALUES (:number_id, :number, :pstn, :specified, %s);
+                   """ % _NEW_RAND_KEY,
                    {"number_id": number_id,
                     "number": number,
                     "pstn": pstn,
@@ -92,46 +142,171 @@ def add_number_to_pool(db_sess, number, pstn=False, specified=False):
     _log.debug("Added %s to the pool", number)
     return number_id
 
+def add_numbers_to_pool(db_sess, numbers, pstn=False, specified=False):
+    """
+    Adds a batch of numbers to the pool in a single multi-row INSERT,
+    skipping any that are already there.  Returns how many were added.
+    """
+    if not numbers:
+        return 0
+    rows = []
+    params = {"pstn": pstn, "specified": specified}
+    for i, number in enumerate(numbers):
+        rows.append("(:number_id_%d, :number_%d, :pstn, :specified, %s)" %
+                    (i, i, _NEW_RAND_KEY))
+        params["number_id_%d" % i] = uuid.uuid4()
+        params["number_%d" % i] = number
+
+    cursor = db_sess.execute("""
+                             INSERT IGNORE INTO numbers (number_id, number, pstn, specified, rand_key)
+                             VALUES %s;
+                             """ % ",\n".join(rows), params)
+    _log.debug("Added %d of %d numbers to the pool", cursor.rowcount, len(numbers))
+    return cursor.rowcount
+
 def allocate_number(db_sess, user_id, pstn = False):
-    # Randomize the number allocated.  ORDER BY RAND() is not the fastest way of
-    # doing this, but it's fast enough and Ellis is only intended as a demo
-    # tool anyway.
-    _log.debug("Allocating a number (%s)"
+    # Randomize the number allocated.  Rather than ORDER BY RAND(), which
+    # sorts every free number in the pool, pick a random allocation key and
+    # take the first free number at or after it - this is a short range scan
+    # of the (pstn, owner_id, rand_key) index however big the pool is.  If
+    # there are no free numbers after that key, wrap round to the start.
+    _log.debug("Allocating a number (%s)",
                'PSTN' if pstn else 'non-PSTN')
 
-    db_sess.execute(
-        """
-        SET @number_id := NULL;
-        UPDATE numbers
-        SET number_id = @number_id := number_id,
-            owner_id = :user_id,
-            gab_listed = 1
-        WHERE owner_id IS NULL
-        AND pstn = :pstn
-        ORDER BY RAND()
-        LIMIT 1;
-        """,
-        {
-            "user_id": user_id,
-            "pstn": 1 if pstn else 0
-        })
-    cursor = db_sess.execute("SELECT @number_id;")
-    (number_id,) = cursor.fetchone()
-
-    if number_id:
-        _log.debug("Fetched %s", number_id)
-        return uuid.UUID(number_id)
+    start_key = random.randint(0, RAND_KEY_MAX)
+    for min_key in (start_key, 0):
+        db_sess.execute(
+            """
+            SET @number_id := NULL;
+            UPDATE numbers
+            SET number_id = @number_id := number_id,
+                owner_id = :user_id,
+                gab_listed = 1,
+                %s
+            WHERE owner_id IS NULL
+            AND pstn = :pstn
+            AND (lease_expires IS NULL OR lease_expires < NOW())
+            AND rand_key >= :min_key
+            ORDER BY rand_key
+            LIMIT 1;
+            """ % _MODIFIED,
+            {
+                "user_id": user_id,
+                "pstn": 1 if pstn else 0,
+                "min_key": min_key
+            })
+        cursor = db_sess.execute("SELECT @number_id;")
+        (number_id,) = cursor.fetchone()
+
+        if number_id:
+            _log.debug("Fetched %s", number_id)
+            _bump_gab_version(db_sess)
+            return uuid.UUID(number_id)
 
     raise NotFound()
 
+def lease_numbers(db_sess, lease_id, pstn, count, lease_secs):
+    """Leases up to count random free numbers for lease_secs, so that they
+    won't be allocated by anyone else until the lease expires.  Returns the
+    number IDs leased."""
+    _log.debug("Leasing %d numbers (%s) as %s",
+               count, 'PSTN' if pstn else 'non-PSTN', lease_id)
+
+    # Take a random run of the free numbers, in the same way as
+    # allocate_number.
+    start_key = random.randint(0, RAND_KEY_MAX)
+    leased = 0
+    for min_key in (start_key, 0):
+        cursor = db_sess.execute(
+            """
+            UPDATE numbers
+            SET lease_id = :lease_id,
+                lease_expires = DATE_ADD(NOW(), INTERVAL :lease_secs SECOND)
+            WHERE owner_id IS NULL
+            AND pstn = :pstn
+            AND (lease_expires IS NULL OR lease_expires < NOW())
+            AND rand_key >= :min_key
+            ORDER BY rand_key
+            LIMIT :count;
+            """,
+            {
+                "lease_id": lease_id,
+                "lease_secs": lease_secs,
+                "pstn": 1 if pstn else 0,
+                "min_key": min_key,
+                "count": count - leased
+            })
+        leased += cursor.rowcount
+        if leased >= count:
+            break
+
+    cursor = db_sess.execute("""
+                             SELECT number_id FROM numbers
+                             WHERE lease_id = :lease_id
+                             AND owner_id IS NULL
+                             AND pstn = :pstn
+                             AND lease_expires > NOW();
+                             """, {"lease_id": lease_id,
+                                   "pstn": 1 if pstn else 0})
+    number_ids = [row[0] for row in cursor.fetchall()]
+    _log.debug("Leased %d numbers", len(number_ids))
+    return number_ids
+
+def allocate_leased_number(db_sess, user_id, number_id, lease_id):
+    """Allocates a number leased by lease_numbers.  Returns False if the
+    number is no longer leased by lease_id (in which case it is untouched)."""
+    cursor = db_sess.execute("""
+                             UPDATE numbers
+                             SET owner_id = :owner,
+                                 gab_listed = 1,
+                                 lease_id = NULL,
+                                 lease_expires = NULL,
+                                 %s
+                             WHERE number_id = :number_id
+                             AND owner_id IS NULL
+                             AND lease_id = :lease_id;
+                             """ % _MODIFIED, {"owner": user_id,
+                                   "number_id": number_id,
+                                   "lease_id": lease_id})
+    if cursor.rowcount != 1:
+        return False
+    _bump_gab_version(db_sess)
+    return True
+
+def release_leases(db_sess, lease_id):
+    """Returns any numbers still leased by lease_id to the pool."""
+    _log.debug("Releasing numbers leased as %s", lease_id)
+    db_sess.execute("""
+                    UPDATE numbers
+                    SET lease_id = NULL,
+                        lease_expires = NULL
+                    WHERE lease_id = :lease_id
+                    AND owner_id IS NULL;
+                    """, {"lease_id": lease_id})
+
 def allocate_specific_number(db_sess, user_id, number_id): # pragma: no cover
         db_sess.execute("""
-                        UPDATE numbers SET owner_id = :owner, gab_listed = 1
+                        UPDATE numbers SET owner_id = :owner, gab_listed = 1, %s
                         WHERE number_id = :number_id;
-                        """, {"owner": user_id,
+                        """ % _MODIFIED, {"owner": user_id,
                               "number_id": number_id})
+        _bump_gab_version(db_sess)
         _log.debug("Updated the owner")
 
+def allocate_sip_uri_async(user_id, sip_uri, callback, errback):
+    """Allocates the given number to the user on a database thread, first
+    adding it to the pool if it isn't already there, and passes its number ID
+    to callback.  Raises background.PoolFull if the pool is overloaded."""
+    dbpool.run(_allocate_sip_uri, (user_id, sip_uri), callback, errback)
+
+def _allocate_sip_uri(db_sess, user_id, sip_uri):
+    try:
+        number_id = uuid.UUID(get_sip_uri_number_id(db_sess, sip_uri))
+    except NotFound:
+        # This SIP URI is not currently in the pool, so add it
+        number_id = add_number_to_pool(db_sess, sip_uri, False, True)
+    allocate_specific_number(db_sess, user_id, number_id)
+    return number_id
 
 
 def get_number(db_sess, number_id, expected_user_id):
@@ -161,6 +336,12 @@ def is_gab_listed(db_sess, expected_user_id, sip_uri): # pragma: no cover
     except TypeError:
         raise NotFound()
 
+def is_gab_listed_async(expected_user_id, sip_uri, callback, errback):
+    """Looks up whether the user's number is listed in the global address
+    book on a database thread, passing the flag to callback, or NotFound to
+    errback if the user doesn't own it.  Raises background.PoolFull if the
+    pool is overloaded."""
+    dbpool.run(is_gab_listed, (expected_user_id, sip_uri), callback, errback)
 
 def update_gab_list(db_sess, user_id, number_id, isListed):
     db_sess.execute("""
@@ -168,15 +349,28 @@ def update_gab_list(db_sess, user_id, number_id, isListed):
                     WHERE number_id = :nid
                     """,
                     {"gab": isListed, "nid": number_id})
+    _bump_gab_version(db_sess)
 
+def update_gab_list_async(user_id, sip_uri, isListed, callback, errback):
+    """As update_gab_list, but for the number with the given SIP URI, on a
+    database thread.  Passes NotFound to errback if there's no such number.
+    Raises background.PoolFull if the pool is overloaded."""
+    dbpool.run(_update_gab_list, (user_id, sip_uri, isListed), callback, errback)
 
-def get_listed_numbers(db_sess): # pragma: no cover
+def _update_gab_list(db_sess, user_id, sip_uri, isListed):
+    number_id = get_sip_uri_number_id(db_sess, sip_uri)
+    update_gab_list(db_sess, user_id, number_id, isListed)
+
+
+def get_listed_contacts(db_sess): # pragma: no cover
+    """Returns the global address book, as a list of (user ID, contact)
+    pairs, one for each user with listed numbers."""
     cursor = db_sess.execute("""
                               SELECT u.user_id, u.full_name, u.email, n.number, n.pstn
                               FROM numbers n
                               INNER JOIN users u ON u.user_id = n.owner_id
                               WHERE n.gab_listed = 1
-                              ORDER BY u.full_name, n.pstn DESC, n.number
+                              ORDER BY u.full_name, u.user_id, n.pstn DESC, n.number
                              """)
 
     last_user_id = None
@@ -190,9 +384,77 @@ def get_listed_numbers(db_sess): # pragma: no cover
             current_output_row = {"full_name": full_name,
                                   "email": email,
                                   "numbers": [number]}
-            output.append(current_output_row)
+            output.append((user_id, current_output_row))
             last_user_id = user_id
         else:
             current_output_row["numbers"].append(number)
 
     return output
+
+def iter_numbers(db_sess, after=None, max_age_secs=None, assigned_only=False):
+    """
+    A generator yielding (number, assigned, last_modified) for each number in
+    the pool (or, if assigned_only is set, each assigned number), in order,
+    starting after the number after (if given).  If max_age_secs is given,
+    only numbers that have changed since they were last verified, or that
+    haven't been verified in the last max_age_secs, are yielded.
+
+    The rows are streamed from the database rather than all being read at
+    once, so db_sess mustn't be used for anything else until they've all been
+    read.
+    """
+    params = {"after": after or ""}
+    conditions = ""
+    if max_age_secs is not None:
+        conditions = """
+                AND (last_verified IS NULL OR
+                     last_verified < DATE_SUB(NOW(), INTERVAL :max_age_secs SECOND))
+                """
+        params["max_age_secs"] = max_age_secs
+    if assigned_only:
+        conditions += "AND owner_id IS NOT NULL"
+
+    db_sess.connection(execution_options={"stream_results": True})
+    cursor = db_sess.execute("""
+                             SELECT number, owner_id IS NOT NULL, last_modified
+                             FROM numbers
+                             WHERE number > :after
+                             %s
+                             ORDER BY number
+                             """ % conditions, params)
+    for number, assigned, last_modified in cursor:
+        yield number, bool(assigned), last_modified
+
+def count_numbers(db_sess, after=None, assigned_only=False):
+    """Returns how many numbers iter_numbers would yield."""
+    cursor = db_sess.execute("""
+                             SELECT COUNT(*) FROM numbers
+                             WHERE number > :after
+                             %s
+                             """ % ("AND owner_id IS NOT NULL" if assigned_only else ""),
+                             {"after": after or ""})
+    return cursor.fetchone()[0]
+
+def get_last_modified(db_sess, number):
+    """Returns when number's owner last changed.  Raises NotFound if it isn't
+    in the pool."""
+    cursor = db_sess.execute("""
+                             SELECT last_modified FROM numbers
+                             WHERE number = :number
+                             """, {"number": number})
+    row = cursor.fetchone()
+    if row is None:
+        raise NotFound()
+    return row[0]
+
+def mark_verified(db_sess, number, last_modified):
+    """Records that number has been checked against Homestead and Homer, as
+    it was at last_modified.  If it has changed since then, it is left to be
+    checked again."""
+    db_sess.execute("""
+                    UPDATE numbers
+                    SET last_verified = NOW()
+                    WHERE number = :number
+                    AND last_modified = :last_modified
+                    """, {"number": number,
+                          "last_modified": last_modified})
@@ -17,10 +17,17 @@ import bcrypt
 
 from metaswitch.ellis.data._base import AlreadyExists
 from metaswitch.ellis.data._base import NotFound
-from metaswitch.ellis import settings
+from metaswitch.ellis import settings, background
+from metaswitch.ellis.data import dbpool
 
 _log = logging.getLogger("ellis.data")
 
+# bcrypt is deliberately slow, so we hash and check passwords on a pool of
+# threads rather than on the IOLoop.
+_password_pool = background.WorkerPool("bcrypt",
+                                       settings.PASSWORD_HASH_THREADS,
+                                       settings.PASSWORD_HASH_MAX_QUEUED)
+
 
 def lookup_user_id(db_sess, email):
     cursor = db_sess.execute("""
@@ -37,10 +44,16 @@ def lookup_user_id(db_sess, email):
     finally:
         cursor.close()
 
+def lookup_user_id_async(email, callback, errback):
+    """Looks up the ID of the user with the given email on a database
+    thread, passing it to callback, or NotFound to errback if there's no such
+    user.  Raises background.PoolFull if the pool is overloaded."""
+    dbpool.run(lookup_user_id, (email,), callback, errback)
+
 def hash_password(password):
     """Hashes the given password using bcrypt."""
     binary = password.encode("utf-8")
-    hashed = bcrypt.hashpw(binary, bcrypt.gensalt(10)) #@UndefinedVariable
+    hashed = bcrypt.hashpw(binary, bcrypt.gensalt(settings.PASSWORD_WORK_FACTOR)) #@UndefinedVariable
     return hashed
 
 def is_password_correct(password, hashed):
@@ -48,7 +61,38 @@ def is_password_correct(password, hashed):
     binary = password.encode("utf-8")
     return bcrypt.hashpw(binary, hashed) == hashed #@UndefinedVariable
 
-def create_user(db_sess, password, full_name, email, expires):
+def needs_rehash(hashed):
+    """returns True if the given bcrypt hash wasn't made with the current
+    work factor."""
+    # bcrypt hashes are of the form $<version>$<work factor>$<salt and hash>
+    try:
+        return int(hashed.split("$")[2]) != settings.PASSWORD_WORK_FACTOR
+    except (IndexError, ValueError):
+        return True
+
+def password_pool_full():
+    """returns True if hash_password_async and check_password_async would
+    raise background.PoolFull."""
+    return _password_pool.full()
+
+def hash_password_async(password, callback, errback):
+    """Hashes the given password on the password pool, passing the hash to
+    callback.  Raises background.PoolFull if the pool is overloaded."""
+    _password_pool.run(hash_password, (password,), callback, errback)
+
+def check_password_async(password, hashed, callback, errback):
+    """Checks the given password on the password pool, passing True to
+    callback if it matches the hash.  Raises background.PoolFull if the pool
+    is overloaded."""
+    _password_pool.run(is_password_correct, (password, hashed), callback, errback)
+
+def get_user_by_email_async(email, callback, errback):
+    """Looks up the user with the given email on a database thread, passing
+    the user (or None) to callback.  Raises background.PoolFull if the pool
+    is overloaded."""
+    dbpool.run(get_user_by_email, (email,), callback, errback)
+
+def create_user(db_sess, password, full_name, email, expires, hashed_password=None):
     # Check if the user already exists.
     try:
         lookup_user_id(db_sess, email)
@@ -58,7 +102,8 @@ def create_user(db_sess, password, full_name, email, expires):
         _log.info("Email %s already exists", email)
         raise AlreadyExists()
 
-    hashed_password = hash_password(password)
+    if hashed_password is None:
+        hashed_password = hash_password(password)
     user_id = uuid.uuid4()
 
     expires_date = (datetime.datetime.now() + datetime.timedelta(days = expires)).strftime("%Y-%m-%d %H:%M:%S") if expires else None
@@ -77,6 +122,15 @@ def create_user(db_sess, password, full_name, email, expires):
                    user)
     return user
 
+def create_user_async(password, full_name, email, expires, hashed_password, callback, errback):
+    """Creates a user on a database thread, passing the user to callback,
+    or AlreadyExists to errback if the email is taken.  Raises
+    background.PoolFull if the pool is overloaded."""
+    dbpool.run(create_user,
+               (password, full_name, email, expires, hashed_password),
+               callback,
+               errback)
+
 def delete_user(db_sess, user_id):
     db_sess.execute("""
                    DELETE FROM users
@@ -86,6 +140,11 @@ def delete_user(db_sess, user_id):
                        "user_id": user_id
                    })
 
+def delete_user_async(user_id, callback, errback):
+    """Deletes the given user on a database thread, then calls callback.
+    Raises background.PoolFull if the pool is overloaded."""
+    dbpool.run(delete_user, (user_id,), callback, errback)
+
 def get_user(db_sess, user_id):
     cursor = db_sess.execute("""
                              SELECT password, full_name, email, expires
@@ -103,13 +162,11 @@ def get_user(db_sess, user_id):
             "email":           email,
             "expires":         expires}
 
-def get_user_by_email_and_password(db_sess, email, password):
-    """Test if the password is correct, and retrieve the user record.
+def get_user_by_email(db_sess, email):
+    """Retrieve the user record, or None if the email address is unknown.
 
-    Returns user (if correct) or None (if incorrect), where user is
-    the record of data from the database.  In particular, user.email
-    is the true email address from the database (which may differ in
-    case or other collation-invariant ways from the supplied email).
+    user.email is the true email address from the database (which may differ
+    in case or other collation-invariant ways from the supplied email).
     """
     cursor = db_sess.execute("""
                              SELECT user_id, password, full_name, email, expires FROM users
@@ -124,17 +181,40 @@ def get_user_by_email_and_password(db_sess, email, password):
         _log.warning("User email %s not found", email)
         return None
     else:
-        if is_password_correct(password, hashed):
-            return {"user_id":         user_id,
-                    "hashed_password": hashed,
-                    "full_name":       full_name,
-                    "email":           true_email,
-                    "expires":         expires}
-        else:
-            return None
+        return {"user_id":         user_id,
+                "hashed_password": hashed,
+                "full_name":       full_name,
+                "email":           true_email,
+                "expires":         expires}
     finally:
         cursor.close()
 
+def get_user_by_email_and_password(db_sess, email, password):
+    """Test if the password is correct, and retrieve the user record.
+
+    Returns user (if correct) or None (if incorrect), where user is
+    the record of data from the database, as for get_user_by_email.
+    """
+    user = get_user_by_email(db_sess, email)
+    if user and is_password_correct(password, user["hashed_password"]):
+        return user
+    else:
+        return None
+
+def set_password(db_sess, user_id, hashed_password):
+    db_sess.execute("""
+                    UPDATE users
+                    SET password = :hashed_password
+                    WHERE user_id = :user_id
+                    """, {"user_id": user_id,
+                          "hashed_password": hashed_password})
+
+def set_password_async(user_id, hashed_password, callback, errback):
+    """Sets the given user's (already hashed) password on a database thread,
+    then calls callback.  Raises background.PoolFull if the pool is
+    overloaded."""
+    dbpool.run(set_password, (user_id, hashed_password), callback, errback)
+
 def _get_valid_token(db_sess, email):
     """Get the currently-valid password recovery token.
 
@@ -193,6 +273,16 @@ def get_token(db_sess, email):
                               "email":   email})
     return token
 
+def get_token_async(email, callback, errback):
+    """Gets a password recovery token, as get_token, on a database thread,
+    passing it and the user's details (as get_details) to callback, or
+    ValueError to errback if the email address is unknown.  Raises
+    background.PoolFull if the pool is overloaded."""
+    dbpool.run(_get_token_and_details, (email,), callback, errback)
+
+def _get_token_and_details(db_sess, email):
+    return get_token(db_sess, email), get_details(db_sess, email)
+
 def get_details(db_sess, email):
     """Get the details of a user given their email address."""
     cursor = db_sess.execute("""
@@ -213,18 +303,35 @@ def get_details(db_sess, email):
     return {"full_name": full_name,
             "email":     true_email}
 
-def set_recovered_password(db_sess, email, token, password):
+def check_recovery_token(db_sess, email, token):
+    """Check a password recovery token without using it.
+
+    If the email address is unknown, throws ValueError.  If there is no
+    token in the database, throws NotFound.  If the token is wrong, throws
+    ValueError.
+    """
+    if token != _get_valid_token(db_sess, email):
+        raise ValueError('Wrong token')
+
+def check_recovery_token_async(email, token, callback, errback):
+    """As check_recovery_token, on a database thread, passing any exception
+    to errback.  Raises background.PoolFull if the pool is overloaded."""
+    dbpool.run(check_recovery_token, (email, token), callback, errback)
+
+def set_recovered_password(db_sess, email, token, password, hashed_password=None):
     """Use a password recovery token to set a new password.
 
     Checks the email address and token are correct, and sets the new
-    password.  If the email address is unknown, throws ValueError.  If
-    there is no token in the database, throws NotFound.  If the token
-    is wrong, throws ValueError.
+    password (or hashed_password, if it has already been hashed).  If the
+    email address is unknown, throws ValueError.  If there is no token in
+    the database, throws NotFound.  If the token is wrong, throws
+    ValueError.
     """
     expected_token = _get_valid_token(db_sess, email)
     if token == expected_token:
         _log.warn("Set password for %s", email)
-        hashed_password = hash_password(password)
+        if hashed_password is None:
+            hashed_password = hash_password(password)
         db_sess.execute("""
                         UPDATE users
                         SET password = :hashed_password,
@@ -235,3 +342,9 @@ def set_recovered_password(db_sess, email, token, password):
                               "hashed_password": hashed_password}),
     else:
         raise ValueError('Wrong token')
+
+def set_recovered_password_async(email, token, hashed_password, callback, errback):
+    """As set_recovered_password, with a password that has already been
+    hashed, on a database thread, passing any exception to errback.  Raises
+    background.PoolFull if the pool is overloaded."""
+    dbpool.run(set_recovered_password, (email, token, None, hashed_password), callback, errback)
@@ -0,0 +1,65 @@
+# @file ifc_cache.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Generates and validates iFC documents, remembering the results.
+
+Almost every line in a deployment has one of a handful of iFC documents -
+the default for its domain, or one of a few templates - so rather than
+generating and parsing the XML afresh for each line, each distinct document
+is generated once, and validated once, keyed by its content hash.
+"""
+
+import hashlib
+import logging
+import defusedxml.minidom
+
+from metaswitch.common import ifcs
+from metaswitch.ellis import settings
+from metaswitch.ellis.cache import TTLCache
+
+_log = logging.getLogger("ellis.ifc_cache")
+
+# An iFC document generated from a template never goes stale, so these are
+# only ever evicted to make room.
+_default_ifcs = TTLCache(settings.IFC_CACHE_SIZE, float("inf"))
+_validated = TTLCache(settings.IFC_CACHE_SIZE, float("inf"))
+
+def ifc_hash(ifc):
+    """Returns the content hash of an iFC document, as a hex string."""
+    if isinstance(ifc, unicode):
+        ifc = ifc.encode("utf-8")
+    return hashlib.sha256(ifc).hexdigest()
+
+def validate(ifc):
+    """
+    Checks that an iFC document is valid XML, returning its content hash.
+    Raises a ValueError if it isn't.
+    """
+    digest = ifc_hash(ifc)
+    if _validated.get(digest) is None:
+        try:
+            defusedxml.minidom.parseString(ifc)
+        except Exception as e:
+            raise ValueError("The XML file containing the iFC is malformed.", e)
+        _validated.put(digest, True)
+    return digest
+
+def default_ifcs(domain):
+    """Returns the default (validated) iFC document for lines in domain."""
+    ifc = _default_ifcs.get(domain)
+    if ifc is None:
+        ifc = ifcs.generate_ifcs(domain)
+        validate(ifc)
+        _default_ifcs.put(domain, ifc)
+    return ifc
+
+def clear():
+    _default_ifcs.clear()
+    _validated.clear()
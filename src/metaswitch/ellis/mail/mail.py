@@ -7,12 +7,36 @@
 # Otherwise no rights are granted except for those provided to you by
 # Metaswitch Networks in a separate written agreement.
 
+"""
+Sends email from a queue on a background thread, so that a slow smarthost
+never holds up the IOLoop.
 
+Each queued message is first written to the spool directory, and is only
+removed once it has been sent, so messages survive Ellis restarting.  A
+spooled message's name records the process that queued it; on startup, each
+process picks up any messages left behind by processes that are no longer
+running.
+
+A message that fails to send is set aside until its backoff has passed, and
+the thread gets on with the rest of the queue meanwhile.  A message that the
+smarthost rejects outright is dropped.
+"""
+
+import errno
+import glob
+import heapq
+import json
+import os
 import smtplib
+import socket
 import logging
 import random
+import threading
+import time
 import urllib
+import uuid
 import string
+import Queue
 from tornado.template import Template
 from pkg_resources import resource_string
 
@@ -23,7 +47,7 @@ _log = logging.getLogger("ellis.mail")
 _template = Template(resource_string(__name__, "forgotpassword.eml"))
 
 def send_recovery_message(urlbase, address, full_name, token):
-    """Send a recovery message to the user.
+    """Queue a recovery message to the user.
 
     urlbase - Prefix of URL to insert into email.  Will have
     email=blah&token=blah appended to it.
@@ -34,8 +58,8 @@ def send_recovery_message(urlbase, address, full_name, token):
 
     token - token to include in email.
     """
-    _log.info("Sending recovery message to %s: token is '%s'", address, token)
-    
+    _log.info("Queueing recovery message to %s: token is '%s'", address, token)
+
     link = "%semail=%s&token=%s" % (urlbase,
                                     urllib.quote_plus(address),
                                     urllib.quote_plus(token))
@@ -50,7 +74,180 @@ def send_recovery_message(urlbase, address, full_name, token):
                                  boundary = boundary)
     message_bytes = message.encode("utf-8")
 
+    _mail_queue.put(settings.EMAIL_RECOVERY_SENDER, address, message_bytes)
+
+def start():
+    """Starts sending queued mail, including any left in the spool by
+    processes that are no longer running."""
+    _mail_queue.start()
+
+
+def _pid_running(pid):
     try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _is_permanent(e):
+    """Returns True if e is the smarthost rejecting a message outright, so
+    that there's no point retrying it."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in e.recipients.values())
+    if isinstance(e, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return e.smtp_code >= 500
+    return False
+
+class _MailQueue(object):
+    def __init__(self):
+        self._pid = None
+        self._queue = None
+        self._server = None
+        # Heap of (due time, attempt, path) for messages waiting to be
+        # retried.  Only touched by the mail thread.
+        self._retries = []
+        self._last_sent = 0
+
+    def start(self):
+        # The thread doesn't survive forking, so start it in the process that
+        # sends the mail.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queue = Queue.Queue()
+        self._server = None
+        self._retries = []
+        settings.ensure_dir_exists(settings.EMAIL_SPOOL_DIR)
+        self._remove_partial_messages()
+        for path in self._claim_orphans():
+            self._queue.put(path)
+        t = threading.Thread(name="mail_thread", target=self._run)
+        t.daemon = True
+        t.start()
+
+    def put(self, sender, address, message_bytes):
+        self.start()
+        name = "%s.%d.msg" % (uuid.uuid4().hex, os.getpid())
+        path = os.path.join(settings.EMAIL_SPOOL_DIR, name)
+        # Write the message under a temporary name and rename it, so we
+        # never spool half a message.
+        with open(path + ".tmp", "w") as f:
+            json.dump({"from": sender,
+                       "to": address,
+                       "message": message_bytes}, f)
+        os.rename(path + ".tmp", path)
+        self._queue.put(path)
+
+    def _remove_partial_messages(self):
+        """Removes messages that processes which are no longer running were
+        part way through spooling."""
+        for path in glob.glob(os.path.join(settings.EMAIL_SPOOL_DIR, "*.msg.tmp")):
+            pid = os.path.basename(path).split(".")[1]
+            if int(pid) == os.getpid() or _pid_running(int(pid)):
+                continue
+            _log.info("Removing partly spooled message %s", path)
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process removed it first
+                pass
+
+    def _claim_orphans(self):
+        """Claims the spooled messages of processes that are no longer
+        running, returning their new paths."""
+        claimed = []
+        for path in sorted(glob.glob(os.path.join(settings.EMAIL_SPOOL_DIR, "*.msg"))):
+            msg_id, pid, _ = os.path.basename(path).split(".")
+            if int(pid) == os.getpid() or _pid_running(int(pid)):
+                continue
+            new_path = os.path.join(settings.EMAIL_SPOOL_DIR,
+                                    "%s.%d.msg" % (msg_id, os.getpid()))
+            try:
+                os.rename(path, new_path)
+            except OSError:
+                # Another process claimed it first
+                continue
+            _log.info("Resending spooled message %s", msg_id)
+            claimed.append(new_path)
+        return claimed
+
+    def _run(self):
+        while True:
+            self._deliver_due()
+            timeout = settings.SMTP_IDLE_TIMEOUT_SEC
+            if self._retries:
+                timeout = max(min(timeout, self._retries[0][0] - time.time()), 0)
+            try:
+                path = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                # Don't hold the connection open indefinitely
+                if time.time() - self._last_sent >= settings.SMTP_IDLE_TIMEOUT_SEC:
+                    self._disconnect()
+                continue
+            self._safe_deliver(path, 0)
+
+    def _deliver_due(self):
+        """Makes the next attempt at each message whose backoff has passed."""
+        while self._retries and self._retries[0][0] <= time.time():
+            _, attempt, path = heapq.heappop(self._retries)
+            self._safe_deliver(path, attempt)
+
+    def _safe_deliver(self, path, attempt):
+        try:
+            self._deliver(path, attempt)
+        except Exception:
+            # Leave the message in the spool for the next restart
+            _log.exception("Failed to deliver spooled message %s", path)
+
+    def _deliver(self, path, attempt=0):
+        """Makes one attempt to send a spooled message.  If it fails, the
+        message is queued to be retried once it has backed off."""
+        with open(path) as f:
+            mail = json.load(f)
+        address = mail["to"]
+        message_bytes = mail["message"].encode("utf-8")
+
+        try:
+            self._send(mail["from"], address, message_bytes)
+        except (smtplib.SMTPException, socket.error) as e:
+            if _is_permanent(e):
+                _log.error("Unable to send email to %s, rejected by %s: %s",
+                           address, settings.SMTP_SMARTHOST, e)
+                os.remove(path)
+                return
+            _log.warning("Unable to send email to %s via %s/%s (attempt %d): %s",
+                         address, settings.SMTP_SMARTHOST, settings.SMTP_USERNAME,
+                         attempt + 1, e)
+            self._disconnect()
+            if attempt + 1 < settings.SMTP_MAX_ATTEMPTS:
+                delay = min(settings.SMTP_RETRY_INITIAL_DELAY_SEC * 2 ** attempt,
+                            settings.SMTP_RETRY_MAX_DELAY_SEC)
+                heapq.heappush(self._retries, (time.time() + delay, attempt + 1, path))
+                return
+            _log.error("Giving up sending email to %s after %d attempts",
+                       address, settings.SMTP_MAX_ATTEMPTS)
+            os.rename(path, path[:-len(".msg")] + ".failed")
+            return
+        else:
+            _log.info("Sent email to %s", address)
+            self._last_sent = time.time()
+        os.remove(path)
+
+    def _send(self, sender, address, message_bytes):
+        if self._server is not None:
+            try:
+                self._server.sendmail(sender, address, message_bytes)
+                return
+            except smtplib.SMTPServerDisconnected:
+                # The smarthost closed the connection while it was idle, so
+                # reconnect straight away rather than count this against the
+                # message.
+                _log.info("Connection to %s was closed, reconnecting", settings.SMTP_SMARTHOST)
+                self._disconnect()
+        self._connect()
+        self._server.sendmail(sender, address, message_bytes)
+
+    def _connect(self):
         server = smtplib.SMTP(
             host = settings.SMTP_SMARTHOST,
             port = settings.SMTP_PORT,
@@ -61,11 +258,14 @@ def send_recovery_message(urlbase, address, full_name, token):
         server.ehlo()  # @@@KSW apparently - seems silly to me
         if settings.SMTP_USERNAME:
             server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-        server.sendmail(settings.EMAIL_RECOVERY_SENDER, address, message_bytes)
-        server.quit()
-    except smtplib.SMTPException as e: # pragma: no cover
-        _log.error("Unable to send email to %s via %s/%s/%s: %s", address, 
-                   settings.SMTP_SMARTHOST, settings.SMTP_USERNAME, settings.SMTP_PASSWORD, e)
-        raise e
-    else:
-        _log.info("Sent email to %s", address)
+        self._server = server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._server = None
+
+_mail_queue = _MailQueue()
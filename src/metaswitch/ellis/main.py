@@ -11,23 +11,36 @@
 
 
 import os
+import signal
 import argparse
 import logging
 import prctl
 import tornado.web
 import tornado.ioloop
 import tornado.process
+import tornado.httpclient
 from tornado.netutil import bind_unix_socket
 from metaswitch.ellis.api import URLS
-from metaswitch.ellis.data import connection
+from metaswitch.ellis.data import connection, allocator
 from metaswitch.ellis import settings
 from metaswitch.ellis.remote import homestead
 from tornado import httpserver
 from metaswitch.ellis import background
+from metaswitch.ellis.mail import mail
 from metaswitch.common import utils, logging_config
 
 _log = logging.getLogger("ellis")
 
+def shutdown():
+    _log.info("Ellis process shutting down")
+    allocator.release_leases()
+    tornado.ioloop.IOLoop.instance().stop()
+
+def sigterm_handler(signum, frame):
+    # Shut down from the IOLoop, rather than in the middle of whatever the
+    # signal interrupted.
+    tornado.ioloop.IOLoop.instance().add_callback(shutdown)
+
 def create_application():
     app_settings = {
         "gzip": True,
@@ -39,8 +52,9 @@ def create_application():
 
 def standalone():
     """
-    Initializes Tornado and our application.  Forks worker processes to handle
-    requests.  Does not return until all child processes exit normally.
+    Initializes Tornado and our application.  If TORNADO_PREFORK is set, forks
+    worker processes to handle requests.  Does not return until all child
+    processes exit normally.
     """
 
     # Parse arguments
@@ -78,22 +92,61 @@ def standalone():
         # We failed to take the lock - another process is already running
         exit(1)
 
-    # Only run one process, not one per core - we don't need the performance
-    # and this keeps everything in one log file
-    prctl.prctl(prctl.NAME, "ellis")
-    logging_config.configure_logging(
-            utils.map_clearwater_log_level(args.log_level),
-            settings.LOGS_DIR,
-            settings.LOG_FILE_PREFIX)
-    _log.info("Ellis process starting up")
+    # Bind the socket before forking, so that all the workers accept
+    # connections on it.
+    unix_socket = bind_unix_socket(settings.HTTP_UNIX,
+                                   0666);
+
+    if settings.TORNADO_PREFORK:
+        # Fork the workers.  The parent process never returns from this - it
+        # keeps the pidfile locked and restarts any worker that crashes.
+        num_processes = tornado.process.cpu_count() * settings.TORNADO_PROCESSES_PER_CORE
+        task_id = tornado.process.fork_processes(num_processes,
+                                                 settings.TORNADO_MAX_RESTARTS)
+
+        # Make sure the worker is killed if the parent exits (e.g. when the
+        # init script sends it SIGTERM), and catch the case where the parent
+        # exited before we asked.
+        prctl.prctl(prctl.PDEATHSIG, signal.SIGTERM)
+        if os.getppid() == 1:
+            exit(1)
+
+        # Each worker has its own log file.
+        prctl.prctl(prctl.NAME, "ellis-%d" % task_id)
+        logging_config.configure_logging(
+                utils.map_clearwater_log_level(args.log_level),
+                settings.LOGS_DIR,
+                settings.LOG_FILE_PREFIX,
+                "worker%d" % task_id)
+        _log.info("Ellis worker process %d starting up", task_id)
+    else:
+        # Only run one process, not one per core - this keeps everything in
+        # one log file
+        prctl.prctl(prctl.NAME, "ellis")
+        logging_config.configure_logging(
+                utils.map_clearwater_log_level(args.log_level),
+                settings.LOGS_DIR,
+                settings.LOG_FILE_PREFIX)
+        _log.info("Ellis process starting up")
+
+    # The database connection pool and the IOLoop mustn't be shared between
+    # processes, so only create them once we've forked.
     connection.init_connection()
 
+    # Talk to Homestead and Homer over pools of keep-alive connections.
+    tornado.httpclient.AsyncHTTPClient.configure(settings.UPSTREAM_HTTP_CLIENT)
+
     http_server = httpserver.HTTPServer(application)
-    unix_socket = bind_unix_socket(settings.HTTP_UNIX,
-                                   0666);
     http_server.add_socket(unix_socket)
 
+    # Return any numbers this process has leased when it's stopped.
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
     homestead.ping()
+    if settings.HOMESTEAD_CACHE_STATS_INTERVAL_SECS:
+        tornado.ioloop.PeriodicCallback(homestead.log_cache_stats,
+                                        settings.HOMESTEAD_CACHE_STATS_INTERVAL_SECS * 1000).start()
+    mail.start()
     background.start_background_worker_io_loop()
     io_loop = tornado.ioloop.IOLoop.instance()
     io_loop.start()
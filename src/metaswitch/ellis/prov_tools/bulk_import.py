@@ -0,0 +1,245 @@
+#!/usr/share/clearwater/clearwater-prov-tools/env/bin/python
+
+# @file bulk_import.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Creates, updates and deletes subscribers listed in a CSV or JSONL file.
+
+Each row (or JSON object) describes one subscriber:
+
+  action      - create, update or delete (default: create)
+  public_id   - the subscriber's IMPU, e.g. sip:6505550000@example.com
+  private_id  - the IMPI (default: derived from the IMPU)
+  domain      - the realm (default: the domain of the IMPU)
+  password    - the password (required to create)
+  ifc         - file containing the iFC template, in which ${DOMAIN} and
+                ${PREFIX} are filled in (default: empty iFC on create,
+                unchanged on update)
+  prefix      - the twin-prefix to fill in (default: --prefix)
+
+The file is read a row at a time, and the rows are dispatched to
+homestead-prov concurrently, except that rows sharing an IMPI are processed
+in turn.  The outcome of each row is written to the results file.
+"""
+
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+from functools import partial
+from metaswitch.ellis import bulk, settings, ifc_cache
+from metaswitch.ellis.remote import upstream
+from metaswitch.ellis.prov_tools import utils
+
+_log = logging.getLogger();
+
+ACTIONS = ("create", "update", "delete")
+
+DEFAULT_IFC = ('<?xml version="1.0" ?>\n'
+               '<ServiceProfile>\n'
+               '</ServiceProfile>')
+
+class InvalidRow(Exception):
+    pass
+
+def read_rows(f, fmt):
+    """
+    A generator that reads the rows of a CSV or JSONL file, yielding each
+    as (row number, dict), or (row number, InvalidRow) if it can't be
+    parsed.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row_number, row in enumerate(reader, 1):
+            yield row_number, dict((k, v) for k, v in row.iteritems() if v)
+    else:
+        for row_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("not a JSON object")
+            except ValueError as e:
+                yield row_number, InvalidRow("Malformed JSON - %s" % e)
+            else:
+                yield row_number, row
+
+class IfcTemplates(object):
+    """
+    Loads iFC templates and fills them in, remembering the results, as many
+    rows are likely to share the same few templates.
+    """
+
+    def __init__(self, default_prefix):
+        self._default_prefix = default_prefix
+        self._templates = {}
+        self._ifcs = {}
+
+    def build(self, template_file, domain, prefix=None):
+        prefix = prefix or self._default_prefix
+        key = (template_file, domain, prefix)
+        if key not in self._ifcs:
+            ifc = self._template(template_file)
+            ifc = ifc.replace("${DOMAIN}", domain)
+            ifc = ifc.replace("${PREFIX}", prefix)
+            try:
+                ifc_cache.validate(ifc)
+            except ValueError as e:
+                raise InvalidRow("iFC from %s is not valid XML - %s" % (template_file, e.args[-1]))
+            self._ifcs[key] = ifc
+        return self._ifcs[key]
+
+    def _template(self, template_file):
+        if template_file not in self._templates:
+            try:
+                with open(template_file, 'r') as f:
+                    self._templates[template_file] = f.read()
+            except IOError as e:
+                raise InvalidRow("Failed to read %s - %s" % (template_file, e.strerror))
+        return self._templates[template_file]
+
+def private_id_of(row):
+    """Returns the IMPI of the subscriber in a row, or None if the row is
+    invalid."""
+    if isinstance(row, InvalidRow):
+        return None
+    public_id = row.get("public_id") or ""
+    return row.get("private_id") or public_id[len("sip:"):] or None
+
+def parse_row(row, ifc_templates):
+    """
+    Validates a row, filling in defaults, and returns the operation as a
+    dict.  Raises InvalidRow if the row isn't valid.
+    """
+    if isinstance(row, InvalidRow):
+        raise row
+
+    op = {"action": row.get("action", "create").lower(),
+          "public_id": row.get("public_id")}
+    if op["action"] not in ACTIONS:
+        raise InvalidRow("Unknown action %s" % op["action"])
+    if not op["public_id"]:
+        raise InvalidRow("No public_id")
+    if not op["public_id"].startswith("sip:") or "@" not in op["public_id"]:
+        raise InvalidRow("public_id %s is not a SIP URI" % op["public_id"])
+
+    op["private_id"] = private_id_of(row)
+    op["domain"] = row.get("domain") or op["public_id"].split("@", 1)[1]
+    op["password"] = row.get("password")
+    if op["action"] == "create" and not op["password"]:
+        raise InvalidRow("No password")
+
+    op["ifc"] = None
+    if row.get("ifc"):
+        op["ifc"] = ifc_templates.build(row["ifc"], op["domain"], row.get("prefix"))
+    elif op["action"] == "create":
+        op["ifc"] = DEFAULT_IFC
+    return op
+
+class Importer(object):
+    """
+    Carries out the operations, as the job for a bulk.BulkRunner, writing
+    the outcome of each row to results.
+    """
+
+    def __init__(self, results, ifc_templates, plaintext=False, dry_run=False):
+        self._results = results
+        self._ifc_templates = ifc_templates
+        self._plaintext = plaintext
+        self._dry_run = dry_run
+
+    def __call__(self, item, callback):
+        row_number, row = item
+        try:
+            op = parse_row(row, self._ifc_templates)
+        except InvalidRow as e:
+            self._record(row_number, row, "invalid", str(e))
+            callback(False)
+            return
+
+        if self._dry_run:
+            self._record(row_number, row, "valid")
+            callback(True)
+            return
+
+        on_done = partial(self._on_done, row_number, row, callback)
+        if op["action"] == "create":
+            utils.create_user_async(op["private_id"], op["public_id"], op["domain"],
+                                    op["password"], op["ifc"], on_done,
+                                    plaintext=self._plaintext, add_to_existing=True)
+        elif op["action"] == "update":
+            utils.update_user_async(op["private_id"], op["public_id"], op["domain"],
+                                    op["password"], op["ifc"], on_done,
+                                    plaintext=self._plaintext)
+        else:
+            utils.delete_user_async(op["private_id"], op["public_id"], on_done)
+
+    def _on_done(self, row_number, row, callback, success):
+        self._record(row_number, row, "ok" if success else "failed")
+        callback(success)
+
+    def _record(self, row_number, row, result, detail=""):
+        if isinstance(row, InvalidRow):
+            action, public_id = "", ""
+        else:
+            action, public_id = row.get("action", "create"), row.get("public_id", "")
+        if result not in ("ok", "valid"):
+            print("Row {}: {} {} {} {}".format(row_number, result, action, public_id, detail))
+        self._results.writerow([row_number, action, public_id, result, detail])
+
+def main():
+    parser = argparse.ArgumentParser(description="Create, update and delete users listed in a file")
+    parser.add_argument("-k", "--keep-going", action="store_true", dest="keep_going", help="keep going on errors")
+    parser.add_argument("-n", "--dry-run", action="store_true", dest="dry_run", help="only validate the rows and their iFCs")
+    parser.add_argument("--hsprov", metavar="IP:PORT", action="store", help="IP address and port of homestead-prov")
+    parser.add_argument("--plaintext", action="store_true", help="store passwords in plaintext")
+    parser.add_argument("--prefix", action="store", default="123", dest="twin_prefix", help="default twin-prefix (default: 123)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="format of the file (default: from its extension)")
+    parser.add_argument("--results", metavar="FILE", action="store", dest="results_file", help="file to write the result of each row to (default: <file>.results.csv)")
+    parser.add_argument("--window", metavar="N", action="store", type=int, default=20, help="number of rows to process at once (default: 20)")
+    parser.add_argument("file", metavar="<file>")
+    args = parser.parse_args()
+
+    utils.setup_logging()
+    utils.disable_load_shedding()
+    settings.HOMESTEAD_URL = args.hsprov or settings.HOMESTEAD_URL
+    fmt = args.format or ("jsonl" if os.path.splitext(args.file)[1] in (".jsonl", ".json") else "csv")
+    results_file = args.results_file or args.file + ".results.csv"
+
+    if not args.dry_run:
+        if not utils.check_connection():
+            sys.exit(1)
+        upstream.set_max_in_flight(max(args.window, 10))
+
+    with open(args.file, 'r') as f, open(results_file, 'w') as r:
+        results = csv.writer(r)
+        results.writerow(["row", "action", "public_id", "result", "detail"])
+        importer = Importer(results,
+                            IfcTemplates(args.twin_prefix),
+                            plaintext=args.plaintext,
+                            dry_run=args.dry_run)
+        runner = bulk.BulkRunner(read_rows(f, fmt),
+                                  importer,
+                                  args.window,
+                                  keep_going=args.keep_going or args.dry_run,
+                                  verb="Validated" if args.dry_run else "Processed",
+                                  key=lambda item: private_id_of(item[1]))
+        success = runner.run()
+
+    print("{} row(s) succeeded, {} failed.  Results are in {}.".format(runner.succeeded,
+                                                                      runner.failed,
+                                                                      results_file))
+    sys.exit(0 if success else 1)
+
+if __name__ == '__main__':
+    main()
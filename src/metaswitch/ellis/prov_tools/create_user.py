@@ -12,7 +12,8 @@
 import sys
 import logging
 import argparse
-from metaswitch.ellis import settings
+from metaswitch.ellis import bulk, settings
+from metaswitch.ellis.remote import upstream
 from metaswitch.ellis.prov_tools import utils
 
 _log = logging.getLogger();
@@ -25,12 +26,15 @@ def main():
     parser.add_argument("--ifc", metavar="iFC-FILE", action="store", dest="ifc_file", help="XML file containing the iFC")
     parser.add_argument("--prefix", action="store", default="123", dest="twin_prefix", help="twin-prefix (default: 123)")
     parser.add_argument("--impi", action="store", default="", dest="impi", help="IMPI (default: derived from the IMPU)")
+    parser.add_argument("--window", metavar="N", action="store", type=int, default=20, help="number of subscribers to create at once (default: 20)")
+    parser.add_argument("--checkpoint", metavar="FILE", action="store", dest="checkpoint_file", help="file recording progress, to resume from if it exists")
     parser.add_argument("dns", metavar="<directory-number>[..<directory-number>]")
     parser.add_argument("domain", metavar="<domain>")
     parser.add_argument("password", metavar="<password>")
     args = parser.parse_args()
 
     utils.setup_logging()
+    utils.disable_load_shedding()
     settings.HOMESTEAD_URL = args.hsprov or settings.HOMESTEAD_URL
     ifc = utils.build_ifc(args.ifc_file, args.domain, args.twin_prefix)
     if not ifc:
@@ -39,54 +43,48 @@ def main():
     if not utils.check_connection():
         sys.exit(1)
 
-    # We use sys.stdout.write to print to stdout without a newline, so we can
-    # indicate progress to the user
-    sys.stdout.write("Creating users...")
-    sys.stdout.flush()
-    count = 0
-    errors = 0
-    for dn in utils.parse_dn_ranges(args.dns):
-        success = True
-        count += 1
-        sys.stdout.write(".")
-        sys.stdout.flush()
+    window = args.window
+    if args.impi != "" and window > 1:
+        # Every DN shares the one private ID, so must be created in turn.
+        print("All subscribers share IMPI {}, so creating them one at a time".format(args.impi))
+        window = 1
+
+    # Let the HTTP client keep as many requests in flight as we do.
+    upstream.set_max_in_flight(max(window, 10))
+
+    def create(dn, callback):
         public_id = "sip:%s@%s" % (dn, args.domain)
         private_id = "%s@%s" % (dn, args.domain)
 
         if args.impi != "":
             private_id = args.impi
 
-        if utils.create_user(private_id, public_id, args.domain, args.password, ifc, plaintext=args.plaintext):
-            if not utils.display_user(public_id, quiet=True):
-                success = False
-        else:
-            success = False
-
-        if not success:
-            errors += 1
-            utils.delete_user(private_id, public_id, force=True)
-            print("Failed to create a subscriber - {}.".format(dn))
-
-            if not args.keep_going:
-                if dn != args.dns:
-                    print("Failed to create any subscribers beyond {}".format(dn))
-
-                break
-
-        if count == 100:
-            print("")
-            print("Created up to user {}".format(dn))
-            count = 0
-
-    if errors == 0:
-        if count == 1:
+        def on_created(success):
+            if success:
+                callback(True)
+            else:
+                print("Failed to create a subscriber - {}.".format(dn))
+                utils.delete_user_async(private_id, public_id, lambda _: callback(False), force=True)
+
+        utils.create_user_async(private_id, public_id, args.domain, args.password, ifc, on_created, plaintext=args.plaintext)
+
+    runner = bulk.BulkRunner(bulk.parse_dn_ranges(args.dns),
+                              create,
+                              window,
+                              checkpoint_file=args.checkpoint_file,
+                              keep_going=args.keep_going,
+                              verb="Created")
+    if runner.run():
+        if runner.succeeded == 1:
             print("Success. Subscriber {} has been created.".format(args.dns))
         else:
-            print("Success. {} subscriber(s) have been created.".format(count))
+            print("Success. {} subscriber(s) have been created.".format(runner.succeeded))
 
         sys.exit(0)
     else:
         print("Finished, but failed to create all subscribers. See logs above for individual subscribers.")
+        if args.checkpoint_file:
+            print("Run again with --checkpoint {} to carry on where this run left off.".format(args.checkpoint_file))
         sys.exit(1)
 
 if __name__ == '__main__':
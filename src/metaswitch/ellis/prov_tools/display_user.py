@@ -12,7 +12,7 @@
 import sys
 import logging
 import argparse
-from metaswitch.ellis import settings
+from metaswitch.ellis import bulk, settings
 from metaswitch.ellis.prov_tools import utils
 
 _log = logging.getLogger();
@@ -28,13 +28,14 @@ def main():
     args = parser.parse_args()
 
     utils.setup_logging(level=logging.CRITICAL if args.quiet else logging.ERROR)
+    utils.disable_load_shedding()
     settings.HOMESTEAD_URL = args.hsprov or settings.HOMESTEAD_URL
 
     if not utils.check_connection():
         sys.exit(1)
 
     success = True
-    for dn in utils.parse_dn_ranges(args.dns):
+    for dn in bulk.parse_dn_ranges(args.dns):
         public_id = "sip:%s@%s" % (dn, args.domain)
 
         if not utils.display_user(public_id, short=args.short):
@@ -0,0 +1,99 @@
+#!/usr/share/clearwater/clearwater-prov-tools/env/bin/python
+
+# @file export_users.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Exports all the subscribers in homestead-prov - their public IDs, private
+IDs, digests and iFCs - to a compressed snapshot file (see snapshot.py),
+from which import_users can restore them.
+"""
+
+import os
+import sys
+import logging
+import argparse
+from functools import partial
+from metaswitch.ellis import settings
+from metaswitch.ellis.remote import upstream
+from metaswitch.ellis.prov_tools import utils, snapshot
+from metaswitch.ellis.prov_tools.list_users import MAX_RECOMMENDED_PARALLEL
+
+_log = logging.getLogger();
+
+class Exporter(object):
+    """
+    Retrieves each user, as the process for a utils.ParallelUserLister, and
+    writes it to the snapshot.
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def __call__(self, public_id, callback):
+        utils.get_user_async(public_id, partial(self._on_got_user, public_id, callback))
+
+    def _on_got_user(self, public_id, callback, user):
+        if user is None:
+            print("Failed to export {}".format(public_id))
+            callback(False)
+        else:
+            self._writer.write(user)
+            callback(True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export users to a snapshot file")
+    parser.add_argument("-k", "--keep-going", action="store_true", dest="keep_going", help="keep going on errors")
+    parser.add_argument("--hsprov", metavar="IP:PORT", action="store", help="IP address and port of homestead-prov")
+    parser.add_argument("--format", choices=snapshot.FORMATS, help="format of the snapshot (default: msgpack if <file> ends .msgpack.gz, otherwise jsonl)")
+    parser.add_argument("--parallel", metavar="N", action="store", type=int, default=4, help="keeps up to N requests in flight at once, adapting to homestead-prov's latency (default: 4)")
+    parser.add_argument("-f", "--force", action="store_true", dest="force", help="forces specified parallelism")
+    parser.add_argument("file", metavar="<file>")
+    args = parser.parse_args()
+
+    utils.setup_logging()
+    utils.disable_load_shedding()
+    settings.HOMESTEAD_URL = args.hsprov or settings.HOMESTEAD_URL
+    fmt = args.format or snapshot.format_of(args.file)
+
+    if args.parallel > MAX_RECOMMENDED_PARALLEL and not args.force:
+        print("Parallelism %d greater than recommended value (%d)" % (args.parallel, MAX_RECOMMENDED_PARALLEL))
+        print("This may impact call processing!  Are you sure? [y/N]")
+        print("(... or specify --force to skip this check and force the specified parallelism)")
+        if raw_input().lower() == "y":
+            print("Continuing...")
+        else:
+            print("Aborting!")
+            sys.exit(1)
+
+    if not utils.check_connection():
+        sys.exit(1)
+    upstream.set_max_in_flight(max(args.parallel, 10))
+
+    # Write to a temporary file, so that an export that fails part way
+    # through doesn't leave behind a snapshot that looks complete.
+    tmp_file = args.file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        writer = snapshot.SnapshotWriter(f, fmt)
+        lister = utils.ParallelUserLister(args.parallel,
+                                          process=Exporter(writer),
+                                          keep_going=args.keep_going)
+        success = lister.run()
+        writer.close()
+
+    if success or args.keep_going:
+        os.rename(tmp_file, args.file)
+        print("Exported {} user(s) to {}.".format(writer.subscribers, args.file))
+    else:
+        os.remove(tmp_file)
+        print("Export failed after {} user(s).".format(writer.subscribers))
+    sys.exit(0 if success else 1)
+
+if __name__ == '__main__':
+    main()
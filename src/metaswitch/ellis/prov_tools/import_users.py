@@ -0,0 +1,93 @@
+#!/usr/share/clearwater/clearwater-prov-tools/env/bin/python
+
+# @file import_users.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Restores the subscribers in a snapshot file written by export_users.
+
+The snapshot is read a subscriber at a time, and the subscribers are
+created concurrently, except that subscribers sharing a private ID are
+created in turn.  Digests are restored as they were exported, so passwords
+don't need to be known.
+"""
+
+import sys
+import logging
+import argparse
+from metaswitch.ellis import bulk, settings
+from metaswitch.ellis.remote import upstream
+from metaswitch.ellis.prov_tools import utils, snapshot
+
+_log = logging.getLogger();
+
+def private_id_of(user):
+    return user["private_ids"][0]["private_id"] if user["private_ids"] else None
+
+def import_user(user, callback, plaintext=False):
+    """Creates a subscriber read from a snapshot, as the job for a
+    bulk.BulkRunner."""
+    if not user["private_ids"]:
+        print("Not importing {} - it has no private IDs".format(user["public_id"]))
+        callback(False)
+        return
+    if len(user["private_ids"]) > 1:
+        # Homestead-prov adds a public ID to the implicit registration set
+        # of one private ID, so the others must be restored separately.
+        print("Only importing {} for private ID {} (of {})".format(user["public_id"],
+                                                                   private_id_of(user),
+                                                                   len(user["private_ids"])))
+
+    av = user["private_ids"][0]
+    realm = av.get("realm") or user["public_id"].split("@", 1)[-1]
+    if "plaintext_password" in av and (plaintext or not av.get("digest_ha1")):
+        utils.create_user_async(av["private_id"], user["public_id"], realm,
+                                av["plaintext_password"], user["ifc"], callback,
+                                plaintext=True, add_to_existing=True)
+    else:
+        utils.create_user_async(av["private_id"], user["public_id"], realm,
+                                None, user["ifc"], callback,
+                                add_to_existing=True, digest_ha1=av.get("digest_ha1"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Import users from a snapshot file")
+    parser.add_argument("-k", "--keep-going", action="store_true", dest="keep_going", help="keep going on errors")
+    parser.add_argument("--hsprov", metavar="IP:PORT", action="store", help="IP address and port of homestead-prov")
+    parser.add_argument("--plaintext", action="store_true", help="restore plaintext passwords where the snapshot has them")
+    parser.add_argument("--format", choices=snapshot.FORMATS, help="format of the snapshot (default: msgpack if <file> ends .msgpack.gz, otherwise jsonl)")
+    parser.add_argument("--window", metavar="N", action="store", type=int, default=20, help="number of users to import at once (default: 20)")
+    parser.add_argument("--checkpoint", metavar="FILE", action="store", dest="checkpoint_file", help="file recording progress, to resume from if it exists")
+    parser.add_argument("file", metavar="<file>")
+    args = parser.parse_args()
+
+    utils.setup_logging()
+    utils.disable_load_shedding()
+    settings.HOMESTEAD_URL = args.hsprov or settings.HOMESTEAD_URL
+    fmt = args.format or snapshot.format_of(args.file)
+
+    if not utils.check_connection():
+        sys.exit(1)
+    upstream.set_max_in_flight(max(args.window, 10))
+
+    with open(args.file, 'rb') as f:
+        runner = bulk.BulkRunner(snapshot.read_snapshot(f, fmt),
+                                  lambda user, callback: import_user(user, callback, plaintext=args.plaintext),
+                                  args.window,
+                                  checkpoint_file=args.checkpoint_file,
+                                  keep_going=args.keep_going,
+                                  verb="Imported",
+                                  key=private_id_of,
+                                  item_id=lambda user: user["public_id"])
+        success = runner.run()
+
+    print("{} user(s) imported, {} failed.".format(runner.succeeded, runner.failed))
+    sys.exit(0 if success else 1)
+
+if __name__ == '__main__':
+    main()
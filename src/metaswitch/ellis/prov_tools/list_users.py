@@ -16,10 +16,14 @@ import time
 
 from tornado.web import HTTPError
 from metaswitch.ellis import settings
+from metaswitch.ellis.remote import upstream
 from metaswitch.ellis.prov_tools import utils
 
 _log = logging.getLogger();
 
+# Beyond this many requests in flight, we ask for confirmation, as with pace.
+MAX_RECOMMENDED_PARALLEL = 8
+
 def pace_wrapper(iterator, pace=10):
     next_time = time.time()
     for item in iterator:
@@ -37,16 +41,27 @@ def main():
     parser.add_argument("--hsprov", metavar="IP:PORT", action="store", help="IP address and port of homestead-prov")
     parser.add_argument("--full", action="store_true", help="displays full information for each user")
     parser.add_argument("--pace", action="store", type=int, help="sets the target number of users to list per second")
+    parser.add_argument("--parallel", metavar="N", action="store", type=int, help="keeps up to N requests in flight at once, adapting to homestead-prov's latency, instead of a fixed pace")
     parser.add_argument("-f", "--force", action="store_true", dest="force", help="forces specified pace")
     args = parser.parse_args()
 
     utils.setup_logging()
+    utils.disable_load_shedding()
     settings.HOMESTEAD_URL = args.hsprov or settings.HOMESTEAD_URL
     default_pace = 5 if args.full else 500
     pace = args.pace or default_pace
 
     # Check the pace and get confirmation if it's too high
-    if pace > default_pace and not args.force:
+    if args.parallel and args.parallel > MAX_RECOMMENDED_PARALLEL and not args.force:
+        print("Parallelism %d greater than recommended value (%d)" % (args.parallel, MAX_RECOMMENDED_PARALLEL))
+        print("This may impact call processing!  Are you sure? [y/N]")
+        print("(... or specify --force to skip this check and force the specified parallelism)")
+        if raw_input().lower() == "y":
+            print("Continuing...")
+        else:
+            print("Aborting!")
+            sys.exit(1)
+    elif not args.parallel and pace > default_pace and not args.force:
         if args.full:
             print("Pace %d greater than recommended value (%d) when --full specified" % (pace, default_pace))
         else:
@@ -62,6 +77,13 @@ def main():
     if not utils.check_connection():
         sys.exit(1)
 
+    if args.parallel:
+        upstream.set_max_in_flight(max(args.parallel, 10))
+        lister = utils.ParallelUserLister(args.parallel,
+                                          process=utils.display_user_async if args.full else None,
+                                          keep_going=args.keep_going)
+        sys.exit(0 if lister.run() else 1)
+
     success = True
     try:
         for public_id in pace_wrapper(utils.list_users(keep_going=args.keep_going), pace=pace):
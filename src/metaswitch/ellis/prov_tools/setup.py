@@ -35,6 +35,7 @@ setup(
         "singledispatch",
         "six",
         "tornado",
-        "defusedxml"
+        "defusedxml",
+        "msgpack-python"
         ],
     )
@@ -0,0 +1,117 @@
+# @file snapshot.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Reads and writes snapshots of the subscribers in homestead-prov, as written
+by export_users and read by import_users.
+
+A snapshot is a gzipped stream of records, either as JSON, one per line, or
+as msgpack.  The first record is a header:
+
+  {"type": "header", "version": 1}
+
+Each subscriber (public ID) is then a record of the form:
+
+  {"type": "subscriber", "public_id": ..., "ifc": <hash of its iFC>,
+   "private_ids": [{"private_id": ..., "realm": ..., "digest_ha1": ...,
+                    "plaintext_password": ... (if stored)}, ...]}
+
+As most subscribers share a handful of iFCs, each distinct iFC is written
+only once, before the first subscriber that uses it:
+
+  {"type": "ifc", "hash": <ifc_cache.ifc_hash of the iFC>, "ifc": ...}
+"""
+
+import gzip
+import json
+import msgpack
+from metaswitch.ellis import ifc_cache
+
+VERSION = 1
+
+FORMATS = ("jsonl", "msgpack")
+
+class InvalidSnapshot(Exception):
+    pass
+
+def format_of(filename):
+    """Returns the format of a snapshot, as given by its name."""
+    if filename.endswith(".msgpack.gz") or filename.endswith(".msgpack"):
+        return "msgpack"
+    return "jsonl"
+
+class SnapshotWriter(object):
+    def __init__(self, f, fmt):
+        self._f = gzip.GzipFile(fileobj=f, mode="wb")
+        self._fmt = fmt
+        self._packer = msgpack.Packer()
+        # The hashes of the iFCs we've written so far
+        self._ifcs = set()
+        self.subscribers = 0
+        self._write({"type": "header", "version": VERSION})
+
+    def write(self, user):
+        """Writes a subscriber, as retrieved by utils.get_user_async."""
+        ifc = user["ifc"]
+        ifc_hash = ifc_cache.ifc_hash(ifc)
+        if ifc_hash not in self._ifcs:
+            self._write({"type": "ifc", "hash": ifc_hash, "ifc": ifc})
+            self._ifcs.add(ifc_hash)
+        self._write({"type": "subscriber",
+                     "public_id": user["public_id"],
+                     "private_ids": user["private_ids"],
+                     "ifc": ifc_hash})
+        self.subscribers += 1
+
+    def close(self):
+        self._f.close()
+
+    def _write(self, record):
+        if self._fmt == "msgpack":
+            self._f.write(self._packer.pack(record))
+        else:
+            self._f.write(json.dumps(record) + "\n")
+
+def _records(f, fmt):
+    if fmt == "msgpack":
+        for record in msgpack.Unpacker(f, encoding="utf-8"):
+            yield record
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_snapshot(f, fmt):
+    """
+    A generator that reads a snapshot, yielding each subscriber as a dict,
+    with its iFC (rather than the iFC's hash) under "ifc".  Raises
+    InvalidSnapshot if the snapshot is malformed.
+    """
+    ifcs = {}
+    records = _records(gzip.GzipFile(fileobj=f, mode="rb"), fmt)
+    try:
+        header = next(records, None)
+        if not isinstance(header, dict) or header.get("type") != "header":
+            raise InvalidSnapshot("No header - is this a %s snapshot?" % fmt)
+        if header.get("version") != VERSION:
+            raise InvalidSnapshot("Unsupported snapshot version %s" % header.get("version"))
+
+        for record in records:
+            if record.get("type") == "ifc":
+                ifcs[record["hash"]] = record["ifc"]
+            elif record.get("type") == "subscriber":
+                if record["ifc"] not in ifcs:
+                    raise InvalidSnapshot("Subscriber %s refers to unknown iFC %s" %
+                                          (record["public_id"], record["ifc"]))
+                record["ifc"] = ifcs[record["ifc"]]
+                yield record
+            else:
+                raise InvalidSnapshot("Unknown record type %s" % record.get("type"))
+    except (ValueError, KeyError, IOError, msgpack.UnpackException) as e:
+        raise InvalidSnapshot("Malformed snapshot - %s" % e)
@@ -12,7 +12,7 @@
 import sys
 import logging
 import argparse
-from metaswitch.ellis import settings
+from metaswitch.ellis import bulk, settings
 from metaswitch.ellis.prov_tools import utils
 
 _log = logging.getLogger();
@@ -32,6 +32,7 @@ def main():
     args = parser.parse_args()
 
     utils.setup_logging()
+    utils.disable_load_shedding()
     settings.HOMESTEAD_URL = args.hsprov or settings.HOMESTEAD_URL
 
     ifc = None
@@ -44,7 +45,7 @@ def main():
         sys.exit(1)
 
     success = True
-    for dn in utils.parse_dn_ranges(args.dns):
+    for dn in bulk.parse_dn_ranges(args.dns):
         public_id = "sip:%s@%s" % (dn, args.domain)
         private_id = "%s@%s" % (dn, args.domain)
 
@@ -11,13 +11,15 @@
 
 
 import sys
-import re
 import json
+import time
 import logging
+import collections
 import tornado.ioloop
 from tornado.web import HTTPError
 import defusedxml.minidom
-from metaswitch.ellis import settings
+from functools import partial
+from metaswitch.ellis import settings, ifc_cache
 from metaswitch.ellis.remote import homestead
 
 _log = logging.getLogger();
@@ -37,33 +39,15 @@ def setup_logging(level=logging.ERROR):
     root.setLevel(level)
     root.addHandler(stdout)
 
-def parse_dn_ranges(dn_ranges):
+def disable_load_shedding():
     """
-    A generator that parses DN ranges of the form <start-dn>..<end-dn>,... or
-    <single-dn>,... and yields each individual DN.
+    Stops homestead-prov requests being turned away by the circuit breaker or
+    the limit on pending requests.  Those protect Ellis's users when
+    homestead-prov is struggling, but the tools bound their own load, and
+    would rather wait than have users fail part way through a run.
     """
-    for dn_range in dn_ranges.split(","):
-        # Split on .. into start and end DNs.  If there's no .., set them identically.
-        dn_range = dn_range.split("..")
-        start_dn = dn_range[0]
-        end_dn = dn_range[1] if len(dn_range) > 1 else dn_range[0]
-
-        if len(start_dn) != len(end_dn):
-            _log.error("Directory number range %s..%s has different start and end number lengths", start_dn, end_dn)
-            continue
-
-        # Find any non-numeric prefix (e.g. +) and check that both numbers have it.
-        dn_prefix = re.search("^[^0-9]*", start_dn).group(0)
-        if not end_dn.startswith(dn_prefix):
-            _log.error("Directory number range %s..%s has different start and end number prefixes", start_dn, end_dn)
-            continue
-
-        # Strip the prefix, iterate through the resulting numbers and yield them
-        suffix_len = len(start_dn) - len(dn_prefix)
-        start_num = int(start_dn[len(dn_prefix):])
-        end_num = int(end_dn[len(dn_prefix):])
-        for num in xrange(start_num, end_num + 1):
-            yield "%s%0*d" % (dn_prefix, suffix_len, num)
+    settings.UPSTREAM_BREAKER_WINDOW = 0
+    settings.UPSTREAM_MAX_PENDING = 0
 
 def build_ifc(ifc_file, domain, twin_prefix):
     """
@@ -78,7 +62,7 @@ def build_ifc(ifc_file, domain, twin_prefix):
             _log.error("Failed to read %s - %s", ifc_file, e.strerror)
             return None
         try:
-            homestead._validate_ifc_file(ifc)
+            ifc_cache.validate(ifc)
         except ValueError as e:
             _log.error("IFC validation failed - %s", e)
             return None
@@ -178,6 +162,99 @@ def delete_user(private_id, public_id, force=False):
 
     return success
 
+def create_user_async(private_id, public_id, domain, password, ifc, callback, plaintext=False, add_to_existing=False, digest_ha1=None):
+    """
+    As create_user, but returns straight away, passing True to callback if
+    the user was created and can be read back, as by display_user.  If
+    add_to_existing is set and the private ID already exists, the public ID
+    is added to it.  If digest_ha1 is given, it is stored in place of a
+    digest of the password.
+    """
+    def on_get_digest(response):
+        if response.code == 200 and add_to_existing:
+            homestead.create_public_id(private_id, public_id, ifc, on_public_id_created)
+        elif response.code == 200:
+            _log.error("Private ID %s already exists - not creating", private_id)
+            callback(True)
+        elif response.code != 404:
+            _log.error("Failed to check private ID %s - HTTP status code %d", private_id, response.code)
+            callback(False)
+        else:
+            homestead.create_private_id(private_id, domain, password, on_private_id_created,
+                                        plaintext=plaintext, digest_ha1=digest_ha1)
+
+    def on_private_id_created(response):
+        if isinstance(response, HTTPError):
+            _log.error("Failed to create private ID %s - HTTP status code %d", private_id, response.code)
+            callback(False)
+        else:
+            homestead.create_public_id(private_id, public_id, ifc, on_public_id_created)
+
+    def on_public_id_created(response):
+        if isinstance(response, HTTPError):
+            _log.error("Failed to create public ID %s - HTTP status code %d", public_id, response.code)
+            callback(False)
+        else:
+            display_user_async(public_id, callback, quiet=True)
+
+    homestead.get_digest(private_id, on_get_digest)
+
+def update_user_async(private_id, public_id, domain, password, ifc, callback, plaintext=False):
+    """
+    As update_user, but returns straight away, passing True to callback if
+    the user was updated.
+    """
+    def update_password():
+        if password:
+            homestead.put_password(private_id, domain, password, on_password_updated, plaintext=plaintext)
+        else:
+            update_ifc()
+
+    def on_password_updated(response):
+        if isinstance(response, HTTPError) or response.error:
+            _log.error("Failed to update password for private ID %s - HTTP status code %d", private_id, response.code)
+            callback(False)
+        else:
+            update_ifc()
+
+    def update_ifc():
+        if ifc:
+            homestead.put_filter_criteria(public_id, ifc, on_ifc_updated)
+        else:
+            callback(True)
+
+    def on_ifc_updated(response):
+        if isinstance(response, HTTPError) or response.error:
+            _log.error("Failed to update public ID %s - HTTP status code %d", public_id, response.code)
+            callback(False)
+        else:
+            callback(True)
+
+    update_password()
+
+def delete_user_async(private_id, public_id, callback, force=False):
+    """
+    As delete_user, but returns straight away, passing True to callback if
+    the user was deleted.
+    """
+    def on_public_id_deleted(response):
+        if isinstance(response, HTTPError):
+            _log.error("Failed to delete public ID %s - HTTP status code %d", public_id, response.code)
+            if not force:
+                callback(False)
+                return
+            homestead.delete_private_id(private_id, partial(on_private_id_deleted, False))
+        else:
+            homestead.delete_private_id(private_id, partial(on_private_id_deleted, True))
+
+    def on_private_id_deleted(success, response):
+        if isinstance(response, HTTPError):
+            _log.error("Failed to delete private ID %s - HTTP status code %d", private_id, response.code)
+            success = False
+        callback(success)
+
+    homestead.delete_public_id(public_id, on_public_id_deleted)
+
 def conditional_print(condition, text):
     if condition:
         print text
@@ -185,61 +262,150 @@ def conditional_print(condition, text):
 # quiet flag will prevent any output to stdout. This way we can check that the
 # user exists and has valid xml, without swamping the output with large iFCs
 def display_user(public_id, short=False, quiet=False):
-    success = True
     callback = Callback()
+    display_user_async(public_id, callback, short=short, quiet=quiet)
+    return callback.wait()[0]
 
-    if not short:
-        conditional_print(not quiet, "Public User ID %s:" % (public_id))
+def display_user_async(public_id, callback, short=False, quiet=False):
+    """
+    As display_user, but returns straight away, passing True or False to
+    callback once the user has been displayed.  The lookups for the user are
+    made in parallel, and the output is printed all at once, so that the
+    output for users displayed concurrently isn't interleaved.
+    """
+    state = {"success": True,
+             "outstanding": 1 if short else 2,
+             "public_id_missing": False,
+             # Default to True so that if we don't check, we may still report
+             # that no information was found.
+             "filter_criteria_missing": True}
+    private_lines = []
+    ifc_lines = []
+
+    def on_get_privates(response):
+        state["public_id_missing"] = (response.code == 404)
+        if response.code == 200:
+            private_ids = json.loads(response.body)['private_ids']
+            state["outstanding"] += len(private_ids)
+            for private_id in private_ids:
+                lines = []
+                private_lines.append(lines)
+                homestead.get_digest(private_id, partial(on_get_digest, private_id, lines))
+        else:
+            _log.error("Failed to retrieve private IDs for public ID %s - HTTP status code %d", public_id, response.code)
+            state["success"] = False
+        on_checked()
 
-    homestead.get_associated_privates(public_id, callback)
-    response = callback.wait()[0]
-    public_id_missing = (response.code == 404)
-    if response.code == 200:
-        private_ids = json.loads(response.body)
-        for private_id in private_ids['private_ids']:
-            homestead.get_digest(private_id, callback)
-            response = callback.wait()[0]
-            if response.code == 200:
-                av = json.loads(response.body)
-                if 'digest_ha1' in av:
-                    password = av['digest_ha1']
-                    if 'plaintext_password' in av:
-                        password += " (%s)" % (av['plaintext_password'],)
-                    if short:
-                        conditional_print(not quiet, "%s/%s: %s" % (public_id, private_id, password))
-                    else:
-                        conditional_print(not quiet, "  Private User ID %s:" % (private_id,))
-                        conditional_print(not quiet, "    HA1 digest: %s" % (password,))
-            else:
-                _log.error("Failed to retrieve digest for private ID %s - HTTP status code %d", private_id, response.code)
-                success = False
-    else:
-        _log.error("Failed to retrieve private IDs for public ID %s - HTTP status code %d", public_id, response.code)
-        success = False
+    def on_get_digest(private_id, lines, response):
+        if response.code == 200:
+            av = json.loads(response.body)
+            if 'digest_ha1' in av:
+                password = av['digest_ha1']
+                if 'plaintext_password' in av:
+                    password += " (%s)" % (av['plaintext_password'],)
+                if short:
+                    lines.append("%s/%s: %s" % (public_id, private_id, password))
+                else:
+                    lines.append("  Private User ID %s:" % (private_id,))
+                    lines.append("    HA1 digest: %s" % (password,))
+        else:
+            _log.error("Failed to retrieve digest for private ID %s - HTTP status code %d", private_id, response.code)
+            state["success"] = False
+        on_checked()
 
-    # Default to True so that if we don't check, we may still report that no
-    # information was found.
-    filter_criteria_missing = True
+    def on_get_filter_criteria(response):
+        state["filter_criteria_missing"] = (response.code == 404)
+        if response.code == 200:
+            try:
+                ifc = defusedxml.minidom.parseString(response.body)
+            except Exception as e:
+                _log.error("Failed to parse iFC for public ID %s - %s", public_id, e)
+                state["success"] = False
+            else:
+                ifc_str = ifc.toprettyxml(indent="  ")
+                ifc_str = "\n".join(filter(lambda l: l.strip() != "", ifc_str.split("\n")))
+                ifc_str = "    " + ifc_str.replace("\n", "\n    ")
+                ifc_lines.append("  iFC:")
+                ifc_lines.append(ifc_str)
+        else:
+            _log.error("Failed to retrieve iFC for public ID %s - HTTP status code %d", public_id, response.code)
+            state["success"] = False
+        on_checked()
+
+    def on_checked():
+        state["outstanding"] -= 1
+        if state["outstanding"] > 0:
+            return
+
+        if state["filter_criteria_missing"] and state["public_id_missing"]:
+            _log.error("Failed to find any information for public ID %s.", public_id)
+
+        lines = [] if short else ["Public User ID %s:" % (public_id)]
+        for private in private_lines:
+            lines.extend(private)
+        lines.extend(ifc_lines)
+        if lines:
+            conditional_print(not quiet, "\n".join(lines))
+        callback(state["success"])
+
+    homestead.get_associated_privates(public_id, on_get_privates)
     if not short:
-        homestead.get_filter_criteria(public_id, callback)
-        response = callback.wait()[0]
-        filter_criteria_missing = (response.code == 404)
+        homestead.get_filter_criteria(public_id, on_get_filter_criteria)
+
+def get_user_async(public_id, callback):
+    """
+    Retrieves everything homestead-prov holds for a public ID, passing
+    callback a dict of the form
+
+      {"public_id": ..., "ifc": ...,
+       "private_ids": [{"private_id": ..., "realm": ..., "digest_ha1": ...,
+                        "plaintext_password": ... (if stored)}, ...]}
+
+    or None if any of it couldn't be retrieved.  The lookups are made in
+    parallel.
+    """
+    user = {"public_id": public_id, "private_ids": [], "ifc": None}
+    state = {"success": True, "outstanding": 2}
+
+    def on_get_privates(response):
         if response.code == 200:
-            ifc = defusedxml.minidom.parseString(response.body)
-            ifc_str = ifc.toprettyxml(indent="  ")
-            ifc_str = "\n".join(filter(lambda l: l.strip() != "", ifc_str.split("\n")))
-            ifc_str = "    " + ifc_str.replace("\n", "\n    ")
+            private_ids = json.loads(response.body)['private_ids']
+            state["outstanding"] += len(private_ids)
+            for private_id in private_ids:
+                av = {"private_id": private_id}
+                user["private_ids"].append(av)
+                homestead.get_digest(private_id, partial(on_get_digest, av))
+        else:
+            _log.error("Failed to retrieve private IDs for public ID %s - HTTP status code %d", public_id, response.code)
+            state["success"] = False
+        on_retrieved()
 
-            conditional_print(not quiet, "  iFC:")
-            conditional_print(not quiet, ifc_str)
+    def on_get_digest(av, response):
+        if response.code == 200:
+            body = json.loads(response.body)
+            for field in ("realm", "digest_ha1", "plaintext_password"):
+                if field in body:
+                    av[field] = body[field]
+        else:
+            _log.error("Failed to retrieve digest for private ID %s - HTTP status code %d", av["private_id"], response.code)
+            state["success"] = False
+        on_retrieved()
+
+    def on_get_filter_criteria(response):
+        if response.code == 200:
+            user["ifc"] = response.body
         else:
             _log.error("Failed to retrieve iFC for public ID %s - HTTP status code %d", public_id, response.code)
-            success = False
+            state["success"] = False
+        on_retrieved()
 
-    if filter_criteria_missing and public_id_missing:
-        _log.error("Failed to find any information for public ID %s.", public_id)
+    def on_retrieved():
+        state["outstanding"] -= 1
+        if state["outstanding"] == 0:
+            callback(user if state["success"] else None)
 
-    return success
+    homestead.get_associated_privates(public_id, on_get_privates)
+    homestead.get_filter_criteria(public_id, on_get_filter_criteria)
 
 
 def list_users(target_users_per_chunk=100, keep_going=False):
@@ -292,3 +458,160 @@ def get_users(chunk, chunk_proportion, full=False):
 
     chunk_rsp = json.loads(response.body)
     return chunk_rsp['public_ids']
+
+class AdaptiveWindow(object):
+    """
+    A limit on the number of requests to keep in flight, which adapts to how
+    quickly homestead-prov is responding.  While responses take no more than
+    LATENCY_TOLERANCE times as long as the quickest seen, the window grows
+    by about one each round trip, up to max_size.  Once they slow down, it
+    halves, at most once a round trip.
+    """
+    LATENCY_TOLERANCE = 2.0
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._size = 1.0
+        # The quickest response seen for each kind of request
+        self._best = {}
+        self._responses_since_decrease = 0
+
+    @property
+    def size(self):
+        return int(self._size)
+
+    def record(self, kind, latency):
+        best = min(self._best.get(kind, latency), latency)
+        self._best[kind] = best
+        self._responses_since_decrease += 1
+        if latency > best * self.LATENCY_TOLERANCE:
+            if self._responses_since_decrease >= self._size:
+                _log.debug("Latency %.3fs over %.3fs - reducing window from %d", latency, best, self.size)
+                self._size = max(1.0, self._size / 2)
+                self._responses_since_decrease = 0
+        else:
+            self._size = min(float(self._max_size), self._size + 1.0 / self._size)
+
+class ParallelUserLister(object):
+    """
+    Lists users, as list_users does, but fetches several chunks at once.  If
+    process is given, rather than printing each user it calls
+    process(public_id, callback) - for example display_user_async - while
+    further chunks are being fetched, and callback is passed True or False
+    once the user has been processed.  Requests are kept in flight within an
+    AdaptiveWindow of up to max_in_flight.
+
+    The space of users is covered in order, a chunk at a time, each chunk
+    being sized to hold about target_users_per_chunk users at the density
+    seen so far.
+    """
+    MAX_CHUNK_PROPORTION = 2**24
+    # Grow chunks by at most this factor at a time, in case the users seen
+    # so far are sparser than the rest.
+    MAX_CHUNK_GROWTH = 16
+
+    def __init__(self, max_in_flight, target_users_per_chunk=100, process=None, keep_going=False):
+        self._window = AdaptiveWindow(max_in_flight)
+        self._target = target_users_per_chunk
+        self._process = process
+        self._keep_going = keep_going
+        self.success = True
+        # The start of the next chunk to fetch, and the size of the last,
+        # in units of the smallest chunk.
+        self._position = 0
+        self._span = 1
+        self._users_seen = 0
+        self._span_seen = 0
+        self._to_process = collections.deque()
+        self._in_flight = 0
+        self._chunks_in_flight = 0
+        self._stopping = False
+        self._io_loop = tornado.ioloop.IOLoop.instance()
+
+    def run(self):
+        """Lists all the users, returning True if successful."""
+        self._io_loop.add_callback(self._pump)
+        self._io_loop.start()
+        return self.success
+
+    def _pump(self):
+        while self._in_flight < self._window.size and not self._stopping:
+            if self._position < self.MAX_CHUNK_PROPORTION and self._want_chunk():
+                self._fetch_chunk()
+            elif self._to_process:
+                self._process_user(self._to_process.popleft())
+            else:
+                break
+
+        if self._in_flight == 0 and (self._stopping or
+                                     (self._position >= self.MAX_CHUNK_PROPORTION and
+                                      not self._to_process)):
+            self._io_loop.stop()
+
+    def _want_chunk(self):
+        if not self._process:
+            return True
+        # Fetch the next chunk while processing the users from the last, but
+        # don't get any further ahead than that.
+        return self._chunks_in_flight == 0 and len(self._to_process) < self._window.size
+
+    def _next_span(self):
+        if self._users_seen:
+            span = self._target * self._span_seen / self._users_seen
+        else:
+            span = self._span * self.MAX_CHUNK_GROWTH
+        span = max(1, min(span, self._span * self.MAX_CHUNK_GROWTH))
+        # Chunks are a power of 2 in size, and start at a multiple of it.
+        span = 1 << (int(span).bit_length() - 1)
+        while self._position % span != 0:
+            span /= 2
+        return span
+
+    def _fetch_chunk(self):
+        span = self._next_span()
+        chunk_proportion = self.MAX_CHUNK_PROPORTION / span
+        chunk = self._position / span
+        self._position += span
+        self._span = span
+        self._in_flight += 1
+        self._chunks_in_flight += 1
+        _log.debug("Bulk-retrieving public IDs (chunk %d/%d)\n", chunk, chunk_proportion)
+        homestead.get_public_ids(chunk, chunk_proportion, True,
+                                 partial(self._on_chunk, chunk, chunk_proportion, time.time()))
+
+    def _on_chunk(self, chunk, chunk_proportion, start_time, response):
+        self._in_flight -= 1
+        self._chunks_in_flight -= 1
+        self._window.record("chunk", time.time() - start_time)
+        if response.error:
+            _log.error("Failed to bulk retrieve public IDs (chunk %d/%d) - HTTP status code %d", chunk, chunk_proportion, response.code)
+            self._failed()
+        else:
+            public_ids = [obj['public_id'] for obj in json.loads(response.body)['public_ids']]
+            _log.debug("Retrieved %d public IDs\n", len(public_ids))
+            self._users_seen += len(public_ids)
+            self._span_seen += self.MAX_CHUNK_PROPORTION / chunk_proportion
+            if self._process:
+                self._to_process.extend(public_ids)
+            else:
+                for public_id in public_ids:
+                    print "%s" % (public_id,)
+                sys.stdout.flush()
+        self._pump()
+
+    def _process_user(self, public_id):
+        self._in_flight += 1
+        self._process(public_id, partial(self._on_processed, time.time()))
+
+    def _on_processed(self, start_time, success):
+        self._in_flight -= 1
+        self._window.record("process", time.time() - start_time)
+        sys.stdout.flush()
+        if not success:
+            self._failed()
+        self._pump()
+
+    def _failed(self):
+        self.success = False
+        if not self._keep_going:
+            self._stopping = True
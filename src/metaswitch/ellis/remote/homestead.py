@@ -12,22 +12,35 @@ import logging
 import urllib
 import json
 import re
-import defusedxml.minidom
+from cStringIO import StringIO
 
 from tornado import httpclient
-from tornado.ioloop import IOLoop
 from tornado.httpclient import HTTPError
+from tornado.ioloop import IOLoop
 
-from metaswitch.ellis import settings
+from metaswitch.ellis import settings, ifc_cache
+from metaswitch.ellis.remote import upstream
+from metaswitch.ellis.cache import TTLCache
 from metaswitch.common import utils
 
 from functools import partial
 
 _log = logging.getLogger("ellis.remote")
 
+# The associations between public and private IDs almost never change, so we
+# cache lookups of them.  Changes made through this module invalidate the
+# cache; changes made elsewhere (e.g. by another Ellis process) are picked up
+# when the cached lookups expire.
+#
+# Workers forked by TORNADO_PREFORK would each have their own caches, and a
+# user's next request may well go to a different worker from the one that
+# made their change, so in that case the caches are disabled.
+_CACHE_SIZE = 0 if settings.TORNADO_PREFORK else settings.HOMESTEAD_CACHE_SIZE
+_privates_cache = TTLCache(_CACHE_SIZE, settings.HOMESTEAD_CACHE_TTL_SECS)
+_publics_cache = TTLCache(_CACHE_SIZE, settings.HOMESTEAD_CACHE_TTL_SECS)
+
 def ping(callback=None):
     """Make sure we can reach homestead"""
-    homestead_client = httpclient.AsyncHTTPClient()
     url = _ping_url()
 
     def default_callback(response):
@@ -40,7 +53,7 @@ def ping(callback=None):
             _log.error("Failed to ping Homestead at %s."
                        " Have you configured your HOMESTEAD_URL?" % url)
 
-    homestead_client.fetch(url, callback or default_callback)
+    upstream.homestead.fetch(url, callback or default_callback)
 
 
 def get_digest(private_id, callback):
@@ -53,36 +66,41 @@ def get_digest(private_id, callback):
     _http_request(url, callback, method='GET')
 
 
-def create_private_id(private_id, realm, password, callback, plaintext=False):
+def create_private_id(private_id, realm, password, callback, plaintext=False, digest_ha1=None):
     """Creates a private ID and associates it with an implicit
-    registration set."""
-    password_resp = put_password(private_id, realm, password, None, plaintext=plaintext)
-    # Having no callback makes this synchronous - but check for errors
-    if isinstance(password_resp, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, password_resp))
-        return None
-    irs_url = _new_irs_url()
-    irs_resp = _sync_http_request(irs_url, method="POST", body="")
-    if isinstance(irs_resp, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, irs_resp))
-        return None
-    uuid = _get_irs_uuid(_location(irs_resp))
-    url = _associate_new_irs_url(private_id, uuid)
-
-    # We have to do this synchronously and then call the callback with
-    # its response - otherwise we return before the IMPI and IRS are
-    # associated and subsequent steps fail
-    response = _sync_http_request(url, method="PUT", body="")
-    IOLoop.instance().add_callback(partial(callback, response))
-
-
-def put_password(private_id, realm, password, callback, plaintext=False):
+    registration set.  See put_password for digest_ha1."""
+    def on_password_put(response):
+        _http_request(_new_irs_url(),
+                      _chain_callback(callback, on_irs_created),
+                      method="POST",
+                      body="")
+
+    def on_irs_created(response):
+        uuid = _get_irs_uuid(_location(response))
+        url = _associate_new_irs_url(private_id, uuid)
+        # Only call the callback once the IMPI and IRS are associated -
+        # otherwise subsequent steps fail
+        _http_request(url, _chain_callback(callback), method="PUT", body="")
+
+    put_password(private_id,
+                 realm,
+                 password,
+                 _chain_callback(callback, on_password_put),
+                 plaintext=plaintext,
+                 digest_ha1=digest_ha1)
+
+
+def put_password(private_id, realm, password, callback, plaintext=False, digest_ha1=None):
     """
     Posts a new password to Homestead for a given private id
     callback receives the HTTPResponse object.
+    If digest_ha1 is given (as when restoring a subscriber whose password
+    isn't known), it is stored as is, and password is ignored.
     """
     url = _private_id_url(private_id)
-    if plaintext:
+    if digest_ha1:
+        body = json.dumps({"digest_ha1": digest_ha1, "realm": realm})
+    elif plaintext:
         body = json.dumps({"plaintext_password": password, "realm": realm})
     else:
         digest = utils.md5("%s:%s:%s" % (private_id,
@@ -101,24 +119,26 @@ def delete_private_id(private_id, callback):
     Deletes a password from Homestead for a given private id
     callback receives the HTTPResponse object.
     """
-    irs_url = _associated_irs_url(private_id)
-    associated_irs_response = _sync_http_request(irs_url, method='GET')
-    if isinstance(associated_irs_response, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, associated_irs_response))
-        return None
-
-    # If there was an error creating the user, there may be no irs, but we want
-    # to continue attempting to delete the user
-    irs_array = json.loads(associated_irs_response.body)['associated_implicit_registration_sets']
-    if len(irs_array) > 0:
-        irs = irs_array[0]
-        irs_deletion = _sync_http_request(_irs_url(irs), method='DELETE')
-        if isinstance(irs_deletion, HTTPError): # pragma: no cover
-            IOLoop.instance().add_callback(partial(callback, irs_deletion))
-            return None
+    callback = _forgetting_associations(callback, private_id=private_id)
+
+    def on_get_irs(response):
+        # If there was an error creating the user, there may be no irs, but we
+        # want to continue attempting to delete the user
+        irs_array = json.loads(response.body)['associated_implicit_registration_sets']
+        if len(irs_array) > 0:
+            irs = irs_array[0]
+            _http_request(_irs_url(irs),
+                          _chain_callback(callback, on_irs_deleted),
+                          method='DELETE')
+        else:
+            on_irs_deleted(None)
 
-    url = _private_id_url(private_id)
-    _http_request(url, callback, method='DELETE')
+    def on_irs_deleted(response):
+        url = _private_id_url(private_id)
+        _http_request(url, callback, method='DELETE')
+
+    irs_url = _associated_irs_url(private_id)
+    _http_request(irs_url, _chain_callback(callback, on_get_irs), method='GET')
 
 
 def get_associated_publics(private_id, callback):
@@ -127,7 +147,7 @@ def get_associated_publics(private_id, callback):
     from Homestead. callback receives the HTTPResponse object.
     """
     url = _associated_public_url(private_id)
-    _http_request(url, callback, method='GET')
+    _cached_lookup(_publics_cache, private_id, url, callback)
 
 
 def create_public_id(private_id, public_id, ifcs, callback):
@@ -136,28 +156,38 @@ def create_public_id(private_id, public_id, ifcs, callback):
     to Homestead. Also sets the given iFCs for that public ID.
     callback receives the HTTPResponse object.
     """
+    # Check the iFCs before we start creating anything, so that we don't leave
+    # a half-provisioned public ID behind if they're invalid
+    ifc_hash = _check_ifc_file(ifcs)
+    callback = _forgetting_associations(callback,
+                                        private_id=private_id,
+                                        public_id=public_id)
+
+    def on_get_irs(response):
+        _log.info(response.body)
+        irs = json.loads(response.body)['associated_implicit_registration_sets'][0]
+        sp_url = _new_service_profile_url(irs)
+        _http_request(sp_url,
+                      _chain_callback(callback, partial(on_sp_created, irs)),
+                      method='POST',
+                      body="")
+
+    def on_sp_created(irs, response):
+        sp = _get_sp_uuid(_location(response))
+        public_url = _new_public_id_url(irs, sp, public_id)
+        body = "<PublicIdentity><Identity>" + \
+               public_id + \
+               "</Identity></PublicIdentity>"
+        _http_request(public_url,
+                      _chain_callback(callback, on_public_id_created),
+                      method='PUT',
+                      body=body)
+
+    def on_public_id_created(response):
+        _put_filter_criteria(public_id, ifcs, ifc_hash, callback)
+
     url = _associated_irs_url(private_id)
-    resp1 = _sync_http_request(url, method='GET')
-    if isinstance(resp1, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, resp1))
-        return None
-    _log.info(resp1.body)
-    irs = json.loads(resp1.body)['associated_implicit_registration_sets'][0]
-    sp_url = _new_service_profile_url(irs)
-    resp2 = _sync_http_request(sp_url, method='POST', body="")
-    if isinstance(resp2, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, resp2))
-        return None
-    sp = _get_sp_uuid(_location(resp2))
-    public_url = _new_public_id_url(irs, sp, public_id)
-    body = "<PublicIdentity><Identity>" + \
-           public_id + \
-           "</Identity></PublicIdentity>"
-    resp3 = _sync_http_request(public_url, method='PUT', body=body)
-    if isinstance(resp3, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, resp3))
-        return None
-    put_filter_criteria(public_id, ifcs, callback)
+    _http_request(url, _chain_callback(callback, on_get_irs), method='GET')
 
 
 def delete_public_id(public_id, callback):
@@ -165,18 +195,20 @@ def delete_public_id(public_id, callback):
     Deletes an association between a public and private identity in Homestead
     callback receives the HTTPResponse object.
     """
+    callback = _forgetting_associations(callback, public_id=public_id)
+
+    def on_get_sp(response):
+        service_profile = _location(response)
+        url = _url_host() + _make_url_without_prefix(service_profile + "/public_ids/{}", public_id)
+        _http_request(url,
+                      _chain_callback(callback, partial(on_public_id_deleted, service_profile)),
+                      method='DELETE')
+
+    def on_public_id_deleted(service_profile, response):
+        _http_request(_url_host() + service_profile, callback, method='DELETE')
+
     public_to_sp_url = _sp_from_public_id_url(public_id)
-    response = _sync_http_request(public_to_sp_url, method='GET')
-    if isinstance(response, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, response))
-        return None
-    service_profile = _location(response)
-    url = _url_host() + _make_url_without_prefix(service_profile + "/public_ids/{}", public_id)
-    resp2 = _sync_http_request(url, method='DELETE')
-    if isinstance(resp2, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, resp2))
-        return None
-    _http_request(_url_host() + service_profile, callback, method='DELETE')
+    _http_request(public_to_sp_url, _chain_callback(callback, on_get_sp), method='GET')
 
 
 def get_associated_privates(public_id, callback):
@@ -186,21 +218,67 @@ def get_associated_privates(public_id, callback):
     callback receives the HTTPResponse object.
     """
     url = _associated_private_url(public_id)
-    _http_request(url, callback, method='GET')
+    _cached_lookup(_privates_cache, public_id, url, callback)
+
+
+def get_associated_privates_batch(public_ids, callback):
+    """
+    Retrieves the associated private identities for each of a list of public
+    identities from Homestead, keeping at most
+    HOMESTEAD_MAX_LOOKUPS_IN_FLIGHT requests outstanding at once.
+    callback receives a dict mapping each public identity to its list of
+    private identities, and a dict mapping each public identity that could
+    not be looked up to the HTTPError.
+    """
+    pending = list(set(public_ids))
+    private_ids = {}
+    errors = {}
+    in_flight = [0]
+
+    def next_lookup():
+        public_id = pending.pop()
+        in_flight[0] += 1
+        get_associated_privates(public_id,
+                                _chain_callback(partial(on_lookup, public_id)))
+
+    def on_lookup(public_id, response):
+        in_flight[0] -= 1
+        if isinstance(response, HTTPError):
+            errors[public_id] = response
+        else:
+            try:
+                # Body is of format {"public_id": "<public_id>",
+                #                    "private_ids": ["<private_id_1>", "<private_id_2>"...]}
+                private_ids[public_id] = json.loads(response.body)["private_ids"]
+            except (ValueError, TypeError, KeyError):
+                _log.error("Could not parse private identity list: %s", response.body)
+                errors[public_id] = HTTPError(502)
+
+        if pending:
+            next_lookup()
+        elif in_flight[0] == 0:
+            callback(private_ids, errors)
+
+    if not pending:
+        callback(private_ids, errors)
+    else:
+        for _ in range(min(settings.HOMESTEAD_MAX_LOOKUPS_IN_FLIGHT, len(pending))):
+            # Lookups may complete synchronously, and start the rest
+            if pending:
+                next_lookup()
 
 
 def get_filter_criteria(public_id, callback):
     """
     Retrieves the filter criteria associated with the given public ID.
     """
+    def on_get_sp(response):
+        sp_location = _location(response)
+        url = _url_host() + _make_url_without_prefix(sp_location + "/filter_criteria")
+        _http_request(url, callback, method='GET')
+
     sp_url = _sp_from_public_id_url(public_id)
-    sp_resp = _sync_http_request(sp_url, method='GET')
-    if isinstance(sp_resp, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, sp_resp))
-        return None
-    sp_location = _location(sp_resp)
-    url = _url_host() + _make_url_without_prefix(sp_location + "/filter_criteria")
-    _http_request(url, callback, method='GET')
+    _http_request(sp_url, _chain_callback(callback, on_get_sp), method='GET')
 
 
 def put_filter_criteria(public_id, ifcs, callback):
@@ -208,20 +286,8 @@ def put_filter_criteria(public_id, ifcs, callback):
     Updates the initial filter criteria in Homestead for the given line.
     callback receives the HTTPResponse object.
     """
-    try:
-        _validate_ifc_file(ifcs)
-    except ValueError as e:
-        _log.error("The initial filter criteria cannot be uploaded as the iFC file \
-                   provided is not a valid XML file - %s", e)
-        raise
-    sp_url = _sp_from_public_id_url(public_id)
-    resp = _sync_http_request(sp_url, method='GET')
-    if isinstance(resp, HTTPError): # pragma: no cover
-        IOLoop.instance().add_callback(partial(callback, resp))
-        return None
-    sp_location = _location(resp)
-    url = _url_host() + _make_url_without_prefix(sp_location + "/filter_criteria")
-    _http_request(url, callback, method='PUT', body=ifcs)
+    ifc_hash = _check_ifc_file(ifcs)
+    _put_filter_criteria(public_id, ifcs, ifc_hash, callback)
 
 def get_public_ids(chunk, chunk_proportion, excludeuuids, callback):
     """
@@ -231,8 +297,131 @@ def get_public_ids(chunk, chunk_proportion, excludeuuids, callback):
     _http_request(url, callback, method='GET')
 
 
+def get_cache_stats():
+    """Returns the hit and miss counts and sizes of the lookup caches"""
+    return {"associated_privates": _privates_cache.stats(),
+            "associated_publics": _publics_cache.stats()}
+
+def log_cache_stats():
+    """Logs how many lookups the caches have answered, and how full they
+    are"""
+    for name, stats in sorted(get_cache_stats().items()):
+        lookups = stats["hits"] + stats["misses"]
+        _log.info("Homestead %s cache: %d lookups, %d%% answered from the cache, %d entries",
+                  name,
+                  lookups,
+                  100 * stats["hits"] / lookups if lookups else 0,
+                  stats["size"])
+
+
 # Utility functions
 
+def _cached_lookup(cache, key, url, callback):
+    """GETs url, or answers from the cache if we've looked it up recently.
+    Only successful lookups are cached."""
+    body = cache.get(key)
+    if body is not None:
+        _log.debug("Answering GET of %s from cache", url)
+        response = httpclient.HTTPResponse(httpclient.HTTPRequest(url, method='GET'),
+                                           200,
+                                           buffer=StringIO(body),
+                                           effective_url=url)
+        # Always call back asynchronously, as we would if we'd sent a request
+        IOLoop.instance().add_callback(partial(callback, response))
+        return
+
+    generation = cache.generation
+    def on_response(response):
+        # Don't cache the result if the association changed while we were
+        # looking it up
+        if response.code == 200 and cache.generation == generation:
+            cache.put(key, response.body)
+        callback(response)
+
+    _http_request(url, on_response, method='GET')
+
+
+def _forget_associations(private_id=None, public_id=None):
+    """Invalidates the cached lookups affected by changing the associations
+    of private_id and/or public_id."""
+    if public_id:
+        _privates_cache.invalidate(public_id)
+    if private_id:
+        _publics_cache.invalidate(private_id)
+
+    # If only one side of the association is known, we don't know which
+    # lookups of the other side are affected.
+    if not private_id:
+        _publics_cache.clear()
+    if not public_id:
+        _privates_cache.clear()
+
+
+def _forgetting_associations(callback, **kwargs):
+    """Invalidates the cached lookups affected by a change both before and
+    after it's made, so that lookups made during the change aren't cached."""
+    _forget_associations(**kwargs)
+    def forgetting_callback(response):
+        _forget_associations(**kwargs)
+        callback(response)
+    return forgetting_callback
+
+
+def _put_filter_criteria(public_id, ifcs, ifc_hash, callback):
+    """Looks up the service profile for the given line and PUTs the
+    (already validated) iFCs, with content hash ifc_hash, to it"""
+    def on_get_sp(response):
+        _log.debug("Writing iFC %s for %s", ifc_hash, public_id)
+        sp_location = _location(response)
+        url = _url_host() + _make_url_without_prefix(sp_location + "/filter_criteria")
+        _http_request(url, callback, method='PUT', body=ifcs)
+
+    sp_url = _sp_from_public_id_url(public_id)
+    _http_request(sp_url, _chain_callback(callback, on_get_sp), method='GET')
+
+
+def _check_ifc_file(ifcs):
+    """Validates iFCs that are about to be uploaded, returning their content
+    hash (see ifc_cache), or logging and re-raising the ValueError if they're
+    not valid XML"""
+    try:
+        return ifc_cache.validate(ifcs)
+    except ValueError as e:
+        _log.error("The initial filter criteria cannot be uploaded as the iFC file \
+                   provided is not a valid XML file - %s", e)
+        raise
+
+
+def _chain_callback(callback, on_success=None):
+    """
+    Returns a callback for one request in a chain of asynchronous requests
+    to Homestead.
+
+    If the request failed, the chain ends and callback receives the HTTPError
+    (as it would have from _sync_http_request).  Otherwise, on_success is
+    called with the HTTPResponse to kick off the next request, or, if this is
+    the last request in the chain, callback receives the HTTPResponse.
+    Homestead answers lookups with 303s, so these count as successes.
+    """
+    def chain_callback(response):
+        if response.error and response.code != 303:
+            error = response.error
+            if not isinstance(error, HTTPError):
+                _log.error("Received exception {}, treating as 500 HTTP error".format(error))
+                error = HTTPError(500)
+            callback(error)
+        elif on_success is None:
+            callback(response)
+        else:
+            try:
+                on_success(response)
+            except Exception as e:
+                _log.error("Received exception {}, treating as 500 HTTP error".format(e))
+                callback(HTTPError(500))
+
+    return chain_callback
+
+
 def _location(httpresponse):
     """Retrieves the Location header from this HTTP response,
     throwing a 500 error if it is missing"""
@@ -244,35 +433,22 @@ def _location(httpresponse):
 
 
 def _http_request(url, callback, **kwargs):
-    http_client = httpclient.AsyncHTTPClient()
     if 'follow_redirects' not in kwargs:
         kwargs['follow_redirects'] = False
-    kwargs['allow_ipv6'] = True
-
-    def do_http_request():
-        _log.info("Sending HTTP %s request to %s",
-                  kwargs.get('method', 'GET'),
-                  url)
-        http_client.fetch(url, callback_wrapper, **kwargs)
 
     def callback_wrapper(response):
         _log.debug("Received response from %s with code %d" % (url, response.code))
         callback(response)
 
-    do_http_request()
+    upstream.homestead.fetch(url, callback_wrapper, **kwargs)
 
 
 def _sync_http_request(url, **kwargs):
-    _log.info("Sending HTTP %s request to %s",
-              kwargs.get('method', 'GET'),
-              url)
-    http_client = httpclient.HTTPClient()
     if 'follow_redirects' not in kwargs:
         kwargs['follow_redirects'] = False
-    kwargs['allow_ipv6'] = True
     while True:
         try:
-            return http_client.fetch(url, **kwargs)
+            return upstream.homestead.fetch_sync(url, **kwargs)
         except HTTPError as e:
             if e.code == 303:
                 return e.response
@@ -391,10 +567,3 @@ def _get_sp_uuid(url):
     if not match: # pragma: no cover
         raise ValueError("URL %s is badly formatted: expected it to match %s" % (url, re_str))
     return match.group(1)
-
-def _validate_ifc_file(ifc_file):
-    """Checks whether ifc_file is a valid XML file. Raises a ValueError if not."""
-    try:
-        defusedxml.minidom.parseString(ifc_file)
-    except Exception as e:
-        raise ValueError("The XML file containing the iFC is malformed.", e)
@@ -0,0 +1,422 @@
+# @file upstream.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+The HTTP clients used to talk to the backends (Homestead and Homer).
+
+Each backend has its own client, shared by every request to it, rather than
+one being set up for each request.  With the curl client (as configured by
+main.py), each of its handles keeps its connection alive, so requests reuse
+a pool of connections to the backend rather than each paying for a new TCP
+connection.  The client also bounds how many requests are in flight to the
+backend at once - any more are queued until one completes.
+
+Every request is made with the connect and request timeouts from settings.
+
+Each backend also has a circuit breaker, so that when the backend is failing
+or slow, requests to it fail straight away rather than piling up behind the
+ones already waiting on it.  A request that isn't sent, because the breaker
+is open or too many requests are already waiting, gets a 503 response whose
+error is a BackendUnavailable - see settings.py for the details.
+
+Idempotent requests (GET, PUT and DELETE) that fail with a server error are
+retried, with jittered exponential backoff, as long as there's time left
+before the deadline of the user request being handled (see deadline()).
+"""
+
+import collections
+import contextlib
+import logging
+import math
+import random
+import threading
+import time
+
+from functools import partial
+
+from tornado import httpclient, httputil
+from tornado.ioloop import IOLoop
+
+from metaswitch.ellis import settings
+
+_log = logging.getLogger("ellis.remote")
+
+# The methods of requests that can safely be retried
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+# Holds the deadline of the user request being handled, as set by deadline()
+_context = threading.local()
+
+@contextlib.contextmanager
+def deadline(when):
+    """
+    A context manager under which requests to the backends, including any
+    retries, should be done by when (as given by time.time()).  Use it as a
+    tornado StackContext, so that it applies to requests made from callbacks
+    too.
+    """
+    old = getattr(_context, "deadline", None)
+    _context.deadline = when
+    try:
+        yield
+    finally:
+        _context.deadline = old
+
+def _deadline():
+    # Outside of a user request, each request gets its own deadline
+    return (getattr(_context, "deadline", None) or
+            time.time() + settings.UPSTREAM_RETRY_DEADLINE_SECS)
+
+def _is_idempotent(kwargs):
+    return kwargs.get('method', 'GET') in IDEMPOTENT_METHODS
+
+def _new_stats():
+    return {"Retries": 0,
+            "Requests recovered by retrying": 0,
+            "Requests failed after retrying": 0}
+
+class BackendUnavailable(httpclient.HTTPError):
+    """The error for a request that was turned away without being sent to
+    the backend.  retry_after is how many seconds to wait before trying
+    again."""
+    def __init__(self, backend, retry_after):
+        super(BackendUnavailable, self).__init__(503, "%s unavailable" % backend)
+        self.backend = backend
+        self.retry_after = retry_after
+
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.state = self.CLOSED
+        # Whether each of the most recent requests succeeded
+        self._outcomes = collections.deque()
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def allow_request(self):
+        """Returns whether a request may be sent, and if so, whether it's the
+        trial of a half-open breaker."""
+        if self.state == self.OPEN:
+            if time.time() < self._opened_at + settings.UPSTREAM_BREAKER_OPEN_SECS:
+                return False, False
+            _log.info("Trying %s again", self.name)
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                return False, False
+            self._trial_in_flight = True
+            return True, True
+        return True, False
+
+    def record(self, success, trial=False):
+        """Records the outcome of a request allowed by allow_request."""
+        if self.state == self.HALF_OPEN:
+            # Requests sent before the breaker opened tell us nothing new
+            if trial:
+                if success:
+                    _log.info("%s has recovered", self.name)
+                    self.reset()
+                else:
+                    self._open()
+            return
+        elif self.state == self.OPEN or not settings.UPSTREAM_BREAKER_WINDOW:
+            return
+
+        self._outcomes.append(success)
+        while len(self._outcomes) > settings.UPSTREAM_BREAKER_WINDOW:
+            self._outcomes.popleft()
+        failures = self._outcomes.count(False)
+        if (len(self._outcomes) >= settings.UPSTREAM_BREAKER_MIN_REQUESTS and
+            failures >= settings.UPSTREAM_BREAKER_ERROR_RATE * len(self._outcomes)):
+            _log.error("%d of the last %d requests to %s failed",
+                       failures, len(self._outcomes), self.name)
+            self._open()
+
+    def is_open(self):
+        """Returns whether the breaker is turning requests away.  Once it's
+        been open for UPSTREAM_BREAKER_OPEN_SECS, it isn't, as the next
+        request is let through as a trial."""
+        if self.state == self.OPEN:
+            return time.time() < self._opened_at + settings.UPSTREAM_BREAKER_OPEN_SECS
+        return self.state == self.HALF_OPEN and self._trial_in_flight
+
+    def retry_after(self):
+        """Returns how many seconds until the breaker will let a request
+        through, which is at least 1."""
+        if self.state != self.OPEN:
+            return 1
+        remaining = self._opened_at + settings.UPSTREAM_BREAKER_OPEN_SECS - time.time()
+        return max(1, int(math.ceil(remaining)))
+
+    def _open(self):
+        _log.error("Not sending requests to %s for %ss",
+                   self.name, settings.UPSTREAM_BREAKER_OPEN_SECS)
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        self._outcomes.clear()
+        self._trial_in_flight = False
+
+def _succeeded(code, request_time):
+    # The backend answering with a client error is no sign of it being
+    # unhealthy.  599 is what tornado reports for a timeout or a failure to
+    # connect.
+    return code < 500 and request_time <= settings.UPSTREAM_BREAKER_SLOW_REQUEST_SECS
+
+class Backend(object):
+    def __init__(self, name, max_in_flight_setting):
+        self.name = name
+        # The name of the setting giving the maximum number of requests in
+        # flight, which is read when the client is created, so that it can be
+        # overridden by local settings
+        self._max_in_flight_setting = max_in_flight_setting
+        self.breaker = CircuitBreaker(name)
+        self.stats = _new_stats()
+        self._client = None
+        self._io_loop = None
+        # Requests in flight or queued on the client
+        self._pending = 0
+        # Blocking clients each run their own IOLoop, so can't be shared
+        # between threads
+        self._local = threading.local()
+
+    def fetch(self, url, callback, **kwargs):
+        """Makes a request to the backend, passing callback the
+        HTTPResponse.  Idempotent requests that fail with a server error are
+        retried, unless retry=False is given."""
+        self._set_defaults(kwargs)
+        retry = kwargs.pop('retry', True) and _is_idempotent(kwargs)
+        deadline = _deadline()
+        state = {"attempts": 1}
+
+        def on_response(response):
+            delay = None
+            if retry:
+                delay = self._retry_delay(response.code, response.error,
+                                          state["attempts"], deadline)
+            if delay is None:
+                self._record_outcome(response.code, state["attempts"])
+                callback(response)
+                return
+            state["attempts"] += 1
+            IOLoop.instance().add_timeout(time.time() + delay,
+                                          partial(self._retry, url, on_response, kwargs, deadline))
+
+        self._send(url, on_response, kwargs)
+
+    def fetch_sync(self, url, **kwargs):
+        """Makes a blocking request to the backend, returning the
+        HTTPResponse, or raising an HTTPError as HTTPClient.fetch does
+        (a BackendUnavailable if the request isn't sent).  Idempotent
+        requests are retried as for fetch."""
+        self._set_defaults(kwargs)
+        retry = kwargs.pop('retry', True) and _is_idempotent(kwargs)
+        deadline = _deadline()
+        attempts = 1
+        while True:
+            try:
+                response = self._send_sync(url, kwargs)
+            except httpclient.HTTPError as e:
+                delay = None
+                if retry:
+                    delay = self._retry_delay(e.code, e, attempts, deadline)
+                if delay is None:
+                    self._record_outcome(e.code, attempts)
+                    raise
+            else:
+                self._record_outcome(response.code, attempts)
+                return response
+            attempts += 1
+            time.sleep(delay)
+            if not self._cap_timeout(kwargs, deadline):
+                self._record_outcome(599, attempts)
+                raise httpclient.HTTPError(599, "Timeout")
+
+    def _send(self, url, callback, kwargs):
+        """Sends a request, once."""
+        error, trial = self._check_available()
+        if error:
+            _log.warning("Not sending HTTP %s request to %s: %s",
+                         kwargs.get('method', 'GET'), url, error)
+            self._fail(url, callback, kwargs, error,
+                       {"Retry-After": str(error.retry_after)})
+            return
+
+        _log.info("Sending HTTP %s request to %s",
+                  kwargs.get('method', 'GET'),
+                  url)
+        client = self._async_client()
+        start = time.time()
+        self._pending += 1
+
+        def on_response(response):
+            self._pending -= 1
+            self.breaker.record(_succeeded(response.code, time.time() - start), trial)
+            callback(response)
+
+        client.fetch(url, on_response, **kwargs)
+
+    def _fail(self, url, callback, kwargs, error, headers=None):
+        """Calls back with a response for error, for a request that isn't
+        being sent."""
+        response = httpclient.HTTPResponse(
+            httpclient.HTTPRequest(url, method=kwargs.get('method', 'GET')),
+            error.code,
+            headers=httputil.HTTPHeaders(headers or {}),
+            effective_url=url,
+            error=error)
+        # Always call back asynchronously, as we would if we'd sent a request
+        IOLoop.instance().add_callback(partial(callback, response))
+
+    def _send_sync(self, url, kwargs):
+        """Sends a blocking request, once."""
+        error, trial = self._check_available()
+        if error:
+            raise error
+        _log.info("Sending HTTP %s request to %s",
+                  kwargs.get('method', 'GET'),
+                  url)
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = httpclient.HTTPClient()
+        start = time.time()
+        code = 599
+        try:
+            response = client.fetch(url, **kwargs)
+            code = response.code
+            return response
+        except httpclient.HTTPError as e:
+            code = e.code
+            raise
+        finally:
+            self.breaker.record(_succeeded(code, time.time() - start), trial)
+
+    def reset(self):
+        """Forgets the clients, the state of the breaker and the stats, so
+        that new clients are created with the current settings."""
+        self.breaker.reset()
+        self.stats = _new_stats()
+        self._client = None
+        self._io_loop = None
+        self._pending = 0
+        self._local = threading.local()
+
+    def _check_available(self):
+        """Returns a BackendUnavailable if a request shouldn't be sent to the
+        backend now (or None if it should), and whether the request is the
+        breaker's trial."""
+        if (settings.UPSTREAM_MAX_PENDING and
+            self._pending >= settings.UPSTREAM_MAX_PENDING):
+            return BackendUnavailable(self.name, 1), False
+        allowed, trial = self.breaker.allow_request()
+        if not allowed:
+            return BackendUnavailable(self.name, self.breaker.retry_after()), False
+        return None, trial
+
+    def _retry(self, url, callback, kwargs, deadline):
+        if not self._cap_timeout(kwargs, deadline):
+            # The retry was due too close to the deadline to be worth sending
+            _log.warning("No time left to retry request to %s", self.name)
+            self._fail(url, callback, kwargs, httpclient.HTTPError(599, "Timeout"))
+            return
+        self._send(url, callback, kwargs)
+
+    def _retry_delay(self, code, error, attempts, deadline):
+        """Returns how long to wait before retrying a request that's been
+        tried attempts times, the last failing with code, or None if it
+        shouldn't be retried."""
+        # There's no point retrying a request that wasn't sent because the
+        # backend is unavailable
+        if code < 500 or isinstance(error, BackendUnavailable):
+            return None
+        if attempts >= settings.UPSTREAM_RETRY_MAX_ATTEMPTS:
+            return None
+        # A random delay up to the backoff, so that requests that failed
+        # together aren't all retried together
+        delay = random.uniform(0, min(settings.UPSTREAM_RETRY_MAX_DELAY_SECS,
+                                      settings.UPSTREAM_RETRY_BASE_DELAY_SECS * 2 ** (attempts - 1)))
+        if time.time() + delay >= deadline:
+            _log.warning("No time left to retry request to %s", self.name)
+            return None
+        _log.warning("Request to %s failed with %s, retrying in %.2fs",
+                     self.name, code, delay)
+        self.stats["Retries"] += 1
+        return delay
+
+    def _record_outcome(self, code, attempts):
+        if attempts > 1:
+            if code < 500:
+                self.stats["Requests recovered by retrying"] += 1
+            else:
+                self.stats["Requests failed after retrying"] += 1
+
+    def _cap_timeout(self, kwargs, deadline):
+        """Limits a retry to whatever time is left before deadline,
+        returning False if there's none."""
+        remaining = deadline - time.time()
+        # Timeouts are in whole milliseconds, and one of 0 means no timeout
+        # at all
+        if remaining < 0.001:
+            return False
+        kwargs['request_timeout'] = min(kwargs['request_timeout'], remaining)
+        return True
+
+    def _async_client(self):
+        # Each process has its own IOLoop once it has forked, and needs its
+        # own client on it.
+        io_loop = IOLoop.instance()
+        if self._client is None or self._io_loop is not io_loop:
+            max_in_flight = getattr(settings, self._max_in_flight_setting)
+            _log.debug("Creating %s client, with up to %d requests in flight",
+                       self.name, max_in_flight)
+            self._client = httpclient.AsyncHTTPClient(io_loop,
+                                                      max_clients=max_in_flight,
+                                                      force_instance=True)
+            self._io_loop = io_loop
+            # Any requests pending were on the old client, so will never
+            # complete on this one
+            self._pending = 0
+        return self._client
+
+    def _set_defaults(self, kwargs):
+        kwargs.setdefault('connect_timeout', settings.UPSTREAM_CONNECT_TIMEOUT_SECS)
+        kwargs.setdefault('request_timeout', settings.UPSTREAM_REQUEST_TIMEOUT_SECS)
+        kwargs['allow_ipv6'] = True
+
+homestead = Backend("Homestead", "HOMESTEAD_MAX_IN_FLIGHT")
+xdm = Backend("Homer", "XDM_MAX_IN_FLIGHT")
+
+BACKENDS = (homestead, xdm)
+
+def unavailable_backends():
+    """Returns the backends whose breakers are open, so that requests to
+    them are failing."""
+    return [b for b in BACKENDS if b.breaker.is_open()]
+
+def stats():
+    """Returns the retry stats of each backend, by name."""
+    return dict((b.name, dict(b.stats)) for b in BACKENDS)
+
+def reset():
+    for backend in BACKENDS:
+        backend.reset()
+
+def set_max_in_flight(max_in_flight):
+    """Lets up to max_in_flight requests be in flight to each backend at
+    once, as the bulk provisioning tools do to match their windows."""
+    settings.HOMESTEAD_MAX_IN_FLIGHT = max_in_flight
+    settings.XDM_MAX_IN_FLIGHT = max_in_flight
+    reset()
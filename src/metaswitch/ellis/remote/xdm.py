@@ -11,9 +11,8 @@
 import logging
 import urllib
 
-from tornado import httpclient
-
 from metaswitch.ellis import settings
+from metaswitch.ellis.remote import upstream
 
 _log = logging.getLogger("ellis.remote")
 
@@ -24,16 +23,11 @@ def simservs_uri(user):
     return uri
 
 def fetch_with_headers(user, uri, callback, **kwargs):
-    _log.info("Sending HTTP %s request to %s",
-              kwargs.get('method', 'GET'),
-              uri)
-    client = httpclient.AsyncHTTPClient()
     headers = kwargs.setdefault("headers", {})
     headers.update({"X-XCAP-Asserted-Identity": user})
-    kwargs['allow_ipv6'] = True
-    client.fetch(uri,
-                 callback,
-                 **kwargs)
+    upstream.xdm.fetch(uri,
+                       callback,
+                       **kwargs)
 
 def get_simservs(user, callback):
     uri = simservs_uri(user)
@@ -27,13 +27,19 @@ def ensure_dir_exists(d):
     if not os.path.isdir(d):
         raise RuntimeError("Failed to create dir %s" % d)
 
-# Tornado configuration
+# Tornado configuration.  By default, Ellis runs as a single process.  If
+# TORNADO_PREFORK is set, it instead forks TORNADO_PROCESSES_PER_CORE worker
+# processes per core, all serving the HTTP_UNIX socket and each logging to its
+# own file.  Workers that crash are restarted, up to TORNADO_MAX_RESTARTS times.
+TORNADO_PREFORK = False
 TORNADO_PROCESSES_PER_CORE = 2
+TORNADO_MAX_RESTARTS = 100
 
 # Calculate useful directories relative to the project.
 _MY_DIR = os.path.dirname(__file__)
 PROJECT_DIR = os.path.abspath(os.path.join(_MY_DIR, "..", "..", ".."))
 LOGS_DIR = os.path.join(PROJECT_DIR, "logs")
+EMAIL_SPOOL_DIR = os.path.join(PROJECT_DIR, "spool")
 CERTS_DIR = os.path.join(PROJECT_DIR, "certificates")
 STATIC_DIR = os.path.join(PROJECT_DIR, "web-content")
 
@@ -63,9 +69,104 @@ SQL_PORT = 5000
 SQL_DB = "ellis"
 SQL_PW = ""
 
+# All the API handlers' queries run on a pool of DB_THREADS threads, each
+# with its own connection, and if DB_MAX_QUEUED queries are already waiting
+# for one, further requests are turned away with a 503.  The connection pool
+# holds 20 connections, which must cover these threads as well as the second
+# connection each uses while leasing numbers (see NUMBER_LEASE_BATCH_SIZE).
+DB_THREADS = 10
+DB_MAX_QUEUED = 200
+
+# Number allocation.  If NUMBER_LEASE_BATCH_SIZE is non-zero, each Ellis
+# process leases that many free numbers at a time and allocates from them,
+# rather than searching the pool for every allocation.  Unused leases are
+# returned on shutdown, or expire after NUMBER_LEASE_SECS.
+NUMBER_LEASE_BATCH_SIZE = 0
+NUMBER_LEASE_SECS = 60
+
+# Up to NUMBER_BATCH_MAX_SIZE numbers may be allocated to an account in one
+# request, and up to NUMBER_BATCH_MAX_IN_FLIGHT of them are created in
+# Homestead and Homer at once.
+NUMBER_BATCH_MAX_SIZE = 500
+NUMBER_BATCH_MAX_IN_FLIGHT = 10
+
 # Homestead setup
 HOMESTEAD_URL = "hs.cw-ngv.com:8889"
 
+# Requests to Homestead and Homer are made over a pool of keep-alive
+# connections to each, with up to HOMESTEAD_MAX_IN_FLIGHT and
+# XDM_MAX_IN_FLIGHT requests in flight at once - further requests are
+# queued.  UPSTREAM_HTTP_CLIENT is the tornado AsyncHTTPClient implementation
+# to use (None for tornado's default, which doesn't keep connections alive).
+UPSTREAM_HTTP_CLIENT = "tornado.curl_httpclient.CurlAsyncHTTPClient"
+UPSTREAM_CONNECT_TIMEOUT_SECS = 5
+UPSTREAM_REQUEST_TIMEOUT_SECS = 20
+HOMESTEAD_MAX_IN_FLIGHT = 50
+XDM_MAX_IN_FLIGHT = 50
+
+# Each backend has a circuit breaker.  Of the last UPSTREAM_BREAKER_WINDOW
+# requests to it, if at least UPSTREAM_BREAKER_MIN_REQUESTS have completed and
+# UPSTREAM_BREAKER_ERROR_RATE of them failed with a server error or took
+# longer than UPSTREAM_BREAKER_SLOW_REQUEST_SECS, the breaker opens.  Requests
+# to the backend then fail straight away (with a 503 and a Retry-After) for
+# UPSTREAM_BREAKER_OPEN_SECS, after which a single trial request is let
+# through - if it succeeds, the breaker closes again.
+#
+# Independently, once UPSTREAM_MAX_PENDING requests are waiting on a backend
+# (in flight or queued), further requests to it are turned away.
+#
+# Set UPSTREAM_BREAKER_WINDOW or UPSTREAM_MAX_PENDING to 0 to disable the
+# breakers or the limit on pending requests, as the repop and sync_databases
+# tools do.
+UPSTREAM_BREAKER_WINDOW = 20
+UPSTREAM_BREAKER_MIN_REQUESTS = 10
+UPSTREAM_BREAKER_ERROR_RATE = 0.5
+UPSTREAM_BREAKER_SLOW_REQUEST_SECS = 5
+UPSTREAM_BREAKER_OPEN_SECS = 10
+UPSTREAM_MAX_PENDING = 200
+
+# Idempotent requests (GET, PUT and DELETE) to Homestead and Homer that fail
+# with a server error, or get no response, are tried up to
+# UPSTREAM_RETRY_MAX_ATTEMPTS times in all.  Before each retry, Ellis waits
+# for a random time of up to UPSTREAM_RETRY_BASE_DELAY_SECS, doubling with
+# each retry to at most UPSTREAM_RETRY_MAX_DELAY_SECS.  Requests aren't
+# retried once UPSTREAM_RETRY_DEADLINE_SECS have passed since the user's
+# request to Ellis arrived (or, outside a user request, since the first
+# attempt).
+UPSTREAM_RETRY_MAX_ATTEMPTS = 3
+UPSTREAM_RETRY_BASE_DELAY_SECS = 0.1
+UPSTREAM_RETRY_MAX_DELAY_SECS = 2
+UPSTREAM_RETRY_DEADLINE_SECS = 30
+
+# Maximum number of lookups to have outstanding to Homestead at once when
+# fetching the private IDs for all a user's numbers.
+HOMESTEAD_MAX_LOOKUPS_IN_FLIGHT = 10
+
+# Maximum number of an account's numbers to remove from Homestead and Homer at
+# once when deleting the account.
+ACCOUNT_DELETE_MAX_IN_FLIGHT = 10
+
+# The bulk deprovisioning API deletes up to DEPROVISION_MAX_ACCOUNTS accounts
+# per request, DEPROVISION_MAX_ACCOUNTS_IN_FLIGHT of them at once.
+DEPROVISION_MAX_ACCOUNTS = 1000
+DEPROVISION_MAX_ACCOUNTS_IN_FLIGHT = 5
+
+# Lookups of the private IDs associated with a public ID (and vice versa) are
+# cached for HOMESTEAD_CACHE_TTL_SECS.  Set HOMESTEAD_CACHE_SIZE to 0 to
+# disable the cache.  Each process only invalidates its own cache when it
+# changes an association, so the cache is always disabled with
+# TORNADO_PREFORK, and changes made by other Ellis nodes may not be seen for
+# up to HOMESTEAD_CACHE_TTL_SECS.  How well the caches are doing is logged every
+# HOMESTEAD_CACHE_STATS_INTERVAL_SECS (0 to never log it).
+HOMESTEAD_CACHE_SIZE = 10000
+HOMESTEAD_CACHE_TTL_SECS = 30
+HOMESTEAD_CACHE_STATS_INTERVAL_SECS = 300
+
+# Number of distinct iFC documents (e.g. the default iFCs for each domain) to
+# keep generated and validated, rather than regenerating and reparsing them
+# for each line.  Set to 0 to disable the cache.
+IFC_CACHE_SIZE = 100
+
 # XDM Server.
 XDM_URL = "homer.cw-ngv.com:7888"
 
@@ -76,6 +177,15 @@ HTTP_UNIX="/tmp/.ellis-sock"  # nosec
 # changed by creating a local_settings.py file in this directory.
 TORNADO_DEBUG = False  # Make tornado emit debug messages to the browser etc.
 
+# Passwords are hashed with bcrypt, using PASSWORD_WORK_FACTOR.  Passwords
+# hashed with a different work factor are rehashed when the user next logs
+# in.  Hashing is done on a pool of PASSWORD_HASH_THREADS threads, and if
+# PASSWORD_HASH_MAX_QUEUED requests are already waiting for one, further
+# requests are turned away with a 503.
+PASSWORD_WORK_FACTOR = 10
+PASSWORD_HASH_THREADS = 4
+PASSWORD_HASH_MAX_QUEUED = 100
+
 # Throttling for password reset emails:
 THROTTLER_EMAIL_RATE_PER_SECOND = 100.0 / (24 * 60 * 60)
 THROTTLER_EMAIL_BURST = 5
@@ -87,6 +197,10 @@ THROTTLER_RECOVER_BURST = 20
 # Expiry token expires after this time.
 RECOVERY_TOKEN_LIFETIME_SECS = 24 * 60 * 60
 
+# Clients may page through the global address book, asking for at most this
+# many contacts at a time.
+GAB_MAX_PAGE_SIZE = 500
+
 # General email settings:
 SMTP_SMARTHOST="smtp.example.com"
 SMTP_PORT=25
@@ -95,6 +209,15 @@ SMTP_USERNAME="user"
 SMTP_PASSWORD="password"
 SMTP_USE_TLS=True
 
+# Email is sent from a queue on a background thread, over a connection to
+# the smarthost that is kept open until it has been idle for
+# SMTP_IDLE_TIMEOUT_SEC.  Failed sends are retried up to SMTP_MAX_ATTEMPTS
+# times, backing off exponentially from SMTP_RETRY_INITIAL_DELAY_SEC.
+SMTP_IDLE_TIMEOUT_SEC=60
+SMTP_MAX_ATTEMPTS=8
+SMTP_RETRY_INITIAL_DELAY_SEC=1
+SMTP_RETRY_MAX_DELAY_SEC=300
+
 # Password recovery email settings:
 EMAIL_RECOVERY_SENDER = "cw-admin@example.com"
 EMAIL_RECOVERY_SENDER_NAME = "Clearwater Automated Password Recovery"
@@ -106,5 +229,7 @@ _local_settings_file = os.path.join(_MY_DIR, "local_settings.py")
 if os.path.exists(_local_settings_file):
     execfile(_local_settings_file)
 
-# Must do this after we've loaded the local settings, in case the paths change
+# Must do this after we've loaded the local settings, in case the paths change.
+# The email spool directory is only created when Ellis starts sending email,
+# so that the tools needn't have one.
 ensure_dir_exists(LOGS_DIR)
@@ -14,17 +14,31 @@ import sys
 import unittest
 import uuid
 from mock import Mock
+import tornado.httpclient
 from tornado.web import HTTPError
 from metaswitch.ellis import settings
 from metaswitch.ellis.api import _base
-from metaswitch.ellis.data  import NotFound, connection
+from metaswitch.ellis.remote import upstream
+from metaswitch.ellis.data  import NotFound, connection, dbpool
 
 from mock import patch, MagicMock, ANY
 
+def run_db_job_inline(fn, args, callback, errback):
+    """Runs database jobs straight away, rather than on a database thread"""
+    try:
+        result = dbpool._in_session(fn, args)
+    except Exception as e:
+        errback(e)
+    else:
+        callback(result)
+
 class BaseTest(unittest.TestCase):
     def setUp(self):
         self.db_sess = MagicMock()
         connection.Session = Mock(return_value=self.db_sess)
+        patcher = patch("metaswitch.ellis.data.dbpool.run", side_effect=run_db_job_inline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
 class TestBaseHandler(BaseTest):
 
@@ -260,6 +274,17 @@ Frumiösen Banderschntzchen!«"""
             '/foo/?detail=%7B%7D&error=true&message=Bad%20Request&'
             'reason=%7B%27foo%27%3A%20%27bar%27%7D&status=400')
 
+    def test_forward_error_backend_unavailable(self):
+        self.handler.send_error = MagicMock()
+        response = MagicMock()
+        response.error = upstream.BackendUnavailable("Homestead", 7)
+        response.__class__ = tornado.httpclient.HTTPResponse
+        self.handler.forward_error(response)
+        self.handler.send_error.assert_called_once_with(503,
+                                                        reason=ANY,
+                                                        detail={"Upstream": "Homestead"},
+                                                        headers={"Retry-After": "7"})
+
     def test_write_error_debug(self):
         self.app.settings.get = MagicMock(return_value=True)
         self.handler.finish = MagicMock()
@@ -289,10 +314,9 @@ class TestLoggedInHandler(BaseTest):
     def test_logged_in_username(self, lookup_user_id):
         lookup_user_id.return_value = OWNER_ID
         self.handler.get_secure_cookie = MagicMock(return_value="user1")
-        username = self.handler.logged_in_username
-        self.assertEqual(username, "user1")
-        username = self.handler.logged_in_username
-        self.assertEqual(username, "user1")
+        callback = MagicMock()
+        self.handler.get_logged_in_username_async(callback, MagicMock())
+        callback.assert_called_once_with("user1")
         self.handler.get_secure_cookie.assert_called_once_with("username")
         lookup_user_id.assert_called_once_with(self.db_sess, "user1")
 
@@ -300,36 +324,62 @@ class TestLoggedInHandler(BaseTest):
     def test_logged_in_username_not_found(self, lookup_user_id):
         lookup_user_id.side_effect = NotFound()
         self.handler.get_secure_cookie = MagicMock(return_value="user1")
-        username = self.handler.logged_in_username
-        self.assertEqual(username, None)
+        callback = MagicMock()
+        self.handler.get_logged_in_username_async(callback, MagicMock())
+        callback.assert_called_once_with(None)
 
-    @patch("metaswitch.ellis.data.numbers.get_sip_uri_owner_id")
-    def test_check_number_ownership_found(self, get_owner):
-        get_owner.return_value = OWNER_ID
-        self.handler.check_number_ownership(SIP_URI, OWNER_ID)
+    @patch("metaswitch.ellis.data.users.lookup_user_id")
+    def test_logged_in_username_no_cookie(self, lookup_user_id):
+        self.handler.get_secure_cookie = MagicMock(return_value=None)
+        callback = MagicMock()
+        self.handler.get_logged_in_username_async(callback, MagicMock())
+        callback.assert_called_once_with(None)
+        self.assertFalse(lookup_user_id.called)
 
-    @patch("metaswitch.ellis.data.numbers.get_sip_uri_owner_id")
-    def test_check_number_ownership_not_found(self, get_owner):
-        get_owner.side_effect = NotFound()
+    @patch("metaswitch.ellis.data.users.lookup_user_id")
+    def test_check_user_id(self, lookup_user_id):
+        lookup_user_id.return_value = OWNER_ID
+        callback = MagicMock()
+        self.handler.get_and_check_user_id_async("user1", callback)
+        callback.assert_called_once_with(OWNER_ID)
+
+    def test_check_user_id_wrong_user(self):
+        self.request.headers = {}
+        self.handler.get_secure_cookie = MagicMock(return_value="user2")
         self.assertRaises(HTTPError,
-                          self.handler.check_number_ownership, SIP_URI, OWNER_ID)
+                          self.handler.get_and_check_user_id_async, "user1", MagicMock())
 
     @patch("metaswitch.ellis.data.numbers.get_sip_uri_owner_id")
-    def test_check_number_ownership_different_user(self, get_owner):
-        get_owner.return_value = uuid.uuid4()
-        self.assertRaises(HTTPError,
-                          self.handler.check_number_ownership, SIP_URI, OWNER_ID)
+    @patch("metaswitch.ellis.data.users.lookup_user_id")
+    def test_check_number_owner_found(self, lookup_user_id, get_owner):
+        lookup_user_id.return_value = OWNER_ID
+        get_owner.return_value = OWNER_ID
+        callback = MagicMock()
+        self.handler.get_and_check_number_owner_async("user1", SIP_URI, callback)
+        get_owner.assert_called_once_with(self.db_sess, SIP_URI)
+        callback.assert_called_once_with(OWNER_ID)
 
+    @patch("metaswitch.ellis.data.numbers.get_sip_uri_owner_id")
     @patch("metaswitch.ellis.data.users.lookup_user_id")
-    def test_is_req_authed(self, lookup_user_id):
-        self.handler.get_secure_cookie = MagicMock(return_value="foo")
-        self.assertTrue(self.handler.is_request_authenticated())
+    def test_check_number_owner_not_found(self, lookup_user_id, get_owner):
+        lookup_user_id.return_value = OWNER_ID
+        get_owner.side_effect = NotFound()
+        self.handler.send_error = MagicMock()
+        callback = MagicMock()
+        self.handler.get_and_check_number_owner_async("user1", SIP_URI, callback)
+        self.assertEqual(self.handler.send_error.call_args[0][0], 404)
+        self.assertFalse(callback.called)
 
+    @patch("metaswitch.ellis.data.numbers.get_sip_uri_owner_id")
     @patch("metaswitch.ellis.data.users.lookup_user_id")
-    def test_is_req_authed_no(self, lookup_user_id):
-        lookup_user_id.side_effect = NotFound()
-        self.handler.get_secure_cookie = MagicMock(return_value="foo")
-        self.assertFalse(self.handler.is_request_authenticated())
+    def test_check_number_owner_different_user(self, lookup_user_id, get_owner):
+        lookup_user_id.return_value = OWNER_ID
+        get_owner.return_value = uuid.uuid4()
+        self.handler.send_error = MagicMock()
+        callback = MagicMock()
+        self.handler.get_and_check_number_owner_async("user1", SIP_URI, callback)
+        self.assertEqual(self.handler.send_error.call_args[0][0], 404)
+        self.assertFalse(callback.called)
 
 class TestUnknownApiHandler(BaseTest):
 
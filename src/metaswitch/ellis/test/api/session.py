@@ -11,9 +11,11 @@
 
 import unittest
 import logging
-from mock import MagicMock, patch
+from mock import MagicMock, ANY, patch
 
+from metaswitch.ellis import background
 from metaswitch.ellis.api import session
+from metaswitch.ellis.api._base import HTTPErrorEx
 from metaswitch.ellis.test.api._base import BaseTest
 
 _log = logging.getLogger("ellis.api")
@@ -35,34 +37,104 @@ class TestSessionHandler(BaseTest):
         self.handler.get_argument = MagicMock(side_effect=get_argument)
         self.request.headers = {}
 
-    @patch("metaswitch.ellis.data.users.get_user_by_email_and_password", return_value = {})
-    def test_post_mainline(self, get_user_by):
-        # Setup
+    def check_now(self, password, hashed, callback, errback):
+        """Stands in for users.check_password_async, calling back immediately"""
+        callback(password == "squirrel")
+
+    def login(self, hashed_password="$2b$10$hashy"):
         self.request.arguments["email"] = "Clarkson"
         self.request.arguments["password"] = "squirrel"
         self.handler.set_status = MagicMock()
         self.handler.set_secure_cookie = MagicMock()
         self.handler.finish = MagicMock()
+        self.user = {"user_id":         '123',
+                     "hashed_password": hashed_password,
+                     "full_name":       'Jeremy Clarkson',
+                     "email":           'clarkson@example.org',
+                     "expires":         0}
+        with patch("metaswitch.ellis.data.users.get_user_by_email") as get_user_by, \
+             patch("metaswitch.ellis.data.users.check_password_async",
+                   side_effect=self.check_now) as check_password:
+            get_user_by.return_value = self.user
+            self.handler.post()
+        get_user_by.assert_called_once_with(self.db_sess, "Clarkson")
+        check_password.assert_called_once_with("squirrel", hashed_password, ANY, ANY)
+
+    def assert_logged_in(self):
+        self.handler.finish.assert_called_once_with({"username": "clarkson@example.org",
+                                                     "full_name": "Jeremy Clarkson"})
+        self.handler.set_secure_cookie.assert_called_once_with("username", "clarkson@example.org")
+
+    @patch("metaswitch.ellis.data.users.hash_password_async")
+    def test_post_mainline(self, hash_password_async):
+        self.login()
+        self.assert_logged_in()
+        # The password was hashed with the current work factor, so isn't
+        # rehashed
+        self.assertFalse(hash_password_async.called)
+
+    @patch("metaswitch.ellis.data.users.set_password")
+    @patch("metaswitch.ellis.data.users.hash_password_async")
+    def test_post_rehash(self, hash_password_async, set_password):
+        self.login("$2b$04$hashy")
+        hash_password_async.assert_called_once_with("squirrel", ANY, ANY)
+        self.assertFalse(self.handler.finish.called)
+
+        # The new hash is saved before we complete the login
+        hash_password_async.call_args[0][1]("$2b$10$newhash")
+        set_password.assert_called_once_with(self.db_sess, '123', "$2b$10$newhash")
+        self.assertTrue(self.db_sess.commit.called)
+        self.assert_logged_in()
+
+    @patch("metaswitch.ellis.data.users.hash_password_async")
+    def test_post_rehash_overloaded(self, hash_password_async):
+        hash_password_async.side_effect = background.PoolFull
+        self.login("$2b$04$hashy")
+        self.assert_logged_in()
+
+    @patch("metaswitch.ellis.data.dbpool.pool_full")
+    @patch("metaswitch.ellis.data.users.get_user_by_email")
+    def test_post_db_overloaded(self, get_user_by, pool_full):
+        self.request.arguments["email"] = "Clarkson"
+        self.request.arguments["password"] = "squirrel"
+        pool_full.return_value = True
+        with self.assertRaises(HTTPErrorEx) as em:
+            self.handler.post()
+        self.assertEquals(503, em.exception.status_code)
+        self.assertEquals({"Retry-After": "1"}, em.exception.headers)
+        self.assertFalse(get_user_by.called)
+
+    @patch("metaswitch.ellis.data.users.get_user_by_email")
+    def test_post_fail(self, get_user_by):
+        # Setup
+        self.request.arguments["email"] = "Clarkson"
+        self.request.arguments["password"] = "squivvel"
+        self.handler.set_status = MagicMock()
+        self.handler.finish = MagicMock()
+        def set_finished(*args):
+            self.handler._finished = True
+        self.handler.finish.side_effect = set_finished
         get_user_by.return_value = {"user_id":         '123',
-                                    "hashed_password": 'hashy',
+                                    "hashed_password": '$2b$10$hashy',
                                     "full_name":       'Jeremy Clarkson',
                                     "email":           'clarkson@example.org',
                                     "expires":         0}
 
         # Test
-        self.handler.post()
+        with patch("metaswitch.ellis.data.users.check_password_async",
+                   side_effect=self.check_now):
+            self.handler.post()
 
         # Asserts
-        get_user_by.assert_called_once_with(self.db_sess, "Clarkson", "squirrel")
-        self.handler.finish.assert_called_once_with({"username": "clarkson@example.org",
-                                                     "full_name": "Jeremy Clarkson"})
-        self.handler.set_secure_cookie.assert_called_once_with("username", "clarkson@example.org")
+        get_user_by.assert_called_once_with(self.db_sess, "Clarkson")
+        self.handler.finish.assert_called_once_with({"status": 403, "detail": {}, "message": "Forbidden", "reason": "Incorrect username or password", "error": True})
 
-    @patch("metaswitch.ellis.data.users.get_user_by_email_and_password")
-    def test_post_fail(self, get_user_by):
+    @patch("metaswitch.ellis.data.users.check_password_async")
+    @patch("metaswitch.ellis.data.users.get_user_by_email")
+    def test_post_unknown_user(self, get_user_by, check_password_async):
         # Setup
-        self.request.arguments["email"] = "Clarkson"
-        self.request.arguments["password"] = "squivvel"
+        self.request.arguments["email"] = "Hammond"
+        self.request.arguments["password"] = "squirrel"
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
         def set_finished(*args):
@@ -74,7 +146,7 @@ class TestSessionHandler(BaseTest):
         self.handler.post()
 
         # Asserts
-        get_user_by.assert_called_once_with(self.db_sess, "Clarkson", "squivvel")
+        self.assertFalse(check_password_async.called)
         self.handler.finish.assert_called_once_with({"status": 403, "detail": {}, "message": "Forbidden", "reason": "Incorrect username or password", "error": True})
 
 if __name__ == "__main__":
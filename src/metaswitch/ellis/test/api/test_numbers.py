@@ -13,8 +13,10 @@
 import uuid
 import unittest
 from mock import MagicMock, ANY, Mock, patch
+from tornado.web import HTTPError
 
 from metaswitch.ellis.api import numbers
+from metaswitch.ellis.data import NotFound
 from metaswitch.ellis.test.api._base import BaseTest
 
 USER_ID = uuid.UUID('90babc2a-d376-494d-a94a-2b1aca07130b')
@@ -23,12 +25,23 @@ NUMBER_ID = uuid.UUID('c9b15e68-5e8b-4bcf-9523-3eda4e677afd')
 NUMBER_ID_HEX = 'c9b15e685e8b4bcf95233eda4e677afd'
 NUMBER_ID2 = uuid.UUID('c9b15e68-5e8b-4bcf-9523-3eda4e123456')
 NUMBER_ID2_HEX = 'c9b15e685e8b4bcf95233eda4e123456'
+NUMBER_ID3 = uuid.UUID('c9b15e68-5e8b-4bcf-9523-3eda4e654321')
 SIP_URI = "sip:5555550123@ngv.metaswitch.com"
 SIP_URI2 = "sip:5555550456@ngv.metaswitch.com"
+SIP_URI3 = "sip:5555550789@ngv.metaswitch.com"
 PRIVATE_ID = "5555550123@ngv.metaswitch.com"
 REALM = "ngv.metaswitch.com"
 GAB_LISTED = 1
 
+def lookup_user_id_now(username, callback):
+    """Stands in for get_and_check_user_id_async, calling back immediately"""
+    callback(USER_ID)
+
+def check_number_owner_now(username, sip_uri, callback):
+    """Stands in for get_and_check_number_owner_async, calling back
+    immediately"""
+    callback(USER_ID)
+
 class TestNumbersHandler(BaseTest):
     """
     Detailed, isolated unit tests of the CredentialsHandler class.
@@ -46,37 +59,26 @@ class TestNumbersHandler(BaseTest):
 
     @patch("metaswitch.ellis.data.numbers.get_numbers")
     def test_get_no_numbers(self, get_numbers):
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
         get_numbers.return_value = []
         self.handler.get("foobar")
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
+        self.handler.get_and_check_user_id_async.assert_called_once_with("foobar", ANY)
         self.handler.finish.assert_called_once_with( { "numbers": [] } )
 
-    @patch("metaswitch.ellis.remote.homestead.get_associated_privates")
-    @patch("metaswitch.ellis.api.numbers.HTTPCallbackGroup")
+    @patch("metaswitch.ellis.remote.homestead.get_associated_privates_batch")
     @patch("metaswitch.ellis.data.numbers.get_numbers")
     def test_get_one_number(self, get_numbers,
-                                  HTTPCallbackGroup,
-                                  get_associated_privates):
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
+                                  get_associated_privates_batch):
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
         get_numbers.return_value = [{"number": SIP_URI, "number_id": NUMBER_ID, "gab_listed": GAB_LISTED}]
-        HTTPCallbackGroup.return_value = MagicMock()
 
         self.handler.get("foobar")
         # Assert that we kick off asynchronous GET at homestead
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
-        HTTPCallbackGroup.assert_called_once_with(ANY, # functools.partial object
-                                                  ANY  # functools.partial object
-                                                  )
-
-        get_associated_privates.assert_called_once_with(SIP_URI,
-                                                        ANY # function
-                                                        # argument
-                                                        )
+        self.handler.get_and_check_user_id_async.assert_called_once_with("foobar", ANY)
+        get_associated_privates_batch.assert_called_once_with([SIP_URI],
+                                                              self.handler._on_get_privates)
         # Simulate success of all requests.
-        response = MagicMock()
-        response.body = '{"private_ids": ["hidden@sip.com"]}'
-        self.handler._on_get_success(SIP_URI, [response])
+        self.handler._on_get_privates({SIP_URI: ["hidden@sip.com"]}, {})
 
         self.handler.finish.assert_called_once_with(
             {
@@ -98,29 +100,26 @@ class TestNumbersHandler(BaseTest):
     def test_get_two_numbers_shared(self):
         self.get_two_numbers(True)
 
-    @patch("metaswitch.ellis.remote.homestead.get_associated_privates")
-    @patch("metaswitch.ellis.api.numbers.HTTPCallbackGroup")
+    @patch("metaswitch.ellis.remote.homestead.get_associated_privates_batch")
     @patch("metaswitch.ellis.data.numbers.get_numbers")
     def get_two_numbers(self, shared_private_id, get_numbers,
-                                                 HTTPCallbackGroup,
-                                                 get_associated_privates):
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
+                                                 get_associated_privates_batch):
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
         get_numbers.return_value = [{"number": "sip:4155551234@sip.com", "number_id": NUMBER_ID, "gab_listed": 0},
                                     {"number": "sip:4155555678@sip.com", "number_id": NUMBER_ID2, "gab_listed": 1}]
-        HTTPCallbackGroup.return_value = MagicMock()
 
         self.handler.get("foobar")
+        get_associated_privates_batch.assert_called_once_with(["sip:4155551234@sip.com",
+                                                               "sip:4155555678@sip.com"],
+                                                              ANY)
 
         # Simulate success of all requests.
-        response1 = MagicMock()
-        response1.body = '{"public_id": "sip:4155551234@sip.com", "private_ids": ["hidden1@sip.com"]}'
-        response2 = MagicMock()
-        if shared_private_id:
-            response2.body = '{"public_id": "sip:4155555678@sip.com", "private_ids": ["hidden1@sip.com"]}'
-        else:
-            response2.body = '{"public_id": "sip:4155555678@sip.com", "private_ids": ["hidden2@sip.com"]}'
-        self.handler._on_get_success("sip:4155551234@sip.com", [response1])
-        self.handler._on_get_success("sip:4155555678@sip.com", [response2])
+        self.handler._on_get_privates(
+            {
+                "sip:4155551234@sip.com": ["hidden1@sip.com"],
+                "sip:4155555678@sip.com": [shared_private_id and "hidden1@sip.com" or "hidden2@sip.com"]
+            },
+            {})
 
         self.handler.finish.assert_called_once_with(
                 {
@@ -148,6 +147,31 @@ class TestNumbersHandler(BaseTest):
                     ]
                 })
 
+    @patch("metaswitch.ellis.remote.xdm.delete_simservs")
+    @patch("metaswitch.ellis.data.numbers.remove_owner")
+    @patch("metaswitch.ellis.remote.homestead.get_associated_privates_batch")
+    @patch("metaswitch.ellis.data.numbers.get_numbers")
+    def test_get_missing_from_homestead(self, get_numbers,
+                                              get_associated_privates_batch,
+                                              remove_owner,
+                                              delete_simservs):
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
+        self.handler.forward_error = MagicMock()
+        get_numbers.return_value = [{"number": SIP_URI, "number_id": NUMBER_ID, "gab_listed": 0},
+                                    {"number": SIP_URI2, "number_id": NUMBER_ID2, "gab_listed": 1}]
+
+        self.handler.get("foobar")
+
+        # The second number has no records in Homestead, so is returned to
+        # the pool
+        error = MagicMock()
+        error.code = 404
+        self.handler._on_get_privates({SIP_URI: ["hidden@sip.com"]}, {SIP_URI2: error})
+        remove_owner.assert_called_once_with(self.db_sess, SIP_URI2)
+        delete_simservs.assert_called_once_with(SIP_URI2, ANY)
+        self.handler.forward_error.assert_called_once_with(error)
+        self.assertFalse(self.handler.finish.called)
+
     def test_post_mainline(self):
         self.post_mainline(False, None)
 
@@ -160,7 +184,7 @@ class TestNumbersHandler(BaseTest):
     def test_post_associate_pstn(self):
         self.post_mainline(True, PRIVATE_ID)
 
-    @patch("metaswitch.common.ifcs.generate_ifcs")
+    @patch("metaswitch.ellis.ifc_cache.default_ifcs")
     @patch("metaswitch.ellis.remote.homestead.create_public_id")
     @patch("metaswitch.ellis.remote.homestead.create_private_id")
     @patch("metaswitch.ellis.remote.homestead.put_filter_criteria")
@@ -177,9 +201,9 @@ class TestNumbersHandler(BaseTest):
                                               put_filter_criteria,
                                               create_private_id,
                                               create_public_id,
-                                              generate_ifcs):
+                                              default_ifcs):
         # Setup
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
         self.request.arguments = {}
         if pstn:
             self.request.arguments["pstn"] = ["tRuE"]
@@ -191,13 +215,13 @@ class TestNumbersHandler(BaseTest):
         gen_sip_pass.return_value = "sip_pass"
         sip_pub_to_priv.return_value = "generated_private_id"
         get_number.return_value = SIP_URI
-        generate_ifcs.return_value = "ifcs"
+        default_ifcs.return_value = "ifcs"
 
         # Test
         self.handler.post("foobar")
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
+        self.handler.get_and_check_user_id_async.assert_called_once_with("foobar", ANY)
         allocate_number.assert_called_once_with(self.db_sess, USER_ID, pstn)
         get_number.assert_called_once_with(self.db_sess, NUMBER_ID, USER_ID)
         if not private_id:
@@ -210,7 +234,7 @@ class TestNumbersHandler(BaseTest):
             # We don't generate a pw if we are just associating a pub/priv id
             create_public_id.assert_called_once_with(PRIVATE_ID, SIP_URI, "ifcs", ANY)
 
-        generate_ifcs.assert_called_once_with(REALM)
+        default_ifcs.assert_called_once_with(REALM)
         post_simservs.assert_called_once_with(SIP_URI, ANY, ANY)
 
         # Simulate success of all requests.
@@ -246,7 +270,7 @@ class TestNumbersHandler(BaseTest):
                                     put_filter_criteria,
                                     put_simservs):
         # Setup
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
         self.request.arguments = {}
         self.request.arguments["private_id"] = [PRIVATE_ID]
         allocate_number.return_value = NUMBER_ID
@@ -258,14 +282,117 @@ class TestNumbersHandler(BaseTest):
         self.handler.post("foobar")
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
+        self.handler.get_and_check_user_id_async.assert_called_once_with("foobar", ANY)
         allocate_number.assert_called_once_with(self.db_sess, USER_ID, False)
         get_number.assert_called_once_with(self.db_sess, NUMBER_ID, USER_ID)
         create_public_id.assert_called_once_with(PRIVATE_ID, SIP_URI, ANY, ANY)
 
         self.handler._on_post_failure({})
-        remove_public_id.assert_called_once_with(self.db_sess, SIP_URI, ANY, ANY, force_delete=True)
+        remove_public_id.assert_called_once_with(SIP_URI, ANY, ANY, force_delete=True)
+
+    def start_patch(self, *args, **kwargs):
+        # The patches must outlive post_batch, as the tests go on to drive
+        # the batch's callbacks
+        patcher = patch(*args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def post_batch(self, atomic, count=2):
+        self.start_patch("metaswitch.ellis.settings.NUMBER_BATCH_MAX_IN_FLIGHT", new=1)
+        remove_public_id = self.start_patch("metaswitch.ellis.api.numbers.remove_public_id")
+        provision_number = self.start_patch("metaswitch.ellis.api.numbers._provision_number")
+        get_number = self.start_patch("metaswitch.ellis.data.numbers.get_number")
+        allocate_numbers = self.start_patch("metaswitch.ellis.data.allocator.allocate_numbers")
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
+        self.handler.set_status = MagicMock()
+        self.request.arguments = {"count": [str(count)], "atomic": [str(atomic)]}
+        allocate_numbers.return_value = [NUMBER_ID, NUMBER_ID2, NUMBER_ID3][:count]
+        get_number.side_effect = [SIP_URI, SIP_URI2, SIP_URI3][:count]
+        groups = []
+        def provision(sip_uri, private_id, request_group):
+            groups.append(request_group)
+            return {"private_id": PRIVATE_ID, "sip_password": "sip_pass"}
+        provision_number.side_effect = provision
 
+        self.handler.post("foobar")
+
+        # The numbers are allocated in one transaction, and created one at a
+        # time
+        allocate_numbers.assert_called_once_with(self.db_sess, USER_ID, count, False)
+        self.assertEqual(self.db_sess.commit.call_count, 1)
+        provision_number.assert_called_once_with(SIP_URI, None, ANY)
+        return groups, provision_number, remove_public_id
+
+    def test_post_batch_mainline(self):
+        groups, provision_number, _ = self.post_batch(False)
+        groups[0]._success_callback([Mock()])
+        provision_number.assert_called_with(SIP_URI2, None, ANY)
+        groups[1]._success_callback([Mock()])
+
+        results = self.handler.finish.call_args[0][0]["numbers"]
+        self.assertEqual([r["sip_uri"] for r in results], [SIP_URI, SIP_URI2])
+        self.assertEqual([r["status"] for r in results], ["created", "created"])
+        self.assertEqual(results[0]["number_id"], NUMBER_ID_HEX)
+        self.assertEqual(results[0]["sip_password"], "sip_pass")
+        self.assertFalse(self.handler.set_status.called)
+
+    def test_post_batch_partial_failure(self):
+        groups, provision_number, remove_public_id = self.post_batch(False)
+        groups[0]._failure_callback(Mock(code=500))
+
+        # Only the failed number is backed out
+        remove_public_id.assert_called_once_with(SIP_URI, ANY, ANY, force_delete=True)
+        remove_public_id.call_args[0][1]({})
+        groups[1]._success_callback([Mock()])
+
+        results = self.handler.finish.call_args[0][0]["numbers"]
+        self.assertEqual([r["status"] for r in results], ["failed", "created"])
+        self.assertEqual(results[0]["error"], {"Upstream error": "500"})
+        self.assertNotIn("sip_password", results[0])
+        self.handler.set_status.assert_called_once_with(502)
+
+    @patch("metaswitch.ellis.data.numbers.remove_owner")
+    def test_post_batch_atomic_failure(self, remove_owner):
+        groups, provision_number, remove_public_id = self.post_batch(True, count=3)
+        groups[0]._success_callback([Mock()])
+        groups[1]._failure_callback(Mock(code=500))
+        remove_public_id.assert_called_once_with(SIP_URI2, ANY, ANY, force_delete=True)
+
+        # The number still queued is never created, but is returned to the
+        # pool straight away
+        self.assertEqual(provision_number.call_count, 2)
+        remove_owner.assert_called_once_with(self.db_sess, SIP_URI3)
+        self.assertEqual(self.db_sess.commit.call_count, 2)
+        remove_public_id.call_args[0][2]({})
+
+        # The whole batch is backed out
+        remove_public_id.assert_called_with(SIP_URI, ANY, ANY, force_delete=True)
+        remove_public_id.call_args[0][1]({})
+
+        results = self.handler.finish.call_args[0][0]["numbers"]
+        self.assertEqual([r["status"] for r in results], ["backed out", "failed", "backed out"])
+        self.assertEqual(remove_public_id.call_count, 2)
+        self.handler.set_status.assert_called_once_with(502)
+
+    @patch("metaswitch.ellis.data.allocator.allocate_numbers")
+    def test_post_batch_bad_count(self, allocate_numbers):
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
+        self.handler.send_error = MagicMock()
+        for count in ("0", "foo", "501"):
+            self.request.arguments = {"count": [count]}
+            self.handler.post("foobar")
+        self.assertEqual([c[0][0] for c in self.handler.send_error.call_args_list], [400] * 3)
+        self.assertFalse(allocate_numbers.called)
+
+    @patch("metaswitch.ellis.data.allocator.allocate_numbers")
+    def test_post_batch_not_enough_numbers(self, allocate_numbers):
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
+        self.handler.send_error = MagicMock()
+        self.request.arguments = {"count": ["2"]}
+        allocate_numbers.side_effect = NotFound()
+        self.handler.post("foobar")
+        self.db_sess.rollback.assert_called_once_with()
+        self.assertEqual(self.handler.send_error.call_args[0][0], 503)
 
 class TestNumberHandler(BaseTest):
     def setUp(self):
@@ -278,18 +405,15 @@ class TestNumberHandler(BaseTest):
     @patch("metaswitch.ellis.api.numbers.remove_public_id")
     def test_delete_mainline(self, remove_public_id):
         # Setup
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
-        self.handler.check_number_ownership = Mock()
+        self.handler.get_and_check_number_owner_async = MagicMock(side_effect=check_number_owner_now)
         self.handler.finish = MagicMock()
 
         # Test
         self.handler.delete("foobar", SIP_URI)
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
-        self.handler.check_number_ownership.assert_called_once_with(SIP_URI, USER_ID)
-        remove_public_id.assert_called_once_with(self.db_sess,
-                                                 SIP_URI,
+        self.handler.get_and_check_number_owner_async.assert_called_once_with("foobar", SIP_URI, ANY)
+        remove_public_id.assert_called_once_with(SIP_URI,
                                                  self.handler._on_delete_success,
                                                  self.handler._on_delete_failure,
                                                  force_delete=False)
@@ -327,8 +451,7 @@ class TestNumberHandler(BaseTest):
             sip_uri = SIP_URI2
 
         # Test
-        numbers.remove_public_id(self.db_sess,
-                                 sip_uri,
+        numbers.remove_public_id(sip_uri,
                                  on_success_handler,
                                  on_failure_handler,
                                  False)
@@ -358,8 +481,7 @@ class TestNumberHandler(BaseTest):
             # if other public identities are associated with the private id
             on_failure_handler.assert_called_once_with(response)
         else:
-            _delete_number.assert_called_once_with(self.db_sess,
-                                                   sip_uri,
+            _delete_number.assert_called_once_with(sip_uri,
                                                    PRIVATE_ID,
                                                    last_public_id,
                                                    on_success_handler,
@@ -380,8 +502,7 @@ class TestNumberHandler(BaseTest):
         sip_uri = SIP_URI2
 
         # Test
-        numbers.remove_public_id(self.db_sess,
-                                 sip_uri,
+        numbers.remove_public_id(sip_uri,
                                  on_success_handler,
                                  on_failure_handler,
                                  False)
@@ -423,8 +544,7 @@ class TestNumberHandler(BaseTest):
         on_failure_handler = MagicMock()
 
         # Test
-        numbers._delete_number(self.db_sess,
-                               SIP_URI,
+        numbers._delete_number(SIP_URI,
                                PRIVATE_ID,
                                delete_digest,
                                on_success_handler,
@@ -469,8 +589,7 @@ class TestSipPasswordHandler(BaseTest):
                                  get_associated_privates,
                                  put_password):
         # Setup
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
-        self.handler.check_number_ownership = Mock()
+        self.handler.get_and_check_number_owner_async = MagicMock(side_effect=check_number_owner_now)
         gen_sip_pass.return_value = "sip_pass"
         HTTPCallbackGroup.return_value = MagicMock()
         self.handler.finish = MagicMock()
@@ -521,16 +640,14 @@ class TestRemoteProxyHandler(BaseTest):
     def test_get_mainline(self, HTTPCallbackGroup):
         # Setup
         HTTPCallbackGroup.return_value = MagicMock()
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
-        self.handler.check_number_ownership = Mock()
+        self.handler.get_and_check_number_owner_async = MagicMock(side_effect=check_number_owner_now)
         self.handler.finish = MagicMock()
 
         # Test
         self.handler.get("foobar", SIP_URI)
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
-        self.handler.check_number_ownership.assert_called_once_with(SIP_URI, USER_ID)
+        self.handler.get_and_check_number_owner_async.assert_called_once_with("foobar", SIP_URI, ANY)
         self.handler.remote_get.assert_called_once_with(SIP_URI, ANY)
 
         # Simulate success of xdm request.
@@ -541,16 +658,14 @@ class TestRemoteProxyHandler(BaseTest):
     def test_get_error(self, HTTPCallbackGroup):
         # Setup
         HTTPCallbackGroup.return_value = MagicMock()
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
-        self.handler.check_number_ownership = Mock()
+        self.handler.get_and_check_number_owner_async = MagicMock(side_effect=check_number_owner_now)
         self.handler.forward_error = MagicMock()
 
         # Test
         self.handler.get("foobar", SIP_URI)
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
-        self.handler.check_number_ownership.assert_called_once_with(SIP_URI, USER_ID)
+        self.handler.get_and_check_number_owner_async.assert_called_once_with("foobar", SIP_URI, ANY)
         self.handler.remote_get.assert_called_once_with(SIP_URI, ANY)
 
         # Simulate error of xdm request.
@@ -563,8 +678,7 @@ class TestRemoteProxyHandler(BaseTest):
     def test_put_mainline(self, HTTPCallbackGroup):
         # Setup
         HTTPCallbackGroup.return_value = MagicMock()
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
-        self.handler.check_number_ownership = Mock()
+        self.handler.get_and_check_number_owner_async = MagicMock(side_effect=check_number_owner_now)
         self.request.body = "<xml>new</xml>"
         self.handler.finish = MagicMock()
 
@@ -572,8 +686,7 @@ class TestRemoteProxyHandler(BaseTest):
         self.handler.put("foobar", SIP_URI)
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
-        self.handler.check_number_ownership.assert_called_once_with(SIP_URI, USER_ID)
+        self.handler.get_and_check_number_owner_async.assert_called_once_with("foobar", SIP_URI, ANY)
         self.handler.remote_put.assert_called_once_with(SIP_URI, "<xml>new</xml>", ANY)
 
         # Simulate success of xdm request.
@@ -584,8 +697,7 @@ class TestRemoteProxyHandler(BaseTest):
     def test_put_error(self, HTTPCallbackGroup):
         # Setup
         HTTPCallbackGroup.return_value = MagicMock()
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
-        self.handler.check_number_ownership = Mock()
+        self.handler.get_and_check_number_owner_async = MagicMock(side_effect=check_number_owner_now)
         self.request.body = "<xml>new</xml>"
         self.handler.forward_error = MagicMock()
 
@@ -593,8 +705,7 @@ class TestRemoteProxyHandler(BaseTest):
         self.handler.put("foobar", SIP_URI)
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with("foobar")
-        self.handler.check_number_ownership.assert_called_once_with(SIP_URI, USER_ID)
+        self.handler.get_and_check_number_owner_async.assert_called_once_with("foobar", SIP_URI, ANY)
         self.handler.remote_put.assert_called_once_with(SIP_URI, "<xml>new</xml>", ANY)
 
         # Simulate error of xdm request.
@@ -634,6 +745,103 @@ class TestIFCsHandler(BaseTest):
         self.assertEquals(self.handler.remote_get, get_filter_criteria)
         self.assertEquals(self.handler.remote_name, "Homestead (iFC)")
 
+class TestGabListedNumbersHandler(BaseTest):
+    """
+    Unit tests of the GabListedNumbersHandler class.
+    """
+    def setUp(self):
+        super(TestGabListedNumbersHandler, self).setUp()
+        self.app = MagicMock()
+        self.app._wsgi = False
+        self.request = MagicMock()
+        self.request.headers = {}
+        self.handler = numbers.GabListedNumbersHandler(self.app, self.request)
+        self.handler.finish = MagicMock()
+        self.args = {}
+        self.handler.get_argument = MagicMock(side_effect=lambda name, default: self.args.get(name, default))
+        numbers._gab_snapshot = None
+        self.addCleanup(setattr, numbers, "_gab_snapshot", None)
+
+        patcher = patch("metaswitch.ellis.data.numbers.get_gab_version")
+        self.get_gab_version = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.get_gab_version.return_value = 7
+        patcher = patch("metaswitch.ellis.data.numbers.get_listed_contacts")
+        self.get_listed_contacts = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.contacts = [{"full_name": name, "email": name + "@example.com", "numbers": [SIP_URI]}
+                         for name in (u"Alice", u"bob", u"Carol")]
+        self.get_listed_contacts.return_value = [("id2", self.contacts[1]),
+                                                 ("id1", self.contacts[0]),
+                                                 ("id3", self.contacts[2])]
+
+    def test_get_all(self):
+        self.handler.get()
+        self.handler.finish.assert_called_once_with({"contacts": self.contacts})
+        self.assertTrue(self.handler._headers["Etag"])
+
+    def test_get_cached(self):
+        self.handler.get()
+        self.handler.get()
+        self.assertEqual(self.get_listed_contacts.call_count, 1)
+
+        # A new version is loaded from the database
+        self.get_gab_version.return_value = 8
+        self.handler.get()
+        self.assertEqual(self.get_listed_contacts.call_count, 2)
+
+    def test_get_not_modified(self):
+        self.handler.get()
+        etag = self.handler._headers["Etag"]
+        self.handler.finish.reset_mock()
+
+        self.request.headers["If-None-Match"] = etag
+        self.handler.get()
+        self.assertEqual(self.handler.get_status(), 304)
+        self.handler.finish.assert_called_once_with()
+
+        # Once the GAB changes, so does the ETag
+        self.get_gab_version.return_value = 8
+        self.handler.set_status(200)
+        self.handler.finish.reset_mock()
+        self.handler.get()
+        self.assertNotEqual(self.handler._headers["Etag"], etag)
+        self.handler.finish.assert_called_once_with({"contacts": self.contacts})
+
+    def test_get_pages(self):
+        self.args["limit"] = "2"
+        self.handler.get()
+        response = self.handler.finish.call_args[0][0]
+        self.assertEqual(response["contacts"], self.contacts[:2])
+
+        self.handler.finish.reset_mock()
+        self.args["cursor"] = response["cursor"]
+        self.handler.get()
+        self.handler.finish.assert_called_once_with({"contacts": self.contacts[2:]})
+
+    def test_get_page_after_change(self):
+        self.args["limit"] = "1"
+        self.handler.get()
+        response = self.handler.finish.call_args[0][0]
+        self.assertEqual(response["contacts"], self.contacts[:1])
+
+        # Alice is no longer listed - the next page still starts after her
+        self.get_gab_version.return_value = 8
+        self.get_listed_contacts.return_value = self.get_listed_contacts.return_value[::2]
+        self.handler.finish.reset_mock()
+        self.args["cursor"] = response["cursor"]
+        self.handler.get()
+        self.assertEqual(self.handler.finish.call_args[0][0]["contacts"], self.contacts[1:2])
+
+    def test_get_bad_arguments(self):
+        self.args["limit"] = "lots"
+        self.assertRaises(HTTPError, self.handler.get)
+        self.args["limit"] = "0"
+        self.assertRaises(HTTPError, self.handler.get)
+        self.args["limit"] = "1"
+        self.args["cursor"] = "garbage"
+        self.assertRaises(HTTPError, self.handler.get)
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -11,6 +11,7 @@
 
 
 import uuid
+import collections
 import unittest
 import httplib
 import copy
@@ -23,6 +24,7 @@ from metaswitch.ellis.api._base import HTTPErrorEx
 from metaswitch.ellis.data import AlreadyExists
 from metaswitch.ellis.data import NotFound
 from metaswitch.ellis import settings
+from metaswitch.ellis.background import PoolFull
 from metaswitch.ellis.test.api._base import BaseTest
 
 EMAIL = "alice@example.com"
@@ -47,7 +49,17 @@ PRIVATE_ID2 = "5555550125@ngv.metaswitch.com"
 NUMBER_OBJ2 = { "number_id": NUMBER_ID2,
                 "number": SIP_URI2,
                 "gab_listed": GAB_LISTED }
+HASHED_PASSWORD = "hashedXXpassword"
 
+def hash_now(password, callback, errback):
+    """Stands in for users.hash_password_async, calling back immediately"""
+    callback(HASHED_PASSWORD)
+
+def lookup_user_id_now(username, callback):
+    """Stands in for get_and_check_user_id_async, calling back immediately"""
+    callback(USER_ID)
+
+@patch("metaswitch.ellis.data.users.hash_password_async", new=hash_now)
 class TestAccountsHandler(BaseTest):
     """
     Detailed, isolated unit tests of the AccountsHandler class.
@@ -83,7 +95,8 @@ class TestAccountsHandler(BaseTest):
         self.handler.post()
 
         # Asserts
-        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, None)
+        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, None,
+                                            HASHED_PASSWORD)
         self.handler.set_status.assert_called_once_with(httplib.CREATED)
         self.handler.finish.assert_called_once_with({"username": EMAIL, "full_name": FULL_NAME})
 
@@ -105,7 +118,8 @@ class TestAccountsHandler(BaseTest):
         self.handler.post()
 
         # Asserts
-        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, None)
+        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, None,
+                                            HASHED_PASSWORD)
         self.handler.set_status.assert_called_once_with(httplib.CREATED)
         self.handler.finish.assert_called_once_with({"username": EMAIL, "full_name": FULL_NAME})
 
@@ -128,7 +142,8 @@ class TestAccountsHandler(BaseTest):
         self.handler.post()
 
         # Asserts
-        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, None)
+        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, None,
+                                            HASHED_PASSWORD)
         self.handler.set_secure_cookie.assert_called_once_with("username", EMAIL)
         self.handler.redirect.assert_called_once_with("/success?data=%7B%22username%22%3A%20%22alice%40example.com%22%2C%20%22full_name%22%3A%20%22Alice%22%7D&message=Created&status=201&success=true")
 
@@ -151,7 +166,8 @@ class TestAccountsHandler(BaseTest):
         self.handler.post()
 
         # Asserts
-        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, 7)
+        create_user.assert_called_once_with(self.db_sess, PASSWORD, FULL_NAME, EMAIL, 7,
+                                            HASHED_PASSWORD)
         self.handler.set_status.assert_called_once_with(httplib.CREATED)
         self.handler.finish.assert_called_once_with({"username": EMAIL, "full_name": FULL_NAME})
 
@@ -161,8 +177,25 @@ class TestAccountsHandler(BaseTest):
         self.request.arguments["signup_code"] = settings.SIGNUP_CODE
         create_user.side_effect = AlreadyExists
 
+        self.handler.send_error = MagicMock()
+
         # Test
-        self.assertRaises(HTTPError, self.handler.post)
+        self.handler._on_password_hashed(HASHED_PASSWORD)
+        self.assertEqual(self.handler.send_error.call_args[0][0], httplib.CONFLICT)
+
+    @patch("metaswitch.ellis.data.users.password_pool_full")
+    @patch("metaswitch.ellis.data.users.create_user")
+    def test_post_overloaded(self, create_user, password_pool_full):
+        # Setup
+        self.request.arguments["signup_code"] = settings.SIGNUP_CODE
+        password_pool_full.return_value = True
+
+        # Test
+        with self.assertRaises(HTTPErrorEx) as em:
+            self.handler.post()
+        self.assertEquals(503, em.exception.status_code)
+        self.assertEquals({"Retry-After": "1"}, em.exception.headers)
+        self.assertEquals(create_user.call_count, 0)
 
     @patch("metaswitch.ellis.data.users.create_user")
     def test_post_no_signup_code(self, create_user):
@@ -170,6 +203,8 @@ class TestAccountsHandler(BaseTest):
         self.assertRaises(HTTPError, self.handler.post)
 
 
+@patch("metaswitch.ellis.data.users.check_recovery_token")
+@patch("metaswitch.ellis.data.users.hash_password_async", side_effect=hash_now)
 class TestAccountPasswordHandler(BaseTest):
     """
     Detailed, isolated unit tests of the AccountPasswordHandler class.
@@ -187,7 +222,7 @@ class TestAccountPasswordHandler(BaseTest):
     @patch("metaswitch.ellis.mail.mail.send_recovery_message")
     @patch("metaswitch.ellis.data.users.get_details")
     @patch("metaswitch.ellis.data.users.get_token")
-    def test_post_email_mainline(self, get_token, get_details, send_recovery_message):
+    def test_post_email_mainline(self, get_token, get_details, send_recovery_message, hash_password_async, check_recovery_token):
         get_token.return_value = TOKEN
         get_details.return_value = {"full_name": FULL_NAME, "email": EMAIL}
         self.handler.set_status = MagicMock()
@@ -203,7 +238,7 @@ class TestAccountPasswordHandler(BaseTest):
     @patch("metaswitch.ellis.api.users._email_throttler")
     @patch("metaswitch.ellis.mail.mail.send_recovery_message")
     @patch("metaswitch.ellis.data.users.get_token")
-    def test_post_email_throttling(self, get_token, send_recovery_message, throttler):
+    def test_post_email_throttling(self, get_token, send_recovery_message, throttler, hash_password_async, check_recovery_token):
         get_token.return_value = TOKEN
         self.handler.set_status = MagicMock()
         self.handler.set_header = MagicMock()
@@ -215,14 +250,14 @@ class TestAccountPasswordHandler(BaseTest):
         with self.assertRaises(HTTPErrorEx) as em:
             self.handler.post(EMAIL)
         e = em.exception
-        self.assertEquals({"Retry-After", "10"}, e.headers)
+        self.assertEquals({"Retry-After": "10"}, e.headers)
         self.assertEquals(503, e.status_code)
         self.assertEquals(get_token.call_count, 0)
         self.assertEquals(send_recovery_message.call_count, 0)
 
     @patch("metaswitch.ellis.mail.mail.send_recovery_message")
     @patch("metaswitch.ellis.data.users.get_token")
-    def test_post_email_bad_email(self, get_token, send_recovery_message):
+    def test_post_email_bad_email(self, get_token, send_recovery_message, hash_password_async, check_recovery_token):
         get_token.side_effect = ValueError
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
@@ -236,7 +271,7 @@ class TestAccountPasswordHandler(BaseTest):
         self.handler.finish.assert_called_once_with({})
 
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_mainline(self, set_recovered_password):
+    def test_post_recovered_mainline(self, set_recovered_password, hash_password_async, check_recovery_token):
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
 
@@ -245,12 +280,14 @@ class TestAccountPasswordHandler(BaseTest):
         self.request.body = PASSWORD.encode("utf-8")
         self.handler.post(EMAIL)
 
-        set_recovered_password.assert_called_once_with(ANY, EMAIL, TOKEN, PASSWORD)
+        hash_password_async.assert_called_once_with(PASSWORD, ANY, ANY)
+        set_recovered_password.assert_called_once_with(ANY, EMAIL, TOKEN, None,
+                                                       HASHED_PASSWORD)
         self.handler.set_status.assert_called_once_with(200)
         self.handler.finish.assert_called_once_with({})
 
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_mainline_browser(self, set_recovered_password):
+    def test_post_recovered_mainline_browser(self, set_recovered_password, hash_password_async, check_recovery_token):
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
 
@@ -258,12 +295,14 @@ class TestAccountPasswordHandler(BaseTest):
         self.request.arguments["recovery_token"] = [TOKEN]
         self.handler.post(EMAIL)
 
-        set_recovered_password.assert_called_once_with(ANY, EMAIL, TOKEN, PASSWORD)
+        hash_password_async.assert_called_once_with(PASSWORD, ANY, ANY)
+        set_recovered_password.assert_called_once_with(ANY, EMAIL, TOKEN, None,
+                                                       HASHED_PASSWORD)
         self.handler.set_status.assert_called_once_with(200)
         self.handler.finish.assert_called_once_with({})
 
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_charset(self, set_recovered_password):
+    def test_post_recovered_charset(self, set_recovered_password, hash_password_async, check_recovery_token):
         """Test charset defaulting."""
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
@@ -273,21 +312,17 @@ class TestAccountPasswordHandler(BaseTest):
         self.request.body = PASSWORD.encode("iso-8859-1")
         self.handler.post(EMAIL)
 
-        set_recovered_password.assert_called_once_with(ANY, EMAIL, TOKEN, PASSWORD)
+        hash_password_async.assert_called_once_with(PASSWORD, ANY, ANY)
+        set_recovered_password.assert_called_once_with(ANY, EMAIL, TOKEN, None,
+                                                       HASHED_PASSWORD)
         self.handler.set_status.assert_called_once_with(200)
         self.handler.finish.assert_called_once_with({})
 
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_charset_fail1(self, set_recovered_password):
+    def test_post_recovered_charset_fail1(self, set_recovered_password, hash_password_async, check_recovery_token):
         """Test charset defaulting."""
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
-        the_password = None
-        def save(self, email, token, password):
-            global the_password
-            the_password = password
-        set_recovered_password(side_effect=save)
-
         self.request.headers["NGV-Recovery-Token"] = TOKEN
         self.request.headers["Content-Type"] = "text/plain"
         # Encode with the wrong format.
@@ -296,15 +331,16 @@ class TestAccountPasswordHandler(BaseTest):
 
         # Should succeed, but set the wrong password.
         set_recovered_password.assert_called_with(ANY,
+                                                  ANY,
                                                   ANY,
                                                   ANY,
                                                   ANY)
-        self.assertNotEqual(PASSWORD, the_password)
+        self.assertNotEqual(PASSWORD, hash_password_async.call_args[0][0])
         self.handler.set_status.assert_called_once_with(200)
         self.handler.finish.assert_called_once_with({})
 
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_charset_fail2(self, set_recovered_password):
+    def test_post_recovered_charset_fail2(self, set_recovered_password, hash_password_async, check_recovery_token):
         """Test charset defaulting."""
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
@@ -321,7 +357,7 @@ class TestAccountPasswordHandler(BaseTest):
 
     @patch("metaswitch.ellis.api.users._recover_throttler")
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_throttling(self, set_recovered_password, throttler):
+    def test_post_recovered_throttling(self, set_recovered_password, throttler, hash_password_async, check_recovery_token):
         self.handler.set_status = MagicMock()
         self.handler.set_header = MagicMock()
         self.handler.finish = MagicMock()
@@ -336,38 +372,58 @@ class TestAccountPasswordHandler(BaseTest):
         with self.assertRaises(HTTPErrorEx) as em:
             self.handler.post(EMAIL)
         e = em.exception
-        self.assertEquals({"Retry-After", "100"}, e.headers)
+        self.assertEquals({"Retry-After": "100"}, e.headers)
         self.assertEquals(503, e.status_code)
         self.assertEquals(set_recovered_password.call_count, 0)
 
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_bad_token(self, set_recovered_password):
+    def test_post_recovered_bad_token(self, set_recovered_password, hash_password_async, check_recovery_token):
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
-        set_recovered_password.side_effect = ValueError("UT")
+        check_recovery_token.side_effect = ValueError("UT")
 
         self.request.headers["NGV-Recovery-Token"] = TOKEN
         self.request.headers["Content-Type"] = "text/plain; charset=utf-8"
         self.request.body = PASSWORD.encode("utf-8")
 
-        # Should return failure
-        self.assertRaises(HTTPError, self.handler.post, EMAIL)
-        self.assertEquals(set_recovered_password.call_count, 1)
+        self.handler.send_error = MagicMock()
+
+        # Should return failure, without bothering to hash the password
+        self.handler.post(EMAIL)
+        self.assertEqual(self.handler.send_error.call_args[0][0], httplib.UNPROCESSABLE_ENTITY)
+        self.assertEquals(hash_password_async.call_count, 0)
+        self.assertEquals(set_recovered_password.call_count, 0)
 
     @patch("metaswitch.ellis.data.users.set_recovered_password")
-    def test_post_recovered_bad_email(self, set_recovered_password):
+    def test_post_recovered_bad_email(self, set_recovered_password, hash_password_async, check_recovery_token):
         self.handler.set_status = MagicMock()
         self.handler.finish = MagicMock()
-        set_recovered_password.side_effect = NotFound
+        check_recovery_token.side_effect = NotFound
 
         self.request.headers["NGV-Recovery-Token"] = TOKEN
         self.request.headers["Content-Type"] = "text/plain; charset=utf-8"
         self.request.body = PASSWORD.encode("utf-8")
 
+        self.handler.send_error = MagicMock()
+
+        # Should return failure, without bothering to hash the password
+        self.handler.post(EMAIL)
+        self.assertEqual(self.handler.send_error.call_args[0][0], httplib.UNPROCESSABLE_ENTITY)
+        self.assertEquals(hash_password_async.call_count, 0)
+        self.assertEquals(set_recovered_password.call_count, 0)
+
+    @patch("metaswitch.ellis.data.users.set_recovered_password")
+    def test_post_recovered_token_used_while_hashing(self, set_recovered_password, hash_password_async, check_recovery_token):
+        set_recovered_password.side_effect = NotFound
+
+        self.handler.send_error = MagicMock()
+
         # Should return failure
-        self.assertRaises(HTTPError, self.handler.post, EMAIL)
+        self.handler._on_recovered_password_hashed(EMAIL, TOKEN, HASHED_PASSWORD)
+        self.assertEqual(self.handler.send_error.call_args[0][0], httplib.UNPROCESSABLE_ENTITY)
         self.assertEquals(set_recovered_password.call_count, 1)
 
+
 class TestAccountHandler(BaseTest):
     def setUp(self):
         super(TestAccountHandler, self).setUp()
@@ -375,7 +431,7 @@ class TestAccountHandler(BaseTest):
         self.app._wsgi = False
         self.request = MagicMock()
         self.handler = users.AccountHandler(self.app, self.request)
-        self.handler.get_and_check_user_id = MagicMock(return_value=USER_ID)
+        self.handler.get_and_check_user_id_async = MagicMock(side_effect=lookup_user_id_now)
         self.handler.set_status = MagicMock()
         # Finish has an important side-effect - it sets _finished to True.  If out mocked version doesn't do this, we see multiple calls to finish.
         def finish(*args):
@@ -392,19 +448,19 @@ class TestAccountHandler(BaseTest):
         self.handler.delete(EMAIL)
 
         # Asserts
-        self.handler.get_and_check_user_id.assert_called_once_with(EMAIL)
+        self.handler.get_and_check_user_id_async.assert_called_once_with(EMAIL, ANY)
         delete_user.assert_called_once_with(self.db_sess, USER_ID)
         self.handler.set_status.assert_called_once_with(httplib.NO_CONTENT)
         self.handler.finish.assert_called_once_with()
 
     @patch("metaswitch.ellis.data.users.delete_user")
-    @patch("metaswitch.ellis.data.numbers.remove_owner")
     @patch("metaswitch.ellis.api.numbers.remove_public_id")
+    @patch("metaswitch.ellis.remote.homestead.get_associated_privates_batch")
     @patch("metaswitch.ellis.data.numbers.get_numbers")
     def test_delete_two_nums(self,
                              get_numbers,
+                             get_privates,
                              remove_public_id,
-                             remove_owner,
                              delete_user):
         # Setup
         get_numbers.return_value = [copy.copy(NUMBER_OBJ), copy.copy(NUMBER_OBJ2)]
@@ -412,39 +468,57 @@ class TestAccountHandler(BaseTest):
         # Test
         self.handler.delete(EMAIL)
 
-        # Assert that we kick off asynchronous deletion at homestead
-        self.handler.get_and_check_user_id.assert_called_once_with(EMAIL)
-        remove_public_id.assert_called_with(self.db_sess,
-                                            SIP_URI2,
-                                            self.handler._on_delete_post_success,
-                                            self.handler._on_delete_post_failure,
-                                            True)
-
-
-        # Simulate success of request.
-        remove_public_id.reset_mock()
-        self.handler._on_delete_post_success([Mock()])
-
-        # Assert that we delete the second number and user locally and finish the response
-        remove_public_id.assert_called_with(self.db_sess,
-                                            SIP_URI,
-                                            self.handler._on_delete_post_success,
-                                            self.handler._on_delete_post_failure,
-                                            True)
+        # Assert that we look up the private IDs, then kick off deletion of
+        # both numbers at once
+        self.handler.get_and_check_user_id_async.assert_called_once_with(EMAIL, ANY)
+        get_privates.assert_called_once_with([SIP_URI, SIP_URI2], ANY)
+        get_privates.call_args[0][1]({SIP_URI: [PRIVATE_ID], SIP_URI2: [PRIVATE_ID2]}, {})
+        self.assertEqual([c[0][0] for c in remove_public_id.call_args_list], [SIP_URI, SIP_URI2])
+        for c in remove_public_id.call_args_list:
+            self.assertTrue(c[0][3])
+
+        # Simulate success of the first request - nothing more happens yet
+        remove_public_id.call_args_list[0][0][1]([Mock()])
+        self.assertFalse(delete_user.called)
 
-        self.handler._on_delete_post_success([Mock()])
+        # Once the second succeeds, we delete the user locally and finish the
+        # response
+        remove_public_id.call_args_list[1][0][1]([Mock()])
         delete_user.assert_called_once_with(self.db_sess, USER_ID)
         self.handler.set_status.assert_called_once_with(httplib.NO_CONTENT)
         self.handler.finish.assert_called_once_with()
 
+    @patch("metaswitch.ellis.settings.ACCOUNT_DELETE_MAX_IN_FLIGHT", new=1)
+    @patch("metaswitch.ellis.data.users.delete_user")
+    @patch("metaswitch.ellis.api.numbers.remove_public_id")
+    @patch("metaswitch.ellis.remote.homestead.get_associated_privates_batch")
+    @patch("metaswitch.ellis.data.numbers.get_numbers")
+    def test_delete_shared_private_id(self,
+                                      get_numbers,
+                                      get_privates,
+                                      remove_public_id,
+                                      delete_user):
+        # The second number shares the first number's private ID, so must be
+        # deleted first
+        get_numbers.return_value = [copy.copy(NUMBER_OBJ), copy.copy(NUMBER_OBJ2)]
+        self.handler.delete(EMAIL)
+        get_privates.call_args[0][1]({SIP_URI: [PRIVATE_ID], SIP_URI2: [PRIVATE_ID]}, {})
+        remove_public_id.assert_called_once_with(SIP_URI2, ANY, ANY, True)
+
+        remove_public_id.call_args[0][1]([Mock()])
+        remove_public_id.assert_called_with(SIP_URI, ANY, ANY, True)
+        remove_public_id.call_args[0][1]([Mock()])
+        delete_user.assert_called_once_with(self.db_sess, USER_ID)
+
+    @patch("metaswitch.ellis.settings.ACCOUNT_DELETE_MAX_IN_FLIGHT", new=1)
     @patch("metaswitch.ellis.data.users.delete_user")
-    @patch("metaswitch.ellis.data.numbers.remove_owner")
     @patch("metaswitch.ellis.api.numbers.remove_public_id")
+    @patch("metaswitch.ellis.remote.homestead.get_associated_privates_batch")
     @patch("metaswitch.ellis.data.numbers.get_numbers")
     def test_delete_two_nums_fail(self,
                                   get_numbers,
+                                  get_privates,
                                   remove_public_id,
-                                  remove_owner,
                                   delete_user):
         # Setup
         get_numbers.return_value = [copy.copy(NUMBER_OBJ), copy.copy(NUMBER_OBJ2)]
@@ -452,23 +526,124 @@ class TestAccountHandler(BaseTest):
 
         # Test
         self.handler.delete(EMAIL)
-
-        # Assert that we kick off asynchronous deletion at homestead
-        self.handler.get_and_check_user_id.assert_called_once_with(EMAIL)
-        remove_public_id.assert_called_with(self.db_sess,
-                                            SIP_URI2,
-                                            self.handler._on_delete_post_success,
-                                            self.handler._on_delete_post_failure,
-                                            True)
+        get_privates.call_args[0][1]({}, {SIP_URI: Mock(code=503), SIP_URI2: Mock(code=503)})
+        remove_public_id.assert_called_once_with(SIP_URI, ANY, ANY, True)
 
         # Simulate failure of the request.
         mock_response = Mock()
-        self.handler._on_delete_post_failure(mock_response)
+        remove_public_id.call_args[0][2](mock_response)
 
-        # Assert that we bin out and don't delete the number or user locally
+        # Assert that we bin out without trying the other number, and don't
+        # delete the user locally
+        self.assertEqual(remove_public_id.call_count, 1)
         self.assertFalse(delete_user.called)
         self.handler.forward_error.assert_called_once_with(mock_response)
 
+class TestAccountsDeprovisionHandler(BaseTest):
+    def setUp(self):
+        super(TestAccountsDeprovisionHandler, self).setUp()
+        self.app = MagicMock()
+        self.app._wsgi = False
+        self.request = MagicMock()
+        self.handler = users.AccountsDeprovisionHandler(self.app, self.request)
+        self.handler.is_admin_request = MagicMock()
+        self.handler.finish = MagicMock()
+        self.handler.send_error = MagicMock()
+        self.callbacks = collections.deque()
+        patcher = patch("metaswitch.ellis.api.users.IOLoop")
+        IOLoop = patcher.start()
+        self.addCleanup(patcher.stop)
+        IOLoop.instance.return_value.add_callback.side_effect = self.callbacks.append
+
+    def run_callbacks(self):
+        while self.callbacks:
+            self.callbacks.popleft()()
+
+    def post(self, emails):
+        with patch.object(users.AccountsDeprovisionHandler, "request_data", new={"emails": emails}):
+            self.handler.post()
+        self.run_callbacks()
+
+    @patch("metaswitch.ellis.api.users.delete_account")
+    @patch("metaswitch.ellis.data.users.lookup_user_id")
+    def test_post_mainline(self, lookup_user_id, delete_account):
+        def lookup(db_sess, email):
+            if email != EMAIL:
+                raise NotFound()
+            return USER_ID
+        lookup_user_id.side_effect = lookup
+        def deleter(user_id, on_success, on_failure):
+            on_success()
+        delete_account.side_effect = deleter
+
+        self.post([EMAIL, BAD_EMAIL, EMAIL])
+
+        self.handler.is_admin_request.assert_called_once_with()
+        delete_account.assert_called_once_with(USER_ID, ANY, ANY)
+        self.handler.finish.assert_called_once_with(
+            {"accounts": [{"email": EMAIL, "status": httplib.NO_CONTENT},
+                          {"email": BAD_EMAIL, "status": httplib.NOT_FOUND, "reason": "User not found"}]})
+
+    @patch("metaswitch.ellis.settings.DEPROVISION_MAX_ACCOUNTS_IN_FLIGHT", new=1)
+    @patch("metaswitch.ellis.api.users.delete_account")
+    @patch("metaswitch.ellis.data.users.lookup_user_id")
+    def test_post_bounded(self, lookup_user_id, delete_account):
+        lookup_user_id.return_value = USER_ID
+        self.post([EMAIL, BAD_EMAIL])
+
+        # Only one account is deleted at a time
+        self.assertEqual(delete_account.call_count, 1)
+        delete_account.call_args[0][2](Mock(code=503))
+        self.run_callbacks()
+        self.assertEqual(delete_account.call_count, 2)
+        delete_account.call_args[0][1]()
+
+        results = self.handler.finish.call_args[0][0]["accounts"]
+        self.assertEqual([r["status"] for r in results], [httplib.BAD_GATEWAY, httplib.NO_CONTENT])
+        self.assertEqual(results[0]["detail"], {"Upstream error": "503"})
+
+    @patch("metaswitch.ellis.api.users.delete_account")
+    @patch("metaswitch.ellis.data.users.lookup_user_id_async")
+    def test_post_account_errors(self, lookup_user_id_async, delete_account):
+        # Errors with some accounts are recorded against them, and the
+        # request is only finished once every account is done
+        def lookup(email, callback, errback):
+            if email == EMAIL:
+                callback(USER_ID)
+            elif email == BAD_EMAIL:
+                raise PoolFull()
+            else:
+                errback(ValueError("Database error"))
+        lookup_user_id_async.side_effect = lookup
+
+        self.post([EMAIL, BAD_EMAIL, "carol@example.com"])
+        self.assertFalse(self.handler.finish.called)
+        self.assertFalse(self.handler.send_error.called)
+
+        delete_account.call_args[0][1]()
+        self.assertEqual(self.handler.finish.call_count, 1)
+        results = self.handler.finish.call_args[0][0]["accounts"]
+        self.assertEqual([r["status"] for r in results],
+                         [httplib.NO_CONTENT, httplib.SERVICE_UNAVAILABLE, httplib.INTERNAL_SERVER_ERROR])
+
+    @patch("metaswitch.ellis.data.users.lookup_user_id")
+    def test_post_many_unknown(self, lookup_user_id):
+        # Each of these completes synchronously, which mustn't recurse
+        lookup_user_id.side_effect = NotFound()
+        emails = ["user%d@example.com" % i for i in range(1000)]
+        self.post(emails)
+        results = self.handler.finish.call_args[0][0]["accounts"]
+        self.assertEqual([r["email"] for r in results], emails)
+        self.assertEqual(set(r["status"] for r in results), set([httplib.NOT_FOUND]))
+
+    def test_post_bad_request(self):
+        self.post("alice@example.com")
+        self.post([1])
+        with patch("metaswitch.ellis.settings.DEPROVISION_MAX_ACCOUNTS", new=1):
+            self.post([EMAIL, BAD_EMAIL])
+        self.assertEqual([c[0][0] for c in self.handler.send_error.call_args_list],
+                         [httplib.BAD_REQUEST] * 3)
+        self.assertFalse(self.handler.finish.called)
 
 if __name__ == "__main__":
     unittest.main()
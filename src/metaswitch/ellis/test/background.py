@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+# @file background.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+import threading
+from mock import MagicMock, patch
+
+from metaswitch.ellis.background import WorkerPool, PoolFull
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        # Run the callbacks that the workers pass back as soon as they're
+        # passed back, and note when they've all arrived
+        self.done = threading.Event()
+        self.callbacks = []
+        def add_callback(callback):
+            self.callbacks.append(callback)
+            callback()
+            self.done.set()
+        self.io_loop = MagicMock()
+        self.io_loop.add_callback.side_effect = add_callback
+        patcher = patch("metaswitch.ellis.background.IOLoop")
+        IOLoop = patcher.start()
+        IOLoop.instance.return_value = self.io_loop
+        self.addCleanup(patcher.stop)
+
+    def test_run(self):
+        pool = WorkerPool("test", 2, 10)
+        callback = MagicMock()
+        errback = MagicMock()
+        pool.run(lambda a, b: a + b, (1, 2), callback, errback)
+        self.assertTrue(self.done.wait(5))
+        callback.assert_called_once_with(3)
+        self.assertFalse(errback.called)
+
+    def test_run_fails(self):
+        pool = WorkerPool("test", 2, 10)
+        callback = MagicMock()
+        errback = MagicMock()
+        error = ValueError("Bad things")
+        def fail():
+            raise error
+        pool.run(fail, (), callback, errback)
+        self.assertTrue(self.done.wait(5))
+        errback.assert_called_once_with(error)
+        self.assertFalse(callback.called)
+
+    def test_full(self):
+        pool = WorkerPool("test", 1, 1)
+        blocker = threading.Event()
+        self.assertFalse(pool.full())
+
+        # The first job occupies the only thread, and the second fills the
+        # queue
+        started = threading.Event()
+        def block():
+            started.set()
+            blocker.wait(5)
+        pool.run(block, (), MagicMock(), MagicMock())
+        self.assertTrue(started.wait(5))
+        drained = threading.Event()
+        pool.run(block, (), lambda result: drained.set(), MagicMock())
+        self.assertTrue(pool.full())
+        self.assertRaises(PoolFull, pool.run, block, (), MagicMock(), MagicMock())
+        blocker.set()
+        # Let the jobs finish before the IOLoop is unpatched
+        self.assertTrue(drained.wait(5))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+# @file bulk.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from functools import partial
+from mock import patch
+import tornado.ioloop
+
+from metaswitch.ellis.bulk import BulkRunner, parse_dn_ranges
+
+ITEMS = ["1", "2", "3", "4", "5"]
+
+class TestParseDnRanges(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(list(parse_dn_ranges("6505550098..6505550101,+441234")),
+                         ["6505550098", "6505550099", "6505550100", "6505550101",
+                          "+441234"])
+
+    def test_bad_ranges(self):
+        # Ranges whose ends don't match are skipped
+        self.assertEqual(list(parse_dn_ranges("100..1000,+100..101,5")), ["5"])
+
+
+@patch("sys.stdout", new_callable=StringIO)
+class TestBulkRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.addCleanup(self.io_loop.close)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.checkpoint_file = os.path.join(self.tmp_dir, "checkpoint")
+        self.done = []
+
+    def run_items(self, items, job, **kwargs):
+        runner = BulkRunner(items, job, checkpoint_file=self.checkpoint_file, **kwargs)
+        runner._io_loop = self.io_loop
+        # Don't hang if the runner never finishes
+        self.io_loop.add_timeout(time.time() + 5, self.io_loop.stop)
+        return runner, runner.run()
+
+    def succeed_later(self, item, callback):
+        self.done.append(item)
+        self.io_loop.add_callback(partial(callback, True))
+
+    def fail_on(self, bad_item, item, callback):
+        self.done.append(item)
+        self.io_loop.add_callback(partial(callback, item != bad_item))
+
+    def checkpoint(self):
+        with open(self.checkpoint_file) as f:
+            return f.read().strip()
+
+    def test_mainline(self, stdout):
+        runner, ok = self.run_items(ITEMS, self.succeed_later, window=2)
+        self.assertTrue(ok)
+        self.assertEqual(self.done, ITEMS)
+        self.assertEqual((runner.succeeded, runner.failed), (5, 0))
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_failure_stops_and_resumes(self, stdout):
+        runner, ok = self.run_items(ITEMS, partial(self.fail_on, "3"), window=1)
+        self.assertFalse(ok)
+        self.assertEqual(self.done, ["1", "2", "3"])
+        self.assertEqual(self.checkpoint(), "2")
+
+        # Resuming retries the failed item and carries on from there
+        self.done = []
+        runner, ok = self.run_items(ITEMS, self.succeed_later, window=1)
+        self.assertTrue(ok)
+        self.assertEqual(self.done, ["3", "4", "5"])
+
+    def test_keep_going(self, stdout):
+        runner, ok = self.run_items(ITEMS, partial(self.fail_on, "3"), window=2, keep_going=True)
+        self.assertFalse(ok)
+        self.assertEqual(self.done, ITEMS)
+        self.assertEqual((runner.succeeded, runner.failed), (4, 1))
+        # The failed item is passed over by the checkpoint
+        self.assertEqual(self.checkpoint(), "5")
+
+    def test_items_callable(self, stdout):
+        with open(self.checkpoint_file, "w") as f:
+            f.write("2\n")
+        checkpoints = []
+        def items(checkpoint):
+            checkpoints.append(checkpoint)
+            return ITEMS[ITEMS.index(checkpoint) + 1:]
+        runner, ok = self.run_items(items, self.succeed_later, window=2)
+        self.assertTrue(ok)
+        self.assertEqual(checkpoints, ["2"])
+        self.assertEqual(self.done, ["3", "4", "5"])
+
+    def test_job_raises(self, stdout):
+        def job(item, callback):
+            if item == "2":
+                raise ValueError("Bad item")
+            self.succeed_later(item, callback)
+        runner, ok = self.run_items(ITEMS, job, window=1, keep_going=True)
+        self.assertEqual((runner.succeeded, runner.failed), (4, 1))
+
+    def test_callback_raises(self, stdout):
+        # An exception from one of the job's later callbacks fails the item,
+        # rather than leaving it in flight
+        def job(item, callback):
+            def later():
+                if item == "2":
+                    raise ValueError("Bad item")
+                callback(True)
+            self.io_loop.add_callback(later)
+        runner, ok = self.run_items(ITEMS, job, window=2, keep_going=True)
+        self.assertEqual((runner.succeeded, runner.failed), (4, 1))
+
+    def test_second_result_ignored(self, stdout):
+        def job(item, callback):
+            callback(True)
+            callback(False)
+        runner, ok = self.run_items(ITEMS, job, window=2)
+        self.assertTrue(ok)
+        self.assertEqual((runner.succeeded, runner.failed), (5, 0))
+
+    def test_key(self, stdout):
+        # Items with the same key run one at a time
+        in_flight = {}
+        most_in_flight = {}
+        def job(item, callback):
+            key = int(item) % 2
+            in_flight[key] = in_flight.get(key, 0) + 1
+            most_in_flight[key] = max(most_in_flight.get(key, 0), in_flight[key])
+            def done():
+                in_flight[key] -= 1
+                callback(True)
+            self.io_loop.add_callback(done)
+        runner, ok = self.run_items(ITEMS, job, window=5, key=lambda item: int(item) % 2)
+        self.assertTrue(ok)
+        self.assertEqual(most_in_flight, {0: 1, 1: 1})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+# @file cache.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+from mock import patch
+from metaswitch.ellis.cache import TTLCache
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = TTLCache(10, 30)
+        self.assertEqual(cache.get("a"), None)
+        cache.put("a", "A")
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    @patch("time.time")
+    def test_expiry(self, time):
+        cache = TTLCache(10, 30)
+        time.return_value = 1000
+        cache.put("a", "A")
+        time.return_value = 1029
+        self.assertEqual(cache.get("a"), "A")
+        time.return_value = 1030
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(2, 30)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        cache.get("a")
+        cache.put("c", "C")
+        # b was least recently used
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+
+    def test_invalidate(self):
+        cache = TTLCache(10, 30)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        generation = cache.generation
+        cache.invalidate("a")
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), "B")
+        cache.clear()
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.generation, generation + 2)
+
+    def test_disabled(self):
+        cache = TTLCache(0, 30)
+        cache.put("a", "A")
+        self.assertEqual(cache.get("a"), None)
+
+if __name__ == "__main__":
+    unittest.main()
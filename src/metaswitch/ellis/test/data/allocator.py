@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# @file allocator.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+import uuid
+from mock import patch
+from metaswitch.ellis.data import allocator, NotFound
+from metaswitch.ellis.data.allocator import NumberAllocator
+from metaswitch.ellis.test.data._base import BaseDataTest
+
+OWNER_ID = uuid.uuid4()
+NUMBER_IDS = [uuid.uuid4() for _ in xrange(3)]
+
+@patch("metaswitch.ellis.data.numbers.allocate_leased_number")
+@patch("metaswitch.ellis.data.numbers.lease_numbers")
+class TestNumberAllocator(BaseDataTest):
+
+    def setUp(self):
+        super(TestNumberAllocator, self).setUp()
+        self.allocator = NumberAllocator(3, 60)
+
+    def test_allocates_from_lease(self, lease_numbers, allocate_leased_number):
+        lease_numbers.return_value = [n.hex for n in NUMBER_IDS]
+        allocate_leased_number.return_value = True
+        allocated = [self.allocator.allocate_number(self.mock_session, OWNER_ID)
+                     for _ in NUMBER_IDS]
+        self.assertEqual(sorted(allocated), sorted(NUMBER_IDS))
+        # Only one lease was needed, and it was committed separately
+        lease_numbers.assert_called_once_with(self.mock_session,
+                                              self.allocator.lease_id,
+                                              False, 3, 60)
+        self.assertEqual(self.mock_session.commit.call_count, 1)
+
+        # Having run out, we lease some more
+        lease_numbers.return_value = []
+        self.assertRaises(NotFound, self.allocator.allocate_number, self.mock_session, OWNER_ID)
+        self.assertEqual(lease_numbers.call_count, 2)
+
+    def test_skips_lost_leases(self, lease_numbers, allocate_leased_number):
+        lease_numbers.return_value = [n.hex for n in NUMBER_IDS]
+        allocate_leased_number.side_effect = [False, True]
+        number_id = self.allocator.allocate_number(self.mock_session, OWNER_ID, True)
+        self.assertEqual(number_id, NUMBER_IDS[1])
+        self.assertEqual(allocate_leased_number.call_count, 2)
+
+    def test_all_leases_lost(self, lease_numbers, allocate_leased_number):
+        lease_numbers.return_value = [n.hex for n in NUMBER_IDS]
+        allocate_leased_number.return_value = False
+        self.assertRaises(NotFound, self.allocator.allocate_number, self.mock_session, OWNER_ID)
+        self.assertEqual(lease_numbers.call_count, 1)
+
+    @patch("time.time")
+    def test_releases_expired_lease(self, time, lease_numbers, allocate_leased_number):
+        time.return_value = 1000
+        lease_numbers.return_value = [n.hex for n in NUMBER_IDS]
+        allocate_leased_number.return_value = True
+        self.allocator.allocate_number(self.mock_session, OWNER_ID)
+        time.return_value = 1060
+        self.allocator.allocate_number(self.mock_session, OWNER_ID)
+        self.assertEqual(lease_numbers.call_count, 2)
+
+    @patch("metaswitch.ellis.data.numbers.release_leases")
+    def test_release_leases(self, release_leases, lease_numbers, allocate_leased_number):
+        self.allocator.release_leases()
+        release_leases.assert_called_once_with(self.mock_session, self.allocator.lease_id)
+        self.assertTrue(self.mock_session.commit.called)
+
+class TestAllocateNumber(BaseDataTest):
+
+    @patch("metaswitch.ellis.settings.NUMBER_LEASE_BATCH_SIZE", 0)
+    @patch("metaswitch.ellis.data.numbers.allocate_number")
+    def test_leasing_disabled(self, allocate_number):
+        allocate_number.return_value = NUMBER_IDS[0]
+        self.assertEqual(allocator.allocate_number(self.mock_session, OWNER_ID, True),
+                         NUMBER_IDS[0])
+        allocate_number.assert_called_once_with(self.mock_session, OWNER_ID, True)
+
+    @patch("metaswitch.ellis.settings.NUMBER_LEASE_BATCH_SIZE", 10)
+    @patch("metaswitch.ellis.data.allocator.NumberAllocator.allocate_number")
+    def test_leasing_enabled(self, allocate_number):
+        allocate_number.return_value = NUMBER_IDS[0]
+        self.assertEqual(allocator.allocate_number(self.mock_session, OWNER_ID),
+                         NUMBER_IDS[0])
+        allocate_number.assert_called_once_with(self.mock_session, OWNER_ID, False)
+
+    @patch("metaswitch.ellis.settings.NUMBER_LEASE_BATCH_SIZE", 0)
+    @patch("metaswitch.ellis.data.numbers.allocate_number")
+    def test_allocate_numbers(self, allocate_number):
+        allocate_number.side_effect = NUMBER_IDS
+        self.assertEqual(allocator.allocate_numbers(self.mock_session, OWNER_ID, 3),
+                         NUMBER_IDS)
+        allocate_number.assert_called_with(self.mock_session, OWNER_ID, False)
+
+    @patch("metaswitch.ellis.settings.NUMBER_LEASE_BATCH_SIZE", 0)
+    @patch("metaswitch.ellis.data.numbers.allocate_number")
+    def test_allocate_numbers_runs_out(self, allocate_number):
+        allocate_number.side_effect = [NUMBER_IDS[0], NotFound()]
+        self.assertRaises(NotFound, allocator.allocate_numbers, self.mock_session, OWNER_ID, 3)
+
+if __name__ == "__main__":
+    unittest.main()
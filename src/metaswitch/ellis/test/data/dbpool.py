@@ -0,0 +1,78 @@
+# @file dbpool.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+from mock import patch, MagicMock
+import unittest
+
+from metaswitch.ellis.data import dbpool, numbers, users
+from metaswitch.ellis.test.data._base import BaseDataTest
+
+class TestDbPool(BaseDataTest):
+
+    def test_commit(self):
+        fn = MagicMock(return_value="result")
+        self.assertEquals(dbpool._in_session(fn, ("a", "b")), "result")
+        fn.assert_called_once_with(self.mock_session, "a", "b")
+        self.mock_session.commit.assert_called_once_with()
+        self.assertFalse(self.mock_session.rollback.called)
+        self.mock_session.close.assert_called_once_with()
+
+    def test_rollback(self):
+        fn = MagicMock(side_effect=ValueError)
+        self.assertRaises(ValueError, dbpool._in_session, fn, ())
+        self.assertFalse(self.mock_session.commit.called)
+        self.mock_session.rollback.assert_called_once_with()
+        self.mock_session.close.assert_called_once_with()
+
+    @patch("metaswitch.ellis.data.dbpool._db_pool")
+    def test_run(self, db_pool):
+        callback = MagicMock()
+        errback = MagicMock()
+        dbpool.run(numbers.get_numbers, ("user",), callback, errback)
+        db_pool.run.assert_called_once_with(dbpool._in_session,
+                                            (numbers.get_numbers, ("user",)),
+                                            callback,
+                                            errback)
+
+    @patch("metaswitch.ellis.data.dbpool.run")
+    def test_async_queries(self, run):
+        callback = MagicMock()
+        errback = MagicMock()
+        users.get_user_by_email_async("foo@bar.com", callback, errback)
+        run.assert_called_once_with(users.get_user_by_email, ("foo@bar.com",), callback, errback)
+        run.reset_mock()
+        numbers.get_numbers_async("user", callback, errback)
+        run.assert_called_once_with(numbers.get_numbers, ("user",), callback, errback)
+        run.reset_mock()
+        users.lookup_user_id_async("foo@bar.com", callback, errback)
+        run.assert_called_once_with(users.lookup_user_id, ("foo@bar.com",), callback, errback)
+        run.reset_mock()
+        users.delete_user_async("user", callback, errback)
+        run.assert_called_once_with(users.delete_user, ("user",), callback, errback)
+        run.reset_mock()
+        numbers.remove_owners_async(["sip:1"], callback, errback)
+        run.assert_called_once_with(numbers._remove_owners, (["sip:1"],), callback, errback)
+        run.reset_mock()
+        numbers.get_sip_uri_owner_id_async("sip:1", callback, errback)
+        run.assert_called_once_with(numbers.get_sip_uri_owner_id, ("sip:1",), callback, errback)
+        run.reset_mock()
+        users.set_recovered_password_async("foo@bar.com", "token", "hash", callback, errback)
+        run.assert_called_once_with(users.set_recovered_password,
+                                    ("foo@bar.com", "token", None, "hash"),
+                                    callback,
+                                    errback)
+
+    @patch("metaswitch.ellis.data.numbers.remove_owner")
+    def test_remove_owners(self, remove_owner):
+        numbers._remove_owners(self.mock_session, ["sip:1", "sip:2"])
+        self.assertEqual([c[0] for c in remove_owner.call_args_list],
+                         [(self.mock_session, "sip:1"), (self.mock_session, "sip:2")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,10 +17,19 @@ from metaswitch.ellis.data.numbers import (get_sip_uri_number_id,
                                                get_sip_uri_owner_id,
                                                remove_owner,
                                                add_number_to_pool,
+                                               add_numbers_to_pool,
                                                allocate_number,
+                                               lease_numbers,
+                                               allocate_leased_number,
+                                               release_leases,
                                                get_number,
                                                get_numbers,
-                                               update_gab_list)
+                                               update_gab_list,
+                                               get_gab_version,
+                                               iter_numbers,
+                                               mark_verified,
+                                               get_last_modified,
+                                               count_numbers)
 from metaswitch.ellis.test.data._base import BaseDataTest
 from metaswitch.ellis.data import NotFound
 
@@ -28,6 +37,7 @@ SIP_URI = "sip:1234@foo.com"
 OWNER_ID = uuid.uuid4()
 NUMBER_ID = uuid.uuid4()
 GAB_LISTED = 1
+BUMP_GAB_VERSION = "UPDATE gab_version SET version = version + 1 WHERE id = 0"
 
 class TestNumbers(BaseDataTest):
 
@@ -78,7 +88,11 @@ class TestNumbers(BaseDataTest):
         get_sip_id.return_value = NUMBER_ID
         self.mock_cursor.rowcount = 1
         remove_owner(self.mock_session, SIP_URI)
-        self.mock_session.execute.assert_called_with(ANY, {"number_id": NUMBER_ID})
+        self.mock_session.execute.assert_any_call(ANY, {"number_id": NUMBER_ID})
+        self.mock_session.execute.assert_called_with(BUMP_GAB_VERSION)
+        # The line is marked as needing to be re-checked
+        self.assertTrue(any("last_verified = NULL" in c[0][0]
+                            for c in self.mock_session.execute.call_args_list))
 
     @patch("metaswitch.ellis.data.numbers.add_number_to_pool")
     @patch("metaswitch.ellis.data.numbers.get_sip_uri_number_id")
@@ -86,7 +100,8 @@ class TestNumbers(BaseDataTest):
         get_sip_id.return_value = NUMBER_ID
         self.mock_cursor.rowcount = 0
         remove_owner(self.mock_session, SIP_URI)
-        self.mock_session.execute.assert_called_with(ANY, {"number_id": NUMBER_ID})
+        self.mock_session.execute.assert_any_call(ANY, {"number_id": NUMBER_ID})
+        self.mock_session.execute.assert_called_with(BUMP_GAB_VERSION)
         self.assertFalse(add_to_pool.called)
 
     @patch("uuid.uuid4")
@@ -101,21 +116,121 @@ class TestNumbers(BaseDataTest):
                                                            "specified": False
                                                            })
 
+    def test_add_numbers_to_pool(self):
+        self.mock_cursor.rowcount = 1
+        added = add_numbers_to_pool(self.mock_session, [SIP_URI, "sip:1235@foo.com"], pstn=True)
+        self.assertEqual(added, 1)
+        self.mock_session.execute.assert_called_once_with(ANY, ANY)
+        sql, params = self.mock_session.execute.call_args[0]
+        self.assertIn("INSERT IGNORE", sql)
+        self.assertEqual(params["number_0"], SIP_URI)
+        self.assertEqual(params["number_1"], "sip:1235@foo.com")
+        self.assertTrue(params["pstn"])
+        self.assertNotEqual(params["number_id_0"], params["number_id_1"])
+
+    def test_add_no_numbers_to_pool(self):
+        self.assertEqual(add_numbers_to_pool(self.mock_session, []), 0)
+        self.assertFalse(self.mock_session.execute.called)
+
     def test_allocate_number(self):
         self.mock_cursor.fetchone.return_value = (NUMBER_ID.hex,)
         num_id = allocate_number(self.mock_session, OWNER_ID)
         self.assertEqual(num_id, NUMBER_ID)
+        self.mock_session.execute.assert_called_with(BUMP_GAB_VERSION)
 
     def test_allocate_pstn_number(self):
         self.mock_cursor.fetchone.return_value = (NUMBER_ID.hex,)
         num_id = allocate_number(self.mock_session, OWNER_ID, True)
         self.assertEqual(num_id, NUMBER_ID)
 
+    @patch("random.randint")
+    def test_allocate_number_from_random_key(self, randint):
+        randint.return_value = 12345
+        self.mock_cursor.fetchone.return_value = (NUMBER_ID.hex,)
+        num_id = allocate_number(self.mock_session, OWNER_ID)
+        self.assertEqual(num_id, NUMBER_ID)
+        self.mock_session.execute.assert_any_call(ANY,
+                                                  {
+                                                    "user_id": OWNER_ID,
+                                                    "pstn": 0,
+                                                    "min_key": 12345
+                                                  })
+
+    @patch("random.randint")
+    def test_allocate_number_wraps_round(self, randint):
+        # No free numbers after the random key, but there is one before it
+        randint.return_value = 12345
+        self.mock_cursor.fetchone.side_effect = [(None,), (NUMBER_ID.hex,)]
+        num_id = allocate_number(self.mock_session, OWNER_ID)
+        self.assertEqual(num_id, NUMBER_ID)
+        self.mock_session.execute.assert_any_call(ANY,
+                                                  {
+                                                    "user_id": OWNER_ID,
+                                                    "pstn": 0,
+                                                    "min_key": 0
+                                                  })
+
     @patch("random.randint")
     def test_allocate_number_not_found(self, randint):
         self.mock_cursor.fetchone.return_value = (None, )
         self.assertRaises(NotFound, allocate_number, self.mock_session, OWNER_ID)
 
+    @patch("random.randint")
+    def test_lease_numbers(self, randint):
+        randint.return_value = 12345
+        self.mock_cursor.rowcount = 10
+        self.mock_cursor.fetchall.return_value = [(NUMBER_ID.hex,)]
+        number_ids = lease_numbers(self.mock_session, "lease", False, 10, 60)
+        self.assertEqual(number_ids, [NUMBER_ID.hex])
+        self.mock_session.execute.assert_any_call(ANY,
+                                                  {
+                                                    "lease_id": "lease",
+                                                    "lease_secs": 60,
+                                                    "pstn": 0,
+                                                    "min_key": 12345,
+                                                    "count": 10
+                                                  })
+        # We got the whole batch, so didn't need to wrap round
+        self.assertEqual(self.mock_session.execute.call_count, 2)
+
+    @patch("random.randint")
+    def test_lease_numbers_wraps_round(self, randint):
+        # Only 4 free numbers after the random key, so the rest of the batch
+        # comes from the start
+        randint.return_value = 12345
+        self.mock_cursor.rowcount = 4
+        self.mock_cursor.fetchall.return_value = []
+        lease_numbers(self.mock_session, "lease", True, 10, 60)
+        self.mock_session.execute.assert_any_call(ANY,
+                                                  {
+                                                    "lease_id": "lease",
+                                                    "lease_secs": 60,
+                                                    "pstn": 1,
+                                                    "min_key": 0,
+                                                    "count": 6
+                                                  })
+
+    def test_allocate_leased_number(self):
+        self.mock_cursor.rowcount = 1
+        self.assertTrue(allocate_leased_number(self.mock_session, OWNER_ID, NUMBER_ID.hex, "lease"))
+        self.mock_session.execute.assert_any_call(ANY,
+                                                  {
+                                                    "owner": OWNER_ID,
+                                                    "number_id": NUMBER_ID.hex,
+                                                    "lease_id": "lease"
+                                                  })
+        self.mock_session.execute.assert_called_with(BUMP_GAB_VERSION)
+
+    def test_allocate_leased_number_lost_lease(self):
+        self.mock_cursor.rowcount = 0
+        self.assertFalse(allocate_leased_number(self.mock_session, OWNER_ID, NUMBER_ID.hex, "lease"))
+        # Nothing changed, so the GAB version is untouched
+        self.assertEqual(self.mock_session.execute.call_count, 1)
+
+    def test_release_leases(self):
+        release_leases(self.mock_session, "lease")
+        self.mock_session.execute.assert_called_once_with(ANY, {"lease_id": "lease"})
+
     def test_get_number(self):
         self.mock_cursor.fetchone.return_value = (SIP_URI, OWNER_ID)
         sip_uri = get_number(self.mock_session, NUMBER_ID, OWNER_ID)
@@ -131,19 +246,61 @@ class TestNumbers(BaseDataTest):
 
     def test_update_gab_list_insert_number(self):
         update_gab_list(self.mock_session, OWNER_ID, NUMBER_ID, True)
-        self.mock_session.execute.assert_called_once_with(ANY,
-                                                          {
-                                                            "gab": True,
-                                                            "nid": NUMBER_ID
-                                                          })
+        self.mock_session.execute.assert_any_call(ANY,
+                                                  {
+                                                    "gab": True,
+                                                    "nid": NUMBER_ID
+                                                  })
+        self.mock_session.execute.assert_called_with(BUMP_GAB_VERSION)
 
     def test_update_gab_list_remove_number(self):
         update_gab_list(self.mock_session, OWNER_ID, NUMBER_ID, False)
-        self.mock_session.execute.assert_called_once_with(ANY,
-                                                          {
-                                                            "gab": False,
-                                                            "nid": NUMBER_ID
-                                                          })
+        self.mock_session.execute.assert_any_call(ANY,
+                                                  {
+                                                    "gab": False,
+                                                    "nid": NUMBER_ID
+                                                  })
+        self.mock_session.execute.assert_called_with(BUMP_GAB_VERSION)
+
+    def test_get_gab_version(self):
+        self.mock_cursor.fetchone.return_value = (42,)
+        self.assertEqual(get_gab_version(self.mock_session), 42)
+
+    def test_iter_numbers(self):
+        self.mock_cursor.__iter__.return_value = iter([(SIP_URI, 1, "t1"), ("sip:1235@foo.com", 0, "t2")])
+        numbers = iter_numbers(self.mock_session, after="sip:1233@foo.com")
+        self.assertEqual(list(numbers), [(SIP_URI, True, "t1"), ("sip:1235@foo.com", False, "t2")])
+        self.mock_session.connection.assert_called_once_with(execution_options={"stream_results": True})
+        self.mock_session.execute.assert_called_once_with(ANY, {"after": "sip:1233@foo.com"})
+        self.assertNotIn("last_verified", self.mock_session.execute.call_args[0][0])
+
+    def test_iter_numbers_incremental(self):
+        self.mock_cursor.__iter__.return_value = iter([])
+        self.assertEqual(list(iter_numbers(self.mock_session, max_age_secs=86400)), [])
+        self.mock_session.execute.assert_called_once_with(ANY, {"after": "", "max_age_secs": 86400})
+        self.assertIn("last_verified IS NULL", self.mock_session.execute.call_args[0][0])
+
+    def test_iter_numbers_assigned_only(self):
+        self.mock_cursor.__iter__.return_value = iter([])
+        self.assertEqual(list(iter_numbers(self.mock_session, assigned_only=True)), [])
+        self.assertIn("owner_id IS NOT NULL", self.mock_session.execute.call_args[0][0])
+
+    def test_count_numbers(self):
+        self.mock_cursor.fetchone.return_value = (42,)
+        self.assertEqual(count_numbers(self.mock_session, after=SIP_URI, assigned_only=True), 42)
+        self.mock_session.execute.assert_called_once_with(ANY, {"after": SIP_URI})
+        self.assertIn("owner_id IS NOT NULL", self.mock_session.execute.call_args[0][0])
+
+    def test_get_last_modified(self):
+        self.mock_cursor.fetchone.return_value = ("t1",)
+        self.assertEqual(get_last_modified(self.mock_session, SIP_URI), "t1")
+        self.mock_cursor.fetchone.return_value = None
+        self.assertRaises(NotFound, get_last_modified, self.mock_session, SIP_URI)
+
+    def test_mark_verified(self):
+        mark_verified(self.mock_session, SIP_URI, "t1")
+        self.mock_session.execute.assert_called_once_with(ANY, {"number": SIP_URI,
+                                                                "last_modified": "t1"})
 
 if __name__ == "__main__":
     unittest.main()
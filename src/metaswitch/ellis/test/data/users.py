@@ -187,6 +187,33 @@ class TestUsers(BaseDataTest):
         test_password("bar")
         test_password(u"Smily face \u263A")
 
+    @patch("metaswitch.ellis.settings.PASSWORD_WORK_FACTOR", 5)
+    def test_needs_rehash(self):
+        hashed = users.hash_password("foo")
+        self.assertFalse(users.needs_rehash(hashed))
+        with patch("metaswitch.ellis.settings.PASSWORD_WORK_FACTOR", 6):
+            self.assertTrue(users.needs_rehash(hashed))
+        self.assertTrue(users.needs_rehash("not a bcrypt hash"))
+
+    def test_set_password(self):
+        users.set_password(self.mock_session, "123", "hashy")
+        self.mock_session.execute.assert_called_once_with(ANY, {"user_id": "123",
+                                                                "hashed_password": "hashy"})
+
+    def test_set_recovered_password_prehashed(self):
+        self.mock_cursor.fetchone.return_value = "etaoinshrdlu", datetime.datetime.now() - datetime.timedelta(seconds=10)
+        users.set_recovered_password(self.mock_session, "email@example.com", "etaoinshrdlu", None,
+                                     hashed_password="hashy")
+        self.mock_session.execute.assert_called_with(ANY, {'email': "email@example.com",
+                                                           'hashed_password': "hashy"})
+
+    def test_check_recovery_token(self):
+        self.mock_cursor.fetchone.return_value = "etaoinshrdlu", datetime.datetime.now() - datetime.timedelta(seconds=10)
+        users.check_recovery_token(self.mock_session, "email@example.com", "etaoinshrdlu")
+        self.assertRaises(ValueError,
+                          users.check_recovery_token,
+                          self.mock_session, "email@example.com", "dunnomatey")
+
     def tearDown(self):
         unittest.TestCase.tearDown(self)
 
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+# @file ifc_cache.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import hashlib
+import unittest
+from mock import patch
+from metaswitch.ellis import ifc_cache
+
+IFC = '<?xml version="1.0" ?><ServiceProfile></ServiceProfile>'
+
+class TestIfcCache(unittest.TestCase):
+
+    def setUp(self):
+        ifc_cache.clear()
+
+    def test_ifc_hash(self):
+        self.assertEqual(ifc_cache.ifc_hash(IFC), hashlib.sha256(IFC).hexdigest())
+        self.assertEqual(ifc_cache.ifc_hash(unicode(IFC)), ifc_cache.ifc_hash(IFC))
+
+    @patch("defusedxml.minidom.parseString")
+    def test_validate_once(self, parse):
+        self.assertEqual(ifc_cache.validate(IFC), ifc_cache.ifc_hash(IFC))
+        self.assertEqual(ifc_cache.validate(IFC), ifc_cache.ifc_hash(IFC))
+        parse.assert_called_once_with(IFC)
+
+    def test_validate_malformed(self):
+        self.assertRaises(ValueError, ifc_cache.validate, "this is malformed ifc")
+        # Failures aren't remembered as valid
+        self.assertRaises(ValueError, ifc_cache.validate, "this is malformed ifc")
+
+    @patch("metaswitch.common.ifcs.generate_ifcs")
+    def test_default_ifcs(self, generate_ifcs):
+        generate_ifcs.side_effect = lambda domain: IFC.replace("></", "><Domain>%s</Domain></" % domain)
+        foo = ifc_cache.default_ifcs("foo.bar")
+        self.assertIn("foo.bar", foo)
+        self.assertEqual(ifc_cache.default_ifcs("foo.bar"), foo)
+        self.assertIn("baz.bar", ifc_cache.default_ifcs("baz.bar"))
+        self.assertEqual([c[0][0] for c in generate_ifcs.call_args_list],
+                         ["foo.bar", "baz.bar"])
+
+    @patch("metaswitch.common.ifcs.generate_ifcs")
+    def test_default_ifcs_invalid(self, generate_ifcs):
+        generate_ifcs.return_value = "this is malformed ifc"
+        self.assertRaises(ValueError, ifc_cache.default_ifcs, "foo.bar")
+        self.assertRaises(ValueError, ifc_cache.default_ifcs, "foo.bar")
+        self.assertEqual(generate_ifcs.call_count, 2)
@@ -9,6 +9,12 @@
 
 
 from mock import patch, MagicMock, ANY
+import glob
+import json
+import os
+import shutil
+import smtplib
+import tempfile
 import unittest
 
 from metaswitch.ellis.mail import mail
@@ -16,38 +22,189 @@ from metaswitch.ellis.mail import mail
 class TestMail(unittest.TestCase):
     _message = None
 
-    @patch("metaswitch.ellis.settings.SMTP_SMARTHOST",             new="smtp.example.com")
-    @patch("metaswitch.ellis.settings.SMTP_PORT",                  new=25)
-    @patch("metaswitch.ellis.settings.SMTP_TIMEOUT_SEC",           new=10)
-    @patch("metaswitch.ellis.settings.SMTP_USERNAME",              new="anonymous")
-    @patch("metaswitch.ellis.settings.SMTP_PASSWORD",              new="password")
-    @patch("metaswitch.ellis.settings.SMTP_USE_TLS",               new=True)
     @patch("metaswitch.ellis.settings.EMAIL_RECOVERY_SENDER",      new="no-reply@example.com")
     @patch("metaswitch.ellis.settings.EMAIL_RECOVERY_SENDER_NAME", new="Clearwater Automated Password Recovery")
     @patch("metaswitch.ellis.settings.EMAIL_RECOVERY_SIGNOFF",     new="The Clearwater Team")
-    @patch("smtplib.SMTP")
-    def test_mainline(self, smtp):
+    @patch("metaswitch.ellis.mail.mail._mail_queue")
+    def test_mainline(self, mail_queue):
         address = "bob@example.com"
         full_name = "Robert Your Uncle"
         token = "deadbeef01&2"
-        server = MagicMock()
-        smtp.return_value = server
         self._message = None
         def dosave(x, y, z):
             self._message = z
-        server.sendmail.side_effect = dosave
-        
+        mail_queue.put.side_effect = dosave
+
         urlbase = "https://www.example.com/forgotpassword?"
         mail.send_recovery_message(urlbase, address, full_name, token)
 
-        smtp.assert_called_once_with(host = "smtp.example.com",
-                                     port = 25,
-                                     timeout = 10)
-        server.starttls.assert_called_once_with()
-        server.login.assert_called_once_with("anonymous", "password")
-        server.sendmail.assert_called_once_with("no-reply@example.com", "bob@example.com", ANY)
-        server.quit.assert_called_once_with()
+        mail_queue.put.assert_called_once_with("no-reply@example.com", "bob@example.com", ANY)
         self.assertIn("please click on the link", self._message)
         self.assertIn("https://www.example.com/forgotpassword?email=bob%40example.com&token=deadbeef01%262", self._message)
         self.assertIn("https://www.example.com/forgotpassword?email=bob%40example.com&amp;token=deadbeef01%262", self._message)
         self.assertTrue(self._message.startswith("From: "), msg=">>" + self._message + "<<")
+
+@patch("metaswitch.ellis.settings.SMTP_SMARTHOST",               new="smtp.example.com")
+@patch("metaswitch.ellis.settings.SMTP_PORT",                    new=25)
+@patch("metaswitch.ellis.settings.SMTP_TIMEOUT_SEC",             new=10)
+@patch("metaswitch.ellis.settings.SMTP_USERNAME",                new="anonymous")
+@patch("metaswitch.ellis.settings.SMTP_PASSWORD",                new="password")
+@patch("metaswitch.ellis.settings.SMTP_USE_TLS",                 new=True)
+@patch("metaswitch.ellis.settings.SMTP_MAX_ATTEMPTS",            new=3)
+@patch("metaswitch.ellis.settings.SMTP_RETRY_INITIAL_DELAY_SEC", new=1)
+@patch("metaswitch.ellis.settings.SMTP_RETRY_MAX_DELAY_SEC",     new=300)
+@patch("metaswitch.ellis.mail.mail.time")
+@patch("smtplib.SMTP")
+class TestMailQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        patcher = patch("metaswitch.ellis.settings.EMAIL_SPOOL_DIR", new=self.spool_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        self.queue = mail._MailQueue()
+        # Don't start the sending thread - the tests deliver the mail
+        self.queue.start = MagicMock()
+        self.queue._queue = MagicMock()
+        self.now = 1000
+
+    def advance(self, clock, secs):
+        self.now += secs
+        clock.time.return_value = self.now
+
+    def spooled(self, pattern="*"):
+        return glob.glob(os.path.join(self.spool_dir, pattern))
+
+    def queue_message(self, address="bob@example.com"):
+        self.queue.put("no-reply@example.com", address, "Hello")
+        return self.queue._queue.put.call_args[0][0]
+
+    def test_spooled_and_sent(self, smtp, clock):
+        server = smtp.return_value
+        path = self.queue_message()
+        self.assertEqual(self.spooled(), [path])
+
+        self.queue._deliver(path)
+        smtp.assert_called_once_with(host="smtp.example.com", port=25, timeout=10)
+        server.starttls.assert_called_once_with()
+        server.login.assert_called_once_with("anonymous", "password")
+        server.sendmail.assert_called_once_with("no-reply@example.com",
+                                                "bob@example.com",
+                                                "Hello")
+        self.assertEqual(self.spooled(), [])
+
+    def test_connection_reused(self, smtp, clock):
+        server = smtp.return_value
+        self.queue._deliver(self.queue_message())
+        self.queue._deliver(self.queue_message("alice@example.com"))
+        self.assertEqual(smtp.call_count, 1)
+        self.assertEqual(server.sendmail.call_count, 2)
+        self.assertFalse(server.quit.called)
+
+        # Once idle, the connection is closed
+        self.queue._disconnect()
+        server.quit.assert_called_once_with()
+
+    def test_retry(self, smtp, clock):
+        self.advance(clock, 0)
+        server = smtp.return_value
+        server.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), None, None]
+        path = self.queue_message()
+        self.queue._deliver(path)
+        self.assertEqual(self.queue._retries, [(1001, 1, path)])
+
+        # Other messages aren't held up while the failed one backs off
+        self.queue._deliver(self.queue_message("alice@example.com"))
+        self.assertEqual(server.sendmail.call_args[0][1], "alice@example.com")
+        self.queue._deliver_due()
+        self.assertEqual(server.sendmail.call_count, 2)
+
+        # Once it has backed off, we reconnect and send it
+        self.advance(clock, 1)
+        self.queue._deliver_due()
+        self.assertEqual(smtp.call_count, 2)
+        self.assertEqual(server.sendmail.call_count, 3)
+        self.assertEqual(self.queue._retries, [])
+        self.assertEqual(self.spooled(), [])
+
+    def test_give_up(self, smtp, clock):
+        self.advance(clock, 0)
+        server = smtp.return_value
+        server.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        self.queue._deliver(self.queue_message())
+        delays = []
+        while self.queue._retries:
+            delays.append(self.queue._retries[0][0] - self.now)
+            self.advance(clock, delays[-1])
+            self.queue._deliver_due()
+        self.assertEqual(server.sendmail.call_count, 3)
+        self.assertEqual(delays, [1, 2])
+        # The message is kept in the spool for investigation
+        self.assertEqual(self.spooled("*.msg"), [])
+        self.assertEqual(len(self.spooled("*.failed")), 1)
+
+    def test_recipient_refused(self, smtp, clock):
+        server = smtp.return_value
+        server.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        self.queue._deliver(self.queue_message())
+        self.assertEqual(server.sendmail.call_count, 1)
+        self.assertEqual(self.spooled(), [])
+
+    def test_rejected(self, smtp, clock):
+        # The smarthost rejecting the message isn't retried
+        server = smtp.return_value
+        server.sendmail.side_effect = smtplib.SMTPDataError(554, "Rejected")
+        self.queue._deliver(self.queue_message())
+        self.assertEqual(self.queue._retries, [])
+        self.assertEqual(self.spooled(), [])
+
+    def test_temporarily_rejected(self, smtp, clock):
+        self.advance(clock, 0)
+        server = smtp.return_value
+        server.sendmail.side_effect = smtplib.SMTPRecipientsRefused(
+            {"bob@example.com": (450, "Mailbox busy")})
+        path = self.queue_message()
+        self.queue._deliver(path)
+        self.assertEqual(self.queue._retries, [(1001, 1, path)])
+        self.assertEqual(self.spooled(), [path])
+
+    def test_stale_connection(self, smtp, clock):
+        # If the smarthost has closed an idle connection, we reconnect
+        # straight away without using up one of the message's attempts
+        server = smtp.return_value
+        self.queue._deliver(self.queue_message())
+        server.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), None]
+        self.queue._deliver(self.queue_message("alice@example.com"))
+        self.assertEqual(smtp.call_count, 2)
+        self.assertEqual(server.sendmail.call_count, 3)
+        self.assertEqual(self.queue._retries, [])
+        self.assertEqual(self.spooled(), [])
+
+    def test_remove_partial_messages(self, smtp, clock):
+        # Partly spooled messages from a process that has exited are removed,
+        # but not those from running processes
+        for name in ("dead.%d.msg.tmp" % 0x7ffffffe,
+                     "live.%d.msg.tmp" % os.getppid(),
+                     "mine.%d.msg.tmp" % os.getpid()):
+            open(os.path.join(self.spool_dir, name), "w").close()
+
+        self.queue._remove_partial_messages()
+        self.assertEqual(sorted(os.path.basename(p) for p in self.spooled()),
+                         ["live.%d.msg.tmp" % os.getppid(),
+                          "mine.%d.msg.tmp" % os.getpid()])
+
+    def test_claim_orphans(self, smtp, clock):
+        message = json.dumps({"from": "no-reply@example.com",
+                              "to": "bob@example.com",
+                              "message": "Hello"})
+        # One message from a process that has exited, and one from a process
+        # that is still running (our parent)
+        for name in ("orphan.%d.msg" % 0x7ffffffe, "live.%d.msg" % os.getppid()):
+            with open(os.path.join(self.spool_dir, name), "w") as f:
+                f.write(message)
+
+        claimed = self.queue._claim_orphans()
+        self.assertEqual(claimed,
+                         [os.path.join(self.spool_dir, "orphan.%d.msg" % os.getpid())])
+        self.assertEqual(len(self.spooled()), 2)
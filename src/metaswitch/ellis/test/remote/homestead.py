@@ -13,7 +13,8 @@ import unittest
 import json
 from tornado.httpclient import HTTPError
 from mock import MagicMock, Mock, patch, ANY
-from metaswitch.ellis.remote import homestead
+from metaswitch.ellis.remote import homestead, upstream
+from metaswitch.ellis import ifc_cache
 
 PRIVATE_URI = "pri@foo.bar"
 PUBLIC_URI = "sip:pub@foo.bar"
@@ -27,22 +28,42 @@ class MockHTTPClient(object):
         response.headers.get_list.return_value = ['/irs/irs-uuid/service_profiles/sp-uuid']
         return response
 
-class MockHTTPClientEmptyResponse(object):
-    def fetch(self, url, *args, **kwargs):
+class MockAsyncHTTPClient(object):
+    """
+    Imitates a tornado.httpclient.AsyncHTTPClient, immediately answering every
+    request with the given code and recording the requests made.
+    """
+    def __init__(self, irs_list=["abc"], code=200, fail_url=None):
+        self.irs_list = irs_list
+        self.code = code
+        self.fail_url = fail_url
+        self.requests = []
+
+    def fetch(self, url, callback, **kwargs):
+        self.requests.append((kwargs.get('method', 'GET'), url))
         response = Mock()
         # Imitate a tornado.httpclient.httpresponse
-        response.body = '{"associated_implicit_registration_sets": []}'
-        return response
+        response.body = json.dumps({"associated_implicit_registration_sets": self.irs_list})
+        response.headers.get_list.return_value = ['/irs/irs-uuid/service_profiles/sp-uuid']
+        response.code = self.code if url == self.fail_url else 200
+        response.error = HTTPError(response.code) if response.code != 200 else None
+        callback(response)
 
 class TestHomestead(unittest.TestCase):
     """
     Detailed, isolated unit tests of the homestead module.
     """
 
-    def standard_setup(self, settings, AsyncHTTPClient):
+    def setUp(self):
+        upstream.reset()
+        homestead._privates_cache.clear()
+        homestead._publics_cache.clear()
+        ifc_cache.clear()
+
+    def standard_setup(self, settings, AsyncHTTPClient, httpclient=None):
         settings.HOMESTEAD_URL = "homestead"
         settings.SIP_DIGEST_REALM = "foo.bar"
-        self.mock_httpclient = Mock()
+        self.mock_httpclient = httpclient or Mock()
         AsyncHTTPClient.return_value = self.mock_httpclient
 
 
@@ -54,7 +75,7 @@ class TestHomesteadPing(TestHomestead):
     def test_ping_mainline(self, settings, AsyncHTTPClient):
         self.standard_setup(settings, AsyncHTTPClient)
         homestead.ping()
-        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", ANY)
+        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", ANY, allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
         mock_response = MagicMock()
         mock_response.body = "OK"
         self.mock_httpclient.fetch.call_args[0][1](mock_response)
@@ -66,7 +87,7 @@ class TestHomesteadPing(TestHomestead):
     def test_ping_fail(self, settings, AsyncHTTPClient):
         self.standard_setup(settings, AsyncHTTPClient)
         homestead.ping()
-        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", ANY)
+        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", ANY, allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
         mock_response = MagicMock()
         mock_response.body = "Failure"
         self.mock_httpclient.fetch.call_args[0][1](mock_response)
@@ -86,7 +107,7 @@ class TestHomesteadPasswords(TestHomestead):
             ANY,
             method='GET',
             follow_redirects=False,
-            allow_ipv6=True)
+            allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
 
     @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
@@ -107,7 +128,7 @@ class TestHomesteadPasswords(TestHomestead):
             body=body,
             headers={'Content-Type': 'application/json'},
             follow_redirects=False,
-            allow_ipv6=True)
+            allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
     @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
@@ -124,85 +145,119 @@ class TestHomesteadPasswords(TestHomestead):
             body=body,
             headers={'Content-Type': 'application/json'},
             follow_redirects=False,
-            allow_ipv6=True)
+            allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
+
+    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.common.utils.md5")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_put_password_digest(self, settings, md5, AsyncHTTPClient):
+        self.standard_setup(settings, AsyncHTTPClient)
+        body = json.dumps({"digest_ha1": "ha1", "realm": "realm"})
+        callback = Mock()
+        homestead.put_password(PRIVATE_URI, "realm", None, callback, digest_ha1="ha1")
+        self.assertFalse(md5.called)
+        self.mock_httpclient.fetch.assert_called_once_with(
+            'http://homestead/private/pri%40foo.bar',
+            ANY,
+            method='PUT',
+            body=body,
+            headers={'Content-Type': 'application/json'},
+            follow_redirects=False,
+            allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
 class TestHomesteadPrivateIDs(TestHomestead):
     """Tests for creating and deleting private IDs"""
 
-    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
+    @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.common.utils.md5")
     @patch("metaswitch.ellis.remote.homestead.settings")
-    def test_create_private_id_mainline(self, settings, md5):
+    def test_create_private_id_mainline(self, settings, md5, AsyncHTTPClient):
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
         callback = Mock()
         md5.return_value = "md5_hash"
         homestead.create_private_id(PRIVATE_URI, "realm", "pw", callback)
         md5.assert_called_once_with("pri@foo.bar:realm:pw")
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('PUT', 'http://homestead/private/pri%40foo.bar'),
+                          ('POST', 'http://homestead/irs/'),
+                          ('PUT', 'http://homestead/private/pri%40foo.bar/associated_implicit_registration_sets/irs-uuid')])
+        self.assertEqual(callback.call_count, 1)
+        self.assertEqual(callback.call_args[0][0].code, 200)
+
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_create_private_id_failure(self, settings, AsyncHTTPClient):
+        """Test that a failure part way through creating a private ID stops
+           the chain of requests and passes the error to the callback.
+        """
+        self.standard_setup(settings,
+                            AsyncHTTPClient,
+                            MockAsyncHTTPClient(code=503, fail_url='http://homestead/irs/'))
+        callback = Mock()
+        homestead.create_private_id(PRIVATE_URI, "realm", "pw", callback)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('PUT', 'http://homestead/private/pri%40foo.bar'),
+                          ('POST', 'http://homestead/irs/')])
+        self.assertEqual(callback.call_count, 1)
+        self.assertTrue(isinstance(callback.call_args[0][0], HTTPError))
+        self.assertEqual(callback.call_args[0][0].code, 503)
 
-    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.homestead.settings")
     def test_delete_private_id_mainline(self, settings, AsyncHTTPClient):
-        self.standard_setup(settings, AsyncHTTPClient)
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
         callback = Mock()
         homestead.delete_private_id(PRIVATE_URI, callback)
-        self.mock_httpclient.fetch.assert_called_once_with(
-            'http://homestead/private/pri%40foo.bar',
-            ANY,
-            method='DELETE',
-            follow_redirects=False,
-            allow_ipv6=True)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('GET', 'http://homestead/private/pri%40foo.bar/associated_implicit_registration_sets'),
+                          ('DELETE', 'http://homestead/irs/abc'),
+                          ('DELETE', 'http://homestead/private/pri%40foo.bar')])
+        self.assertEqual(callback.call_count, 1)
 
-    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClientEmptyResponse)
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.homestead.settings")
     def test_delete_private_id_no_irs(self, settings, AsyncHTTPClient):
         """Test that trying to delete a private id that has no associated IRS
            will still result in a DELETE being sent.
         """
-        self.standard_setup(settings, AsyncHTTPClient)
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient(irs_list=[]))
         callback = Mock()
         homestead.delete_private_id(PRIVATE_URI, callback)
-        self.mock_httpclient.fetch.assert_called_once_with(
-            'http://homestead/private/pri%40foo.bar',
-            ANY,
-            method='DELETE',
-            follow_redirects=False,
-            allow_ipv6=True)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('GET', 'http://homestead/private/pri%40foo.bar/associated_implicit_registration_sets'),
+                          ('DELETE', 'http://homestead/private/pri%40foo.bar')])
+        self.assertEqual(callback.call_count, 1)
 
 
 class TestHomesteadPublicIDs(TestHomestead):
     """Tests for creating and deleting public IDs"""
 
-    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.homestead.settings")
     def test_create_public_id_mainline(self, settings, AsyncHTTPClient):
-        self.standard_setup(settings, AsyncHTTPClient)
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
         callback = Mock()
         homestead.create_public_id(PRIVATE_URI, PUBLIC_URI, '<?xml version="1.0" ?>\n<ServiceProfile>\n</ServiceProfile>', callback)
-        self.mock_httpclient.fetch.assert_called_with(
-          'http://homestead/irs/irs-uuid/service_profiles/sp-uuid/filter_criteria',
-            ANY,
-            body='<?xml version="1.0" ?>\n<ServiceProfile>\n</ServiceProfile>',
-            method='PUT',
-            follow_redirects=False,
-            allow_ipv6=True)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('GET', 'http://homestead/private/pri%40foo.bar/associated_implicit_registration_sets'),
+                          ('POST', 'http://homestead/irs/abc/service_profiles'),
+                          ('PUT', 'http://homestead/irs/abc/service_profiles/sp-uuid/public_ids/sip%3Apub%40foo.bar'),
+                          ('GET', 'http://homestead/public/sip%3Apub%40foo.bar/service_profile'),
+                          ('PUT', IFC_URL)])
+        self.assertEqual(callback.call_count, 1)
 
-    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.homestead.settings")
     def test_delete_public_id_mainline(self, settings, AsyncHTTPClient):
-        self.standard_setup(settings, AsyncHTTPClient)
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
         callback = Mock()
         homestead.delete_public_id(PUBLIC_URI, callback)
-        # The public ID itself is deleted synchronously - we don't
-        # have infrastructure to test that yet
-        self.mock_httpclient.fetch.assert_called_once_with(
-          'http://homestead/irs/irs-uuid/service_profiles/sp-uuid',
-            ANY,
-            method='DELETE',
-            follow_redirects=False,
-            allow_ipv6=True)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('GET', 'http://homestead/public/sip%3Apub%40foo.bar/service_profile'),
+                          ('DELETE', 'http://homestead/irs/irs-uuid/service_profiles/sp-uuid/public_ids/sip%3Apub%40foo.bar'),
+                          ('DELETE', 'http://homestead/irs/irs-uuid/service_profiles/sp-uuid')])
+        self.assertEqual(callback.call_count, 1)
 
     @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
@@ -227,7 +282,7 @@ class TestHomesteadAssociations(TestHomestead):
             ANY,
             method='GET',
             follow_redirects=False,
-            allow_ipv6=True)
+            allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
     @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
@@ -241,36 +296,177 @@ class TestHomesteadAssociations(TestHomestead):
             ANY,
             method='GET',
             follow_redirects=False,
-            allow_ipv6=True)
+            allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
+
+    @patch("metaswitch.ellis.remote.homestead.get_associated_privates")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_get_associated_privates_batch(self, settings, get_associated_privates):
+        settings.HOMESTEAD_MAX_LOOKUPS_IN_FLIGHT = 2
+        callback = Mock()
+        public_ids = ["sip:%d@foo.bar" % i for i in range(5)]
+        homestead.get_associated_privates_batch(public_ids, callback)
+
+        # Only two lookups are started at once
+        self.assertEqual(get_associated_privates.call_count, 2)
+
+        # Each lookup that completes starts another, until all are done
+        responses = 0
+        while get_associated_privates.call_args_list[responses:]:
+            public_id, lookup_callback = get_associated_privates.call_args_list[responses][0]
+            response = Mock()
+            response.error = None
+            response.body = json.dumps({"private_ids": [public_id[4:]]})
+            responses += 1
+            lookup_callback(response)
+            self.assertTrue(get_associated_privates.call_count - responses <= 2)
+            self.assertEqual(callback.called, responses == 5)
+
+        self.assertEqual(sorted(c[0][0] for c in get_associated_privates.call_args_list),
+                         public_ids)
+        callback.assert_called_once_with(dict((p, [p[4:]]) for p in public_ids), {})
+
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_get_associated_privates_batch_failure(self, settings, AsyncHTTPClient):
+        self.standard_setup(settings,
+                            AsyncHTTPClient,
+                            MockAsyncHTTPClient(code=404,
+                                                fail_url='http://homestead/public/sip%3Apub%40foo.bar/associated_private_ids'))
+        settings.HOMESTEAD_MAX_LOOKUPS_IN_FLIGHT = 10
+        callback = Mock()
+        homestead.get_associated_privates_batch([PUBLIC_URI, "sip:other@foo.bar"], callback)
+
+        # The responses from the mock client don't contain private IDs, so
+        # the lookup that succeeds can't be parsed
+        self.assertEqual(len(self.mock_httpclient.requests), 2)
+        private_ids, errors = callback.call_args[0]
+        self.assertEqual(private_ids, {})
+        self.assertEqual(errors[PUBLIC_URI].code, 404)
+        self.assertEqual(errors["sip:other@foo.bar"].code, 502)
+
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_get_associated_privates_batch_empty(self, settings):
+        callback = Mock()
+        homestead.get_associated_privates_batch([], callback)
+        callback.assert_called_once_with({}, {})
+
+class TestHomesteadCache(TestHomestead):
+
+    def setUp(self):
+        super(TestHomesteadCache, self).setUp()
+        self.lookup_url = 'http://homestead/public/sip%3Apub%40foo.bar/associated_private_ids'
+
+    def lookup(self):
+        callback = Mock()
+        with patch("metaswitch.ellis.remote.homestead.IOLoop") as IOLoop:
+            homestead.get_associated_privates(PUBLIC_URI, callback)
+            # Cached responses are delivered asynchronously
+            for call in IOLoop.instance.return_value.add_callback.call_args_list:
+                call[0][0]()
+        self.assertEqual(callback.call_count, 1)
+        return callback.call_args[0][0]
+
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_lookup_cached(self, settings, AsyncHTTPClient):
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
+        stats = homestead.get_cache_stats()["associated_privates"]
+        first = self.lookup()
+        second = self.lookup()
+        self.assertEqual(self.mock_httpclient.requests, [('GET', self.lookup_url)])
+        self.assertEqual(second.code, 200)
+        self.assertEqual(second.body, first.body)
+        new_stats = homestead.get_cache_stats()["associated_privates"]
+        self.assertEqual(new_stats["hits"], stats["hits"] + 1)
+        self.assertEqual(new_stats["misses"], stats["misses"] + 1)
+        self.assertEqual(new_stats["size"], 1)
+
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_failed_lookup_not_cached(self, settings, AsyncHTTPClient):
+        self.standard_setup(settings,
+                            AsyncHTTPClient,
+                            MockAsyncHTTPClient(code=404, fail_url=self.lookup_url))
+        self.assertEqual(self.lookup().code, 404)
+        self.assertEqual(self.lookup().code, 404)
+        self.assertEqual(len(self.mock_httpclient.requests), 2)
+
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_delete_public_id_invalidates(self, settings, AsyncHTTPClient):
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
+        self.lookup()
+        homestead.delete_public_id(PUBLIC_URI, Mock())
+        del self.mock_httpclient.requests[:]
+        self.lookup()
+        self.assertEqual(self.mock_httpclient.requests, [('GET', self.lookup_url)])
+
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_lookup_during_change_not_cached(self, settings, AsyncHTTPClient):
+        self.standard_setup(settings, AsyncHTTPClient)
+        lookup_callback = Mock()
+        homestead.get_associated_privates(PUBLIC_URI, lookup_callback)
+        # The association is deleted before the lookup completes
+        homestead.delete_private_id(PRIVATE_URI, Mock())
+        response = Mock()
+        response.code = 200
+        response.body = '{"private_ids": ["%s"]}' % PRIVATE_URI
+        self.mock_httpclient.fetch.call_args_list[0][0][1](response)
+        lookup_callback.assert_called_once_with(response)
+        self.assertEqual(homestead.get_cache_stats()["associated_privates"]["size"], 0)
+
+    @patch("metaswitch.ellis.remote.homestead._log")
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_log_cache_stats(self, settings, AsyncHTTPClient, _log):
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
+        homestead._privates_cache.hits = homestead._privates_cache.misses = 0
+        homestead._publics_cache.hits = homestead._publics_cache.misses = 0
+        for _ in range(4):
+            self.lookup()
+        homestead.log_cache_stats()
+        self.assertEqual(_log.info.call_args_list[-2][0][1:],
+                         ("associated_privates", 4, 75, 1))
+        self.assertEqual(_log.info.call_args_list[-1][0][1:],
+                         ("associated_publics", 0, 0, 0))
 
 class TestHomesteadiFCs(TestHomestead):
 
-    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.homestead.settings")
     def test_get_ifcs(self, settings, AsyncHTTPClient):
-        self.standard_setup(settings, AsyncHTTPClient)
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
         callback = Mock()
         homestead.get_filter_criteria(PUBLIC_URI, callback)
-        self.mock_httpclient.fetch.assert_called_once_with(IFC_URL,
-                                                           ANY,
-                                                           method="GET",
-                                                           follow_redirects=False,
-                                                           allow_ipv6=True)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('GET', 'http://homestead/public/sip%3Apub%40foo.bar/service_profile'),
+                          ('GET', IFC_URL)])
+        self.assertEqual(callback.call_count, 1)
+
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_get_ifcs_no_service_profile(self, settings, AsyncHTTPClient):
+        self.standard_setup(settings,
+                            AsyncHTTPClient,
+                            MockAsyncHTTPClient(code=404,
+                                                fail_url='http://homestead/public/sip%3Apub%40foo.bar/service_profile'))
+        callback = Mock()
+        homestead.get_filter_criteria(PUBLIC_URI, callback)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('GET', 'http://homestead/public/sip%3Apub%40foo.bar/service_profile')])
+        self.assertEqual(callback.call_args[0][0].code, 404)
 
-    @patch("tornado.httpclient.HTTPClient", new=MockHTTPClient)
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.homestead.settings")
     def test_put_ifcs(self, settings, AsyncHTTPClient):
-        self.standard_setup(settings, AsyncHTTPClient)
+        self.standard_setup(settings, AsyncHTTPClient, MockAsyncHTTPClient())
         callback = Mock()
         homestead.put_filter_criteria(PUBLIC_URI, '<xml />', callback)
-        self.mock_httpclient.fetch.assert_called_once_with(IFC_URL,
-                                                           ANY,
-                                                           method="PUT",
-                                                           body='<xml />',
-                                                           follow_redirects=False,
-                                                           allow_ipv6=True)
+        self.assertEqual(self.mock_httpclient.requests,
+                         [('GET', 'http://homestead/public/sip%3Apub%40foo.bar/service_profile'),
+                          ('PUT', IFC_URL)])
+        self.assertEqual(callback.call_count, 1)
 
 
 class TestHomesteadBulkPublicIDs(TestHomestead):
@@ -287,7 +483,7 @@ class TestHomesteadBulkPublicIDs(TestHomestead):
             ANY,
             method="GET",
             follow_redirects=False,
-            allow_ipv6=True)
+            allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
 
 class TestHomesteadAsync(TestHomestead):
@@ -300,7 +496,7 @@ class TestHomesteadAsync(TestHomestead):
         homestead._http_request("http://homestead/ping", self.callback)
 
     def expect_fetch_and_respond_with(self, code):
-        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", ANY, follow_redirects=False, allow_ipv6=True)
+        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", ANY, follow_redirects=False, allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
         internal_callback = self.mock_httpclient.fetch.call_args[0][1]
         self.mock_httpclient.reset_mock()
         mock_response = MagicMock()
@@ -321,9 +517,25 @@ class TestHomesteadAsync(TestHomestead):
     @patch("metaswitch.ellis.remote.homestead.settings")
     def test_fail(self, settings, AsyncHTTPClient, IOLoop):
         self.setup_and_do_initial_request(settings, AsyncHTTPClient, IOLoop)
+        # Server errors are retried, up to three attempts in all
+        for _ in range(2):
+            self.expect_fetch_and_respond_with(500)
+            self.assertFalse(self.callback.called)
+            self.mock_ioloop.add_timeout.call_args[0][1]()
         mock_response = self.expect_fetch_and_respond_with(500)
         self.callback.assert_called_once_with(mock_response)
 
+    @patch("tornado.ioloop.IOLoop.instance")
+    @patch("tornado.httpclient.AsyncHTTPClient")
+    @patch("metaswitch.ellis.remote.homestead.settings")
+    def test_fail_then_succeed(self, settings, AsyncHTTPClient, IOLoop):
+        self.setup_and_do_initial_request(settings, AsyncHTTPClient, IOLoop)
+        self.expect_fetch_and_respond_with(599)
+        self.mock_ioloop.add_timeout.call_args[0][1]()
+        mock_response = self.expect_fetch_and_respond_with(200)
+        self.callback.assert_called_once_with(mock_response)
+        self.assertEqual(upstream.homestead.stats["Requests recovered by retrying"], 1)
+
 
 class TestHomesteadSync(TestHomestead):
 
@@ -334,31 +546,32 @@ class TestHomesteadSync(TestHomestead):
     @patch("tornado.httpclient.HTTPClient")
     def test_succeed(self, HTTPClient):
         self.setup_httpclient(HTTPClient)
-        self.mock_httpclient.fetch.return_value = "OK"
-        self.assertEqual(homestead._sync_http_request("http://homestead/ping"), "OK")
-        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True)
+        response = Mock(code=200)
+        self.mock_httpclient.fetch.return_value = response
+        self.assertEqual(homestead._sync_http_request("http://homestead/ping"), response)
+        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
     @patch("tornado.httpclient.HTTPClient")
     def test_fail_303(self, HTTPClient):
         self.setup_httpclient(HTTPClient)
         self.mock_httpclient.fetch.side_effect = HTTPError(303, response="303 response")
         self.assertEqual(homestead._sync_http_request("http://homestead/ping"), "303 response")
-        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True)
+        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
     @patch("tornado.httpclient.HTTPClient")
     def test_fail_exception(self, HTTPClient):
         self.setup_httpclient(HTTPClient)
         self.mock_httpclient.fetch.side_effect = Exception()
         self.assertEqual(homestead._sync_http_request("http://homestead/ping").code, 500)
-        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True)
+        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
     @patch("tornado.httpclient.HTTPClient")
     def test_fail_http_exception(self, HTTPClient):
         self.setup_httpclient(HTTPClient)
-        e = HTTPError(503)
+        e = HTTPError(403)
         self.mock_httpclient.fetch.side_effect = e
         self.assertEqual(homestead._sync_http_request("http://homestead/ping"), e)
-        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True)
+        self.mock_httpclient.fetch.assert_called_once_with("http://homestead/ping", follow_redirects=False, allow_ipv6=True, connect_timeout=ANY, request_timeout=ANY)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+
+# @file upstream.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import Mock, patch, ANY
+from tornado.httpclient import HTTPError
+
+from metaswitch.ellis.remote import upstream
+
+@patch("metaswitch.ellis.settings.UPSTREAM_CONNECT_TIMEOUT_SECS", new=1)
+@patch("metaswitch.ellis.settings.UPSTREAM_REQUEST_TIMEOUT_SECS", new=2)
+@patch("metaswitch.ellis.settings.HOMESTEAD_MAX_IN_FLIGHT", new=7)
+@patch("metaswitch.ellis.remote.upstream.IOLoop")
+@patch("tornado.httpclient.AsyncHTTPClient")
+class TestBackend(unittest.TestCase):
+    def setUp(self):
+        upstream.reset()
+
+    def test_client_shared(self, AsyncHTTPClient, IOLoop):
+        callback = Mock()
+        upstream.homestead.fetch("http://homestead/a", callback)
+        upstream.homestead.fetch("http://homestead/b", callback, method="PUT", request_timeout=10)
+
+        # One client is created for all the requests, bounding how many are
+        # in flight
+        AsyncHTTPClient.assert_called_once_with(IOLoop.instance.return_value,
+                                                max_clients=7,
+                                                force_instance=True)
+        client = AsyncHTTPClient.return_value
+        client.fetch.assert_any_call("http://homestead/a",
+                                     ANY,
+                                     connect_timeout=1,
+                                     request_timeout=2,
+                                     allow_ipv6=True)
+        client.fetch.assert_called_with("http://homestead/b",
+                                        ANY,
+                                        method="PUT",
+                                        connect_timeout=1,
+                                        request_timeout=10,
+                                        allow_ipv6=True)
+
+        # The responses are passed on
+        response = Mock(code=200)
+        client.fetch.call_args[0][1](response)
+        callback.assert_called_once_with(response)
+
+    def test_new_client_per_io_loop(self, AsyncHTTPClient, IOLoop):
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        # As after forking
+        IOLoop.instance.return_value = Mock()
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        self.assertEqual(AsyncHTTPClient.call_count, 2)
+
+    def test_backends_separate(self, AsyncHTTPClient, IOLoop):
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        upstream.xdm.fetch("http://homer/a", Mock())
+        self.assertEqual(AsyncHTTPClient.call_count, 2)
+
+    @patch("metaswitch.ellis.settings.XDM_MAX_IN_FLIGHT", new=7)
+    def test_set_max_in_flight(self, AsyncHTTPClient, IOLoop):
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        upstream.set_max_in_flight(30)
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        upstream.xdm.fetch("http://homer/a", Mock())
+
+        # The existing client is replaced by one that allows more in flight
+        self.assertEqual(AsyncHTTPClient.call_args_list[1:],
+                         [((IOLoop.instance.return_value,), {"max_clients": 30, "force_instance": True})] * 2)
+
+    @patch("tornado.httpclient.HTTPClient")
+    def test_sync_client_shared(self, HTTPClient, AsyncHTTPClient, IOLoop):
+        HTTPClient.return_value.fetch.return_value = Mock(code=200)
+        upstream.homestead.fetch_sync("http://homestead/a", method="PUT", body="")
+        response = upstream.homestead.fetch_sync("http://homestead/b")
+        HTTPClient.assert_called_once_with()
+        self.assertEqual(response, HTTPClient.return_value.fetch.return_value)
+        HTTPClient.return_value.fetch.assert_called_with("http://homestead/b",
+                                                         connect_timeout=1,
+                                                         request_timeout=2,
+                                                         allow_ipv6=True)
+
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_ATTEMPTS", new=1)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_MIN_REQUESTS", new=4)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_ERROR_RATE", new=0.5)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_OPEN_SECS", new=10)
+    @patch("metaswitch.ellis.remote.upstream.time")
+    def test_breaker_opens(self, time, AsyncHTTPClient, IOLoop):
+        time.time.return_value = 1000
+        client = AsyncHTTPClient.return_value
+
+        def respond(code):
+            callback = Mock()
+            upstream.homestead.fetch("http://homestead/a", callback)
+            client.fetch.call_args[0][1](Mock(code=code))
+            callback.assert_called_once_with(ANY)
+
+        # Client errors don't count against the backend
+        respond(200)
+        respond(404)
+        respond(500)
+        self.assertEqual(upstream.unavailable_backends(), [])
+        respond(599)
+        self.assertEqual(upstream.unavailable_backends(), [upstream.homestead])
+        self.assertEqual(client.fetch.call_count, 4)
+
+        # Now requests fail without being sent
+        time.time.return_value = 1003
+        callback = Mock()
+        upstream.homestead.fetch("http://homestead/a", callback, method="PUT")
+        self.assertEqual(client.fetch.call_count, 4)
+        IOLoop.instance.return_value.add_callback.call_args[0][0]()
+        response = callback.call_args[0][0]
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.request.method, "PUT")
+        self.assertEqual(response.headers["Retry-After"], "7")
+        self.assertTrue(isinstance(response.error, upstream.BackendUnavailable))
+        self.assertEqual(response.error.backend, "Homestead")
+
+        # Homer is unaffected
+        upstream.xdm.fetch("http://homer/a", Mock())
+        self.assertEqual(client.fetch.call_count, 5)
+
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_ATTEMPTS", new=1)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_MIN_REQUESTS", new=2)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_SLOW_REQUEST_SECS", new=5)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_OPEN_SECS", new=10)
+    @patch("metaswitch.ellis.remote.upstream.time")
+    def test_breaker_trial(self, time, AsyncHTTPClient, IOLoop):
+        time.time.return_value = 1000
+        client = AsyncHTTPClient.return_value
+
+        # Slow requests count as failures
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        time.time.return_value = 1006
+        client.fetch.call_args_list[0][0][1](Mock(code=200))
+        client.fetch.call_args_list[1][0][1](Mock(code=200))
+        self.assertTrue(upstream.homestead.breaker.is_open())
+
+        # Once the breaker has been open for a while, one request is let
+        # through to try the backend again
+        time.time.return_value = 1016
+        self.assertFalse(upstream.homestead.breaker.is_open())
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        self.assertEqual(client.fetch.call_count, 3)
+        self.assertTrue(upstream.homestead.breaker.is_open())
+
+        # It fails, so the breaker opens again
+        client.fetch.call_args[0][1](Mock(code=502))
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        self.assertEqual(client.fetch.call_count, 3)
+
+        # The next trial succeeds, closing the breaker
+        time.time.return_value = 1026
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        client.fetch.call_args[0][1](Mock(code=200))
+        self.assertEqual(upstream.homestead.breaker.state, upstream.CircuitBreaker.CLOSED)
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        self.assertEqual(client.fetch.call_count, 6)
+
+    @patch("metaswitch.ellis.settings.UPSTREAM_MAX_PENDING", new=2)
+    def test_load_shedding(self, AsyncHTTPClient, IOLoop):
+        client = AsyncHTTPClient.return_value
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        callback = Mock()
+        upstream.homestead.fetch("http://homestead/a", callback)
+        self.assertEqual(client.fetch.call_count, 2)
+        IOLoop.instance.return_value.add_callback.call_args[0][0]()
+        self.assertEqual(callback.call_args[0][0].code, 503)
+
+        # The breaker isn't affected
+        self.assertEqual(upstream.unavailable_backends(), [])
+
+        # Once a request completes, there's room for another
+        client.fetch.call_args[0][1](Mock(code=200))
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        self.assertEqual(client.fetch.call_count, 3)
+
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_ATTEMPTS", new=1)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_MIN_REQUESTS", new=1)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_WINDOW", new=0)
+    @patch("metaswitch.ellis.settings.UPSTREAM_MAX_PENDING", new=0)
+    def test_load_shedding_disabled(self, AsyncHTTPClient, IOLoop):
+        client = AsyncHTTPClient.return_value
+        for _ in range(300):
+            upstream.homestead.fetch("http://homestead/a", Mock())
+        for call in client.fetch.call_args_list:
+            call[0][1](Mock(code=500))
+
+        # Every request was sent, and all the failures didn't open the breaker
+        self.assertEqual(client.fetch.call_count, 300)
+        self.assertEqual(upstream.unavailable_backends(), [])
+        upstream.homestead.fetch("http://homestead/a", Mock())
+        self.assertEqual(client.fetch.call_count, 301)
+
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_ATTEMPTS", new=1)
+    @patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_MIN_REQUESTS", new=1)
+    @patch("tornado.httpclient.HTTPClient")
+    def test_sync_breaker(self, HTTPClient, AsyncHTTPClient, IOLoop):
+        HTTPClient.return_value.fetch.side_effect = HTTPError(599)
+        self.assertRaises(HTTPError, upstream.homestead.fetch_sync, "http://homestead/a")
+        self.assertRaises(upstream.BackendUnavailable, upstream.homestead.fetch_sync, "http://homestead/a")
+        self.assertEqual(HTTPClient.return_value.fetch.call_count, 1)
+
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_ATTEMPTS", new=3)
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_BASE_DELAY_SECS", new=0.5)
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_DELAY_SECS", new=0.8)
+    @patch("metaswitch.ellis.remote.upstream.random.uniform", side_effect=lambda low, high: high)
+    @patch("metaswitch.ellis.remote.upstream.time")
+    def test_retry(self, time, uniform, AsyncHTTPClient, IOLoop):
+        time.time.return_value = 1000
+        client = AsyncHTTPClient.return_value
+        io_loop = IOLoop.instance.return_value
+        callback = Mock()
+        upstream.homestead.fetch("http://homestead/a", callback, method="PUT", body="x")
+
+        # Each retry is after a random delay, of up to twice as long as the
+        # last, up to the maximum
+        for delay in (0.5, 0.8):
+            client.fetch.call_args[0][1](Mock(code=503))
+            uniform.assert_called_with(0, delay)
+            io_loop.add_timeout.assert_called_with(1000 + delay, ANY)
+            io_loop.add_timeout.call_args[0][1]()
+        self.assertEqual(client.fetch.call_count, 3)
+        client.fetch.assert_called_with("http://homestead/a", ANY, method="PUT", body="x",
+                                        connect_timeout=1, request_timeout=2, allow_ipv6=True)
+        self.assertFalse(callback.called)
+
+        # The last attempt fails too
+        response = Mock(code=599)
+        client.fetch.call_args[0][1](response)
+        callback.assert_called_once_with(response)
+        self.assertEqual(upstream.stats()["Homestead"],
+                         {"Retries": 2,
+                          "Requests recovered by retrying": 0,
+                          "Requests failed after retrying": 1})
+
+    def test_no_retry(self, AsyncHTTPClient, IOLoop):
+        client = AsyncHTTPClient.return_value
+        io_loop = IOLoop.instance.return_value
+
+        # POSTs aren't idempotent, so aren't retried
+        callback = Mock()
+        upstream.homestead.fetch("http://homestead/a", callback, method="POST", body="")
+        client.fetch.call_args[0][1](Mock(code=500))
+        self.assertEqual(callback.call_count, 1)
+
+        # Nor are requests that ask not to be
+        callback = Mock()
+        upstream.homestead.fetch("http://homestead/a", callback, retry=False)
+        self.assertFalse("retry" in client.fetch.call_args[1])
+        client.fetch.call_args[0][1](Mock(code=500))
+        self.assertEqual(callback.call_count, 1)
+
+        # Nor are client errors
+        callback = Mock()
+        upstream.homestead.fetch("http://homestead/a", callback)
+        client.fetch.call_args[0][1](Mock(code=404))
+        self.assertEqual(callback.call_count, 1)
+        self.assertFalse(io_loop.add_timeout.called)
+
+    @patch("metaswitch.ellis.settings.UPSTREAM_RETRY_BASE_DELAY_SECS", new=1)
+    @patch("metaswitch.ellis.remote.upstream.random.uniform", side_effect=lambda low, high: high)
+    @patch("metaswitch.ellis.remote.upstream.time")
+    def test_retry_deadline(self, time, uniform, AsyncHTTPClient, IOLoop):
+        time.time.return_value = 1000
+        client = AsyncHTTPClient.return_value
+        io_loop = IOLoop.instance.return_value
+
+        with upstream.deadline(1002.5):
+            callback = Mock()
+            upstream.homestead.fetch("http://homestead/a", callback)
+
+        # The retry is only given the time left before the deadline
+        client.fetch.call_args[0][1](Mock(code=500))
+        time.time.return_value = 1001
+        io_loop.add_timeout.call_args[0][1]()
+        self.assertEqual(client.fetch.call_args[1]["request_timeout"], 1.5)
+
+        # There's no time left to retry again
+        client.fetch.call_args[0][1](Mock(code=500))
+        self.assertEqual(callback.call_count, 1)
+        self.assertEqual(client.fetch.call_count, 2)
+
+    @patch("metaswitch.ellis.remote.upstream.random.uniform", side_effect=lambda low, high: high)
+    @patch("metaswitch.ellis.remote.upstream.time")
+    def test_retry_too_late(self, time, uniform, AsyncHTTPClient, IOLoop):
+        time.time.return_value = 1000
+        client = AsyncHTTPClient.return_value
+        io_loop = IOLoop.instance.return_value
+
+        with upstream.deadline(1001):
+            callback = Mock()
+            upstream.homestead.fetch("http://homestead/a", callback)
+        client.fetch.call_args[0][1](Mock(code=500))
+
+        # The retry is due in time, but runs after the deadline, so rather
+        # than being sent without a timeout, it fails
+        time.time.return_value = 1001
+        io_loop.add_timeout.call_args[0][1]()
+        io_loop.add_callback.call_args[0][0]()
+        self.assertEqual(client.fetch.call_count, 1)
+        self.assertEqual(callback.call_args[0][0].code, 599)
+        self.assertEqual(upstream.homestead.stats["Requests failed after retrying"], 1)
+
+    @patch("metaswitch.ellis.remote.upstream.time")
+    @patch("tornado.httpclient.HTTPClient")
+    def test_sync_retry_too_late(self, HTTPClient, time, AsyncHTTPClient, IOLoop):
+        time.time.return_value = 1000
+        time.sleep.side_effect = lambda delay: setattr(time.time, "return_value", 1100)
+        HTTPClient.return_value.fetch.side_effect = [HTTPError(502), Mock(code=200)]
+        with upstream.deadline(1010):
+            self.assertRaises(HTTPError, upstream.homestead.fetch_sync, "http://homestead/a")
+        self.assertEqual(HTTPClient.return_value.fetch.call_count, 1)
+
+    @patch("metaswitch.ellis.remote.upstream.time")
+    @patch("tornado.httpclient.HTTPClient")
+    def test_sync_retry(self, HTTPClient, time, AsyncHTTPClient, IOLoop):
+        time.time.return_value = 1000
+        response = Mock(code=200)
+        HTTPClient.return_value.fetch.side_effect = [HTTPError(502), response]
+        self.assertEqual(upstream.homestead.fetch_sync("http://homestead/a"), response)
+        self.assertEqual(time.sleep.call_count, 1)
+        self.assertEqual(upstream.homestead.stats["Requests recovered by retrying"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,9 +11,9 @@
 
 
 import unittest
-from mock import patch, Mock
+from mock import patch, Mock, ANY
 
-from metaswitch.ellis.remote import xdm
+from metaswitch.ellis.remote import xdm, upstream
 
 SIP_URI = "sip:1234@foo.com"
 XML = """<?xml version="1.0" encoding="UTF-8"?>
@@ -26,6 +26,9 @@ XML = """<?xml version="1.0" encoding="UTF-8"?>
 SIMSERVS_URL = "http://xdm/org.etsi.ngn.simservs/users/sip%3A1234%40foo.com/simservs.xml"
 
 class TestXDM(unittest.TestCase):
+    def setUp(self):
+        upstream.reset()
+
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.xdm.settings")
     def test_get_simservs(self, settings, AsyncHTTPClient):
@@ -37,10 +40,15 @@ class TestXDM(unittest.TestCase):
         xdm.get_simservs(SIP_URI, callback)
 
         client.fetch.assert_called_once_with(SIMSERVS_URL,
-                                             callback,
+                                             ANY,
                                              method="GET",
                                              headers={"X-XCAP-Asserted-Identity": SIP_URI},
-                                             allow_ipv6=True)
+                                             allow_ipv6=True,
+                                             connect_timeout=ANY,
+                                             request_timeout=ANY)
+        response = Mock(code=200)
+        client.fetch.call_args[0][1](response)
+        callback.assert_called_once_with(response)
 
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.xdm.settings")
@@ -53,11 +61,13 @@ class TestXDM(unittest.TestCase):
         xdm.put_simservs(SIP_URI, XML, callback)
 
         client.fetch.assert_called_once_with(SIMSERVS_URL,
-                                             callback,
+                                             ANY,
                                              method="PUT",
                                              body=XML,
                                              headers={"X-XCAP-Asserted-Identity": SIP_URI},
-                                             allow_ipv6=True)
+                                             allow_ipv6=True,
+                                             connect_timeout=ANY,
+                                             request_timeout=ANY)
 
     @patch("tornado.httpclient.AsyncHTTPClient")
     @patch("metaswitch.ellis.remote.xdm.settings")
@@ -70,7 +80,9 @@ class TestXDM(unittest.TestCase):
         xdm.delete_simservs(SIP_URI, callback)
 
         client.fetch.assert_called_once_with(SIMSERVS_URL,
-                                             callback,
+                                             ANY,
                                              method="DELETE",
                                              headers={"X-XCAP-Asserted-Identity": SIP_URI},
-                                             allow_ipv6=True)
+                                             allow_ipv6=True,
+                                             connect_timeout=ANY,
+                                             request_timeout=ANY)
@@ -0,0 +1,60 @@
+# @file create_numbers.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+from StringIO import StringIO
+from mock import patch, MagicMock
+
+from metaswitch.ellis.tools.create_numbers import public_ids, standalone
+
+class TestPublicIds(unittest.TestCase):
+
+    def test_count(self):
+        self.assertEqual(list(public_ids(6505550000, 2, False, "example.com")),
+                         ["sip:6505550000@example.com", "sip:6505550001@example.com"])
+
+    def test_pstn(self):
+        self.assertEqual(list(public_ids(None, 1, True, "example.com")),
+                         ["sip:+15108580271@example.com"])
+
+    def test_ranges(self):
+        self.assertEqual(list(public_ids(None, 1, False, "example.com", ranges="100..101,+44123")),
+                         ["sip:100@example.com", "sip:101@example.com", "sip:+44123@example.com"])
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("metaswitch.ellis.tools.create_numbers.numbers")
+@patch("metaswitch.ellis.tools.create_numbers.connection")
+class TestStandalone(unittest.TestCase):
+
+    def test_batches(self, connection, numbers, stdout):
+        session = connection.Session.return_value
+        batches = []
+        def add_numbers_to_pool(db_sess, batch, pstn, provisionable):
+            batches.append(batch)
+            # The first number is already in the pool
+            return len(batch) - 1 if len(batches) == 1 else len(batch)
+        numbers.add_numbers_to_pool.side_effect = add_numbers_to_pool
+
+        standalone(6505550000, 5, False, "example.com", batch_size=2)
+
+        # Each batch is inserted and committed in turn
+        self.assertEqual(batches, [["sip:6505550000@example.com", "sip:6505550001@example.com"],
+                                   ["sip:6505550002@example.com", "sip:6505550003@example.com"],
+                                   ["sip:6505550004@example.com"]])
+        self.assertEqual(session.commit.call_count, 3)
+        self.assertIn("Created 4 numbers, 1 already present", stdout.getvalue())
+
+    def test_no_numbers(self, connection, numbers, stdout):
+        standalone(None, 1, False, "example.com", ranges="100..1000")
+        self.assertFalse(numbers.add_numbers_to_pool.called)
+        self.assertIn("Created 0 numbers", stdout.getvalue())
+
+if __name__ == "__main__":
+    unittest.main()
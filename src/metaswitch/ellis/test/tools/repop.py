@@ -0,0 +1,162 @@
+# @file repop.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import json
+import unittest
+from StringIO import StringIO
+from mock import patch, MagicMock, ANY
+
+from metaswitch.ellis.tools import repop
+from metaswitch.ellis.tools.repop import Repopulator, ALL, DIGESTS, SIMSERVS
+
+SIP_URI = "sip:6505550000@example.com"
+PRIVATE_ID = "6505550000@example.com"
+LAST_MODIFIED = "2016-01-01 00:00:00"
+ITEM = (SIP_URI, True, LAST_MODIFIED)
+
+def response(code, body=None):
+    return MagicMock(code=code, body=json.dumps(body) if body is not None else "")
+
+def responds(*responses):
+    """Returns a side effect for a homestead or xdm function that passes its
+    callback each of responses in turn."""
+    responses = list(responses)
+    def side_effect(*args, **kwargs):
+        args[-1](responses.pop(0))
+    return side_effect
+
+PRIVATES = response(200, {"private_ids": [PRIVATE_ID]})
+OK = response(200)
+NOT_FOUND = response(404)
+ERROR = response(500)
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("metaswitch.ellis.tools.repop.ifc_cache")
+@patch("metaswitch.ellis.tools.repop.default_simservs")
+@patch("metaswitch.ellis.tools.repop.xdm")
+@patch("metaswitch.ellis.tools.repop.homestead")
+class TestRepopulator(unittest.TestCase):
+
+    def setUp(self):
+        self.callback = MagicMock()
+
+    def test_all_present(self, homestead, xdm, simservs, ifc_cache, stdout):
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(OK)
+        homestead.get_filter_criteria.side_effect = responds(OK)
+        xdm.get_simservs.side_effect = responds(OK)
+        repopulator = Repopulator(ALL)
+        repopulator(ITEM, self.callback)
+        self.callback.assert_called_once_with(True)
+        homestead.get_digest.assert_called_once_with(PRIVATE_ID, ANY)
+        self.assertFalse(homestead.put_password.called)
+        self.assertFalse(homestead.put_filter_criteria.called)
+        self.assertFalse(xdm.put_simservs.called)
+        self.assertEqual(repopulator.stats["Lines checked"], 1)
+
+    def test_missing(self, homestead, xdm, simservs, ifc_cache, stdout):
+        # Whatever is missing is put back and read back
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(NOT_FOUND, OK)
+        homestead.put_password.side_effect = responds(OK)
+        homestead.get_filter_criteria.side_effect = responds(NOT_FOUND, OK)
+        homestead.put_filter_criteria.side_effect = responds(OK)
+        xdm.get_simservs.side_effect = responds(NOT_FOUND, OK)
+        xdm.put_simservs.side_effect = responds(OK)
+        repopulator = Repopulator(ALL)
+        repopulator(ITEM, self.callback)
+        self.callback.assert_called_once_with(True)
+        homestead.put_password.assert_called_once_with(PRIVATE_ID, "example.com", ANY, ANY)
+        homestead.put_filter_criteria.assert_called_once_with(SIP_URI, ifc_cache.default_ifcs.return_value, ANY)
+        ifc_cache.default_ifcs.assert_called_with("example.com")
+        xdm.put_simservs.assert_called_once_with(SIP_URI, simservs.return_value, ANY)
+        self.assertEqual(homestead.get_digest.call_count, 2)
+        self.assertEqual((repopulator.stats["Digests re-created"],
+                          repopulator.stats["IFCs re-created"],
+                          repopulator.stats["Simservs re-created"]), (1, 1, 1))
+
+    def test_recreate_line(self, homestead, xdm, simservs, ifc_cache, stdout):
+        homestead.get_associated_privates.side_effect = responds(NOT_FOUND)
+        homestead.create_private_id.side_effect = responds(OK)
+        homestead.create_public_id.side_effect = responds(OK)
+        repopulator = Repopulator([DIGESTS])
+        repopulator(ITEM, self.callback)
+        self.callback.assert_called_once_with(True)
+        homestead.create_private_id.assert_called_once_with(PRIVATE_ID, "example.com", ANY, ANY)
+        homestead.create_public_id.assert_called_once_with(PRIVATE_ID, SIP_URI,
+                                                           ifc_cache.default_ifcs.return_value, ANY)
+        self.assertEqual(repopulator.stats["Lines re-created"], 1)
+
+    def test_simservs_only(self, homestead, xdm, simservs, ifc_cache, stdout):
+        xdm.get_simservs.side_effect = responds(OK)
+        Repopulator([SIMSERVS])(ITEM, self.callback)
+        self.callback.assert_called_once_with(True)
+        self.assertFalse(homestead.get_associated_privates.called)
+        self.assertFalse(homestead.get_filter_criteria.called)
+
+    def test_error(self, homestead, xdm, simservs, ifc_cache, stdout):
+        # A failure in Homestead fails the line, but Homer is still
+        # repopulated
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(ERROR)
+        xdm.get_simservs.side_effect = responds(NOT_FOUND, OK)
+        xdm.put_simservs.side_effect = responds(OK)
+        repopulator = Repopulator(ALL)
+        repopulator(ITEM, self.callback)
+        self.callback.assert_called_once_with(False)
+        self.assertFalse(homestead.get_filter_criteria.called)
+        self.assertTrue(xdm.put_simservs.called)
+        self.assertEqual(repopulator.stats["Errors"], 1)
+
+    def test_put_not_read_back(self, homestead, xdm, simservs, ifc_cache, stdout):
+        xdm.get_simservs.side_effect = responds(NOT_FOUND, NOT_FOUND)
+        xdm.put_simservs.side_effect = responds(OK)
+        repopulator = Repopulator([SIMSERVS])
+        repopulator(ITEM, self.callback)
+        self.callback.assert_called_once_with(False)
+        self.assertEqual(repopulator.stats["Errors"], 1)
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_WINDOW", new=20)
+@patch("metaswitch.ellis.settings.UPSTREAM_MAX_PENDING", new=200)
+@patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_ATTEMPTS", new=2)
+@patch("metaswitch.ellis.settings.UPSTREAM_RETRY_BASE_DELAY_SECS", new=0.1)
+@patch("metaswitch.ellis.settings.UPSTREAM_RETRY_MAX_DELAY_SECS", new=1)
+@patch("metaswitch.ellis.settings.UPSTREAM_RETRY_DEADLINE_SECS", new=5)
+@patch("metaswitch.ellis.tools.repop.AsyncHTTPClient")
+@patch("metaswitch.ellis.tools.repop.upstream")
+@patch("metaswitch.ellis.tools.repop.connection")
+@patch("metaswitch.ellis.tools.repop.numbers")
+@patch("metaswitch.ellis.tools.repop.BulkRunner")
+class TestStandalone(unittest.TestCase):
+
+    def test_standalone(self, bulk_runner, numbers, connection, upstream, client, stdout):
+        stream_session = MagicMock()
+        db_session = MagicMock()
+        connection.Session.side_effect = [stream_session, db_session]
+        bulk_runner.return_value.run.return_value = True
+        upstream.stats.return_value = {}
+        self.assertTrue(repop.standalone(ALL, 10, rate=5))
+
+        # Only assigned numbers are repopulated, from the checkpoint
+        args, kwargs = bulk_runner.call_args
+        args[0]("sip:6505550000@example.com")
+        numbers.iter_numbers.assert_called_once_with(stream_session,
+                                                     after="sip:6505550000@example.com",
+                                                     assigned_only=True)
+        kwargs["total"](None)
+        numbers.count_numbers.assert_called_once_with(db_session, after=None, assigned_only=True)
+        self.assertEqual(kwargs["rate"], 5)
+        upstream.set_max_in_flight.assert_called_once_with(10)
+        stream_session.close.assert_called_once_with()
+        db_session.close.assert_called_once_with()
+
+if __name__ == "__main__":
+    unittest.main()
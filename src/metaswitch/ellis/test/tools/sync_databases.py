@@ -0,0 +1,272 @@
+# @file sync_databases.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import json
+import unittest
+from StringIO import StringIO
+from mock import patch, MagicMock, ANY
+
+from metaswitch.ellis.data import NotFound
+from metaswitch.ellis.tools import sync_databases
+from metaswitch.ellis.tools.sync_databases import (LineSyncer, DiffWriter, read_diff,
+                                                   DELETE_LINE, DELETE_REMOTE,
+                                                   PUT_DEFAULT_IFC)
+
+SIP_URI = "sip:6505550000@example.com"
+PRIVATE_ID = "6505550000@example.com"
+LAST_MODIFIED = "2016-01-01 00:00:00"
+
+def response(code, body=None):
+    return MagicMock(code=code, body=json.dumps(body) if body is not None else "")
+
+def responds(*responses):
+    """Returns a side effect for a homestead or xdm function that passes its
+    callback each of responses in turn."""
+    responses = list(responses)
+    def side_effect(*args, **kwargs):
+        args[-1](responses.pop(0))
+    return side_effect
+
+PRIVATES = response(200, {"private_ids": [PRIVATE_ID]})
+OK = response(200)
+NOT_FOUND = response(404)
+ERROR = response(500)
+
+def entry(action, reason, private_id=None, assigned=True):
+    return {"number": SIP_URI,
+            "assigned": assigned,
+            "last_modified": LAST_MODIFIED,
+            "action": action,
+            "private_id": private_id,
+            "reason": reason}
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("metaswitch.ellis.tools.sync_databases.numbers")
+@patch("metaswitch.ellis.tools.sync_databases.xdm")
+@patch("metaswitch.ellis.tools.sync_databases.homestead")
+class TestLineSyncer(unittest.TestCase):
+
+    def setUp(self):
+        self.db_session = MagicMock()
+        self.syncer = LineSyncer(self.db_session)
+        self.callback = MagicMock()
+
+    def check(self, assigned=True):
+        self.syncer.check((SIP_URI, assigned, LAST_MODIFIED), self.callback)
+
+    def test_check_consistent(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(OK)
+        homestead.get_filter_criteria.side_effect = responds(OK)
+        self.check()
+        self.callback.assert_called_once_with(True, None)
+        homestead.get_digest.assert_called_once_with(PRIVATE_ID, ANY)
+        self.assertEqual(self.syncer.stats["Inconsistent lines"], 0)
+
+    def test_check_no_private_id(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(NOT_FOUND)
+        self.check()
+        self.callback.assert_called_once_with(True, entry(DELETE_LINE, "No private ID in Homestead"))
+        self.assertEqual(self.syncer.stats["Inconsistent lines"], 1)
+
+    def test_check_no_digest(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(NOT_FOUND)
+        self.check()
+        self.callback.assert_called_once_with(True, entry(DELETE_LINE, "No digest in Homestead", PRIVATE_ID))
+        self.assertFalse(homestead.get_filter_criteria.called)
+
+    def test_check_no_ifc(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(OK)
+        homestead.get_filter_criteria.side_effect = responds(NOT_FOUND)
+        self.check()
+        self.callback.assert_called_once_with(True, entry(PUT_DEFAULT_IFC, "No iFC in Homestead"))
+
+    def test_check_unassigned_private_id(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        self.check(assigned=False)
+        self.callback.assert_called_once_with(
+            True,
+            entry(DELETE_REMOTE, "Unassigned number has a private ID in Homestead", PRIVATE_ID, assigned=False))
+        self.assertEqual(self.syncer.stats["Unassigned numbers in Ellis"], 1)
+
+    def test_check_unassigned_simservs(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(NOT_FOUND)
+        xdm.get_simservs.side_effect = responds(OK)
+        self.check(assigned=False)
+        self.callback.assert_called_once_with(
+            True,
+            entry(DELETE_REMOTE, "Unassigned number has simservs in Homer", assigned=False))
+
+    def test_check_unassigned_consistent(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(NOT_FOUND)
+        xdm.get_simservs.side_effect = responds(NOT_FOUND)
+        self.check(assigned=False)
+        self.callback.assert_called_once_with(True, None)
+
+    def test_check_error(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(ERROR)
+        self.check()
+        self.callback.assert_called_once_with(False, None)
+        self.assertEqual(self.syncer.stats["Errors"], 1)
+
+    def test_sync_consistent(self, homestead, xdm, numbers, stdout):
+        # A consistent line is just marked as verified
+        homestead.get_associated_privates.side_effect = responds(PRIVATES)
+        homestead.get_digest.side_effect = responds(OK)
+        homestead.get_filter_criteria.side_effect = responds(OK)
+        self.syncer.sync((SIP_URI, True, LAST_MODIFIED), self.callback)
+        self.callback.assert_called_once_with(True)
+        numbers.mark_verified.assert_called_once_with(self.db_session, SIP_URI, LAST_MODIFIED)
+        self.assertFalse(homestead.put_filter_criteria.called)
+
+    def test_sync_error(self, homestead, xdm, numbers, stdout):
+        # A line that couldn't be checked isn't marked as verified
+        homestead.get_associated_privates.side_effect = responds(ERROR)
+        self.syncer.sync((SIP_URI, True, LAST_MODIFIED), self.callback)
+        self.callback.assert_called_once_with(False)
+        self.assertFalse(numbers.mark_verified.called)
+
+    def test_repair_delete_line(self, homestead, xdm, numbers, stdout):
+        homestead.get_associated_publics.side_effect = responds(
+            response(200, {"associated_public_ids": [SIP_URI]}))
+        homestead.delete_private_id.side_effect = responds(OK)
+        xdm.delete_simservs.side_effect = responds(OK)
+        self.syncer.repair(entry(DELETE_LINE, "No digest in Homestead", PRIVATE_ID), self.callback)
+        self.callback.assert_called_once_with(True)
+        numbers.remove_owner.assert_called_once_with(self.db_session, SIP_URI)
+        # The private ID goes with its only public ID
+        homestead.delete_private_id.assert_called_once_with(PRIVATE_ID, ANY)
+        self.assertFalse(homestead.delete_public_id.called)
+        xdm.delete_simservs.assert_called_once_with(SIP_URI, ANY)
+        numbers.mark_verified.assert_called_once_with(self.db_session, SIP_URI, LAST_MODIFIED)
+
+    def test_repair_delete_remote_shared(self, homestead, xdm, numbers, stdout):
+        # A private ID with other public IDs is kept
+        homestead.get_associated_publics.side_effect = responds(
+            response(200, {"associated_public_ids": [SIP_URI, "sip:other@example.com"]}))
+        homestead.delete_public_id.side_effect = responds(OK)
+        xdm.delete_simservs.side_effect = responds(NOT_FOUND)
+        self.syncer.repair(entry(DELETE_REMOTE, "", PRIVATE_ID, assigned=False), self.callback)
+        self.callback.assert_called_once_with(True)
+        homestead.delete_public_id.assert_called_once_with(SIP_URI, ANY)
+        self.assertFalse(homestead.delete_private_id.called)
+        self.assertFalse(numbers.remove_owner.called)
+
+    def test_repair_delete_remote_error(self, homestead, xdm, numbers, stdout):
+        xdm.delete_simservs.side_effect = responds(ERROR)
+        self.syncer.repair(entry(DELETE_REMOTE, "", assigned=False), self.callback)
+        self.callback.assert_called_once_with(False)
+        self.assertFalse(homestead.get_associated_publics.called)
+        self.assertFalse(numbers.mark_verified.called)
+
+    @patch("metaswitch.ellis.tools.sync_databases.ifc_cache")
+    def test_repair_put_default_ifc(self, ifc_cache, homestead, xdm, numbers, stdout):
+        homestead.put_filter_criteria.side_effect = responds(OK)
+        self.syncer.repair(entry(PUT_DEFAULT_IFC, "No iFC in Homestead"), self.callback)
+        self.callback.assert_called_once_with(True)
+        ifc_cache.default_ifcs.assert_called_once_with("example.com")
+        homestead.put_filter_criteria.assert_called_once_with(SIP_URI, ifc_cache.default_ifcs.return_value, ANY)
+        self.assertEqual(self.syncer.stats["Missing IFCs re-created"], 1)
+
+    def test_repair_unknown_action(self, homestead, xdm, numbers, stdout):
+        self.syncer.repair(entry("bogus", ""), self.callback)
+        self.callback.assert_called_once_with(False)
+        self.assertEqual(self.syncer.stats["Errors"], 1)
+
+    def test_apply(self, homestead, xdm, numbers, stdout):
+        numbers.get_last_modified.return_value = LAST_MODIFIED
+        xdm.delete_simservs.side_effect = responds(OK)
+        self.syncer.apply(entry(DELETE_REMOTE, "", assigned=False), self.callback)
+        self.callback.assert_called_once_with(True)
+        numbers.get_last_modified.assert_called_once_with(self.db_session, SIP_URI)
+        xdm.delete_simservs.assert_called_once_with(SIP_URI, ANY)
+
+    def test_apply_stale(self, homestead, xdm, numbers, stdout):
+        # Lines that have changed since the diff was made are left alone
+        numbers.get_last_modified.return_value = "2016-01-02 00:00:00"
+        self.syncer.apply(entry(DELETE_LINE, "No private ID in Homestead"), self.callback)
+        self.callback.assert_called_once_with(True)
+        self.assertFalse(numbers.remove_owner.called)
+        self.assertFalse(xdm.delete_simservs.called)
+        self.assertEqual(self.syncer.stats["Stale diff entries skipped"], 1)
+
+    def test_apply_removed(self, homestead, xdm, numbers, stdout):
+        numbers.get_last_modified.side_effect = NotFound()
+        self.syncer.apply(entry(DELETE_LINE, "No private ID in Homestead"), self.callback)
+        self.callback.assert_called_once_with(True)
+        self.assertFalse(numbers.remove_owner.called)
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("metaswitch.ellis.tools.sync_databases.numbers")
+@patch("metaswitch.ellis.tools.sync_databases.xdm")
+@patch("metaswitch.ellis.tools.sync_databases.homestead")
+class TestDiff(unittest.TestCase):
+
+    def test_round_trip(self, homestead, xdm, numbers, stdout):
+        # Only the inconsistent line is written to the diff, and nothing is
+        # changed or marked as verified
+        homestead.get_associated_privates.side_effect = responds(NOT_FOUND, PRIVATES)
+        homestead.get_digest.side_effect = responds(OK)
+        homestead.get_filter_criteria.side_effect = responds(OK)
+        syncer = LineSyncer(MagicMock())
+        f = StringIO()
+        writer = DiffWriter(syncer, f)
+        callback = MagicMock()
+        writer((SIP_URI, True, LAST_MODIFIED), callback)
+        writer(("sip:6505550001@example.com", True, LAST_MODIFIED), callback)
+        self.assertEqual(callback.call_args_list, [((True,),), ((True,),)])
+        self.assertFalse(numbers.remove_owner.called)
+        self.assertFalse(numbers.mark_verified.called)
+
+        # Reading the diff back gives the entry to apply, skipping blank lines
+        f = StringIO(f.getvalue() + "\n")
+        self.assertEqual(list(read_diff(f)), [entry(DELETE_LINE, "No private ID in Homestead")])
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("metaswitch.ellis.settings.UPSTREAM_BREAKER_WINDOW", new=20)
+@patch("metaswitch.ellis.settings.UPSTREAM_MAX_PENDING", new=200)
+@patch("metaswitch.ellis.tools.sync_databases.AsyncHTTPClient")
+@patch("metaswitch.ellis.tools.sync_databases.upstream")
+@patch("metaswitch.ellis.tools.sync_databases.connection")
+@patch("metaswitch.ellis.tools.sync_databases.numbers")
+@patch("metaswitch.ellis.tools.sync_databases.BulkRunner")
+class TestStandalone(unittest.TestCase):
+
+    def run_standalone(self, connection, bulk_runner, **kwargs):
+        self.stream_session = MagicMock()
+        connection.Session.side_effect = [self.stream_session, MagicMock()]
+        bulk_runner.return_value.run.return_value = True
+        self.assertTrue(sync_databases.standalone(10, **kwargs))
+        return bulk_runner.call_args
+
+    def test_incremental(self, bulk_runner, numbers, connection, upstream, client, stdout):
+        args, kwargs = self.run_standalone(connection, bulk_runner, max_age_secs=86400)
+        # The lines are listed from the checkpoint, leaving out those
+        # verified recently
+        lines = args[0]
+        lines("sip:6505550000@example.com")
+        numbers.iter_numbers.assert_called_once_with(self.stream_session,
+                                                     after="sip:6505550000@example.com",
+                                                     max_age_secs=86400)
+        self.assertEqual(kwargs["window"], 10)
+        upstream.set_max_in_flight.assert_called_once_with(10)
+
+    def test_full(self, bulk_runner, numbers, connection, upstream, client, stdout):
+        args, kwargs = self.run_standalone(connection, bulk_runner)
+        args[0](None)
+        numbers.iter_numbers.assert_called_once_with(self.stream_session,
+                                                     after=None,
+                                                     max_age_secs=None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,38 +9,61 @@
 # Otherwise no rights are granted except for those provided to you by
 # Metaswitch Networks in a separate written agreement.
 
+"""
+Adds numbers to the pool of numbers available for allocation.
 
+The numbers are given either as --start and --count, or as --ranges of the
+form <start-dn>..<end-dn>,<single-dn>,...  They are generated as they're
+inserted, in batches of --batch-size rows per INSERT, so that even a pool of
+millions of numbers is loaded in minutes.  Numbers already in the pool are
+left as they are.
+"""
+
+import time
 import logging
+import itertools
 
 from optparse import OptionParser
 
 from metaswitch.ellis.data import numbers, connection
-from sqlalchemy.exc import IntegrityError
+from metaswitch.ellis.bulk import parse_dn_ranges
 from metaswitch.ellis import settings
 from metaswitch.common import utils, logging_config
 
 _log = logging.getLogger("ellis.create_numbers")
 
-def standalone(start, num, pstn, realm):
+def public_ids(start, num, pstn, realm, ranges=None):
+    """A generator yielding the public ID of each number to add."""
+    if ranges:
+        dns = parse_dn_ranges(ranges)
+    else:
+        if not start:
+            start = 5108580271 if pstn else 6505550000
+        dns = (("+1%d" if pstn else "%d") % n for n in xrange(start, start + num))
+    for dn in dns:
+        yield "sip:%s@%s" % (dn, realm)
+
+def standalone(start, num, pstn, realm, ranges=None, batch_size=1000):
     connection.init_connection()
     s = connection.Session()
+    ids = public_ids(start, num, pstn, realm, ranges)
     create_count = 0
-    if not start:
-        start = 5108580271 if pstn else 6505550000
-    for x in xrange(num):
-        if pstn:
-            public_id = "sip:+1%d@%s" % (start + x, realm)
-        else:
-            public_id = "sip:%d@%s" % (start + x, realm)
-        try:
-            numbers.add_number_to_pool(s, public_id, pstn, False)
-        except IntegrityError:
-            # Entry already exists, not creating in db
-            pass
-        else:
-            create_count += 1
-    s.commit()
-    print "Created %d numbers, %d already present in database" % (create_count, num - create_count)
+    total = 0
+    start_time = last_report = time.time()
+    while True:
+        batch = list(itertools.islice(ids, batch_size))
+        if not batch:
+            break
+        create_count += numbers.add_numbers_to_pool(s, batch, pstn, False)
+        s.commit()
+        total += len(batch)
+        now = time.time()
+        if now - last_report >= 1:
+            print "Processed %d numbers - %d rows/s" % (total, total / (now - start_time))
+            last_report = now
+    elapsed = time.time() - start_time
+    print "Created %d numbers, %d already present in database (%d rows/s)" % \
+        (create_count, total - create_count, total / elapsed if elapsed else total)
 
 if __name__ == '__main__':
     parser = OptionParser()
@@ -55,6 +78,15 @@ if __name__ == '__main__':
                       type="int",
                       default=1,
                       help="Create this many numbers, if not specified, only one number will be created")
+    parser.add_option("--ranges",
+                      dest="ranges",
+                      type="string",
+                      help="Create the numbers in these ranges, of the form <start-dn>..<end-dn>,<single-dn>,... rather than --start and --count")
+    parser.add_option("--batch-size",
+                      dest="batch_size",
+                      type="int",
+                      default=1000,
+                      help="Insert this many numbers at a time (default: 1000)")
     parser.add_option("-p",
                       "--pstn",
                       action="store_true",
@@ -73,7 +105,7 @@ if __name__ == '__main__':
                       type="int")
     (options, args) = parser.parse_args()
 
-    if args:
+    if args or options.batch_size < 1:
         parser.print_help()
     else:
         logging_config.configure_logging(
@@ -82,4 +114,9 @@ if __name__ == '__main__':
                 settings.LOG_FILE_PREFIX,
                 "create_db")
 
-        standalone(options.start, options.num, options.pstn, options.realm)
+        standalone(options.start,
+                   options.num,
+                   options.pstn,
+                   options.realm,
+                   ranges=options.ranges,
+                   batch_size=options.batch_size)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+# @file repop.py
+#
+# Copyright (C) Metaswitch Networks 2016
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Re-seeds Homestead and Homer with the lines assigned in Ellis, for example
+after either has been rebuilt.
+
+For each assigned number, whatever of the following is missing is put back:
+- digests: the private ID and its digest in Homestead.  A line with no
+  private ID at all is re-created, with the default iFC.  A private ID with
+  no digest is given a new, randomly generated password, which the
+  subscriber will need to reset through Ellis;
+- ifcs: the iFC in Homestead, as the default for the line's domain;
+- simservs: the simservs document in Homer, as the default.
+
+Anything already present is left alone, and anything put back is read back
+to check that it took.
+
+The numbers are streamed from the database in order, with up to --window
+lines in flight at once, and at most --rate lines started each second.
+Requests that fail with a server error are retried with backoff, more
+patiently than when handling a user's request.
+If --checkpoint is given, progress is recorded there so that an interrupted
+run can be resumed.
+"""
+
+import sys
+import json
+import logging
+
+from functools import partial
+from optparse import OptionParser
+
+from tornado.httpclient import AsyncHTTPClient
+
+from metaswitch.common import utils, logging_config
+from metaswitch.common.simservs import default_simservs
+from metaswitch.ellis.data import numbers, connection
+from metaswitch.ellis.remote import homestead, xdm, upstream
+from metaswitch.ellis.bulk import BulkRunner
+from metaswitch.ellis import settings, ifc_cache
+
+_log = logging.getLogger("ellis.repop")
+
+DIGESTS = "digests"
+IFCS = "ifcs"
+SIMSERVS = "simservs"
+ALL = (DIGESTS, IFCS, SIMSERVS)
+
+# How many times to try a request that fails with a server error (or doesn't
+# get a response at all), how long to back off between tries, and how long to
+# keep trying for - see the UPSTREAM_RETRY_* settings.  The breakers and the
+# limit on pending requests are disabled: the window bounds the load on the
+# backends, and a struggling backend should slow the run down rather than
+# fail every line in it.
+MAX_ATTEMPTS = 5
+RETRY_INITIAL_DELAY_SEC = 0.5
+RETRY_MAX_DELAY_SEC = 10
+RETRY_DEADLINE_SEC = 120
+
+class Repopulator(object):
+    """Puts back whatever is missing for a line, as the job for a
+    BulkRunner."""
+
+    def __init__(self, what):
+        self._what = what
+        self._simservs = default_simservs()
+        self.stats = {"Lines checked": 0,
+                      "Lines re-created": 0,
+                      "Digests re-created": 0,
+                      "IFCs re-created": 0,
+                      "Simservs re-created": 0,
+                      "Errors": 0}
+
+    def __call__(self, item, callback):
+        sip_uri = item[0]
+        self.stats["Lines checked"] += 1
+        steps = []
+        if DIGESTS in self._what or IFCS in self._what:
+            steps.append(self._repop_homestead)
+        if SIMSERVS in self._what:
+            steps.append(self._repop_homer)
+
+        # Homestead and Homer are repopulated at once
+        state = {"outstanding": len(steps), "success": True}
+
+        def on_step_done(success):
+            state["success"] = state["success"] and success
+            state["outstanding"] -= 1
+            if state["outstanding"] == 0:
+                callback(state["success"])
+
+        for step in steps:
+            step(sip_uri, on_step_done)
+
+    def _repop_homestead(self, sip_uri, callback):
+        domain = utils.sip_uri_to_domain(sip_uri)
+
+        def repop_ifc(success=True):
+            if not success or IFCS not in self._what:
+                callback(success)
+                return
+            self._ensure(sip_uri,
+                         "IFCs",
+                         partial(homestead.get_filter_criteria, sip_uri),
+                         partial(homestead.put_filter_criteria,
+                                 sip_uri,
+                                 ifc_cache.default_ifcs(domain)),
+                         callback)
+
+        def on_got_privates(response):
+            if response.code == 404:
+                self._recreate_line(sip_uri, domain, callback)
+            elif response.code != 200:
+                self._error("GET", sip_uri, response)
+                callback(False)
+            else:
+                try:
+                    private_id = json.loads(response.body)["private_ids"][0]
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    _log.error("Unexpected response to GET of private IDs for %s: %r (%s)",
+                               sip_uri, response.body, e)
+                    callback(False)
+                    return
+                self._ensure(sip_uri,
+                             "Digests",
+                             partial(homestead.get_digest, private_id),
+                             partial(homestead.put_password,
+                                     private_id,
+                                     domain,
+                                     utils.generate_sip_password()),
+                             repop_ifc)
+
+        if DIGESTS in self._what:
+            homestead.get_associated_privates(sip_uri, on_got_privates)
+        else:
+            repop_ifc()
+
+    def _repop_homer(self, sip_uri, callback):
+        self._ensure(sip_uri,
+                     "Simservs",
+                     partial(xdm.get_simservs, sip_uri),
+                     partial(xdm.put_simservs, sip_uri, self._simservs),
+                     callback)
+
+    def _recreate_line(self, sip_uri, domain, callback):
+        """Re-creates a line that Homestead has no record of, as when the line
+        was first created."""
+        print "Re-creating %s" % sip_uri
+        private_id = utils.sip_public_id_to_private(sip_uri)
+
+        def on_private_id_created(response):
+            if response.code >= 300:
+                self._error("POST", sip_uri, response)
+                callback(False)
+                return
+            homestead.create_public_id(private_id,
+                                       sip_uri,
+                                       ifc_cache.default_ifcs(domain),
+                                       on_public_id_created)
+
+        def on_public_id_created(response):
+            if response.code >= 300:
+                self._error("POST", sip_uri, response)
+                callback(False)
+                return
+            self.stats["Lines re-created"] += 1
+            callback(True)
+
+        homestead.create_private_id(private_id,
+                                    domain,
+                                    utils.generate_sip_password(),
+                                    on_private_id_created)
+
+    def _ensure(self, sip_uri, what, get, put, callback):
+        """
+        Makes sure that a resource exists, by GETting it, and if there's
+        nothing there, PUTting it and GETting it again to check.  get and put
+        each take just a callback.  Passes callback whether the resource now
+        exists.
+        """
+        def on_get(response):
+            if response.code == 200:
+                callback(True)
+            elif response.code == 404:
+                print "%s %s needs to be repopulated" % (sip_uri, what)
+                put(on_put)
+            else:
+                self._error("GET", sip_uri, response)
+                callback(False)
+
+        def on_put(response):
+            if response.code >= 300:
+                self._error("PUT", sip_uri, response)
+                callback(False)
+                return
+            self.stats["%s re-created" % what] += 1
+            get(on_check)
+
+        def on_check(response):
+            if response.code != 200:
+                self._error("GET", sip_uri, response)
+            callback(response.code == 200)
+
+        get(on_get)
+
+    def _error(self, method, sip_uri, response):
+        print "Error %s while %s for %s" % (response.code, method, sip_uri)
+        self.stats["Errors"] += 1
+
+def print_summary(stats):
+    print "\nSummary:"
+    table_format = "{:<40}{}"
+    for s in sorted(stats):
+        print table_format.format(s, stats[s])
+
+def standalone(what, window, rate=None, checkpoint_file=None, stats_file=None, keep_going=False):
+    """Entry point to script"""
+    AsyncHTTPClient.configure(settings.UPSTREAM_HTTP_CLIENT)
+    upstream.set_max_in_flight(window)
+    settings.UPSTREAM_RETRY_MAX_ATTEMPTS = MAX_ATTEMPTS
+    settings.UPSTREAM_RETRY_BASE_DELAY_SECS = RETRY_INITIAL_DELAY_SEC
+    settings.UPSTREAM_RETRY_MAX_DELAY_SECS = RETRY_MAX_DELAY_SEC
+    settings.UPSTREAM_RETRY_DEADLINE_SECS = RETRY_DEADLINE_SEC
+    settings.UPSTREAM_BREAKER_WINDOW = 0
+    settings.UPSTREAM_MAX_PENDING = 0
+    connection.init_connection()
+    # The numbers are streamed over their own connection, which is busy
+    # until they've all been read.
+    stream_session = connection.Session()
+    db_session = connection.Session()
+
+    repopulator = Repopulator(what)
+    runner = BulkRunner(lambda checkpoint: numbers.iter_numbers(stream_session,
+                                                                after=checkpoint,
+                                                                assigned_only=True),
+                        repopulator,
+                        window,
+                        checkpoint_file=checkpoint_file,
+                        keep_going=keep_going,
+                        verb="Repopulated",
+                        item_id=lambda item: item[0],
+                        rate=rate,
+                        total=lambda checkpoint: numbers.count_numbers(db_session,
+                                                                       after=checkpoint,
+                                                                       assigned_only=True))
+    success = runner.run()
+    stream_session.close()
+    db_session.close()
+
+    stats = dict(repopulator.stats)
+    for backend, backend_stats in upstream.stats().iteritems():
+        for name, value in backend_stats.iteritems():
+            stats["%s: %s" % (backend, name)] = value
+    print_summary(stats)
+    if stats_file:
+        with open(stats_file, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+    return success
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--log-level",
+                      dest="log_level",
+                      default=2,
+                      type="int")
+    parser.add_option("--what",
+                      dest="what",
+                      default=",".join(ALL),
+                      help="comma-separated list of what to repopulate, from %s (default: all)" % ", ".join(ALL))
+    parser.add_option("--window",
+                      dest="window",
+                      default=20,
+                      type="int",
+                      help="number of lines to repopulate at once (default: 20)")
+    parser.add_option("--rate",
+                      dest="rate",
+                      type="float",
+                      help="maximum number of lines to start each second (default: no limit)")
+    parser.add_option("--checkpoint",
+                      dest="checkpoint_file",
+                      metavar="FILE",
+                      help="file recording progress, to resume from if it exists")
+    parser.add_option("--stats-file",
+                      dest="stats_file",
+                      metavar="FILE",
+                      help="file to write the summary to, as JSON")
+    parser.add_option("-k", "--keep-going",
+                      dest="keep_going",
+                      action="store_true",
+                      default=False,
+                      help="keep going when a line can't be repopulated")
+    (options, args) = parser.parse_args()
+
+    what = [w.strip() for w in options.what.split(",") if w.strip()]
+    if args or not what or any(w not in ALL for w in what):
+        parser.print_help()
+    else:
+        logging_config.configure_logging(
+                utils.map_clearwater_log_level(options.log_level),
+                settings.LOGS_DIR,
+                settings.LOG_FILE_PREFIX,
+                "repop")
+
+        success = standalone(what,
+                             options.window,
+                             rate=options.rate,
+                             checkpoint_file=options.checkpoint_file,
+                             stats_file=options.stats_file,
+                             keep_going=options.keep_going)
+        sys.exit(0 if success else 1)
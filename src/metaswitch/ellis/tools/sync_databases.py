@@ -9,203 +9,323 @@
 # Otherwise no rights are granted except for those provided to you by
 # Metaswitch Networks in a separate written agreement.
 
+"""
+Brings Homestead and Homer into line with the numbers in Ellis.
 
-import logging
+For each number that Ellis thinks is assigned:
+- if Homestead has no private ID or digest for it, the line is deleted;
+- if Homestead has no iFC for it, the default iFC is put back.
+
+For each number that Ellis thinks is unassigned, any record of it is
+removed from Homestead and Homer.
+
+The numbers are streamed from the database in order, and checked with up to
+--window lines in flight at once.  If --checkpoint is given, progress is
+recorded there so that an interrupted run can be resumed.
+
+Each line checked successfully is marked as verified.  With --incremental,
+only lines that have changed since they were last verified, or that haven't
+been verified for --max-age days, are checked, so that regular runs scale
+with the churn in lines rather than with the number of lines.
+
+With --audit FILE, nothing is changed: what needs repairing is written to
+FILE, one JSON object per line, for review.  --apply FILE then makes those
+repairs, skipping any line that has changed in Ellis since the audit.
+"""
+
+import sys
 import json
+import logging
 
+from functools import partial
 from optparse import OptionParser
 
-from tornado.ioloop import IOLoop
 from tornado.httpclient import AsyncHTTPClient
 
-from metaswitch.common import ifcs, utils, logging_config
-from metaswitch.ellis.data import numbers, connection
-from metaswitch.ellis.remote import homestead, xdm
-from metaswitch.ellis import settings
-
-_log = logging.getLogger("ellis.create_numbers")
+from metaswitch.common import utils, logging_config
+from metaswitch.ellis.data import numbers, connection, NotFound
+from metaswitch.ellis.remote import homestead, xdm, upstream
+from metaswitch.ellis.bulk import BulkRunner
+from metaswitch.ellis import settings, ifc_cache
 
-AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient",
-                          max_clients=100)
-connection.init_connection()
-db_session = connection.Session()
+_log = logging.getLogger("ellis.sync_databases")
 
-pending_requests = 0
-inconsistent_uris = set()
-stats = {"Assigned numbers in Ellis": 0,
-         "Unassigned numbers in Ellis": 0,
-         "Credentials & associations deleted": 0,
-         "Simservs & iFCs deleted": 0,
-         "Missing IFCs re-created": 0,
-         "Errors": 0}
+# The repairs that a line may need, as recorded in a diff
+DELETE_LINE = "delete_line"
+DELETE_REMOTE = "delete_remote"
+PUT_DEFAULT_IFC = "put_default_ifc"
 
-def create_get_handler(sip_uri, on_found=None, on_not_found=None):
+class LineSyncer(object):
     """
-    Handler that asserts that a resource exists, executing the on_not_found handler if not
-    """
-    def handle_get(response):
-        global pending_requests
-        url = response.request.url
-        if not response.error:
-            print "Successful GET from %s" % url
-            if on_found:
-                data = json.loads(response.body)
-                on_found(sip_uri, **data)
-        elif response.code == 404:
-            print "404 for %s" % url
-            if on_not_found:
-                on_not_found()
-        else:
-            print "Error %s while GET %s" % (response.error, url)
-            stats["Errors"] += 1
-        pending_requests -= 1
-        if pending_requests == 0:
-            on_complete()
-    return handle_get
-
-def logging_handler(response):
-    """
-    Handler for requests where we only want to log out the result
-    """
-    global pending_requests
-    url = response.request.url
-    method = response.request.method
-    if not response.error:
-        print "Successful %s from %s" % (method, url)
-    else:
-        print "Error %s while %s %s" % (response.error, method, url)
-        stats["Errors"] += 1
-    pending_requests -= 1
-    if pending_requests == 0:
-        on_complete()
+    Checks numbers against Homestead and Homer, and repairs them, as jobs for
+    a BulkRunner.
 
-def validate_line(sip_uri):
-    """
-    Validate details about line in homestead
-    """
-    print "Validating %s " % sip_uri
-    # Verify the private id exists for this line exists in homestead, delete the line otherwise
-    global pending_requests
-    pending_requests += 1
-    delete_line = number_deleter(None, sip_uri)
-    homestead.get_associated_privates(sip_uri,
-                                      create_get_handler(sip_uri,
-                                                         on_found=ensure_digest_exists,
-                                                         on_not_found=delete_line))
-
-def invalidate_line(sip_uri):
+    check works out what (if anything) is wrong with a line, as a diff entry,
+    and repair puts right what a diff entry describes, so that a diff can be
+    reviewed before it is applied.  sync does both at once.
     """
-    Try to get private id and then delete all details from Homestead
-    """
-    print "Invalidating %s " % sip_uri
-    # Verify the private id exists for this line exists in homestead, delete the line otherwise
-    global pending_requests
-    pending_requests += 1
-    delete_line = number_deleter(None, sip_uri)
-
-    def extract_private_and_delete(sip_uri, **kwargs):
-        private_id = kwargs["private_ids"][0]
-        delete_line_with_private = number_deleter(private_id, sip_uri)
-        delete_line_with_private()
-
-    homestead.get_associated_privates(sip_uri,
-                                      create_get_handler(sip_uri,
-                                                         on_found=extract_private_and_delete,
-                                                         on_not_found=delete_line))
-
-def number_deleter(private_id, sip_uri):
-    def delete_line():
+
+    def __init__(self, db_session):
+        self._db_session = db_session
+        self.stats = {"Assigned numbers in Ellis": 0,
+                      "Unassigned numbers in Ellis": 0,
+                      "Inconsistent lines": 0,
+                      "Stale diff entries skipped": 0,
+                      "Credentials & associations deleted": 0,
+                      "Simservs & iFCs deleted": 0,
+                      "Missing IFCs re-created": 0,
+                      "Errors": 0}
+
+    def sync(self, item, callback):
+        """Checks a line, as yielded by numbers.iter_numbers, and repairs it
+        if need be."""
+        def on_checked(success, entry):
+            if success and entry:
+                self.repair(entry, callback)
+            else:
+                self._on_done(item[0], item[2], callback, success)
+        self.check(item, on_checked)
+
+    def apply(self, entry, callback):
+        """Repairs a line as described by an entry from a diff, provided that
+        it hasn't changed in Ellis since the diff was made."""
+        try:
+            current = str(numbers.get_last_modified(self._db_session, entry["number"]))
+        except NotFound:
+            current = None
+        if current != entry["last_modified"]:
+            print "Skipping %s - it has changed since the diff was made" % entry["number"]
+            self.stats["Stale diff entries skipped"] += 1
+            callback(True)
+            return
+        self.repair(entry, callback)
+
+    def check(self, item, callback):
         """
-        Remove details about line from ellis, homestead and homer
+        Works out what needs doing to a line, as yielded by
+        numbers.iter_numbers, passing callback True and the diff entry (or
+        None if the line is consistent), or False if it couldn't be checked.
         """
-        print "Deleting %s %s" % (private_id, sip_uri)
-        numbers.remove_owner(db_session, sip_uri)
-        # Attempt to delete info about line from remotes
-        global pending_requests
-        if private_id:
-            stats["Credentials & associations deleted"] += 1
-            pending_requests += 2
-            homestead.delete_password(private_id, logging_handler)
-            homestead.delete_associated_public(private_id, sip_uri, logging_handler)
-        stats["Simservs & iFCs deleted"] += 1
-        pending_requests += 2
-        homestead.delete_filter_criteria(sip_uri, logging_handler)
-        xdm.delete_simservs(sip_uri, logging_handler)
-
-    return delete_line
-
-def ensure_digest_exists(sip_uri, **kwargs):
-    private_id = kwargs["private_ids"][0]
-    print "Verifying digest exists for %s" % private_id
-    global pending_requests
-    pending_requests+=1
-    delete_line = number_deleter(private_id, sip_uri)
-    homestead.get_digest(private_id,
-                         create_get_handler(sip_uri,
-                                            on_found=ensure_valid_ifc,
-                                            on_not_found=delete_line))
-
-def ensure_valid_ifc(sip_uri, **kwargs):
-    """
-    Check if a line has valid IFC, populate with default if not
-    """
-    print "Verifying IFC for %s" % sip_uri
-    global pending_requests
-    pending_requests+=1
-    def put_default_ifc():
+        sip_uri, assigned, last_modified = item
+        fail = partial(callback, False, None)
+
+        def needs(action, reason, private_id=None):
+            self.stats["Inconsistent lines"] += 1
+            callback(True, {"number": sip_uri,
+                            "assigned": assigned,
+                            "last_modified": str(last_modified),
+                            "action": action,
+                            "private_id": private_id,
+                            "reason": reason})
+
+        def on_got_privates(response):
+            try:
+                private_id = json.loads(response.body)["private_ids"][0]
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                _log.error("Unexpected response to GET of private IDs for %s: %r (%s)",
+                           sip_uri, response.body, e)
+                fail()
+                return
+            if not assigned:
+                needs(DELETE_REMOTE, "Unassigned number has a private ID in Homestead", private_id)
+                return
+            homestead.get_digest(private_id,
+                                 self._get_handler(sip_uri,
+                                                   fail,
+                                                   lambda response: check_ifc(),
+                                                   partial(needs, DELETE_LINE, "No digest in Homestead", private_id)))
+
+        def check_ifc():
+            homestead.get_filter_criteria(sip_uri,
+                                          self._get_handler(sip_uri,
+                                                            fail,
+                                                            lambda response: callback(True, None),
+                                                            partial(needs, PUT_DEFAULT_IFC, "No iFC in Homestead")))
+
+        if assigned:
+            self.stats["Assigned numbers in Ellis"] += 1
+            print "Validating %s" % sip_uri
+            on_not_found = partial(needs, DELETE_LINE, "No private ID in Homestead")
+        else:
+            self.stats["Unassigned numbers in Ellis"] += 1
+            print "Invalidating %s" % sip_uri
+            on_not_found = lambda: xdm.get_simservs(sip_uri,
+                                                    self._get_handler(sip_uri,
+                                                                      fail,
+                                                                      lambda response: needs(DELETE_REMOTE, "Unassigned number has simservs in Homer"),
+                                                                      lambda: callback(True, None)))
+        homestead.get_associated_privates(sip_uri,
+                                          self._get_handler(sip_uri,
+                                                            fail,
+                                                            on_got_privates,
+                                                            on_not_found))
+
+    def repair(self, entry, callback):
+        """Carries out the repair described by a diff entry, then marks the
+        line as verified."""
+        sip_uri = entry["number"]
+        on_done = partial(self._on_done, sip_uri, entry["last_modified"], callback)
+        if entry["action"] == DELETE_LINE:
+            self._delete_line(sip_uri, entry["private_id"], on_done)
+        elif entry["action"] == DELETE_REMOTE:
+            self._delete_remote(sip_uri, entry["private_id"], on_done)
+        elif entry["action"] == PUT_DEFAULT_IFC:
+            self._put_default_ifc(sip_uri, on_done)
+        else:
+            print "Unknown action %s for %s" % (entry["action"], sip_uri)
+            self.stats["Errors"] += 1
+            callback(False)
+
+    def _on_done(self, sip_uri, last_modified, callback, success):
+        if success:
+            numbers.mark_verified(self._db_session, sip_uri, last_modified)
+            self._db_session.commit()
+        callback(success)
+
+    def _get_handler(self, sip_uri, fail, on_found, on_not_found):
+        """Returns a callback for a GET that calls on_found with the response
+        if it succeeded, on_not_found if there was nothing to get, or
+        otherwise fail."""
+        def handle_get(response):
+            if response.code == 200:
+                on_found(response)
+            elif response.code == 404:
+                on_not_found()
+            else:
+                self._error("GET", sip_uri, response)
+                fail()
+        return handle_get
+
+    def _error(self, method, sip_uri, response):
+        print "Error %s while %s for %s" % (response.code, method, sip_uri)
+        self.stats["Errors"] += 1
+
+    def _put_default_ifc(self, sip_uri, callback):
         print "Adding default IFC for %s" % sip_uri
-        stats["Missing IFCs re-created"] += 1
-        global pending_requests
-        pending_requests+=1
+        self.stats["Missing IFCs re-created"] += 1
+
+        def on_put(response):
+            if response.code >= 300:
+                self._error("PUT", sip_uri, response)
+            callback(response.code < 300)
+
         homestead.put_filter_criteria(sip_uri,
-                                      ifcs.generate_ifcs(utils.sip_uri_to_domain(sip_uri)),
-                                      logging_handler)
-    homestead.get_filter_criteria(sip_uri,
-                                  create_get_handler(sip_uri, on_not_found=put_default_ifc))
-def check_existing_uris():
-    """
-    Get list of numbers that ellis thinks exist and:
-    - Verify the digest exists in homestead, deleting the line if not.
-    - If the digest exists, but the IFC does not, put in the default IFC
-    """
-    cursor = db_session.execute("SELECT number FROM numbers WHERE owner_id IS NOT NULL")
-    assigned_numbers = [row[0] for row in cursor.fetchall()]
-    stats["Assigned numbers in Ellis"] = len(assigned_numbers)
-    for sip_uri in assigned_numbers:
-        validate_line(sip_uri)
+                                      ifc_cache.default_ifcs(utils.sip_uri_to_domain(sip_uri)),
+                                      on_put)
 
-def remove_nonexisting_uris():
-    """
-    Get list of numbers that ellis thinks do not exist and
-    remove any record of them from homestead and homer
-    """
-    cursor = db_session.execute("SELECT number FROM numbers WHERE owner_id IS NULL")
-    unassigned_numbers = [row[0] for row in cursor.fetchall()]
-    stats["Unassigned numbers in Ellis"] = len(unassigned_numbers)
-    for sip_uri in unassigned_numbers:
-        invalidate_line(sip_uri)
+    def _delete_line(self, sip_uri, private_id, callback):
+        """Removes the line from Ellis, then from Homestead and Homer"""
+        print "Deleting %s %s" % (private_id, sip_uri)
+        numbers.remove_owner(self._db_session, sip_uri)
+        self._db_session.commit()
+        self.stats["Simservs & iFCs deleted"] += 1
+        self._delete_remote(sip_uri, private_id, callback)
 
-def on_complete():
-    """
-    Called when all request have completed
-    """
-    IOLoop.instance().stop()
-    db_session.commit()
-    # To avoid counting the lines deleted as part of the unassigned, subtract these
-    # from the line delete count
-    stats["Simservs & iFCs deleted"] -= stats["Unassigned numbers in Ellis"]
+    def _delete_remote(self, sip_uri, private_id, callback):
+        """
+        Removes the line from Homestead (if it has a private ID there) and
+        Homer.  As when deleting a line through the API, the private ID is
+        only deleted along with its last public ID.
+        """
+        state = {"outstanding": 2 if private_id else 1, "success": True}
+
+        def on_deleted(method, response):
+            if response.code >= 300 and response.code != 404:
+                self._error(method, sip_uri, response)
+                state["success"] = False
+            state["outstanding"] -= 1
+            if state["outstanding"] == 0:
+                callback(state["success"])
+
+        def on_got_publics(response):
+            if response.code != 200:
+                on_deleted("GET", response)
+                return
+            public_ids = json.loads(response.body)["associated_public_ids"]
+            if public_ids == [sip_uri]:
+                homestead.delete_private_id(private_id, partial(on_deleted, "DELETE"))
+            else:
+                homestead.delete_public_id(sip_uri, partial(on_deleted, "DELETE"))
+
+        if private_id:
+            self.stats["Credentials & associations deleted"] += 1
+            homestead.get_associated_publics(private_id, on_got_publics)
+        xdm.delete_simservs(sip_uri, partial(on_deleted, "DELETE"))
+
+class DiffWriter(object):
+    """Writes the diff entries for lines as they're checked, one JSON object
+    per line, as the job for a BulkRunner in audit mode."""
+
+    def __init__(self, syncer, f):
+        self._syncer = syncer
+        self._f = f
+
+    def __call__(self, item, callback):
+        self._syncer.check(item, partial(self._on_checked, callback))
+
+    def _on_checked(self, callback, success, entry):
+        if entry:
+            self._f.write(json.dumps(entry, sort_keys=True) + "\n")
+        callback(success)
+
+def read_diff(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+def print_summary(stats):
     print "\nSummary:"
     table_format = "{:<40}{}"
-    for s in stats:
+    for s in sorted(stats):
         print table_format.format(s, stats[s])
 
-def standalone():
+def standalone(window, checkpoint_file=None, stats_file=None, keep_going=False, max_age_secs=None,
+               audit_file=None, apply_file=None):
     """
-    Entry point to script
+    Entry point to script.  If audit_file is given, the diff is written to
+    it rather than applied; if apply_file is given, the diff in it is
+    applied rather than the lines being checked.
     """
-    check_existing_uris()
-    remove_nonexisting_uris()
-    IOLoop.instance().start()
+    AsyncHTTPClient.configure(settings.UPSTREAM_HTTP_CLIENT)
+    # As for repop, the window bounds the load on the backends, so don't turn
+    # requests away as Ellis does when serving users.
+    settings.UPSTREAM_BREAKER_WINDOW = 0
+    settings.UPSTREAM_MAX_PENDING = 0
+    upstream.set_max_in_flight(window)
+    connection.init_connection()
+    # The numbers are streamed over their own connection, which is busy
+    # until they've all been read.
+    stream_session = connection.Session()
+    db_session = connection.Session()
+
+    syncer = LineSyncer(db_session)
+    lines = lambda checkpoint: numbers.iter_numbers(stream_session,
+                                                    after=checkpoint,
+                                                    max_age_secs=max_age_secs)
+    run = partial(BulkRunner,
+                  window=window,
+                  checkpoint_file=checkpoint_file,
+                  keep_going=keep_going)
+    if audit_file:
+        # Append when resuming, so as not to lose the diff so far
+        with open(audit_file, "a" if checkpoint_file else "w") as f:
+            runner = run(lines, DiffWriter(syncer, f), verb="Audited", item_id=lambda item: item[0])
+            success = runner.run()
+    elif apply_file:
+        with open(apply_file) as f:
+            runner = run(read_diff(f), syncer.apply, verb="Applied", item_id=lambda entry: entry["number"])
+            success = runner.run()
+    else:
+        runner = run(lines, syncer.sync, verb="Synced", item_id=lambda item: item[0])
+        success = runner.run()
+    stream_session.close()
+    db_session.commit()
+
+    print_summary(syncer.stats)
+    if stats_file:
+        with open(stats_file, "w") as f:
+            json.dump(syncer.stats, f, indent=2, sort_keys=True)
+    return success
 
 if __name__ == '__main__':
     parser = OptionParser()
@@ -213,9 +333,45 @@ if __name__ == '__main__':
                       dest="log_level",
                       default=2,
                       type="int")
+    parser.add_option("--window",
+                      dest="window",
+                      default=20,
+                      type="int",
+                      help="number of lines to check at once (default: 20)")
+    parser.add_option("--checkpoint",
+                      dest="checkpoint_file",
+                      metavar="FILE",
+                      help="file recording progress, to resume from if it exists")
+    parser.add_option("--stats-file",
+                      dest="stats_file",
+                      metavar="FILE",
+                      help="file to write the summary to, as JSON")
+    parser.add_option("--incremental",
+                      dest="incremental",
+                      action="store_true",
+                      default=False,
+                      help="only check lines changed since they were last verified, or not verified for --max-age days")
+    parser.add_option("--max-age",
+                      dest="max_age_days",
+                      default=7,
+                      type="float",
+                      help="with --incremental, re-check lines not verified for this many days (default: 7)")
+    parser.add_option("--audit",
+                      dest="audit_file",
+                      metavar="FILE",
+                      help="don't change anything, but write what needs repairing to FILE, for --apply")
+    parser.add_option("--apply",
+                      dest="apply_file",
+                      metavar="FILE",
+                      help="repair the lines listed in FILE by --audit, rather than checking every line")
+    parser.add_option("-k", "--keep-going",
+                      dest="keep_going",
+                      action="store_true",
+                      default=False,
+                      help="keep going when a line can't be checked")
     (options, args) = parser.parse_args()
 
-    if args:
+    if args or (options.audit_file and options.apply_file):
         parser.print_help()
     else:
         logging_config.configure_logging(
@@ -224,4 +380,11 @@ if __name__ == '__main__':
                 settings.LOG_FILE_PREFIX,
                 "sync_databases")
 
-        standalone()
+        success = standalone(options.window,
+                             checkpoint_file=options.checkpoint_file,
+                             stats_file=options.stats_file,
+                             keep_going=options.keep_going,
+                             max_age_secs=int(options.max_age_days * 86400) if options.incremental else None,
+                             audit_file=options.audit_file,
+                             apply_file=options.apply_file)
+        sys.exit(0 if success else 1)